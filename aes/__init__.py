@@ -1,3 +1,19 @@
-from aes.aes_encrypt import state_from_bytes, sub_bytes
+"""
+Implementare AES (FIPS 197). Modulele se importa la cerere: `from aes import sub_bytes`
+incarca aes.aes_encrypt abia la primul acces, nu la importul pachetului.
+"""
 
-from aes.aes_constants import s_box, Rcon
\ No newline at end of file
+_LAZY = {
+    'state_from_bytes': 'aes.aes_commons',
+    'sub_bytes': 'aes.aes_encrypt',
+    's_box': 'aes.aes_constants',
+    'Rcon': 'aes.aes_constants',
+}
+
+
+def __getattr__(name):
+    module = _LAZY.get(name)
+    if module is None:
+        raise AttributeError(f"module 'aes' has no attribute {name!r}")
+    import importlib
+    return getattr(importlib.import_module(module), name)
@@ -0,0 +1,167 @@
+"""
+Generator de cod pentru criptarea/decriptarea unui bloc AES, specializat pe numarul de runde.
+
+Implementarea de referinta (aes_encrypt_block, aes_decrypt_block) lucreaza pe o matrice 4x4
+si apeleaza la fiecare runda functii generice (sub_bytes, shift_rows, mix_columns, xor_b).
+Aici se genereaza sursa Python fara bucle: starea sta in 16 variabile locale (s0..s15, cu
+s[4*c + r] = state[r][c], aceeasi ordine ca octetii blocului), fiecare runda este scrisa
+explicit, iar SubBytes + ShiftRows + MixColumns devin cate patru citiri din tabele
+precalculate (S, 2*S, 3*S) combinate cu xor. Cheile de runda sunt o lista plata de octeti,
+in aceeasi ordine (16 octeti pe runda).
+
+Compilarea sursei generate dureaza zeci de milisecunde, prea mult pentru fiecare pornire a
+unui client. De aceea sursa, impreuna cu tabelele, se scrie o singura data in
+aes/_aes_generated.py, iar importurile urmatoare il incarca direct din bytecode-ul din
+__pycache__. Fisierul poarta in prima linie un hash al acestui modul si al modulelor din care
+vin tabelele (aes_constants, aes_commons) si este regenerat cand oricare se schimba; daca
+fisierul nu poate fi scris (instalare read-only), sursa se compileaza in memorie.
+`python -m aes.aes_codegen <fisier>` scrie sursa intr-un fisier, pentru inspectie.
+"""
+
+import hashlib
+import importlib
+import os
+import sys
+
+from aes import aes_commons, aes_constants
+from aes.aes_commons import mul_gf8
+from aes.aes_constants import s_box, inv_s_box, mul_mat_crypt, mul_mat_decrypt
+
+ROUNDS = (10, 12, 14)
+GENERATED_MODULE = 'aes._aes_generated'
+GENERATED_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '_aes_generated.py')
+# modulele din care se genereaza codul: o schimbare in oricare invalideaza cache-ul
+HASHED_SOURCES = (__file__, aes_constants.__file__, aes_commons.__file__)
+
+
+def tables():
+    """
+    Tabelele folosite de codul generat: valoarea din S-box (E) sau din S-box-ul invers (D)
+    inmultita in GF(2^8) cu coeficientul din MixColumns.
+    """
+    result = {f"E{m}": tuple(mul_gf8(s_box[x], m) for x in range(256)) for m in (1, 2, 3)}
+    result.update({f"D{m}": tuple(mul_gf8(inv_s_box[x], m) for x in range(256)) for m in (1, 9, 11, 13, 14)})
+    return result
+
+
+def _round(lines, src, dst, rk_offset, shift, mul_mat, prefix):
+    """O runda completa: fiecare octet nou este xor-ul a patru citiri din tabele si al cheii."""
+    for c in range(4):
+        # coloana c dupa (Inv)ShiftRows: randul r vine din coloana (c + shift * r) mod 4
+        column = [f"{src}{4 * ((c + shift * r) % 4) + r}" for r in range(4)]
+        for r in range(4):
+            terms = [f"{prefix}{mul_mat[r][j]}[{column[j]}]" for j in range(4)]
+            lines.append(f"    {dst}{4 * c + r} = {' ^ '.join(terms)} ^ rk[{rk_offset + 4 * c + r}]")
+
+
+def _last_round(lines, src, dst, rk_offset, shift, sbox):
+    for c in range(4):
+        for r in range(4):
+            lines.append(f"    {dst}{4 * c + r} = {sbox}[{src}{4 * ((c + shift * r) % 4) + r}] ^ rk[{rk_offset + 4 * c + r}]")
+
+
+def generate_encrypt_source(nr):
+    """Sursa functiei encrypt_block_<nr>(block, rk) pentru cheile de runda ale criptarii."""
+    lines = [f"def encrypt_block_{nr}(block, rk, E1=E1, E2=E2, E3=E3):"]
+    lines.append("    " + ", ".join(f"s{i}" for i in range(16)) + " = block")
+    for i in range(16):
+        lines.append(f"    s{i} ^= rk[{i}]")
+    src, dst = "s", "t"
+    for round in range(1, nr):
+        _round(lines, src, dst, 16 * round, 1, mul_mat_crypt, "E")
+        src, dst = dst, src
+    _last_round(lines, src, dst, 16 * nr, 1, "E1")
+    lines.append("    return bytes((" + ", ".join(f"{dst}{i}" for i in range(16)) + "))")
+    return "\n".join(lines) + "\n"
+
+
+def generate_decrypt_source(nr):
+    """
+    Sursa functiei decrypt_block_<nr>(block, rk): cifrul invers echivalent (FIPS 197, 5.3.5),
+    cu cheile de runda din key_expansion_eic (rundele din mijloc trecute prin InvMixColumns).
+    """
+    lines = [f"def decrypt_block_{nr}(block, rk, D1=D1, D9=D9, D11=D11, D13=D13, D14=D14):"]
+    lines.append("    " + ", ".join(f"s{i}" for i in range(16)) + " = block")
+    for i in range(16):
+        lines.append(f"    s{i} ^= rk[{16 * nr + i}]")
+    src, dst = "s", "t"
+    for round in range(nr - 1, 0, -1):
+        _round(lines, src, dst, 16 * round, -1, mul_mat_decrypt, "D")
+        src, dst = dst, src
+    _last_round(lines, src, dst, 0, -1, "D1")
+    lines.append("    return bytes((" + ", ".join(f"{dst}{i}" for i in range(16)) + "))")
+    return "\n".join(lines) + "\n"
+
+
+def generate_source():
+    """Sursa completa (fara tabele) pentru toate dimensiunile de cheie."""
+    return "\n\n".join([generate_encrypt_source(nr) for nr in ROUNDS] + [generate_decrypt_source(nr) for nr in ROUNDS])
+
+
+def generator_hash():
+    digest = hashlib.sha256()
+    for path in HASHED_SOURCES:
+        with open(os.path.abspath(path), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def generate_module_source(version):
+    """Modulul complet pentru cache: tabelele ca literali si functiile generate."""
+    lines = [f"# generat de aes/aes_codegen.py ({version}), nu se editeaza", ""]
+    lines += [f"{name} = {table!r}" for name, table in tables().items()]
+    return "\n".join(lines) + "\n\n\n" + generate_source()
+
+
+def load_generated_module():
+    """
+    Modulul generat din cache, scris (sau rescris) daca lipseste sau este vechi.
+    None daca nu este la zi si nu poate fi scris.
+    """
+    version = generator_hash()
+    header = f"# generat de aes/aes_codegen.py ({version})"
+    try:
+        with open(GENERATED_PATH) as f:
+            current = f.readline().startswith(header)
+    except OSError:
+        current = False
+    if not current:
+        tmp = f"{GENERATED_PATH}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, 'w') as f:
+                f.write(generate_module_source(version))
+            os.replace(tmp, GENERATED_PATH)
+        except OSError:
+            try:
+                os.remove(tmp) # scris pe jumatate (disc plin, ...)
+            except OSError:
+                pass
+            return None
+        importlib.invalidate_caches()
+        sys.modules.pop(GENERATED_MODULE, None) # o versiune veche deja importata nu mai conteaza
+    return importlib.import_module(GENERATED_MODULE)
+
+
+def compile_block_functions():
+    """Functiile generate: (criptare, decriptare), dictionare nr -> functie."""
+    module = load_generated_module()
+    if module is not None:
+        namespace = vars(module)
+    else:
+        namespace = tables() # instalare read-only: compilam in memorie, la fiecare pornire
+        exec(compile(generate_source(), "<aes_codegen>", "exec"), namespace)
+    return ({nr: namespace[f"encrypt_block_{nr}"] for nr in ROUNDS},
+            {nr: namespace[f"decrypt_block_{nr}"] for nr in ROUNDS})
+
+
+ENCRYPT_BLOCK, DECRYPT_BLOCK = compile_block_functions()
+
+
+def flatten_key_schedule(key_schedule):
+    """Cheile de runda (lista de cuvinte de 4 octeti) ca lista plata de octeti."""
+    return [byte for word in key_schedule for byte in word]
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1], "w") if len(sys.argv) > 1 else sys.stdout as out:
+        out.write(generate_source())
@@ -0,0 +1,43 @@
+"""
+Modul de operare CTR (counter), NIST SP 800-38A, sectiunea 6.5.
+https://nvlpubs.nist.gov/nistpubs/Legacy/SP/nistspecialpublication800-38a.pdf
+
+Blocul de counter are 16 bytes: nonce (8 bytes) || counter (8 bytes, big endian).
+Keystream-ul se obtine criptand blocurile de counter si se face xor cu datele, deci
+criptarea si decriptarea sunt aceeasi operatie si datele nu trebuie completate (padding).
+Orice bloc se poate calcula independent, ceea ce permite reluarea unui transfer de la
+orice offset multiplu de 16 bytes.
+
+Aceeasi pereche (cheie, nonce) nu trebuie folosita de doua ori pentru aceleasi valori ale counterului.
+"""
+from aes.aes_commons import get_nr
+from aes.aes_encrypt import key_expansion
+from aes.aes_codegen import ENCRYPT_BLOCK, flatten_key_schedule
+
+BLOCK_SIZE = 16
+NONCE_SIZE = 8
+
+
+def aes_ctr_keystream(round_keys, nr, nonce: bytes, counter: int, blocks: int) -> bytes:
+    """Keystream pentru `blocks` blocuri, incepand cu valoarea `counter` (round_keys: lista plata de octeti)."""
+    assert len(nonce) == NONCE_SIZE, "Nonce-ul trebuie sa aiba exact 8 bytes"
+    encrypt_block = ENCRYPT_BLOCK[nr]
+    return b''.join(
+        encrypt_block(nonce + (counter + i).to_bytes(8, 'big'), round_keys)
+        for i in range(blocks)
+    )
+
+
+def aes_ctr(data: bytes, key: bytes, nonce: bytes, counter: int = 0) -> bytes:
+    """
+    Cripteaza (sau decripteaza) data in modul CTR.
+    `counter` este indexul primului bloc, adica offsetul in bytes / 16.
+    """
+    if not data:
+        return b''
+    round_keys = flatten_key_schedule(key_expansion(key))
+    nr = get_nr(len(key) * 8)
+    blocks = (len(data) + BLOCK_SIZE - 1) // BLOCK_SIZE
+    keystream = aes_ctr_keystream(round_keys, nr, nonce, counter, blocks)[:len(data)]
+    # xor pe intregul buffer deodata, ca numere intregi
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(keystream, 'big')).to_bytes(len(data), 'big')
@@ -1,7 +1,7 @@
-from aes import state_from_bytes
 from aes.aes_constants import inv_s_box, mul_mat_decrypt
 from aes.aes_commons import get_nr, xor_b, sub_word, rot_word, rcon, mix_columns, split_key_to_words, add_round_key, \
-    round_key_matrix, bytes_from_state
+    round_key_matrix, bytes_from_state, state_from_bytes
+from aes.aes_codegen import DECRYPT_BLOCK, flatten_key_schedule
 
 
 def inv_shift_rows(state):
@@ -69,17 +69,22 @@ def key_expansion_eic(key):
 
 def aes_decryption(input: bytes, key: bytes):
     """
-    Criptare AES.
+    Decriptare AES, cu functia generata pentru numarul de runde al cheii (aes_codegen).
 
     Pseudocod preluat:
     https://nvlpubs.nist.gov/nistpubs/FIPS/NIST.FIPS.197-upd1.pdf
     Pagina 12 (20 of 46)
     """
-    state = state_from_bytes(input)
-    key_schedule = key_expansion_eic(key)
+    assert len(input) == 16, "Inputul trebuie sa aiba exact 16 bytes"
+    nr = get_nr(len(key) * 8)
+    return DECRYPT_BLOCK[nr](input, flatten_key_schedule(key_expansion_eic(key)))
 
-    key_length = len(key) * 8
-    nr = get_nr(key_length)
+
+def aes_decrypt_block(input: bytes, key_schedule, nr):
+    """
+    Decriptarea unui bloc cu cheile de runda din key_expansion_eic (implementarea de referinta).
+    """
+    state = state_from_bytes(input)
 
     state = add_round_key(state, round_key_matrix(key_schedule[4 * nr : 4 * (nr + 1)]))
 
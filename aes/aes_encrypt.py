@@ -7,6 +7,7 @@ from aes.aes_commons import (get_nr, xor_b, rot_word, rcon,
                              split_key_to_words, bytes_from_state,
                              mix_columns, round_key_matrix, sub_word)
 from aes.aes_constants import s_box, mul_mat_crypt
+from aes.aes_codegen import ENCRYPT_BLOCK, flatten_key_schedule
 
 
 def key_expansion(key):
@@ -82,12 +83,20 @@ def aes_encryption(input: bytes, key: bytes):
     Pseudocod preluat:
     https://nvlpubs.nist.gov/nistpubs/FIPS/NIST.FIPS.197-upd1.pdf
     Pagina 12 (20 of 46)
+
+    Foloseste functia generata pentru numarul de runde al cheii (aes_codegen);
+    aes_encrypt_block este implementarea de referinta, pas cu pas.
     """
-    state = state_from_bytes(input)
-    key_schedule = key_expansion(key)
+    assert len(input) == 16, "Inputul trebuie sa aiba exact 16 bytes"
+    nr = get_nr(len(key) * 8)
+    return ENCRYPT_BLOCK[nr](input, flatten_key_schedule(key_expansion(key)))
 
-    key_length = len(key) * 8
-    nr = get_nr(key_length)
+
+def aes_encrypt_block(input: bytes, key_schedule, nr):
+    """
+    Criptarea unui bloc cu cheile de runda deja generate (implementarea de referinta).
+    """
+    state = state_from_bytes(input)
 
     state = add_round_key(state, round_key_matrix(key_schedule[0:4]))
 
@@ -0,0 +1,36 @@
+"""
+Cheie AES cu cheile de runda generate o singura data.
+
+aes_encryption si aes_decryption extind cheia la fiecare bloc; key_expansion in Python pur
+costa cat cateva blocuri criptate. O sesiune care cripteaza multe mesaje cu aceeasi cheie
+pastreaza un AESKey. Cheile de runda pentru decriptare (key_expansion_eic) se genereaza abia
+la prima decriptare, o sesiune care doar cripteaza nu plateste memorie pentru ele.
+"""
+from aes.aes_commons import get_nr
+from aes.aes_encrypt import key_expansion
+from aes.aes_decrypt import key_expansion_eic
+from aes.aes_codegen import ENCRYPT_BLOCK, DECRYPT_BLOCK, flatten_key_schedule
+
+
+class AESKey:
+    __slots__ = ('key', 'nr', '_encrypt_keys', '_decrypt_keys')
+
+    def __init__(self, key: bytes):
+        self.key = key
+        self.nr = get_nr(len(key) * 8)
+        self._encrypt_keys = None
+        self._decrypt_keys = None
+
+    def encrypt(self, block: bytes) -> bytes:
+        """Acelasi rezultat ca aes_encryption(block, self.key)."""
+        assert len(block) == 16, "Inputul trebuie sa aiba exact 16 bytes"
+        if self._encrypt_keys is None:
+            self._encrypt_keys = flatten_key_schedule(key_expansion(self.key))
+        return ENCRYPT_BLOCK[self.nr](block, self._encrypt_keys)
+
+    def decrypt(self, block: bytes) -> bytes:
+        """Acelasi rezultat ca aes_decryption(block, self.key)."""
+        assert len(block) == 16, "Inputul trebuie sa aiba exact 16 bytes"
+        if self._decrypt_keys is None:
+            self._decrypt_keys = flatten_key_schedule(key_expansion_eic(self.key))
+        return DECRYPT_BLOCK[self.nr](block, self._decrypt_keys)
@@ -0,0 +1,74 @@
+"""
+Runs the benchmark suites and prints the results as JSON.
+
+    python -m benchmarks                         # every suite
+    python -m benchmarks --only aes rsa --quick  # a subset, fewer iterations
+    python -m benchmarks --save baseline.json    # store the results as a baseline
+    python -m benchmarks --baseline baseline.json --tolerance 0.2
+
+With --baseline the exit code is 1 when a metric regressed by more than the tolerance.
+"""
+
+import argparse
+import importlib
+import json
+import platform
+import sys
+import time
+
+from benchmarks.common import compare
+
+SUITES = {
+    "aes": "benchmarks.bench_aes",
+    "rsa": "benchmarks.bench_rsa",
+    "handshake": "benchmarks.bench_handshake",
+    "relay": "benchmarks.bench_relay",
+    "transfer": "benchmarks.bench_transfer",
+    "startup": "benchmarks.bench_startup",
+    "transport": "benchmarks.bench_transport",
+    "outbound": "benchmarks.bench_outbound",
+    "sessions": "benchmarks.bench_sessions",
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("--only", nargs="+", choices=sorted(SUITES), help="suites to run (default: all)")
+    parser.add_argument("--quick", action="store_true", help="fewer iterations, for smoke runs")
+    parser.add_argument("--save", metavar="FILE", help="write the results to FILE")
+    parser.add_argument("--baseline", metavar="FILE", help="compare against a previously saved run")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative slowdown (default 0.15)")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name in args.only or SUITES:
+        suite = importlib.import_module(SUITES[name])
+        results.update(suite.run(quick=args.quick))
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "quick": args.quick,
+        },
+        "results": results,
+    }
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        report["regressions"] = compare(results, baseline["results"], args.tolerance)
+        exit_code = 1 if report["regressions"] else 0
+
+    output = json.dumps(report, indent=2)
+    if args.save:
+        with open(args.save, "w") as f:
+            f.write(output + "\n")
+    print(output)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+"""
+AES benchmarks: single block, bulk (many blocks with the same key) and key expansion, and the
+generated per-key-size block functions against the reference round loop.
+"""
+
+import secrets
+
+from aes.aes_encrypt import aes_encryption, aes_encrypt_block, key_expansion
+from aes.aes_decrypt import aes_decryption, aes_decrypt_block, key_expansion_eic
+from aes.aes_codegen import ENCRYPT_BLOCK, DECRYPT_BLOCK, flatten_key_schedule
+from aes.aes_commons import get_nr
+from benchmarks.common import measure
+
+KEY_SIZES = (128, 192, 256)
+BULK_BLOCKS = 64
+
+
+def run(quick=False):
+    number = 50 if quick else 300
+    bulk_rounds = 2 if quick else 10
+    results = {}
+
+    for key_size in KEY_SIZES:
+        key = secrets.token_bytes(key_size // 8)
+        block = secrets.token_bytes(16)
+        cipher = aes_encryption(block, key)
+        bulk = [secrets.token_bytes(16) for _ in range(BULK_BLOCKS)]
+
+        results[f"aes.encrypt_block.{key_size}"] = measure(lambda: aes_encryption(block, key), number)
+        results[f"aes.decrypt_block.{key_size}"] = measure(lambda: aes_decryption(cipher, key), number)
+        results[f"aes.key_expansion.{key_size}"] = measure(lambda: key_expansion(key), number)
+        results[f"aes.key_expansion_eic.{key_size}"] = measure(lambda: key_expansion_eic(key), number)
+
+        def encrypt_bulk():
+            for b in bulk:
+                aes_encryption(b, key)
+
+        stats = measure(encrypt_bulk, bulk_rounds)
+        stats["mb_per_sec"] = stats["ops_per_sec"] * BULK_BLOCKS * 16 / 1e6
+        results[f"aes.encrypt_bulk.{key_size}"] = stats
+
+        # The block functions alone, with the round keys already expanded
+        nr = get_nr(key_size)
+        schedule, schedule_eic = key_expansion(key), key_expansion_eic(key)
+        round_keys, round_keys_eic = flatten_key_schedule(schedule), flatten_key_schedule(schedule_eic)
+        pairs = (
+            ("encrypt", lambda: aes_encrypt_block(block, schedule, nr), lambda: ENCRYPT_BLOCK[nr](block, round_keys)),
+            ("decrypt", lambda: aes_decrypt_block(cipher, schedule_eic, nr), lambda: DECRYPT_BLOCK[nr](cipher, round_keys_eic)),
+        )
+        for name, reference, generated in pairs:
+            reference_stats = measure(reference, number)
+            generated_stats = measure(generated, number)
+            generated_stats["speedup"] = generated_stats["ops_per_sec"] / reference_stats["ops_per_sec"]
+            results[f"aes.{name}_round_loop.{key_size}"] = reference_stats
+            results[f"aes.{name}_generated.{key_size}"] = generated_stats
+
+    return results
@@ -0,0 +1,155 @@
+"""
+Handshake benchmarks: the current RSA key transport against ephemeral DH in the RFC 7919
+groups, both as pure computation (both sides of one handshake) and over real connections
+to a local SecureServer. Also compares the fixed-base table against pow() for g^x, and
+times the HKDF key schedule: all the keys of one epoch, and one HKDF-Expand from a PRK whose
+HMAC pads are already hashed against one that keys HMAC again.
+
+The storm cases replay what a server restart looks like: many clients connecting at the same
+time. They use bare sockets (key frame out, offer in, no verification) so the client side
+costs next to nothing and the rate is the server's, with and without batched signatures.
+"""
+
+import contextlib
+import os
+import secrets
+import threading
+import time
+
+from crypto.rsa import rsa_generate_keys, rsa_encrypt, rsa_decrypt
+from crypto.dh import GROUPS, GENERATOR, group_table, fixed_base_pow, dh_generate_keys, dh_shared_secret, dh_derive_key
+from topology.server import SecureServer
+from topology.identity import SIGN_BATCH
+from topology.keyschedule import KeySchedule
+from topology.record import CLIENT_TO_SERVER, SERVER_TO_CLIENT
+from crypto.hkdf import HmacSha256, hkdf_extract, hkdf_expand
+from topology.topology import SecureClient
+from benchmarks.common import measure, latency_summary
+from benchmarks.bench_sessions import open_session
+
+QUICK_GROUPS = ('ffdhe2048',)
+
+
+def rsa_handshake():
+    """Client keypair, server encrypts a 16 byte key byte by byte, client decrypts it."""
+    public_key, private_key = rsa_generate_keys(128)
+    aes_key = secrets.token_bytes(16)
+    encrypted = [rsa_encrypt(b, public_key) for b in aes_key]
+    return bytes(rsa_decrypt(c, private_key) for c in encrypted)
+
+
+def epoch_keys(secret):
+    """What a session derives at the handshake and at every rekey."""
+    schedule = KeySchedule(secret)
+    for direction in (CLIENT_TO_SERVER, SERVER_TO_CLIENT):
+        schedule.traffic_key(direction)
+        schedule.mac_key(direction)
+        schedule.nonce(direction)
+    return schedule.next_secret(1)
+
+
+def dh_handshake(group):
+    client_public, client_secret = dh_generate_keys(group)
+    server_public, server_secret = dh_generate_keys(group)
+    server_key = dh_derive_key(group, dh_shared_secret(group, client_public, server_secret), client_public, server_public)
+    client_key = dh_derive_key(group, dh_shared_secret(group, server_public, client_secret), client_public, server_public)
+    return server_key == client_key
+
+
+def connect_rate(key_exchange, count):
+    """Handshakes/sec of count clients connecting one after the other (client construction included)."""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        server = SecureServer('127.0.0.1', 0)
+        threading.Thread(target=server.start, daemon=True).start()
+        server.listening.wait(5)
+        try:
+            start = time.perf_counter()
+            for i in range(count):
+                client = SecureClient(f"hs{i}", port=server.port, server_key=server.identity_fingerprint,
+                                      key_exchange=key_exchange)
+                client.connect()
+                client.close()
+            elapsed = time.perf_counter() - start
+        finally:
+            server.stop()
+    return {"handshakes": count, "handshakes_per_sec": count / elapsed if elapsed else 0.0,
+            "mean_us": elapsed / count * 1e6}
+
+
+def storm_rate(sign_batch, count, concurrency):
+    """Handshakes/sec and connect-to-offer latency of count clients, concurrency connecting at any time."""
+    public_key, _ = rsa_generate_keys(128)
+    names = iter(range(count))
+    names_lock = threading.Lock()
+    latencies = []
+
+    def reconnect_loop(address):
+        while True:
+            with names_lock:
+                i = next(names, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            sock = open_session(address, f"storm{i}", public_key)
+            latencies.append(time.perf_counter() - start)
+            sock.close()
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        server = SecureServer('127.0.0.1', 0, sign_batch=sign_batch, heartbeat_interval=3600)
+        threading.Thread(target=server.start, daemon=True).start()
+        server.listening.wait(5)
+        try:
+            threads = [threading.Thread(target=reconnect_loop, args=(('127.0.0.1', server.port),))
+                       for _ in range(concurrency)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            counters = server.metrics.snapshot()["counters"]
+        finally:
+            server.stop()
+    batches = counters.get("sign_batches_total", 0)
+    return {"handshakes": count, "handshakes_per_sec": count / elapsed if elapsed else 0.0,
+            "mean_batch": counters.get("sign_batched_total", 0) / batches if batches else 1.0,
+            **latency_summary(latencies)}
+
+
+def run(quick=False):
+    groups = QUICK_GROUPS if quick else tuple(GROUPS)
+    number = 10 if quick else 50
+    results = {}
+
+    stats = measure(rsa_handshake, number)
+    stats["handshakes_per_sec"] = stats.pop("ops_per_sec")
+    results["handshake.compute.rsa"] = stats
+
+    for group in groups:
+        group_table(group) # built once per process, not part of a handshake
+        stats = measure(lambda: dh_handshake(group), number)
+        stats["handshakes_per_sec"] = stats.pop("ops_per_sec")
+        results[f"handshake.compute.{group}"] = stats
+
+        p, bits = GROUPS[group]
+        x = secrets.randbits(bits)
+        table = group_table(group)
+        results[f"dh.fixed_base.{group}"] = measure(lambda: fixed_base_pow(table, x, p), number * 4)
+        results[f"dh.pow.{group}"] = measure(lambda: pow(GENERATOR, x, p), number * 4)
+
+    secret = secrets.token_bytes(16)
+    prk = hkdf_extract(b"salt", secret)
+    prk_state = HmacSha256(prk)
+    results["keyschedule.epoch"] = measure(lambda: epoch_keys(secret), number * 20)
+    results["hkdf.expand.16"] = measure(lambda: hkdf_expand(prk, b"p2p traffic key c2s", 16), number * 100)
+    results["hkdf.expand.16.cached_pads"] = measure(lambda: hkdf_expand(prk_state, b"p2p traffic key c2s", 16), number * 100)
+
+    connects = 10 if quick else 50
+    results["handshake.connect.rsa"] = connect_rate('rsa', connects)
+    for group in groups:
+        results[f"handshake.connect.{group}"] = connect_rate(group, connects)
+
+    storm, concurrency = (64, 32) if quick else (512, 128)
+    results["handshake.storm.unbatched"] = storm_rate(1, storm, concurrency)
+    results["handshake.storm.batched"] = storm_rate(SIGN_BATCH, storm, concurrency)
+    return results
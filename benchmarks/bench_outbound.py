@@ -0,0 +1,147 @@
+"""
+Outbound scheduling: control frame latency on a connection saturated with bulk data.
+
+Two senders keep BULK_WINDOW each queued on one OutboundQueue with 32 KB data frames while
+the reader drains the TCP connection at a fixed rate, like a client on a slow link. A 64 byte
+control frame (a heartbeat or rekey notice) is queued every few milliseconds and timed until
+the reader has it. fifo is the queue without priorities (every frame waits for the bytes
+queued before it), priority the two-class queue with fragmentation.
+
+Socket buffers are kept small, and TCP_NOTSENT_LOWAT set where the platform has it, so the
+kernel does not hold a second, unscheduled queue behind ours.
+"""
+
+import socket
+import threading
+import time
+
+from topology import transport
+from topology.flow import OutboundQueue, FrameAssembler, CONTROL, LENGTH_MASK
+from benchmarks.common import latency_summary
+
+READ_RATE = 8 * 1024 * 1024 # bytes per second the paced reader drains
+BULK_FRAME = 32 * 1024
+BULK_WINDOW = 384 * 1024 # bytes each sender keeps in flight, below the queue's high watermark
+CONTROL_INTERVAL = 0.005
+SOCKET_BUFFER = 32 * 1024
+NOTSENT_LOWAT = 16 * 1024
+
+
+def frame(body):
+    return len(body).to_bytes(4, 'big') + body
+
+
+def connected_pair():
+    listener = transport.listen("tcp://127.0.0.1:0")
+    accepted = []
+    acceptor = threading.Thread(target=lambda: accepted.append(listener.accept()[0]))
+    acceptor.start()
+    reader = transport.connect(listener.url)
+    acceptor.join()
+    listener.close()
+    writer = accepted[0]
+    for sock in (reader, writer):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    reader.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+    writer.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+    if hasattr(socket, "TCP_NOTSENT_LOWAT"):
+        writer.setsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, NOTSENT_LOWAT)
+    return writer, reader
+
+
+def paced_reader(sock, sent_at, latencies, data_bytes, stop):
+    """Reads at READ_RATE, timing every control frame (body b"c" + id) against its enqueue time."""
+    assembler = FrameAssembler()
+    buffer = bytearray()
+    started = time.perf_counter()
+    received = 0
+    while not stop.is_set():
+        try:
+            chunk = sock.recv(16 * 1024)
+        except OSError:
+            return
+        if not chunk:
+            return
+        received += len(chunk)
+        buffer += chunk
+        while len(buffer) >= 4:
+            prefix = int.from_bytes(buffer[:4], 'big')
+            size = prefix & LENGTH_MASK
+            if len(buffer) < 4 + size:
+                break
+            body = bytes(buffer[4:4 + size])
+            del buffer[:4 + size]
+            whole = assembler.feed(prefix, body)
+            if whole is None:
+                continue
+            if whole[:1] == b"c":
+                latencies.append(time.perf_counter() - sent_at.pop(int(whole[1:])))
+            else:
+                data_bytes[whole[:1]] = data_bytes.get(whole[:1], 0) + len(whole)
+        ahead = received / READ_RATE - (time.perf_counter() - started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def bulk_sender(queue, flow, data_bytes, stop):
+    body = frame(flow + b"x" * (BULK_FRAME - 1))
+    put = 0
+    while not stop.is_set():
+        if put - data_bytes.get(flow, 0) >= BULK_WINDOW or not queue.put(body, flow=flow):
+            time.sleep(0.001)
+            continue
+        put += BULK_FRAME
+
+
+def saturated(prioritize, duration):
+    writer_sock, reader_sock = connected_pair()
+    queue = OutboundQueue(writer_sock, prioritize=prioritize)
+    sent_at = {}
+    latencies = []
+    data_bytes = {}
+    stop = threading.Event()
+    threads = [threading.Thread(target=paced_reader, args=(reader_sock, sent_at, latencies, data_bytes, stop), daemon=True)]
+    threads += [threading.Thread(target=bulk_sender, args=(queue, flow, data_bytes, stop), daemon=True)
+                for flow in (b"a", b"b")]
+    for thread in threads:
+        thread.start()
+
+    time.sleep(0.2) # let the queue fill up
+    deadline = time.perf_counter() + duration
+    seq = 0
+    refused = 0
+    while time.perf_counter() < deadline:
+        sent_at[seq] = time.perf_counter()
+        if not queue.put(frame(b"c%d" % seq + b" " * 56), CONTROL):
+            del sent_at[seq]
+            refused += 1
+        seq += 1
+        time.sleep(CONTROL_INTERVAL)
+    time.sleep(0.5) # the last control frames still have to cross the queue
+    stop.set()
+    queue.discard()
+    for sock in (writer_sock, reader_sock):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+    result = {"control_frames": len(latencies), "control_refused": refused}
+    result.update(latency_summary(latencies))
+    total = sum(data_bytes.values())
+    result["bulk_mb_per_sec"] = total / (duration + 0.7) / 1e6
+    result["bulk_share_a"] = data_bytes.get(b"a", 0) / total if total else 0.0
+    return result
+
+
+def run(quick=False):
+    duration = 1.0 if quick else 5.0
+    results = {
+        "outbound.fifo.control": saturated(False, duration),
+        "outbound.priority.control": saturated(True, duration),
+    }
+    baseline = results["outbound.fifo.control"]["p99_us"]
+    entry = results["outbound.priority.control"]
+    entry["p99_vs_fifo"] = entry["p99_us"] / baseline if baseline else 0.0
+    return results
@@ -0,0 +1,269 @@
+"""
+End-to-end relay benchmark: a SecureServer on localhost and N headless clients
+sending to each other in a ring. Reports relayed messages/sec and latency percentiles,
+once with server logging disabled and once logging every message at DEBUG. The rekey
+variant rekeys every session each REKEY_EVERY frames, to show rekeying costs no throughput.
+
+The send cases time SecureClient.send() itself (encryption, record MAC and the write) for
+messages sent at an interactive pace, in the "ctr" message mode (XOR with precomputed
+keystream) and in the "block" mode (one AES block encryption per message), together with the
+relay latency to the recipient and the server's mean re-encryption time.
+
+The storm cases measure relay latency between two established clients while hundreds of new
+clients do DH handshakes against the same server: handshake crypto in the connection threads
+with no limits (what every accepted socket used to get), with admission control, and with the
+crypto in worker processes. The server runs in a child process there, so the benchmark's own
+threads don't compete with it for the GIL.
+"""
+
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from topology.server import SecureServer
+from topology.topology import SecureClient
+from topology.log import configure_logging, ROOT_LOGGER
+from topology.rekey import RekeyPolicy
+from topology.identity import ephemeral_identity, public_part, fingerprint
+from crypto.dh import dh_generate_keys
+from benchmarks.common import latency_summary
+from benchmarks.bench_sessions import serve, recv_exact
+
+REKEY_EVERY = 25 # frames per session key in the rekey variant
+STORM_GROUP = 'ffdhe2048'
+STORM_INTERVAL = 0.005 # seconds between the relayed messages measured during a storm
+STORM_WARMUP = 20 # messages relayed before the measurement starts
+SEND_INTERVAL = 0.002 # seconds between the messages of the send cases
+STORM_QUEUE = 32 # handshake limit of the storm cases, below the storm's concurrency so some are turned away
+# server options of the storm cases; "inline" lifts the limits to get the old behaviour back
+STORM_MODES = {
+    "inline": {"handshake_queue": 1 << 30, "handshake_workers": 1 << 30},
+    "admission": {"handshake_queue": STORM_QUEUE},
+    "processes": {"handshake_queue": STORM_QUEUE, "handshake_processes": True},
+}
+
+
+class BenchClient:
+    """A headless SecureClient that records the latency of every message it receives."""
+
+    def __init__(self, name, url, server_key, **options):
+        self.client = SecureClient(name, url=url, server_key=server_key, on_message=self.on_message, **options)
+        self.name = name
+        self.sent_at = {}
+        self.latencies = []
+        self.senders = {}
+        self.expected = 0
+        self.done = threading.Event()
+
+    def connect(self, senders, expected):
+        self.senders = senders
+        self.expected = expected
+        self.client.connect()
+
+    def send(self, target, seq):
+        self.sent_at[seq] = time.perf_counter()
+        self.client.send(target, str(seq).encode())
+
+    def on_message(self, sender, payload, msg):
+        self.latencies.append(time.perf_counter() - self.senders[sender].sent_at[int(payload)])
+        if len(self.latencies) >= self.expected:
+            self.done.set()
+
+
+def run(quick=False, clients=4, messages=None):
+    messages = messages or (20 if quick else 200)
+    results = {f"relay.ring.{clients}": run_ring(clients, messages)}
+    for mode in ("block", "ctr"):
+        results[f"relay.send.{mode}"] = run_send(mode, 200 if quick else 2000)
+    storm, concurrency = (128, 64) if quick else (512, 256)
+    results["relay.storm.none"] = run_storm({}, 0, concurrency)
+    for mode, options in STORM_MODES.items():
+        results[f"relay.storm.{mode}"] = run_storm(options, storm, concurrency)
+    results[f"relay.ring.{clients}.rekey"] = run_ring(
+        clients, messages, rekey_policy=RekeyPolicy(max_bytes=0, max_messages=REKEY_EVERY, max_seconds=0))
+
+    # same traffic with every relayed message logged (written to /dev/null by the background listener)
+    with open(os.devnull, 'w') as devnull:
+        listener = configure_logging(logging.DEBUG, stream=devnull)
+        try:
+            results[f"relay.ring.{clients}.log_debug"] = run_ring(clients, messages)
+        finally:
+            listener.stop()
+            logger = logging.getLogger(ROOT_LOGGER)
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+            logger.setLevel(logging.NOTSET)
+            logger.propagate = True
+    return results
+
+
+def run_ring(clients, messages, url="tcp://127.0.0.1:0", **server_options):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        server = SecureServer('127.0.0.1', 0, url=url, **server_options)
+        threading.Thread(target=server.start, daemon=True).start()
+        server.listening.wait(5)
+
+        bench_clients = [BenchClient(f"bench{i}", server.url, server.identity_fingerprint) for i in range(clients)]
+        senders = {client.name: client for client in bench_clients}
+        for client in bench_clients:
+            client.connect(senders, messages)
+
+        def send_all(client, target):
+            for seq in range(messages):
+                client.send(target, seq)
+
+        start = time.perf_counter()
+        senders_threads = [threading.Thread(target=send_all, args=(client, bench_clients[(i + 1) % clients].name))
+                           for i, client in enumerate(bench_clients)]
+        for thread in senders_threads:
+            thread.start()
+        for thread in senders_threads:
+            thread.join()
+        for client in bench_clients:
+            client.done.wait(timeout=60)
+        elapsed = time.perf_counter() - start
+
+        for client in bench_clients:
+            client.client.close()
+        server.stop()
+
+    latencies = [latency for client in bench_clients for latency in client.latencies]
+    result = {
+        "clients": clients,
+        "messages": len(latencies),
+        "msgs_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "rekeys": server.metrics.snapshot()["counters"].get("rekeys_total", 0),
+    }
+    result.update(latency_summary(latencies))
+    return result
+
+
+def run_send(message_mode, messages):
+    """Latency of alice's send() calls and of their relay to bob, both clients in message_mode."""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        server = SecureServer('127.0.0.1', 0, url="tcp://127.0.0.1:0")
+        threading.Thread(target=server.start, daemon=True).start()
+        server.listening.wait(5)
+        alice = BenchClient("alice", server.url, server.identity_fingerprint, message_mode=message_mode)
+        bob = BenchClient("bob", server.url, server.identity_fingerprint, message_mode=message_mode)
+        senders = {"alice": alice}
+        alice.connect(senders, 0)
+        bob.connect(senders, STORM_WARMUP + messages)
+
+        send_times = []
+        for seq in range(STORM_WARMUP + messages):
+            start = time.perf_counter()
+            alice.send("bob", seq)
+            if seq >= STORM_WARMUP:
+                send_times.append(time.perf_counter() - start)
+            time.sleep(SEND_INTERVAL)
+        bob.done.wait(timeout=10)
+        snapshot = server.metrics.snapshot()
+        alice.client.close()
+        bob.client.close()
+        server.stop()
+
+    encrypt = snapshot["histograms"].get("aes_encrypt_seconds", {})
+    result = {
+        "messages": len(send_times),
+        "server_encrypt_mean_us": encrypt["sum"] / encrypt["count"] * 1e6 if encrypt.get("count") else 0.0,
+        "keystream_misses": snapshot["counters"].get("keystream_misses_total", 0),
+    }
+    result.update({f"send_{name}": value for name, value in latency_summary(send_times).items()})
+    result.update({f"relay_{name}": value for name, value in latency_summary(bob.latencies[STORM_WARMUP:]).items()})
+    return result
+
+
+def storm_handshake(address, key_frame):
+    """One bare handshake of the storm; returns retry_after if the server turned it away."""
+    sock = socket.create_connection(address)
+    try:
+        body = json.dumps(key_frame).encode()
+        sock.sendall(len(body).to_bytes(4, 'big') + body)
+        reply = json.loads(recv_exact(sock, int.from_bytes(recv_exact(sock, 4), 'big')))
+    finally:
+        sock.close()
+    return reply.get("retry_after") if reply.get("type") == "busy" else None
+
+
+def run_storm(server_options, count, concurrency):
+    """Relay latency alice -> bob while count clients (concurrency at a time) do DH handshakes."""
+    context = multiprocessing.get_context("fork")
+    urls, stop = context.Queue(), context.Event()
+    # the child serves with ephemeral_identity(); generated here first, the forked child inherits it
+    server_key = fingerprint(public_part(ephemeral_identity()))
+    # not a daemon: the server may start handshake worker processes of its own
+    child = context.Process(target=serve, args=(urls, stop), kwargs=server_options)
+    child.start()
+    url = urls.get(timeout=30)
+    host, port = url[len("tcp://"):].rsplit(":", 1)
+    address = (host, int(port))
+
+    # one DH public value for the whole storm: the server still does a fresh key pair and
+    # shared secret per handshake, the benchmark process does no modexp of its own
+    client_public, _ = dh_generate_keys(STORM_GROUP)
+    names = iter(range(count))
+    names_lock = threading.Lock()
+    rejected = []
+
+    def storm_loop():
+        while True:
+            with names_lock:
+                i = next(names, None)
+            if i is None:
+                return
+            key_frame = {"type": "key", "from": f"storm{i}", "kex": STORM_GROUP, "data": format(client_public, 'x')}
+            while True:
+                retry_after = storm_handshake(address, key_frame)
+                if retry_after is None:
+                    break
+                rejected.append(i)
+                time.sleep(retry_after)
+
+    wait_deadline = time.monotonic() + 30
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        alice, bob = BenchClient("alice", url, server_key), BenchClient("bob", url, server_key)
+        senders = {"alice": alice}
+        alice.connect(senders, 0)
+        bob.connect(senders, 1 << 30)
+        # warm-up: the first messages on fresh connections wait for delayed ACKs, not for the server
+        for seq in range(STORM_WARMUP):
+            alice.send("bob", seq)
+            time.sleep(STORM_INTERVAL)
+        while len(bob.latencies) < STORM_WARMUP and time.monotonic() < wait_deadline:
+            time.sleep(0.01)
+        bob.latencies = []
+
+        threads = [threading.Thread(target=storm_loop) for _ in range(min(concurrency, count))]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        seq = 0
+        while seq < 100 or any(thread.is_alive() for thread in threads):
+            alice.send("bob", STORM_WARMUP + seq)
+            seq += 1
+            time.sleep(STORM_INTERVAL)
+        elapsed = time.perf_counter() - start
+        wait_deadline = time.monotonic() + 10
+        while len(bob.latencies) < seq and time.monotonic() < wait_deadline:
+            time.sleep(0.01)
+        alice.client.close()
+        bob.client.close()
+
+    stop.set()
+    child.join(10)
+    if child.is_alive():
+        child.terminate()
+    result = {
+        "handshakes": count,
+        "handshakes_per_sec": count / elapsed if count and elapsed else 0.0,
+        "rejected": len(rejected),
+        "messages": len(bob.latencies),
+    }
+    result.update(latency_summary(bob.latencies))
+    return result
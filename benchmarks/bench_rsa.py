@@ -0,0 +1,81 @@
+"""
+RSA benchmarks: key generation, encryption, decryption and the my_pow primitive, plus
+RSASSA-PSS signing (CRT against a plain m^d mod n, and batch RSA per signature) and
+verification of the server's signature.
+"""
+
+import secrets
+
+from crypto.rsa import rsa_generate_keys, rsa_encrypt, rsa_decrypt
+from crypto.pss import rsa_generate_signing_keys, rsa_pss_sign, rsa_pss_verify
+from crypto.batch_rsa import batch_exponents, rsa_pss_sign_batch
+from tools.tools import my_pow
+from topology.identity import VerificationCache, public_part, encode_public_key, fingerprint, sign_offer
+from benchmarks.common import measure
+
+# bits of each prime; 128 is what SecureClient uses today
+PRIME_SIZES = (128, 256, 512, 1024)
+QUICK_PRIME_SIZES = (128, 256)
+# modulus sizes of the server signing key
+SIGNING_SIZES = (2048, 3072)
+QUICK_SIGNING_SIZES = (2048,)
+BATCH_SIZES = (2, 4, 8)
+
+
+def run(quick=False):
+    sizes = QUICK_PRIME_SIZES if quick else PRIME_SIZES
+    results = {}
+
+    for bits in sizes:
+        keygen_rounds = 3 if quick or bits >= 1024 else 10
+        results[f"rsa.generate_keys.{bits}"] = measure(lambda: rsa_generate_keys(bits), keygen_rounds, repeat=1)
+
+        public_key, private_key = rsa_generate_keys(bits)
+        n = public_key[0]
+        message = secrets.randbelow(n)
+        cipher = rsa_encrypt(message, public_key)
+        number = 20 if quick else 100
+
+        results[f"rsa.encrypt.{bits}"] = measure(lambda: rsa_encrypt(message, public_key), number)
+        results[f"rsa.decrypt.{bits}"] = measure(lambda: rsa_decrypt(cipher, private_key), number)
+
+        d = private_key[1]
+        results[f"tools.my_pow.{bits}"] = measure(lambda: my_pow(cipher, d, n), number)
+        results[f"builtin.pow.{bits}"] = measure(lambda: pow(cipher, d, n), number)
+
+    for bits in QUICK_SIGNING_SIZES if quick else SIGNING_SIZES:
+        results.update(run_signing(bits, 10 if quick else 50))
+    return results
+
+
+def run_signing(bits, number):
+    public_key, private_key = rsa_generate_signing_keys(bits)
+    n, e, d = private_key[:3]
+    message = secrets.token_bytes(32)
+    signature = rsa_pss_sign(message, private_key)
+    m = secrets.randbelow(n)
+    results = {
+        f"pss.sign.{bits}": measure(lambda: rsa_pss_sign(message, private_key), number),
+        f"pss.sign_no_crt.{bits}": measure(lambda: pow(m, d, n), number),
+        f"pss.verify.{bits}": measure(lambda: rsa_pss_verify(message, signature, public_key), number),
+    }
+    for size in BATCH_SIZES:
+        messages = [secrets.token_bytes(32) for _ in range(size)]
+        exponents = batch_exponents(private_key, size)
+        stats = measure(lambda: rsa_pss_sign_batch(messages, private_key, exponents), max(1, number // size))
+        # per signature, comparable with pss.sign
+        results[f"pss.sign_batch{size}.{bits}"] = {"ops_per_sec": stats["ops_per_sec"] * size,
+                                                   "mean_us": stats["mean_us"] / size}
+
+    # Client side of a handshake: first connection (empty cache) against a reconnect
+    key_fingerprint = fingerprint(public_key)
+    key_frame = {"type": "key", "from": "bench", "data": [1, 2], "nonce": secrets.token_hex(16)}
+    offer = {"type": "shared_aes_offer", "from": "server", "data": [3, 4],
+             "server_key": encode_public_key(public_part(private_key))}
+    offer["signature"] = sign_offer(private_key, key_fingerprint, "bench", key_frame, offer)
+    results[f"handshake.verify.cold.{bits}"] = measure(
+        lambda: VerificationCache().verify("bench", key_frame, offer, key_fingerprint), number)
+    cache = VerificationCache()
+    results[f"handshake.verify.cached.{bits}"] = measure(
+        lambda: cache.verify("bench", key_frame, offer, key_fingerprint), number)
+    return results
@@ -0,0 +1,109 @@
+"""
+Memory per idle session: what a connected client that sends nothing costs the server.
+
+The server runs in a child process so its resident memory can be read from /proc without
+the benchmark's own sockets and keys in it. Clients do the real handshake (key frame, wait
+for the AES offer) and then stay silent. RSS and thread count are sampled before and after,
+and the growth is divided by the number of sessions; per_100k_mb projects it to the 100k
+sessions we want to hold on one host. Address space is reported too: at 100k threads the
+reserved stacks, not the resident pages, are what runs out first.
+"""
+
+import multiprocessing
+import os
+import socket
+import time
+
+from crypto.rsa import rsa_generate_keys
+
+
+def serve(urls, stop, **options):
+    """Child process: a server on a free port, its URL put on urls, stopped when stop is set."""
+    import threading
+    from topology.server import SecureServer
+    from topology.identity import ephemeral_identity
+    server = SecureServer('127.0.0.1', 0, identity=ephemeral_identity(), url="tcp://127.0.0.1:0",
+                          heartbeat_interval=3600, idle_timeout=7200, **options)
+    threading.Thread(target=server.start, daemon=True).start()
+    server.listening.wait(10)
+    urls.put(server.url)
+    stop.wait()
+    server.stop()
+
+
+def process_status(pid):
+    """(resident bytes, virtual bytes, threads) of a process, from /proc (Linux)."""
+    fields = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            fields[key] = value.split()
+    return int(fields["VmRSS"][0]) * 1024, int(fields["VmSize"][0]) * 1024, int(fields["Threads"][0])
+
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("server closed the connection")
+        data += chunk
+    return data
+
+
+def open_session(address, name, public_key):
+    sock = socket.create_connection(address)
+    body = ('{"type": "key", "from": "%s", "data": [%d, %d]}' % (name, *public_key)).encode()
+    sock.sendall(len(body).to_bytes(4, 'big') + body)
+    recv_exact(sock, int.from_bytes(recv_exact(sock, 4), 'big')) # the AES offer: session registered
+    return sock
+
+
+def settle(pid):
+    """Status once the server stopped allocating (threads parked, queues idle)."""
+    previous = None
+    for _ in range(20):
+        time.sleep(0.25)
+        status = process_status(pid)
+        if status == previous:
+            break
+        previous = status
+    return previous
+
+
+def idle_sessions(count):
+    context = multiprocessing.get_context("fork")
+    urls, stop = context.Queue(), context.Event()
+    child = context.Process(target=serve, args=(urls, stop), daemon=True)
+    child.start()
+    host, port = urls.get(timeout=30)[len("tcp://"):].rsplit(":", 1)
+    address = (host, int(port))
+    public_key, _ = rsa_generate_keys(128) # one small key for everyone, the server only encrypts to it
+
+    # a first batch warms up imports, caches and the thread pool of the allocator
+    warmup = [open_session(address, f"warm{i}", public_key) for i in range(20)]
+    rss_before, vm_before, threads_before = settle(child.pid)
+    sockets = [open_session(address, f"idle{i}", public_key) for i in range(count)]
+    rss_after, vm_after, threads_after = settle(child.pid)
+
+    for sock in warmup + sockets:
+        sock.close()
+    stop.set()
+    child.join(10)
+    if child.is_alive():
+        child.terminate()
+
+    per_session = (rss_after - rss_before) / count
+    return {
+        "sessions": count,
+        "rss_per_session_kib": per_session / 1024,
+        "vm_per_session_kib": (vm_after - vm_before) / count / 1024,
+        "threads_per_session": (threads_after - threads_before) / count,
+        "per_100k_mb": per_session * 100000 / 1e6,
+    }
+
+
+def run(quick=False):
+    if not os.path.exists("/proc/self/status"):
+        return {}
+    return {"sessions.idle": idle_sessions(200 if quick else 2000)}
@@ -0,0 +1,55 @@
+"""
+Cold start benchmarks: how long a fresh interpreter takes to import the client, the server
+and the AES modules, measured with `python -X importtime` in a subprocess per run.
+
+import_ms is the time spent in the imports themselves (interpreter startup excluded),
+wall_ms the whole process, as seen by someone running a short-lived client.
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+TARGETS = {
+    "client": "import topology.topology",
+    "server": "import topology.server",
+    "aes": "import aes.aes_encrypt, aes.aes_decrypt, aes.aes_ctr",
+}
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def importtime(code):
+    """(wall seconds, {top-level module: cumulative us}) of one interpreter running code."""
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=ROOT,
+                          capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - start
+    modules = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if name.startswith(" ") and not name.startswith("  "): # top level: imported by code itself
+            modules[name.strip()] = int(cumulative)
+    return wall, modules
+
+
+def run(quick=False):
+    runs = 3 if quick else 10
+    baseline = [importtime("pass") for _ in range(runs)]
+    startup_modules = set().union(*(modules for _, modules in baseline))
+    results = {"startup.interpreter": {"wall_ms": statistics.median(wall for wall, _ in baseline) * 1e3}}
+
+    for name, code in TARGETS.items():
+        walls, imports = [], []
+        for _ in range(runs):
+            wall, modules = importtime(code)
+            walls.append(wall)
+            imports.append(sum(us for module, us in modules.items() if module not in startup_modules))
+        results[f"startup.{name}"] = {
+            "import_ms": statistics.median(imports) / 1e3,
+            "wall_ms": statistics.median(walls) * 1e3,
+        }
+    return results
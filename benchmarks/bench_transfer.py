@@ -0,0 +1,72 @@
+"""
+File transfer benchmark: one client streams a random file to another through a local
+SecureServer. Reports end-to-end MB/s (sender, server re-encryption and receiver together).
+
+The sizes can be overridden with P2P_BENCH_FILE_SIZES, e.g. "1M,64M,1G". With the pure
+Python AES every byte is encrypted four times on the way (sender, server decrypt and encrypt,
+receiver), so the large sizes take a long time and are not part of the default run.
+"""
+
+import os
+import tempfile
+import threading
+import time
+
+from topology.server import SecureServer
+from topology.topology import SecureClient
+
+MB = 1024 * 1024
+FILE_SIZES = "1M,4M"
+FILE_SIZES_QUICK = "1M"
+ALL_FILE_SIZES = "1M,16M,256M,1G" # the full ladder, for P2P_BENCH_FILE_SIZES
+
+
+def parse_sizes(spec):
+    units = {"K": 1024, "M": MB, "G": 1024 * MB}
+    return [int(part[:-1]) * units[part[-1].upper()] if part[-1].upper() in units else int(part)
+            for part in spec.split(",")]
+
+
+def write_random_file(path, size):
+    """Writes size random bytes, one MB at a time."""
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            block = os.urandom(min(MB, remaining))
+            f.write(block)
+            remaining -= len(block)
+
+
+def run(quick=False):
+    spec = os.environ.get("P2P_BENCH_FILE_SIZES") or (FILE_SIZES_QUICK if quick else FILE_SIZES)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        server = SecureServer('127.0.0.1', 0)
+        threading.Thread(target=server.start, daemon=True).start()
+        server.listening.wait(5)
+        sender = SecureClient("bench-sender", port=server.port, server_key=server.identity_fingerprint)
+        receiver = SecureClient("bench-receiver", port=server.port, server_key=server.identity_fingerprint,
+                                download_dir=os.path.join(tmp, "downloads"))
+        sender.connect()
+        receiver.connect()
+        try:
+            for size in parse_sizes(spec):
+                path = os.path.join(tmp, f"file-{size}.bin")
+                write_random_file(path, size)
+                start = time.perf_counter()
+                ok = sender.send_file("bench-receiver", path)
+                elapsed = time.perf_counter() - start
+                results[f"transfer.file.{size // MB}mb" if size >= MB else f"transfer.file.{size // 1024}kb"] = {
+                    "bytes": size,
+                    "ok": ok,
+                    "seconds": elapsed,
+                    "mb_per_sec": size / MB / elapsed if elapsed else 0.0,
+                }
+                os.remove(path)
+                if ok:
+                    os.remove(os.path.join(tmp, "downloads", os.path.basename(path)))
+        finally:
+            sender.close()
+            receiver.close()
+            server.stop()
+    return results
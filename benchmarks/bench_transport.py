@@ -0,0 +1,124 @@
+"""
+Transport latency: the same traffic over tcp://, unix:// and mem:// (topology.transport).
+
+pingpong: one connection, a 64 byte frame echoed back by a thread on the listening side, so
+the round trip is the transport alone (syscalls, loopback stack, thread wakeups).
+relay: one SecureClient messaging another through a SecureServer, one message in flight at a
+time (AES, JSON, server queues and two hops), to show how much of an end-to-end message the
+transport actually is.
+"""
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from topology import transport
+from benchmarks.common import latency_summary
+from topology.server import SecureServer
+from topology.topology import SecureClient
+from topology.identity import ephemeral_identity
+
+FRAME = (60).to_bytes(4, 'big') + b"x" * 60 # length prefix and payload, as on the wire
+
+
+def urls(tmp):
+    return {
+        "tcp": "tcp://127.0.0.1:0",
+        "unix": f"unix://{os.path.join(tmp, 'bench.sock')}",
+        "mem": "mem://",
+    }
+
+
+def recv_exact(conn, size):
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("closed")
+        data += chunk
+    return data
+
+
+def echo(conn):
+    try:
+        while True:
+            conn.sendall(recv_exact(conn, len(FRAME)))
+    except (ConnectionError, OSError):
+        pass
+
+
+def pingpong(url, round_trips):
+    listener = transport.listen(url)
+    accepted = []
+    acceptor = threading.Thread(target=lambda: accepted.append(listener.accept()[0]))
+    acceptor.start()
+    client = transport.connect(listener.url)
+    acceptor.join()
+    server_side = accepted[0]
+    if isinstance(client, socket.socket) and client.family != socket.AF_UNIX:
+        for sock in (client, server_side):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    threading.Thread(target=echo, args=(server_side,), daemon=True).start()
+
+    latencies = []
+    for _ in range(round_trips):
+        start = time.perf_counter()
+        client.sendall(FRAME)
+        recv_exact(client, len(FRAME))
+        latencies.append(time.perf_counter() - start)
+    client.close()
+    server_side.close()
+    listener.close()
+    result = {"round_trips": round_trips}
+    result.update(latency_summary(latencies))
+    return result
+
+
+def relay(url, messages):
+    server = SecureServer('127.0.0.1', 0, identity=ephemeral_identity(), url=url)
+    threading.Thread(target=server.start, daemon=True).start()
+    server.listening.wait(5)
+    arrived = threading.Event()
+    sender = SecureClient("bench-sender", url=server.url, server_key=server.identity_fingerprint)
+    receiver = SecureClient("bench-receiver", url=server.url, server_key=server.identity_fingerprint,
+                            on_message=lambda *args: arrived.set())
+    sender.connect()
+    receiver.connect()
+
+    latencies = []
+    for seq in range(messages):
+        arrived.clear()
+        start = time.perf_counter()
+        sender.send("bench-receiver", str(seq).encode())
+        if not arrived.wait(5):
+            break
+        latencies.append(time.perf_counter() - start)
+    sender.close()
+    receiver.close()
+    server.stop()
+    result = {"messages": len(latencies)}
+    result.update(latency_summary(latencies))
+    return result
+
+
+def run(quick=False):
+    round_trips = 500 if quick else 5000
+    messages = 100 if quick else 1000
+    results = {}
+    tmp = tempfile.mkdtemp(prefix="bench-transport-")
+    try:
+        for name, url in urls(tmp).items():
+            results[f"transport.{name}.pingpong"] = pingpong(url, round_trips)
+            results[f"transport.{name}.relay"] = relay(url, messages)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    for name in ("unix", "mem"):
+        for kind in ("pingpong", "relay"):
+            entry = results[f"transport.{name}.{kind}"]
+            baseline = results[f"transport.tcp.{kind}"]["p50_us"]
+            entry["p50_vs_tcp"] = entry["p50_us"] / baseline if baseline else 0.0
+    return results
@@ -0,0 +1,71 @@
+"""
+Helpers shared by the benchmark suites: timing, percentiles and baseline comparison.
+"""
+
+import time
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def measure(fn, number, repeat=3):
+    """Runs fn number times, repeat times, and keeps the best round (least noisy)."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return {
+        "ops_per_sec": number / best if best else 0.0,
+        "mean_us": best / number * 1e6,
+    }
+
+
+def latency_summary(latencies_s):
+    """p50/p99/max of a list of latencies given in seconds, reported in microseconds."""
+    values = sorted(latencies_s)
+    return {
+        "p50_us": percentile(values, 50) * 1e6,
+        "p99_us": percentile(values, 99) * 1e6,
+        "max_us": (values[-1] if values else 0.0) * 1e6,
+    }
+
+
+# Metrics where a bigger value is better; every other numeric metric is treated as a cost
+HIGHER_IS_BETTER = ("ops_per_sec", "msgs_per_sec", "mb_per_sec", "handshakes_per_sec")
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of regressions of results against baseline, beyond the relative tolerance."""
+    regressions = []
+    for name, metrics in baseline.items():
+        current = results.get(name)
+        if not current:
+            continue
+        for metric, old in metrics.items():
+            new = current.get(metric)
+            if not isinstance(old, (int, float)) or not isinstance(new, (int, float)) or old == 0:
+                continue
+            if metric in HIGHER_IS_BETTER:
+                change = (old - new) / old
+            elif metric.endswith("_us") or metric.endswith("_ms") or metric.endswith("_kib"):
+                change = (new - old) / old
+            else:
+                continue
+            if change > tolerance:
+                regressions.append({
+                    "benchmark": name,
+                    "metric": metric,
+                    "baseline": old,
+                    "current": new,
+                    "change_pct": round(change * 100, 1),
+                })
+    return regressions
@@ -0,0 +1,104 @@
+"""
+Batch RSA (A. Fiat, "Batch RSA", CRYPTO '89): mai multe operatii cu cheia privata cu pretul
+aproximativ al uneia singure.
+
+Toate operatiile folosesc acelasi modul n, dar fiecare are alt exponent public e_i, prim mic.
+Pentru valorile v_1..v_b se cer radacinile r_i = v_i^(1/e_i) mod n, adica semnatura lui v_i
+sub cheia (n, e_i). Fie E = e_1 * ... * e_b:
+
+1. urcare in arbore: M = prod v_i^(E/e_i) mod n, doar cu ridicari la puteri mici (E are
+   cateva zeci de biti);
+2. o singura ridicare la putere cu cheia privata: R = M^(1/E) = prod r_i, cu CRT modulo p si q;
+3. coborare in arbore: la fiecare nod, R se desparte in produsele celor doua jumatati cu un X
+   ales prin teorema chineza a resturilor, X = 0 mod E_stanga si X = 1 mod E_dreapta.
+
+Pentru 8 semnaturi RSA-2048 costul total este cam cat doua semnaturi obisnuite. Cheia privata
+trebuie sa aiba forma CRT din crypto.pss (cu p si q). Exponentii trebuie sa fie primi cu
+p - 1 si q - 1; batch_exponents ii alege pentru o cheie data.
+"""
+
+from crypto.pss import emsa_pss_encode
+
+# Exponentii publici mici din care se aleg cei ai unui lot; clientii accepta doar acestia
+BATCH_PRIMES = (3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67, 71, 73, 79, 83, 89, 97)
+
+
+def batch_exponents(private_key, count):
+    """Primii count exponenti din BATCH_PRIMES valizi pentru cheia privata (primi cu p - 1 si q - 1)."""
+    p, q = private_key[3], private_key[4]
+    # e este prim, deci cmmdc(e, p - 1) = 1 exact cand e nu divide p - 1
+    exponents = tuple(e for e in BATCH_PRIMES if (p - 1) % e and (q - 1) % e)
+    if len(exponents) < count:
+        raise ValueError(f"Cheia permite doar loturi de {len(exponents)} operatii")
+    return exponents[:count]
+
+
+def _product_tree(values, exponents, n):
+    """Nodul (E, M, stanga, dreapta) al arborelui, cu M = prod v_i^(E/e_i) mod n."""
+    if len(values) == 1:
+        return exponents[0], values[0] % n, None, None
+    half = len(values) // 2
+    left = _product_tree(values[:half], exponents[:half], n)
+    right = _product_tree(values[half:], exponents[half:], n)
+    e_left, m_left = left[0], left[1]
+    e_right, m_right = right[0], right[1]
+    return e_left * e_right, pow(m_left, e_right, n) * pow(m_right, e_left, n) % n, left, right
+
+
+def _split_root(node, root, n, roots):
+    """Desparte root = M^(1/E) al nodului in radacinile frunzelor, adaugate in ordine la roots."""
+    _, _, left, right = node
+    if left is None:
+        roots.append(root)
+        return
+    e_left, m_left = left[0], left[1]
+    e_right, m_right = right[0], right[1]
+    # X = 0 mod e_left si X = 1 mod e_right, deci
+    # root^X = r_st^X * r_dr^X = m_left^(X/e_left) * r_dr * m_right^((X-1)/e_right)
+    x = e_left * pow(e_left, -1, e_right)
+    known = pow(m_left, x // e_left, n) * pow(m_right, (x - 1) // e_right, n) % n
+    root_right = pow(root, x, n) * pow(known, -1, n) % n
+    root_left = root * pow(root_right, -1, n) % n
+    _split_root(left, root_left, n, roots)
+    _split_root(right, root_right, n, roots)
+
+
+def batch_rsa_roots(values, exponents, private_key):
+    """
+    Lista [v_i^(1/e_i) mod n] pentru values si exponents de aceeasi lungime.
+        exponents: primi diferiti intre ei, fiecare prim cu p - 1 si q - 1 (vezi batch_exponents)
+    """
+    if len(values) != len(exponents) or not values:
+        raise ValueError("Un lot are cel putin o valoare si cate un exponent pentru fiecare")
+    if len(set(exponents)) != len(exponents):
+        raise ValueError("Exponentii unui lot trebuie sa fie diferiti")
+    n, _, _, p, q, _, _, qinv = private_key
+    tree = _product_tree(values, exponents, n)
+    e_total, m_total = tree[0], tree[1]
+
+    # Singura ridicare la putere cu exponent mare, cu CRT ca in rsa_crt_sign_int
+    s1 = pow(m_total, pow(e_total, -1, p - 1), p)
+    s2 = pow(m_total, pow(e_total, -1, q - 1), q)
+    root = s2 + q * ((s1 - s2) * qinv % p)
+
+    roots = []
+    _split_root(tree, root, n, roots)
+    return roots
+
+
+def rsa_pss_sign_batch(messages, private_key, exponents=None):
+    """
+    RSASSA-PSS-SIGN pentru mai multe mesaje deodata: semnatura mesajului i se verifica cu
+    rsa_pss_verify(message, signature, (n, exponents[i])).
+    """
+    n = private_key[0]
+    mod_bits = n.bit_length()
+    if exponents is None:
+        exponents = batch_exponents(private_key, len(messages))
+    encoded = [int.from_bytes(emsa_pss_encode(message, mod_bits - 1), 'big') for message in messages]
+    roots = batch_rsa_roots(encoded, exponents, private_key)
+    # Verificarea cu exponent mic costa putin si prinde o eroare de calcul, ca in rsa_crt_sign_int
+    for s, m, e in zip(roots, encoded, exponents):
+        if pow(s, e, n) != m:
+            raise ArithmeticError("Semnatura din lot nu se verifica")
+    return [s.to_bytes((mod_bits + 7) // 8, 'big') for s in roots]
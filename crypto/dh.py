@@ -0,0 +1,165 @@
+"""
+RFC7919: Negotiated Finite Field Diffie-Hellman Ephemeral Parameters for TLS
+https://datatracker.ietf.org/doc/html/rfc7919
+
+Schimb de chei Diffie-Hellman efemer in grupurile ffdhe (g = 2, p prim sigur).
+Fiecare parte alege un exponent secret aleator x, trimite g^x mod p, iar cheia comuna este
+(g^y)^x = (g^x)^y mod p. Secretele sunt doar numere aleatoare, deci nu exista cautare de
+numere prime ca la RSA, iar dupa conexiune nu ramane nimic care sa decripteze traficul
+(forward secrecy).
+
+Baza g este mereu aceeasi, asa ca g^x se calculeaza cu tabele precalculate (metoda cu
+ferestre fixe): pentru fiecare fereastra de WINDOW biti a exponentului se pastreaza toate
+puterile g^(d * 2^(WINDOW*i)), iar g^x devine un produs de cateva zeci de inmultiri modulare,
+fara ridicari la patrat.
+"""
+
+import secrets
+import threading
+
+from crypto.hkdf import hkdf
+
+FFDHE2048_P = int(
+    'FFFFFFFFFFFFFFFFADF85458A2BB4A9AAFDC5620273D3CF1D8B9C583CE2D3695'
+    'A9E13641146433FBCC939DCE249B3EF97D2FE363630C75D8F681B202AEC4617A'
+    'D3DF1ED5D5FD65612433F51F5F066ED0856365553DED1AF3B557135E7F57C935'
+    '984F0C70E0E68B77E2A689DAF3EFE8721DF158A136ADE73530ACCA4F483A797A'
+    'BC0AB182B324FB61D108A94BB2C8E3FBB96ADAB760D7F4681D4F42A3DE394DF4'
+    'AE56EDE76372BB190B07A7C8EE0A6D709E02FCE1CDF7E2ECC03404CD28342F61'
+    '9172FE9CE98583FF8E4F1232EEF28183C3FE3B1B4C6FAD733BB5FCBC2EC22005'
+    'C58EF1837D1683B2C6F34A26C1B2EFFA886B423861285C97FFFFFFFFFFFFFFFF'
+    , 16)
+FFDHE3072_P = int(
+    'FFFFFFFFFFFFFFFFADF85458A2BB4A9AAFDC5620273D3CF1D8B9C583CE2D3695'
+    'A9E13641146433FBCC939DCE249B3EF97D2FE363630C75D8F681B202AEC4617A'
+    'D3DF1ED5D5FD65612433F51F5F066ED0856365553DED1AF3B557135E7F57C935'
+    '984F0C70E0E68B77E2A689DAF3EFE8721DF158A136ADE73530ACCA4F483A797A'
+    'BC0AB182B324FB61D108A94BB2C8E3FBB96ADAB760D7F4681D4F42A3DE394DF4'
+    'AE56EDE76372BB190B07A7C8EE0A6D709E02FCE1CDF7E2ECC03404CD28342F61'
+    '9172FE9CE98583FF8E4F1232EEF28183C3FE3B1B4C6FAD733BB5FCBC2EC22005'
+    'C58EF1837D1683B2C6F34A26C1B2EFFA886B4238611FCFDCDE355B3B6519035B'
+    'BC34F4DEF99C023861B46FC9D6E6C9077AD91D2691F7F7EE598CB0FAC186D91C'
+    'AEFE130985139270B4130C93BC437944F4FD4452E2D74DD364F2E21E71F54BFF'
+    '5CAE82AB9C9DF69EE86D2BC522363A0DABC521979B0DEADA1DBF9A42D5C4484E'
+    '0ABCD06BFA53DDEF3C1B20EE3FD59D7C25E41D2B66C62E37FFFFFFFFFFFFFFFF'
+    , 16)
+FFDHE4096_P = int(
+    'FFFFFFFFFFFFFFFFADF85458A2BB4A9AAFDC5620273D3CF1D8B9C583CE2D3695'
+    'A9E13641146433FBCC939DCE249B3EF97D2FE363630C75D8F681B202AEC4617A'
+    'D3DF1ED5D5FD65612433F51F5F066ED0856365553DED1AF3B557135E7F57C935'
+    '984F0C70E0E68B77E2A689DAF3EFE8721DF158A136ADE73530ACCA4F483A797A'
+    'BC0AB182B324FB61D108A94BB2C8E3FBB96ADAB760D7F4681D4F42A3DE394DF4'
+    'AE56EDE76372BB190B07A7C8EE0A6D709E02FCE1CDF7E2ECC03404CD28342F61'
+    '9172FE9CE98583FF8E4F1232EEF28183C3FE3B1B4C6FAD733BB5FCBC2EC22005'
+    'C58EF1837D1683B2C6F34A26C1B2EFFA886B4238611FCFDCDE355B3B6519035B'
+    'BC34F4DEF99C023861B46FC9D6E6C9077AD91D2691F7F7EE598CB0FAC186D91C'
+    'AEFE130985139270B4130C93BC437944F4FD4452E2D74DD364F2E21E71F54BFF'
+    '5CAE82AB9C9DF69EE86D2BC522363A0DABC521979B0DEADA1DBF9A42D5C4484E'
+    '0ABCD06BFA53DDEF3C1B20EE3FD59D7C25E41D2B669E1EF16E6F52C3164DF4FB'
+    '7930E9E4E58857B6AC7D5F42D69F6D187763CF1D5503400487F55BA57E31CC7A'
+    '7135C886EFB4318AED6A1E012D9E6832A907600A918130C46DC778F971AD0038'
+    '092999A333CB8B7A1A1DB93D7140003C2A4ECEA9F98D0ACC0A8291CDCEC97DCF'
+    '8EC9B55A7F88A46B4DB5A851F44182E1C68A007E5E655F6AFFFFFFFFFFFFFFFF'
+    , 16)
+
+
+# grup -> (p, bitii exponentului secret). Exponentii scurti sunt cei din RFC7919, anexa A:
+# aproximativ dublul puterii de securitate a grupului.
+GROUPS = {
+    'ffdhe2048': (FFDHE2048_P, 225),
+    'ffdhe3072': (FFDHE3072_P, 275),
+    'ffdhe4096': (FFDHE4096_P, 325),
+}
+GENERATOR = 2
+WINDOW = 6 # biti per fereastra; tabela are ceil(biti / WINDOW) * 2^WINDOW intrari
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def fixed_base_table(p, exponent_bits, base=GENERATOR, window=WINDOW):
+    """
+    Tabela pentru ridicarea lui base la puteri de cel mult exponent_bits biti:
+        table[i][d] = base^(d * 2^(window * i)) mod p
+    """
+    table = []
+    row_base = base
+    for _ in range((exponent_bits + window - 1) // window):
+        row = [1]
+        for _ in range(1, 1 << window):
+            row.append(row[-1] * row_base % p)
+        table.append(row)
+        # baza urmatoarei ferestre: row_base^(2^window)
+        row_base = row[-1] * row_base % p
+    return table
+
+
+def fixed_base_pow(table, exponent, p, window=WINDOW):
+    """
+    base^exponent mod p folosind tabela: o inmultire pentru fiecare fereastra nenula.
+    ValueError daca exponentul e negativ sau are mai multi biti decat acopera tabela.
+    """
+    mask = (1 << window) - 1
+    result = 1
+    for row in table:
+        if not exponent:
+            break
+        digit = exponent & mask
+        if digit:
+            result = result * row[digit] % p
+        exponent >>= window
+    if exponent:
+        raise ValueError("Exponentul este mai mare decat tabela")
+    return result
+
+
+def group_table(group):
+    """Tabela generatorului pentru un grup, construita o singura data (la prima folosire)."""
+    table = _tables.get(group)
+    if table is None:
+        with _tables_lock:
+            table = _tables.get(group)
+            if table is None:
+                p, exponent_bits = GROUPS[group]
+                table = _tables[group] = fixed_base_table(p, exponent_bits)
+    return table
+
+
+def dh_generate_keys(group):
+    """
+    Genereaza o pereche efemera (cheie publica, cheie secreta) in grupul dat.
+    Secretul este un numar aleator de exponent_bits biti (cel mult), nu e nevoie de numere prime.
+    """
+    p, exponent_bits = GROUPS[group]
+    private_key = 0
+    while private_key < 2:
+        private_key = secrets.randbits(exponent_bits)
+    public_key = fixed_base_pow(group_table(group), private_key, p)
+    return public_key, private_key
+
+
+def dh_check_public(group, public_key):
+    """RFC7919, sectiunea 5.1: cheia publica a celuilalt trebuie sa fie in intervalul (1, p - 1)."""
+    p, _ = GROUPS[group]
+    return 1 < public_key < p - 1
+
+
+def dh_shared_secret(group, peer_public_key, private_key):
+    """Secretul comun (g^y)^x mod p, ca bytes de lungimea lui p (cu zerouri la inceput, RFC7919 sect. 2)."""
+    p, _ = GROUPS[group]
+    if not dh_check_public(group, peer_public_key):
+        raise ValueError("Cheie publica Diffie-Hellman invalida")
+    shared = pow(peer_public_key, private_key, p)
+    return shared.to_bytes((p.bit_length() + 7) // 8, 'big')
+
+
+def dh_derive_key(group, shared_secret, client_public, server_public, length=16):
+    """
+    Cheia AES a sesiunii: HKDF (RFC 5869) cu secretul comun ca material de cheie, numele grupului
+    ca salt si cele doua chei publice ca info. Cheile publice leaga cheia de schimbul respectiv
+    (un atacator nu poate combina doua schimburi).
+    """
+    p, _ = GROUPS[group]
+    size = (p.bit_length() + 7) // 8
+    info = client_public.to_bytes(size, 'big') + server_public.to_bytes(size, 'big')
+    return hkdf(shared_secret, b"p2p " + group.encode(), info, length)
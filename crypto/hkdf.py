@@ -0,0 +1,99 @@
+"""
+HMAC-SHA-256 (RFC 2104, FIPS 198-1) si HKDF (RFC 5869).
+https://www.rfc-editor.org/rfc/rfc5869
+
+HKDF face din secretul unui schimb de chei (RSA sau DH) oricate chei independente:
+
+1. extract: PRK = HMAC(salt, IKM), un secret uniform de 32 bytes;
+2. expand: T(i) = HMAC(PRK, T(i-1) || info || i), OKM = T(1) || T(2) || ... trunchiat la L.
+
+Valori diferite pentru info (de exemplu "cheie client -> server", "cheie server -> client")
+dau chei independente din acelasi PRK.
+
+HMAC(K, m) = H((K ^ opad) || H((K ^ ipad) || m)). Starea SHA-256 dupa blocul K ^ ipad si cea
+dupa K ^ opad nu depind de mesaj, asa ca HmacSha256 le calculeaza o singura data si le copiaza
+pentru fiecare mesaj: un HMAC cu cheie cunoscuta costa doua compresii SHA-256 in loc de patru.
+Un PRK folosit de mai multe ori (hkdf_expand cu alt info) pastreaza un HmacSha256.
+"""
+
+import hashlib
+
+HASH = hashlib.sha256
+HASH_SIZE = 32
+BLOCK_SIZE = 64 # blocul SHA-256, lungimea padurilor
+IPAD = bytes(0x36 for _ in range(BLOCK_SIZE))
+OPAD = bytes(0x5c for _ in range(BLOCK_SIZE))
+
+
+def _xor(a, b):
+    return bytes(x ^ y for x, y in zip(a, b))
+
+
+class HmacSha256:
+    """
+    HMAC-SHA-256 cu starile interna si externa precalculate.
+    Se foloseste ca hashlib: copy(), update(data), digest().
+    """
+
+    __slots__ = ('_inner', '_outer')
+
+    def __init__(self, key=b''):
+        if len(key) > BLOCK_SIZE:
+            key = HASH(key).digest()
+        key = key.ljust(BLOCK_SIZE, b'\0')
+        self._inner = HASH(_xor(key, IPAD))
+        self._outer = HASH(_xor(key, OPAD)) # nu se modifica niciodata, copiile o pot imparti
+
+    def copy(self):
+        other = HmacSha256.__new__(HmacSha256)
+        other._inner = self._inner.copy()
+        other._outer = self._outer
+        return other
+
+    def update(self, data):
+        self._inner.update(data)
+
+    def digest(self):
+        outer = self._outer.copy()
+        outer.update(self._inner.digest())
+        return outer.digest()
+
+    def mac(self, data):
+        """HMAC(cheie, data) fara sa modifice starea precalculata."""
+        inner = self._inner.copy()
+        inner.update(data)
+        outer = self._outer.copy()
+        outer.update(inner.digest())
+        return outer.digest()
+
+
+def hmac_sha256(key, data):
+    return HmacSha256(key).mac(data)
+
+
+def hkdf_extract(salt, ikm):
+    """PRK din materialul de cheie ikm. Fara salt (b'' sau None) se foloseste HASH_SIZE zerouri."""
+    return hmac_sha256(salt or bytes(HASH_SIZE), ikm)
+
+
+def hkdf_expand(prk, info, length):
+    """
+    OKM de length bytes (cel mult 255 * HASH_SIZE).
+        prk: PRK-ul (bytes) sau un HmacSha256 deja cheiat cu el, refolosit intre apeluri
+    """
+    if length > 255 * HASH_SIZE:
+        raise ValueError(f"HKDF poate produce cel mult {255 * HASH_SIZE} bytes")
+    state = prk if isinstance(prk, HmacSha256) else HmacSha256(prk)
+    okm = b''
+    block = b''
+    counter = 1
+    while len(okm) < length:
+        block = state.mac(block + info + bytes([counter]))
+        okm += block
+        counter += 1
+    return okm[:length]
+
+
+def hkdf(ikm, salt, info, length):
+    """HKDF complet: extract urmat de expand."""
+    return hkdf_expand(hkdf_extract(salt, ikm), info, length)
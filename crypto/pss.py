@@ -0,0 +1,126 @@
+"""
+RFC8017: RSA Cryptography Specifications Version 2.2
+https://datatracker.ietf.org/doc/html/rfc8017
+
+Semnaturi RSASSA-PSS (sectiunea 8.1) cu SHA-256 si MGF1-SHA256, sare de 32 de octeti.
+
+Cheia privata pastreaza parametrii CRT (sectiunea 3.2, a doua forma): in loc de s = m^d mod n
+se calculeaza doua ridicari la putere modulo p si q, cu exponenti de jumatate de lungime, si
+se combina rezultatele (Garner). Este de aproximativ 3-4 ori mai rapid decat m^d mod n.
+Semnatura este verificata cu exponentul public inainte de a fi intoarsa, ca o eroare de
+calcul intr-una din jumatati sa nu scape o semnatura gresita (care ar divulga p sau q).
+"""
+
+import hashlib
+import secrets
+
+HASH = hashlib.sha256
+HASH_LEN = 32
+SALT_LEN = HASH_LEN
+PUBLIC_EXPONENT = 65537
+
+
+def rsa_generate_signing_keys(modulus_bits: int):
+    """
+    Genereaza o pereche de chei RSA pentru semnaturi, cu un modul de exact modulus_bits biti.
+
+    public key: (n, e)
+    private key: (n, e, d, p, q, dP, dQ, qInv)
+    """
+    from Cryptodome.Util import number # doar pentru generarea cheilor
+    while True:
+        p = number.getPrime(modulus_bits // 2)
+        q = number.getPrime(modulus_bits - modulus_bits // 2)
+        n = p * q
+        if p != q and n.bit_length() == modulus_bits and number.GCD(PUBLIC_EXPONENT, (p - 1) * (q - 1)) == 1:
+            break
+    return (n, PUBLIC_EXPONENT), rsa_crt_private_key(p, q, PUBLIC_EXPONENT)
+
+
+def rsa_crt_private_key(p, q, e=PUBLIC_EXPONENT):
+    """Cheia privata cu parametrii CRT precalculati, din factorii p si q."""
+    if p < q:
+        p, q = q, p # qInv = q^-1 mod p, cu p > q ca in RFC
+    n = p * q
+    d = pow(e, -1, (p - 1) * (q - 1))
+    return (n, e, d, p, q, d % (p - 1), d % (q - 1), pow(q, -1, p))
+
+
+def rsa_crt_sign_int(m, private_key):
+    """RSASP1 (5.2.1) cu CRT: s = m^d mod n."""
+    n, e, _, p, q, dp, dq, qinv = private_key
+    s1 = pow(m, dp, p)
+    s2 = pow(m, dq, q)
+    s = s2 + q * ((s1 - s2) * qinv % p)
+    if pow(s, e, n) != m:
+        raise ArithmeticError("Semnatura CRT nu se verifica")
+    return s
+
+
+def mgf1(seed, length):
+    """MGF1 (anexa B.2.1) cu SHA-256."""
+    output = b''
+    counter = 0
+    while len(output) < length:
+        output += HASH(seed + counter.to_bytes(4, 'big')).digest()
+        counter += 1
+    return output[:length]
+
+
+def emsa_pss_encode(message, em_bits, salt=None):
+    """EMSA-PSS-ENCODE (9.1.1). salt poate fi fixat doar pentru vectori de test."""
+    em_len = (em_bits + 7) // 8
+    m_hash = HASH(message).digest()
+    if salt is None:
+        salt = secrets.token_bytes(SALT_LEN)
+    if em_len < HASH_LEN + len(salt) + 2:
+        raise ValueError("Modul prea mic pentru PSS")
+
+    h = HASH(b'\x00' * 8 + m_hash + salt).digest()
+    db = b'\x00' * (em_len - len(salt) - HASH_LEN - 2) + b'\x01' + salt
+    masked_db = bytearray(a ^ b for a, b in zip(db, mgf1(h, em_len - HASH_LEN - 1)))
+    masked_db[0] &= 0xFF >> (8 * em_len - em_bits)
+    return bytes(masked_db) + h + b'\xbc'
+
+
+def emsa_pss_verify(message, em, em_bits, salt_len=SALT_LEN):
+    """EMSA-PSS-VERIFY (9.1.2): True daca em este o codificare corecta a mesajului."""
+    em_len = (em_bits + 7) // 8
+    if len(em) != em_len or em_len < HASH_LEN + salt_len + 2 or em[-1] != 0xBC:
+        return False
+    masked_db, h = em[:em_len - HASH_LEN - 1], em[em_len - HASH_LEN - 1:-1]
+    top_mask = 0xFF >> (8 * em_len - em_bits)
+    if masked_db[0] & ~top_mask & 0xFF:
+        return False
+    db = bytearray(a ^ b for a, b in zip(masked_db, mgf1(h, em_len - HASH_LEN - 1)))
+    db[0] &= top_mask
+    padding_len = em_len - HASH_LEN - salt_len - 2
+    if any(db[:padding_len]) or db[padding_len] != 0x01:
+        return False
+    salt = bytes(db[len(db) - salt_len:]) if salt_len else b''
+    return secrets.compare_digest(HASH(b'\x00' * 8 + HASH(message).digest() + salt).digest(), h)
+
+
+def rsa_pss_sign(message: bytes, private_key, salt=None):
+    """RSASSA-PSS-SIGN (8.1.1): semnatura de lungimea modulului, in octeti."""
+    n = private_key[0]
+    mod_bits = n.bit_length()
+    em = emsa_pss_encode(message, mod_bits - 1, salt)
+    s = rsa_crt_sign_int(int.from_bytes(em, 'big'), private_key)
+    return s.to_bytes((mod_bits + 7) // 8, 'big')
+
+
+def rsa_pss_verify(message: bytes, signature: bytes, public_key):
+    """RSASSA-PSS-VERIFY (8.1.2): True daca semnatura este valida pentru mesaj si cheia publica."""
+    n, e = public_key
+    mod_bits = n.bit_length()
+    if len(signature) != (mod_bits + 7) // 8:
+        return False
+    s = int.from_bytes(signature, 'big')
+    if s >= n:
+        return False
+    em_len = (mod_bits - 1 + 7) // 8
+    m = pow(s, e, n)
+    if m.bit_length() > mod_bits - 1:
+        return False
+    return emsa_pss_verify(message, m.to_bytes(em_len, 'big'), mod_bits - 1)
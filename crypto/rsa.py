@@ -3,7 +3,6 @@ RFC8017: RSA Cryptography Specifications Version 2.2
 https://datatracker.ietf.org/doc/html/rfc8017
 """
 
-from Cryptodome.Util import number
 import math
 from tools.tools import my_pow
 
@@ -44,6 +43,9 @@ def rsa_generate_keys(no_bits: int):
     private key: (n, d)
     """
     
+    # Cryptodome se incarca doar cand chiar generam chei, nu la importul modulului
+    from Cryptodome.Util import number
+
     # 1. generam doua numere prime (de preferat mari.)
     p = number.getPrime(no_bits)
     q = number.getPrime(no_bits)
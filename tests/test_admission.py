@@ -0,0 +1,90 @@
+"""
+Test handshake admission control: the handshake limit, busy rejections and worker processes
+"""
+
+import sys
+import os
+import socket
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from topology.admission import HandshakeAdmission
+from topology.server import SecureServer
+from topology.topology import SecureClient
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+class TestHandshakeAdmission(unittest.TestCase):
+    def test_limit(self):
+        admission = HandshakeAdmission(limit=2, retry_after=1.0)
+        self.assertTrue(admission.admit())
+        self.assertTrue(admission.admit())
+        self.assertFalse(admission.admit())
+        admission.done()
+        self.assertTrue(admission.admit())
+        frame = admission.busy_frame()
+        self.assertEqual(frame["type"], "busy")
+        self.assertTrue(0.5 <= frame["retry_after"] <= 1.5)
+
+class TestAdmissionServer(unittest.TestCase):
+    def start_server(self, **options):
+        self.server = SecureServer('127.0.0.1', 0, **options)
+        threading.Thread(target=self.server.start, daemon=True).start()
+        self.assertTrue(self.server.listening.wait(5))
+        self.addCleanup(self.server.stop)
+
+    def test_busy_server_turns_client_away_until_a_place_frees(self):
+        self.start_server(handshake_queue=1)
+        self.server.admission.retry_after = 0.05
+        # A connection that never sends its key frame holds the only place
+        silent = socket.create_connection(('127.0.0.1', self.server.port))
+        self.assertTrue(wait_until(lambda: self.server.admission.pending == 1))
+
+        alice = SecureClient("alice", port=self.server.port, server_key=self.server.identity_fingerprint)
+        connecting = threading.Thread(target=alice.connect)
+        connecting.start()
+        self.assertTrue(wait_until(lambda: self.server.metrics.snapshot()["counters"].get("handshakes_rejected_total")))
+        silent.close()
+        connecting.join(10)
+        try:
+            self.assertIsNotNone(alice.keys)
+            self.assertIn("alice", self.server.connected_clients)
+        finally:
+            alice.close()
+        self.assertTrue(wait_until(lambda: self.server.admission.pending == 0))
+
+    def test_dh_handshakes_in_worker_processes(self):
+        self.start_server(handshake_processes=True, handshake_workers=1)
+        self.assertIsNotNone(self.server.handshake_pool)
+        received = []
+        done = threading.Event()
+
+        def on_message(sender, payload, msg):
+            received.append(payload)
+            done.set()
+
+        alice = SecureClient("alice", port=self.server.port, server_key=self.server.identity_fingerprint,
+                             key_exchange='ffdhe2048')
+        bob = SecureClient("bob", port=self.server.port, server_key=self.server.identity_fingerprint, on_message=on_message)
+        alice.connect()
+        bob.connect()
+        try:
+            alice.send("bob", b"hello")
+            self.assertTrue(done.wait(5))
+        finally:
+            alice.close()
+            bob.close()
+        self.assertEqual(received, [b"hello"])
+        self.assertEqual(self.server.metrics.snapshot()["counters"]["handshakes_total"], 2)
+
+if __name__ == "__main__":
+    unittest.main()
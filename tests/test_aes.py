@@ -4,11 +4,20 @@ Unit test AES
 
 import sys
 import os
+import tempfile
+from unittest import mock
 
 from aes.aes_decrypt import inv_shift_rows, inv_sub_bytes, aes_decryption, key_expansion_eic
 from aes.aes_encrypt import from_byte_to_sbox, shift_rows, \
     aes_encryption, key_expansion, add_round_key
 
+from aes.aes_ctr import aes_ctr
+from aes.aes_key import AESKey
+from aes import aes_codegen
+from aes.aes_codegen import ENCRYPT_BLOCK, DECRYPT_BLOCK, flatten_key_schedule
+from aes.aes_encrypt import aes_encrypt_block
+from aes.aes_decrypt import aes_decrypt_block
+from aes.aes_commons import get_nr
 from aes.aes_constants import mul_mat_crypt, mul_mat_decrypt
 from aes.aes_commons import xTimes, bytes_from_state, multiply_column, mix_columns, mul_gf8, extract_column
 
@@ -346,5 +355,68 @@ class TestAES(unittest.TestCase):
         plain = aes_decryption(cipher, key)
         assert plain == plaintext
 
+    def test_aes_192_256(self):
+        # FIPS 197, anexa C.2 si C.3
+        plaintext = bytes.fromhex("00112233445566778899aabbccddeeff")
+        for key_hex, expected_hex in (
+                ("000102030405060708090a0b0c0d0e0f1011121314151617", "dda97ca4864cdfe06eaf70a0ec0d7191"),
+                ("000102030405060708090a0b0c0d0e0f101112131415161718191a1b1c1d1e1f", "8ea2b7ca516745bfeafc49904b496089")):
+            key = bytes.fromhex(key_hex)
+            self.assertEqual(aes_encryption(plaintext, key), bytes.fromhex(expected_hex))
+            self.assertEqual(aes_decryption(bytes.fromhex(expected_hex), key), plaintext)
+
+    def test_generated_matches_reference(self):
+        # functiile generate (aes_codegen) trebuie sa dea exact rezultatul implementarii de referinta
+        for key_size in (16, 24, 32):
+            nr = get_nr(key_size * 8)
+            for _ in range(20):
+                key = os.urandom(key_size)
+                block = os.urandom(16)
+                schedule, schedule_eic = key_expansion(key), key_expansion_eic(key)
+                cipher = aes_encrypt_block(block, schedule, nr)
+                self.assertEqual(ENCRYPT_BLOCK[nr](block, flatten_key_schedule(schedule)), cipher)
+                self.assertEqual(aes_decrypt_block(cipher, schedule_eic, nr), block)
+                self.assertEqual(DECRYPT_BLOCK[nr](cipher, flatten_key_schedule(schedule_eic)), block)
+
+    def test_codegen_without_writable_cache(self):
+        # instalare read-only: fisierul generat nu poate fi scris, functiile se compileaza in memorie
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "read-only", "_aes_generated.py")
+            with mock.patch.object(aes_codegen, "GENERATED_PATH", path):
+                encrypt, decrypt = aes_codegen.compile_block_functions()
+            self.assertFalse(os.path.exists(os.path.dirname(path)))
+        key = os.urandom(16)
+        block = os.urandom(16)
+        rk = flatten_key_schedule(key_expansion(key))
+        self.assertEqual(encrypt[10](block, rk), ENCRYPT_BLOCK[10](block, rk))
+        self.assertEqual(decrypt[10](encrypt[10](block, rk), flatten_key_schedule(key_expansion_eic(key))), block)
+
+    def test_aes_key(self):
+        # cheile de runda generate o data dau acelasi rezultat ca functiile care le genereaza la fiecare bloc
+        for key_size in (16, 24, 32):
+            key = os.urandom(key_size)
+            aes_key = AESKey(key)
+            for _ in range(5):
+                block = os.urandom(16)
+                cipher = aes_key.encrypt(block)
+                self.assertEqual(cipher, aes_encryption(block, key))
+                self.assertEqual(aes_key.decrypt(cipher), block)
+
+    def test_aes_ctr(self):
+        # NIST SP 800-38A, F.5.1 CTR-AES128.Encrypt (primele doua blocuri, counterul trece peste un byte)
+        key = bytes.fromhex("2b7e151628aed2a6abf7158809cf4f3c")
+        counter_block = bytes.fromhex("f0f1f2f3f4f5f6f7f8f9fafbfcfdfeff")
+        plaintext = bytes.fromhex("6bc1bee22e409f96e93d7e117393172a"
+                                  "ae2d8a571e03ac9c9eb76fac45af8e51")
+        expected = bytes.fromhex("874d6191b620e3261bef6864990db6ce"
+                                 "9806f66b7970fdff8617187bb9fffdff")
+
+        nonce, counter = counter_block[:8], int.from_bytes(counter_block[8:], 'big')
+        self.assertEqual(aes_ctr(plaintext, key, nonce, counter), expected)
+        self.assertEqual(aes_ctr(expected, key, nonce, counter), plaintext)
+        # fara padding, iar al doilea bloc se poate calcula separat
+        self.assertEqual(aes_ctr(plaintext[:5], key, nonce, counter), expected[:5])
+        self.assertEqual(aes_ctr(plaintext[16:], key, nonce, counter + 1), expected[16:])
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,80 @@
+"""
+Test the shared buffer pool
+"""
+
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from unittest import mock
+from topology.buffers import BufferPool
+from topology.server import SecureServer, MAX_FRAME
+from topology.identity import ephemeral_identity
+
+class TrickleConn:
+    """A socket that hands out its bytes a few at a time, then reports the connection closed."""
+
+    def __init__(self, data, step=3):
+        self.data = data
+        self.step = step
+
+    def recv(self, size):
+        piece, self.data = self.data[:min(size, self.step)], self.data[min(size, self.step):]
+        return piece
+
+    def recv_into(self, view, size):
+        piece = self.recv(size)
+        view[:len(piece)] = piece
+        return len(piece)
+
+class TestBufferPool(unittest.TestCase):
+    def test_size_classes_and_reuse(self):
+        pool = BufferPool(min_size=1024, max_size=8192, max_free=2)
+        small = pool.acquire(10)
+        self.assertEqual(len(small), 1024)
+        self.assertEqual(len(pool.acquire(5000)), 8192)
+        pool.release(small)
+        self.assertIs(pool.acquire(1000), small)
+        self.assertEqual(pool.stats()["reused"], 1)
+
+    def test_bounded(self):
+        pool = BufferPool(min_size=1024, max_size=8192, max_free=2)
+        buffers = [pool.acquire(1024) for _ in range(5)]
+        for buffer in buffers:
+            pool.release(buffer)
+        self.assertEqual(pool.stats()["free_bytes"], 2 * 1024)
+        large = pool.acquire(10000) # over max_size: allocated exactly, never kept
+        self.assertEqual(len(large), 10000)
+        pool.release(large)
+        pool.release(bytearray(3000)) # not a size class
+        self.assertEqual(pool.stats()["free_bytes"], 2 * 1024)
+
+class TestRecvFull(unittest.TestCase):
+    def setUp(self):
+        self.server = SecureServer('127.0.0.1', 0, identity=ephemeral_identity())
+        self.pool = BufferPool()
+        patcher = mock.patch("topology.server.POOL", self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_prefix_split_across_reads(self):
+        body = b'{"type": "ping"}'
+        frame = self.server.recv_full(TrickleConn(len(body).to_bytes(4, 'big') + body, step=1))
+        self.assertEqual(bytes(frame), body)
+        self.server.release_frame(frame)
+        self.assertEqual(self.pool.stats()["free_bytes"], 4096)
+
+    def test_oversized_frame_rejected_before_allocating(self):
+        self.assertIsNone(self.server.recv_full(TrickleConn((MAX_FRAME + 1).to_bytes(4, 'big') + b"x" * 10)))
+        self.assertEqual(self.pool.stats()["allocated"], 0)
+        self.assertEqual(self.server.metrics.snapshot()["counters"]['drops_total{reason="frame_too_large"}'], 1)
+
+    def test_buffer_released_when_connection_closes_mid_frame(self):
+        self.assertIsNone(self.server.recv_full(TrickleConn((5000).to_bytes(4, 'big') + b"x" * 100)))
+        self.assertEqual(self.pool.stats()["free_bytes"], 8192)
+        self.assertIsNone(self.server.recv_full(TrickleConn(b"\0\0"))) # closed inside the prefix
+
+if __name__ == "__main__":
+    unittest.main()
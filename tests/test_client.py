@@ -0,0 +1,222 @@
+"""
+Test client <-> server (headless SecureClient against a local SecureServer)
+"""
+
+import sys
+import os
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from topology.server import SecureServer
+from topology.topology import SecureClient
+from topology.identity import ephemeral_identity
+from crypto.pss import rsa_generate_signing_keys
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+class TestSecureClient(unittest.TestCase):
+    def setUp(self):
+        self.store = tempfile.TemporaryDirectory()
+        # One signing key for all tests instead of a new one in every store directory
+        self.server = SecureServer('127.0.0.1', 0, store_dir=self.store.name, identity=ephemeral_identity())
+        threading.Thread(target=self.server.start, daemon=True).start()
+        self.assertTrue(self.server.listening.wait(5))
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.stop()
+        self.store.cleanup()
+
+    def client(self, name, **kwargs):
+        kwargs.setdefault("server_key", self.server.identity_fingerprint)
+        client = SecureClient(name, port=self.server.port, **kwargs)
+        self.clients.append(client)
+        return client
+
+    def test_send_and_iterate(self):
+        alice = self.client("alice")
+        bob = self.client("bob")
+        alice.connect()
+        bob.connect()
+
+        self.assertTrue(alice.send("bob", b"salut"))
+        self.assertEqual(next(bob.messages(timeout=10)), ("alice", b"salut"))
+
+    def test_pipelined_sends_arrive_in_order(self):
+        received = []
+        done = threading.Event()
+
+        def on_message(sender, payload, msg):
+            received.append(payload)
+            if len(received) == 50:
+                done.set()
+
+        alice = self.client("alice")
+        bob = self.client("bob", on_message=on_message)
+        alice.connect()
+        bob.connect()
+
+        for i in range(50):
+            alice.send("bob", str(i).encode())
+        self.assertTrue(done.wait(30))
+        self.assertEqual(received, [str(i).encode() for i in range(50)])
+
+    def test_dh_handshake(self):
+        alice = self.client("alice", key_exchange="ffdhe2048")
+        bob = self.client("bob") # RSA and DH sessions relay to each other
+        alice.connect()
+        bob.connect()
+        self.assertIsNone(alice.private_key) # the DH secret is gone once the key is derived
+
+        self.assertTrue(alice.send("bob", b"fara RSA"))
+        self.assertEqual(next(bob.messages(timeout=10)), ("alice", b"fara RSA"))
+        self.assertTrue(bob.send("alice", b"raspuns"))
+        self.assertEqual(next(alice.messages(timeout=10)), ("bob", b"raspuns"))
+
+    def test_unknown_key_exchange(self):
+        with self.assertRaises(ValueError):
+            SecureClient("alice", key_exchange="ffdhe1024")
+
+    def test_server_key_pinned(self):
+        alice = self.client("alice", server_key=self.server.identity_fingerprint)
+        alice.connect()
+        self.assertTrue(alice.send("alice", b"ok"))
+
+        mallory = self.client("mallory", server_key="ab" * 32)
+        with self.assertRaises(ConnectionError):
+            mallory.connect(timeout=10)
+        self.assertIsNone(mallory.keys)
+
+    def test_server_key_pinned_on_first_use(self):
+        known_hosts = os.path.join(self.store.name, "known_hosts")
+        alice = self.client("alice", server_key=None, known_hosts=known_hosts)
+        alice.connect()
+        self.assertEqual(alice.server_key, self.server.identity_fingerprint)
+        with open(known_hosts) as f:
+            self.assertEqual(f.read(), f"{alice.url} {self.server.identity_fingerprint}\n")
+
+        # The server comes back on the same URL with another key: a new client (a restart,
+        # another process) finds the pin in known_hosts and refuses it
+        self.server.stop()
+        impostor = SecureServer('127.0.0.1', self.server.port, identity=rsa_generate_signing_keys(2048)[1])
+        threading.Thread(target=impostor.start, daemon=True).start()
+        self.assertTrue(impostor.listening.wait(5))
+        self.addCleanup(impostor.stop)
+        bob = self.client("bob", server_key=None, known_hosts=known_hosts)
+        with self.assertRaises(ConnectionError):
+            bob.connect(timeout=10)
+        self.assertIsNone(bob.keys)
+        self.assertIn("does not match the pinned key", bob.handshake_error)
+
+    def test_unpinned_server_key_needs_opt_in(self):
+        alice = self.client("alice", server_key=None, known_hosts=None)
+        with self.assertRaises(ConnectionError):
+            alice.connect(timeout=10)
+        self.assertIsNone(alice.keys)
+
+        bob = self.client("bob", server_key=None, known_hosts=None, insecure_tofu=True)
+        bob.connect()
+        self.assertEqual(bob.server_key, self.server.identity_fingerprint)
+
+    def test_payload_too_long(self):
+        alice = self.client("alice")
+        alice.connect()
+        with self.assertRaises(ValueError):
+            alice.send("bob", b"x" * 17)
+
+    def test_offline_messages_delivered_on_connect(self):
+        bob = self.client("bob")
+        bob.connect()
+        bob.close()
+        self.assertTrue(wait_until(lambda: "bob" not in self.server.connected_clients))
+        alice = self.client("alice")
+        alice.connect()
+        alice.send("bob", b"ai mesaj")
+        alice.send("bob", b"inca unul")
+
+        bob = self.client("bob")
+        bob.connect()
+        inbox = bob.messages(timeout=10)
+        self.assertEqual([next(inbox), next(inbox)], [("alice", b"ai mesaj"), ("alice", b"inca unul")])
+
+    def test_no_queue_for_names_never_seen(self):
+        alice = self.client("alice")
+        alice.connect()
+        alice.send("nimeni", b"pierdut")
+        alice.send("alice", b"dupa") # handled after the first one by the same thread
+        self.assertEqual(next(alice.messages(timeout=10)), ("alice", b"dupa"))
+        self.assertFalse(self.server.offline_store.knows("nimeni"))
+        self.assertEqual(self.server.metrics.snapshot()["counters"]['drops_total{reason="no_recipient"}'], 1)
+
+    def test_stats_only_for_admin_clients(self):
+        self.server.admin_clients = frozenset({"admin"})
+        events = []
+        got_stats = threading.Event()
+
+        def on_event(msg):
+            events.append(msg)
+            got_stats.set()
+
+        alice = self.client("alice")
+        admin = self.client("admin")
+        alice.connect()
+        admin.connect()
+        alice.on_event = admin.on_event = on_event
+
+        alice.send_data_to_server({"type": "stats", "from": "alice"})
+        alice.send("admin", b"dupa stats") # same handler thread: the stats frame was handled before this
+        self.assertEqual(next(admin.messages(timeout=10)), ("alice", b"dupa stats"))
+        self.assertEqual(events, [])
+        self.assertEqual(self.server.metrics.snapshot()["counters"]['drops_total{reason="not_admin"}'], 1)
+
+        admin.send_data_to_server({"type": "stats", "from": "admin"})
+        self.assertTrue(got_stats.wait(10))
+        self.assertEqual(events[0]["type"], "stats")
+
+    def test_bad_frames_keep_the_connection(self):
+        alice = self.client("alice")
+        bob = self.client("bob")
+        alice.connect()
+        bob.connect()
+        for frame in ([1, 2, 3], "text",
+                      {"type": "rekey_ack", "from": "alice", "epoch": "unu"},
+                      {"type": "offline_ack", "from": "alice", "seq": None},
+                      {"type": "presence_subscribe", "from": "alice", "since": -1},
+                      {"type": "message", "from": "alice", "recipient": "bob", "data": [], "epoch": [0]}):
+            alice.send_data_to_server(frame)
+        alice.send("bob", b"tot aici")
+        self.assertEqual(next(bob.messages(timeout=10)), ("alice", b"tot aici"))
+        self.assertEqual(self.server.metrics.snapshot()["counters"]['drops_total{reason="bad_frame"}'], 6)
+
+    def test_profile_and_trace_dump_only_for_admin_clients(self):
+        alice = self.client("alice")
+        bob = self.client("bob")
+        alice.connect()
+        bob.connect()
+        alice.send_data_to_server({"type": "profile", "from": "alice", "messages": 10})
+        alice.send_data_to_server({"type": "trace_dump", "from": "alice"})
+        alice.send("bob", b"dupa admin")
+        self.assertEqual(next(bob.messages(timeout=10)), ("alice", b"dupa admin"))
+        self.assertFalse(self.server.profile_window.active)
+        self.assertEqual(self.server.metrics.snapshot()["counters"]['drops_total{reason="not_admin"}'], 2)
+
+    def test_close_ends_iterator(self):
+        alice = self.client("alice")
+        alice.connect()
+        alice.close()
+        self.assertEqual(list(alice.messages(timeout=10)), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+"""
+Unit test payload compression
+"""
+
+import sys
+import os
+import zlib
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from topology.compression import Compressor, negotiate, supported, MIN_SIZE
+from topology.metrics import MetricsRegistry
+
+TEXT = ("salut, ce faci? sounds good, see you tomorrow. " * 200).encode()
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.metrics = MetricsRegistry()
+        self.compressor = Compressor(negotiate(supported()), self.metrics)
+
+    def test_roundtrip(self):
+        data, compressed = self.compressor.compress(TEXT)
+        self.assertTrue(compressed)
+        self.assertLess(len(data), len(TEXT) // 10)
+        self.assertEqual(self.compressor.decompress(data), TEXT)
+
+        counters = self.metrics.snapshot()["counters"]
+        self.assertEqual(counters["compression_bytes_saved_total"], len(TEXT) - len(data))
+        self.assertEqual(self.metrics.snapshot()["histograms"]["compress_seconds"]["count"], 1)
+
+    def test_skips_small_and_incompressible(self):
+        small = b"x" * (MIN_SIZE - 1)
+        self.assertEqual(self.compressor.compress(small), (small, False))
+        noise = os.urandom(32 * 1024)
+        self.assertEqual(self.compressor.compress(noise), (noise, False))
+
+        counters = self.metrics.snapshot()["counters"]
+        self.assertEqual(counters['compression_skipped_total{reason="small"}'], 1)
+        self.assertEqual(counters['compression_skipped_total{reason="incompressible"}'], 1)
+
+    def test_negotiation(self):
+        self.assertIsNone(negotiate(None))
+        self.assertIsNone(negotiate({"codec": "brotli"}))
+        plain = Compressor(negotiate({"codec": "zlib", "dictionary": "another"}))
+        self.assertFalse(plain.compatible(self.compressor))
+        self.assertEqual(plain.decompress(plain.compress(TEXT)[0]), TEXT)
+
+    def test_decompress_limits(self):
+        bomb = zlib.compress(b"\0" * (4 * 1024 * 1024))
+        plain = Compressor(negotiate({"codec": "zlib"}))
+        with self.assertRaises(ValueError):
+            plain.decompress(bomb)
+        with self.assertRaises(ValueError):
+            plain.decompress(b"not zlib")
+
+if __name__ == "__main__":
+    unittest.main()
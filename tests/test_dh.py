@@ -0,0 +1,62 @@
+"""
+Unit test Diffie-Hellman (RFC 7919 ffdhe)
+"""
+
+import sys
+import os
+import secrets
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from Cryptodome.Util import number
+from crypto.dh import (GROUPS, GENERATOR, FFDHE2048_P, fixed_base_table, fixed_base_pow, group_table,
+                       dh_generate_keys, dh_shared_secret, dh_check_public, dh_derive_key)
+
+class TestDH(unittest.TestCase):
+    def test_ffdhe_primes(self):
+        # RFC 7919, anexa A.1: primele si ultimele cifre hex ale lui ffdhe2048
+        self.assertTrue(('%X' % FFDHE2048_P).startswith("FFFFFFFFFFFFFFFFADF85458A2BB4A9AAFDC5620273D3CF1"))
+        self.assertTrue(('%X' % FFDHE2048_P).endswith("886B423861285C97FFFFFFFFFFFFFFFF"))
+        self.assertTrue(number.isPrime(FFDHE2048_P) and number.isPrime((FFDHE2048_P - 1) // 2))
+        for group, (p, _) in GROUPS.items():
+            self.assertEqual(p.bit_length(), int(group[5:]))
+            # p si (p - 1) / 2 trec testul Fermat (prim sigur); testul complet dureaza prea mult pentru 4096
+            self.assertEqual(pow(3, p - 1, p), 1, group)
+            self.assertEqual(pow(3, (p - 1) // 2 - 1, (p - 1) // 2), 1, group)
+
+    def test_fixed_base_pow(self):
+        p = 1000003
+        table = fixed_base_table(p, 40, base=5, window=3)
+        for exponent in (0, 1, 7, 8, 12345, 2 ** 40 - 1):
+            self.assertEqual(fixed_base_pow(table, exponent, p, window=3), pow(5, exponent, p))
+        # 14 ferestre de 3 biti acopera exponenti de cel mult 42 de biti
+        for exponent in (2 ** 42, -1):
+            with self.assertRaises(ValueError):
+                fixed_base_pow(table, exponent, p, window=3)
+
+        p, bits = GROUPS['ffdhe2048']
+        x = secrets.randbits(bits)
+        self.assertEqual(fixed_base_pow(group_table('ffdhe2048'), x, p), pow(GENERATOR, x, p))
+
+    def test_key_agreement(self):
+        for group in GROUPS:
+            client_public, client_secret = dh_generate_keys(group)
+            server_public, server_secret = dh_generate_keys(group)
+            shared = dh_shared_secret(group, server_public, client_secret)
+            self.assertEqual(shared, dh_shared_secret(group, client_public, server_secret))
+            self.assertEqual(len(shared) * 8, GROUPS[group][0].bit_length())
+            key = dh_derive_key(group, shared, client_public, server_public)
+            self.assertEqual(len(key), 16)
+            self.assertNotEqual(key, dh_derive_key(group, shared, server_public, client_public))
+
+    def test_invalid_public_keys(self):
+        p, _ = GROUPS['ffdhe2048']
+        _, secret = dh_generate_keys('ffdhe2048')
+        for bad in (0, 1, p - 1, p, p + 5):
+            self.assertFalse(dh_check_public('ffdhe2048', bad))
+            with self.assertRaises(ValueError):
+                dh_shared_secret('ffdhe2048', bad, secret)
+
+if __name__ == "__main__":
+    unittest.main()
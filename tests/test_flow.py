@@ -0,0 +1,281 @@
+"""
+Unit test flow control (rate limits, outbound queues, slow consumers)
+"""
+
+import sys
+import os
+import json
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from topology.flow import (TokenBucket, RateLimiter, OutboundQueue, FrameAssembler, POLICY_PARK, CONTROL,
+                           FRAGMENT_SIZE, LENGTH_MASK)
+from topology.server import SecureServer
+from topology.rekey import KeyRing, RekeyPolicy
+from topology.record import Sequencer, CLIENT_TO_SERVER
+from topology.keyschedule import traffic_key
+from aes.aes_encrypt import aes_encryption
+
+class StalledConn:
+    """Socket stand-in whose sendall blocks until released, like a client that stopped reading."""
+    def __init__(self):
+        self.release = threading.Event()
+        self.sent = []
+
+    def sendall(self, data):
+        self.release.wait()
+        self.sent.append(bytes(data)) # copied, like a socket: the buffer goes back to the pool
+
+    def shutdown(self, how):
+        self.release.set()
+
+    def close(self):
+        pass
+
+class RecordingConn(StalledConn):
+    def __init__(self):
+        super().__init__()
+        self.release.set()
+        self.arrivals = []
+
+    def sendall(self, data):
+        super().sendall(data)
+        self.arrivals.append(time.perf_counter())
+
+class TestRateLimits(unittest.TestCase):
+    def test_token_bucket_burst_then_refuse(self):
+        bucket = TokenBucket(rate=1, burst=3)
+        self.assertEqual([bucket.consume() for _ in range(4)], [True, True, True, False])
+
+    def test_rate_limiter_bytes(self):
+        limiter = RateLimiter(msgs_per_sec=0, bytes_per_sec=100)
+        self.assertTrue(limiter.allow(60))
+        self.assertFalse(limiter.allow(60))
+
+class TestOutboundQueue(unittest.TestCase):
+    def test_watermarks(self):
+        conn = StalledConn()
+        queue = OutboundQueue(conn, high_watermark=150, low_watermark=0)
+        self.assertTrue(queue.put(b"x" * 60))
+        time.sleep(0.05) # writer picks the first frame and blocks in sendall
+        self.assertTrue(queue.put(b"x" * 60))
+        self.assertFalse(queue.put(b"x" * 60)) # would exceed the high watermark
+        self.assertFalse(queue.put(b"x")) # stays refused until drained below the low watermark
+        self.assertEqual(queue.stats()["dropped"], 2)
+
+        conn.release.set()
+        deadline = time.time() + 5
+        while queue.stats()["over_watermark"] and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(queue.put(b"y"))
+        queue.close()
+        queue.writer.join(5)
+        self.assertEqual(b"".join(conn.sent), b"x" * 120 + b"y")
+
+def frame(body):
+    return len(body).to_bytes(4, 'big') + body
+
+def split_frames(data):
+    """Frames of a captured byte stream, fragments put back together."""
+    assembler = FrameAssembler()
+    frames = []
+    offset = 0
+    while offset < len(data):
+        prefix = int.from_bytes(data[offset:offset + 4], 'big')
+        size = prefix & LENGTH_MASK
+        whole = assembler.feed(prefix, data[offset + 4:offset + 4 + size])
+        offset += 4 + size
+        if whole is not None:
+            frames.append(whole)
+    return frames
+
+def wait_until(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+class TestWriterThread(unittest.TestCase):
+    def test_idle_writer_exits_and_restarts(self):
+        conn = RecordingConn()
+        queue = OutboundQueue(conn, linger=0.05)
+        self.assertIsNone(queue.writer) # no thread until there is something to send
+        queue.put(frame(b"one"), CONTROL)
+        first = queue.writer
+        self.assertTrue(wait_until(lambda: queue.writer is None))
+        first.join(1)
+        self.assertFalse(first.is_alive())
+        self.assertIsNone(queue.control) # idle queue holds no containers either
+        queue.put(frame(b"two"), flow="alice")
+        self.assertIsNot(queue.writer, first)
+        queue.close()
+        queue.writer.join(5)
+        self.assertEqual(split_frames(b"".join(conn.sent)), [b"one", b"two"])
+
+class TestScheduling(unittest.TestCase):
+    def stalled_queue(self):
+        """A queue whose writer is stuck sending a first control frame, so everything after it waits."""
+        conn = StalledConn()
+        queue = OutboundQueue(conn, high_watermark=1024 * 1024)
+        queue.put(frame(b"first"), CONTROL)
+        self.assertTrue(wait_until(lambda: queue.depth == 0))
+        return conn, queue
+
+    def drain(self, conn, queue):
+        conn.release.set()
+        queue.close()
+        queue.writer.join(5)
+        return split_frames(b"".join(conn.sent))[1:]
+
+    def test_control_overtakes_data(self):
+        conn, queue = self.stalled_queue()
+        for body in (b"data-1", b"data-2"):
+            queue.put(frame(body), flow="alice")
+        queue.put(frame(b"ping"), CONTROL)
+        self.assertEqual(self.drain(conn, queue), [b"ping", b"data-1", b"data-2"])
+
+    def test_flows_share_fairly(self):
+        conn, queue = self.stalled_queue()
+        for flow in ("bulk", "chat"):
+            for i in range(4):
+                queue.put(frame(flow.encode() + b"%d" % i + b"." * 8000), flow=flow)
+        order = [body[:5].rstrip(b"0123456789") for body in self.drain(conn, queue)]
+        # two 8 KB frames per 16 KB quantum, taking turns
+        self.assertEqual(order, [b"bulk", b"bulk", b"chat", b"chat"] * 2)
+
+    def test_weights(self):
+        conn, queue = self.stalled_queue()
+        for i in range(6):
+            queue.put(frame(b"a" * 8000), flow="a")
+            queue.put(frame(b"b" * 8000), flow="b", weight=2)
+        order = b"".join(body[:1] for body in self.drain(conn, queue))
+        self.assertEqual(order, b"aabbbbaabbaa")
+
+    def test_large_frame_fragmented_around_control(self):
+        conn = StalledConn()
+        queue = OutboundQueue(conn)
+        big = os.urandom(FRAGMENT_SIZE * 2 + 100)
+        queue.put(frame(big), flow="file")
+        self.assertTrue(wait_until(lambda: queue.data_taken == 1)) # first fragment on its way
+        queue.put(frame(b"rekey"), CONTROL)
+        conn.release.set()
+        queue.close()
+        queue.writer.join(5)
+        self.assertEqual(len(conn.sent), 3) # one fragment per sendall, the control frame with the second
+        self.assertEqual(split_frames(b"".join(conn.sent)), [b"rekey", big])
+
+    def test_fifo_mode(self):
+        conn = StalledConn()
+        queue = OutboundQueue(conn, prioritize=False)
+        queue.put(frame(b"first"), CONTROL)
+        self.assertTrue(wait_until(lambda: queue.depth == 0))
+        big = b"x" * (FRAGMENT_SIZE * 2)
+        queue.put(frame(big), flow="file")
+        queue.put(frame(b"ping"), CONTROL)
+        frames = self.drain(conn, queue)
+        self.assertEqual(frames, [big, b"ping"])
+        self.assertFalse(any(int.from_bytes(chunk[:4], 'big') & ~LENGTH_MASK for chunk in conn.sent))
+
+    def test_rekey_waits_for_old_epoch_data(self):
+        server = SecureServer('127.0.0.1', 0, rekey_policy=RekeyPolicy(max_bytes=0, max_messages=1, max_seconds=0))
+        alice, bob = RecordingConn(), StalledConn()
+        key = bytes(range(16))
+        with server.client_lock:
+            for name, conn in (("alice", alice), ("bob", bob)):
+                server.register_client(name, conn, (1, 1))
+                server.connected_clients[name].keys = KeyRing(key)
+            bob_info = server.connected_clients["bob"]
+            bob_info.outbound.put(frame(b"blocker"), CONTROL)
+        self.assertTrue(wait_until(lambda: bob_info.outbound.depth == 0))
+
+        def relay():
+            msg = {"type": "message", "from": "alice", "recipient": "bob",
+                   "data": list(aes_encryption(b"salut".ljust(16, b"\0"), traffic_key(key, CLIENT_TO_SERVER))), "epoch": 0}
+            server.relay_message("alice", msg, time.perf_counter())
+
+        relay() # queued under epoch 0, then the notice for epoch 1 jumps ahead of it
+        self.assertEqual(bob_info.keys.epoch, 1)
+        bob_info.keys.confirm(1)
+        relay()
+        self.assertEqual(bob_info.keys.epoch, 1) # the epoch 0 frame has not left the queue yet
+
+        bob.release.set()
+        self.assertTrue(wait_until(lambda: bob_info.outbound.data_taken == 2))
+        relay()
+        self.assertEqual(bob_info.keys.epoch, 2)
+        server.stop()
+
+class TestSlowConsumer(unittest.TestCase):
+    def setUp(self):
+        self.key = bytes(range(16))
+
+    def make_server(self, **kwargs):
+        server = SecureServer('127.0.0.1', 0, high_watermark=2048, low_watermark=512, **kwargs)
+        conns = {"alice": RecordingConn(), "bob": RecordingConn(), "carol": StalledConn()}
+        with server.client_lock:
+            for name, conn in conns.items():
+                server.register_client(name, conn, (1, 1))
+                server.connected_clients[name].keys = KeyRing(self.key)
+        return server, conns
+
+    def relay(self, server, recipient):
+        msg = {"type": "message", "from": "alice", "recipient": recipient,
+               "data": list(aes_encryption(b"salut".ljust(16, b"\0"), traffic_key(self.key, CLIENT_TO_SERVER)))}
+        started = time.perf_counter()
+        server.relay_message("alice", msg, started)
+        return started
+
+    def test_stalled_client_does_not_delay_others(self):
+        server, conns = self.make_server()
+        sent_at = []
+        bob_queue = server.connected_clients["bob"].outbound
+        for _ in range(50):
+            self.relay(server, "carol") # carol never reads
+            sent_at.append(self.relay(server, "bob"))
+            # bob keeps up; on one core the relay loop could otherwise outrun his writer thread
+            wait_until(lambda: bob_queue.depth == 0)
+
+        def frames_for_bob():
+            return sum(chunk.count(b'"recipient": "bob"') for chunk in conns["bob"].sent)
+
+        deadline = time.time() + 5
+        while frames_for_bob() < 50 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(frames_for_bob(), 50)
+        self.assertLess(conns["bob"].arrivals[-1] - sent_at[-1], 1.0)
+
+        # carol overflowed her queue and was disconnected under the default policy
+        self.assertNotIn("carol", server.connected_clients)
+        snapshot = server.metrics.snapshot()
+        self.assertEqual(snapshot["counters"]["slow_consumer_disconnects_total"], 1)
+        server.stop()
+
+    def test_park_policy_keeps_client(self):
+        server, conns = self.make_server(slow_consumer_policy=POLICY_PARK)
+        for _ in range(50):
+            self.relay(server, "carol")
+        self.assertTrue(server.connected_clients["carol"].parked)
+        snapshot = server.metrics.snapshot()
+        self.assertEqual(snapshot["gauges"]["parked_clients"], 1)
+        self.assertGreater(snapshot["counters"]['drops_total{reason="queue_full"}'], 0)
+        server.stop()
+
+    def test_rate_limited_sender(self):
+        server, conns = self.make_server(rate_limit_msgs=5)
+        sequencer = Sequencer()
+        server._recv_timing.prefix_at = time.perf_counter()
+        for _ in range(20):
+            msg = {"type": "message", "from": "alice", "recipient": "bob",
+                   "data": list(aes_encryption(b"x".ljust(16, b"\0"), traffic_key(self.key, CLIENT_TO_SERVER))), "epoch": 0}
+            frame = json.dumps(sequencer.seal(msg, self.key, CLIENT_TO_SERVER)).encode()
+            server.process_frame(conns["alice"], "alice", frame, time.perf_counter())
+        counters = server.metrics.snapshot()["counters"]
+        self.assertEqual(counters["messages_relayed_total"], 5)
+        self.assertEqual(counters['drops_total{reason="rate_limited"}'], 15)
+        server.stop()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+"""
+Unit test HMAC-SHA-256 si HKDF (RFC 4231, RFC 5869)
+"""
+
+import sys
+import os
+import hmac
+import hashlib
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from crypto.hkdf import HmacSha256, hmac_sha256, hkdf_extract, hkdf_expand, hkdf
+
+class TestHmac(unittest.TestCase):
+    def test_rfc4231_vectors(self):
+        # RFC 4231, cazurile 1, 2 si 6 (cheie mai lunga decat blocul SHA-256)
+        vectors = [
+            (b"\x0b" * 20, b"Hi There",
+             "b0344c61d8db38535ca8afceaf0bf12b881dc200c9833da726e9376c2e32cff7"),
+            (b"Jefe", b"what do ya want for nothing?",
+             "5bdcc146bf60754e6a042426089575c75a003f089d2739839dec58b964ec3843"),
+            (b"\xaa" * 131, b"Test Using Larger Than Block-Size Key - Hash Key First",
+             "60e431591ee0b67f0d8a26aacbf5b77f8e0bc6213728c5140546040f0ee37f54"),
+        ]
+        for key, data, expected in vectors:
+            self.assertEqual(hmac_sha256(key, data).hex(), expected)
+
+    def test_precomputed_state_is_reused(self):
+        state = HmacSha256(b"cheie")
+        for data in (b"", b"a", b"x" * 200):
+            self.assertEqual(state.mac(data), hmac.new(b"cheie", data, hashlib.sha256).digest())
+        # update pe o copie nu atinge starea precalculata
+        running = state.copy()
+        running.update(b"abc")
+        running.update(b"def")
+        self.assertEqual(running.digest(), state.mac(b"abcdef"))
+        self.assertEqual(state.mac(b""), hmac_sha256(b"cheie", b""))
+
+class TestHkdf(unittest.TestCase):
+    def test_rfc5869_vectors(self):
+        # RFC 5869, anexa A, cazurile 1-3 (SHA-256)
+        vectors = [
+            (b"\x0b" * 22, bytes(range(13)), bytes(range(0xf0, 0xfa)), 42,
+             "077709362c2e32df0ddc3f0dc47bba6390b6c73bb50f9c3122ec844ad7c2b3e5",
+             "3cb25f25faacd57a90434f64d0362f2a2d2d0a90cf1a5a4c5db02d56ecc4c5bf34007208d5b887185865"),
+            (bytes(range(0x50)), bytes(range(0x60, 0xb0)), bytes(range(0xb0, 0x100)), 82,
+             "06a6b88c5853361a06104c9ceb35b45cef760014904671014a193f40c15fc244",
+             "b11e398dc80327a1c8e7f78c596a49344f012eda2d4efad8a050cc4c19afa97c"
+             "59045a99cac7827271cb41c65e590e09da3275600c2f09b8367793a9aca3db71"
+             "cc30c58179ec3e87c14c01d5c1f3434f1d87"),
+            (b"\x0b" * 22, b"", b"", 42,
+             "19ef24a32c717b167f33a91d6f648bdf96596776afdb6377ac434c1c293ccb04",
+             "8da4e775a563c18f715f802a063c5a31b8a11f5c5ee1879ec3454e5f3c738d2d9d201395faa4b61a96c8"),
+        ]
+        for ikm, salt, info, length, prk, okm in vectors:
+            self.assertEqual(hkdf_extract(salt, ikm).hex(), prk)
+            self.assertEqual(hkdf_expand(bytes.fromhex(prk), info, length).hex(), okm)
+            self.assertEqual(hkdf_expand(HmacSha256(bytes.fromhex(prk)), info, length).hex(), okm)
+            self.assertEqual(hkdf(ikm, salt, info, length).hex(), okm)
+
+    def test_length_limit(self):
+        self.assertEqual(len(hkdf_expand(b"k" * 32, b"", 255 * 32)), 255 * 32)
+        with self.assertRaises(ValueError):
+            hkdf_expand(b"k" * 32, b"", 255 * 32 + 1)
+
+if __name__ == "__main__":
+    unittest.main()
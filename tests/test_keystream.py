@@ -0,0 +1,134 @@
+"""
+Test the CTR message mode: precomputed keystream, counter handling and relaying between modes
+"""
+
+import sys
+import os
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from aes.aes_ctr import aes_ctr
+from aes.aes_key import AESKey
+from topology.keystream import Keystream, decrypt_ctr
+from topology.rekey import RekeyPolicy, derive_next_key
+from topology.server import SecureServer
+from topology.topology import SecureClient
+
+KEY = bytes(range(16))
+NONCE = bytes(8)
+
+class ManualRefiller:
+    """Records the streams that asked for a refill instead of running a thread."""
+
+    def __init__(self):
+        self.scheduled = []
+
+    def schedule(self, stream):
+        self.scheduled.append(stream)
+
+def expected_block(stream, counter):
+    return aes_ctr(bytes(16), KEY, stream.nonce, counter)
+
+class TestKeystream(unittest.TestCase):
+    def test_blocks_match_aes_ctr(self):
+        refiller = ManualRefiller()
+        stream = Keystream(AESKey(KEY), NONCE, capacity=4, refiller=refiller)
+        self.assertEqual(refiller.scheduled, [stream]) # filled ahead of the first send
+        while stream.refill_one():
+            pass
+        self.assertEqual(stream.available, 4)
+        for counter in range(4):
+            self.assertEqual(stream.take(), (counter, expected_block(stream, counter)))
+
+    def test_counters_are_never_reused_across_refills(self):
+        refiller = ManualRefiller()
+        stream = Keystream(AESKey(KEY), NONCE, capacity=4, refiller=refiller)
+        taken = []
+        for round in range(6):
+            for _ in range(round % 3): # refills that stop short, run dry or overlap takes
+                stream.refill_one()
+            taken.extend(stream.take() for _ in range(3))
+        self.assertEqual([counter for counter, _ in taken], list(range(18)))
+        for counter, block in taken:
+            self.assertEqual(block, expected_block(stream, counter))
+
+    def test_client_keeps_one_stream_per_epoch(self):
+        client = SecureClient("alice")
+        client.ctr = True
+        next_key = derive_next_key(KEY, 1)
+        stream = client.keystream_for(0, KEY)
+        self.assertIs(client.keystream_for(0, KEY), stream)
+        newer = client.keystream_for(1, next_key)
+        self.assertNotEqual((newer.cipher.key, newer.nonce), (stream.cipher.key, stream.nonce))
+        # a send still holding the epoch 0 key must not restart that epoch's counters
+        self.assertIsNone(client.keystream_for(0, KEY))
+        self.assertIs(client.keystream_for(1, next_key), newer)
+
+    def test_decrypt_ctr(self):
+        stream = Keystream(AESKey(KEY), NONCE, refiller=ManualRefiller())
+        stream.take()
+        counter, ciphertext = stream.encrypt(b"hello".ljust(16, b"\0"))
+        frame = {"data": list(ciphertext), "nonce": stream.nonce.hex(), "ctr": counter}
+        self.assertEqual(decrypt_ctr(AESKey(KEY), frame).rstrip(b"\0"), b"hello")
+        for bad in ({"ctr": -1}, {"ctr": "1"}, {"nonce": "00"}, {"data": list(ciphertext) * 2}):
+            with self.assertRaises(ValueError):
+                decrypt_ctr(AESKey(KEY), {**frame, **bad})
+
+class TestCtrRelay(unittest.TestCase):
+    def setUp(self):
+        self.server = SecureServer('127.0.0.1', 0, rekey_policy=RekeyPolicy(max_bytes=0, max_messages=10, max_seconds=0))
+        threading.Thread(target=self.server.start, daemon=True).start()
+        self.assertTrue(self.server.listening.wait(5))
+        self.addCleanup(self.server.stop)
+
+    def client(self, name, **options):
+        received = []
+        done = threading.Event()
+
+        def on_message(sender, payload, msg):
+            received.append((payload, msg))
+            if len(received) >= client.expected:
+                done.set()
+
+        client = SecureClient(name, port=self.server.port, server_key=self.server.identity_fingerprint,
+                              on_message=on_message, **options)
+        client.expected, client.received, client.done = 1, received, done
+        client.connect()
+        self.addCleanup(client.close)
+        return client
+
+    def test_ctr_and_block_clients_talk_to_each_other(self):
+        alice = self.client("alice")
+        bob = self.client("bob", message_mode='block')
+        self.assertTrue(alice.ctr)
+        self.assertFalse(bob.ctr)
+        alice.send("bob", b"to bob")
+        bob.send("alice", b"to alice")
+        self.assertTrue(bob.done.wait(5))
+        self.assertTrue(alice.done.wait(5))
+        self.assertEqual(bob.received[0][0], b"to bob")
+        self.assertNotIn("ctr", bob.received[0][1])
+        self.assertEqual(alice.received[0][0], b"to alice")
+        self.assertIn("ctr", alice.received[0][1])
+
+    def test_rekeys_start_new_streams(self):
+        alice = self.client("alice")
+        bob = self.client("bob")
+        bob.expected = 60
+        for i in range(bob.expected):
+            self.assertTrue(alice.send("bob", str(i).encode()))
+        self.assertTrue(bob.done.wait(10))
+        self.assertEqual([payload for payload, _ in bob.received], [str(i).encode() for i in range(60)])
+        blocks = [(msg["epoch"], msg["nonce"], msg["ctr"]) for _, msg in bob.received]
+        self.assertEqual(len(set(blocks)), len(blocks))
+        epochs = {}
+        for epoch, nonce, _ in blocks:
+            epochs.setdefault(epoch, set()).add(nonce)
+        self.assertGreater(len(epochs), 1)
+        nonces = [nonce for epoch in sorted(epochs) for nonce in epochs[epoch]]
+        self.assertEqual(len(nonces), len(set(nonces))) # no nonce carried over into another epoch
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+"""
+Unit test load generator
+"""
+
+import sys
+import os
+import asyncio
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from topology.loadgen import parse_size, start_offsets, parse_args, run_worker, summarize, SimulatedClient
+from topology.server import SecureServer
+
+class TestLoadgen(unittest.TestCase):
+    def test_sizes_clamped_to_block(self):
+        self.assertEqual(parse_size("fixed:12")(), 12)
+        self.assertEqual(parse_size("fixed:64")(), 16)
+        sizes = {parse_size("uniform:8:10")() for _ in range(200)}
+        self.assertEqual(sizes, {8, 9, 10})
+        self.assertIn(parse_size("choice:9,15")(), (9, 15))
+        with self.assertRaises(ValueError):
+            parse_size("normal:3")
+
+    def test_ramp_profiles(self):
+        self.assertEqual(start_offsets(3, "none"), [0.0, 0.0, 0.0])
+        self.assertEqual(start_offsets(4, "linear:4"), [0.0, 1.0, 2.0, 3.0])
+        self.assertEqual(start_offsets(4, "step:2:10"), [0.0, 0.0, 5.0, 5.0])
+
+    def test_message_id_roundtrip(self):
+        for msg_id in (0, 35, 36, 123456):
+            self.assertEqual(int(SimulatedClient.encode_id(msg_id), 36), msg_id)
+
+    def test_worker_against_server(self):
+        server = SecureServer('127.0.0.1', 0)
+        threading.Thread(target=server.start, daemon=True).start()
+        self.assertTrue(server.listening.wait(5))
+        try:
+            config = parse_args(["--port", str(server.port), "--clients", "4", "--processes", "1",
+                                 "--rate", "20", "--duration", "1", "--drain", "1", "--arrival", "constant"])
+            stats = asyncio.run(run_worker(0, 4, start_offsets(4, "none"), config))
+        finally:
+            server.stop()
+
+        self.assertEqual(len(stats.handshake_times), 4)
+        self.assertGreater(stats.sent, 0)
+        self.assertEqual(stats.received, stats.sent)
+
+        summary = summarize([{
+            "sent": stats.sent, "received": stats.received, "bytes_sent": stats.bytes_sent,
+            "latencies": stats.latencies, "handshake_times": stats.handshake_times,
+            "handshake_done": stats.handshake_done, "errors": stats.errors, "unanswered": len(stats.sent_at),
+        }], config, 2.0)
+        self.assertEqual(summary["handshakes"], 4)
+        self.assertNotIn("lost", summary["errors"])
+        self.assertGreater(summary["latency_ms"]["p99"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
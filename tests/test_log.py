@@ -0,0 +1,78 @@
+"""
+Unit test structured logging
+"""
+
+import sys
+import os
+import io
+import logging
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from topology.log import configure_logging, get_logger, RateLimitFilter, StructuredFormatter, ROOT_LOGGER
+
+class TestLog(unittest.TestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+
+    def tearDown(self):
+        logger = logging.getLogger(ROOT_LOGGER)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.setLevel(logging.NOTSET)
+        logger.propagate = True
+
+    def log_lines(self, listener):
+        listener.stop()  # drains the queue
+        return self.stream.getvalue().splitlines()
+
+    def test_structured_fields_and_redaction(self):
+        listener = configure_logging(logging.DEBUG, stream=self.stream)
+        get_logger("server").debug("Decrypted message", extra={"sender": "client1", "payload": "secret text"})
+
+        lines = self.log_lines(listener)
+        self.assertEqual(len(lines), 1)
+        self.assertIn('level=DEBUG', lines[0])
+        self.assertIn('logger=p2p.server', lines[0])
+        self.assertIn('msg="Decrypted message"', lines[0])
+        self.assertIn('sender=client1', lines[0])
+        self.assertIn('payload="<redacted 11 chars>"', lines[0])
+        self.assertNotIn('secret', lines[0])
+
+    def test_redaction_can_be_disabled(self):
+        listener = configure_logging(logging.DEBUG, stream=self.stream, redact=False)
+        get_logger("server").debug("Decrypted message", extra={"payload": "hello"})
+        self.assertIn('payload=hello', self.log_lines(listener)[0])
+
+    def test_level_filtering(self):
+        listener = configure_logging(logging.INFO, stream=self.stream)
+        log = get_logger("server")
+        log.debug("hidden")
+        log.info("shown")
+        lines = self.log_lines(listener)
+        self.assertEqual(len(lines), 1)
+        self.assertIn('msg=shown', lines[0])
+
+    def test_rate_limit(self):
+        limiter = RateLimitFilter(interval=60, burst=2)
+        record = logging.LogRecord("p2p.server", logging.WARNING, "", 0, "Malformed JSON", (), None)
+        allowed = [limiter.filter(record) for _ in range(5)]
+        self.assertEqual(allowed, [True, True, False, False, False])
+
+        info = logging.LogRecord("p2p.server", logging.INFO, "", 0, "Malformed JSON", (), None)
+        self.assertTrue(all(limiter.filter(info) for _ in range(5)))
+
+        limiter.interval = 0
+        record = logging.LogRecord("p2p.server", logging.WARNING, "", 0, "Malformed JSON", (), None)
+        self.assertTrue(limiter.filter(record))
+        self.assertEqual(record.suppressed, 3)
+
+    def test_formatter_quotes_values(self):
+        record = logging.LogRecord("p2p.server", logging.INFO, "", 0, "Client connected", (), None)
+        record.client = 'a "b"'
+        line = StructuredFormatter().format(record)
+        self.assertIn('client="a \\"b\\""', line)
+
+if __name__ == "__main__":
+    unittest.main()
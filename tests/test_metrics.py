@@ -0,0 +1,74 @@
+"""
+Unit test metrics registry
+"""
+
+import sys
+import os
+import threading
+import urllib.request
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from topology.metrics import MetricsRegistry, serve_metrics, HISTOGRAM_BUCKETS
+
+class TestMetrics(unittest.TestCase):
+    def test_counters_merged_across_threads(self):
+        registry = MetricsRegistry()
+
+        def work():
+            for _ in range(1000):
+                registry.inc('messages_relayed_total')
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        registry.inc('messages_relayed_total')
+
+        # the shards of finished threads must not be lost
+        self.assertEqual(registry.snapshot()["counters"]['messages_relayed_total'], 4001)
+        self.assertEqual(registry.snapshot()["counters"]['messages_relayed_total'], 4001)
+
+    def test_histogram_buckets(self):
+        registry = MetricsRegistry()
+        registry.observe('send_seconds', 0.0000005)  # 0.5us -> bucket 0
+        registry.observe('send_seconds', 0.000003)   # 3us   -> bucket 2 (< 4us)
+        registry.observe('send_seconds', 1000)       # overflow -> +Inf
+
+        histogram = registry.snapshot()["histograms"]['send_seconds']
+        self.assertEqual(histogram["count"], 3)
+        self.assertEqual(histogram["buckets"][0], 1)
+        self.assertEqual(histogram["buckets"][2], 1)
+        self.assertEqual(histogram["buckets"][HISTOGRAM_BUCKETS], 1)
+
+    def test_prometheus_text(self):
+        registry = MetricsRegistry()
+        registry.inc('drops_total{reason="offline"}', 2)
+        registry.inc('drops_total{reason="malformed"}')
+        registry.set_gauge('connected_clients', 3)
+        with registry.time('handshake_seconds'):
+            pass
+
+        text = registry.render_prometheus()
+        self.assertEqual(text.count('# TYPE p2p_drops_total counter'), 1)
+        self.assertIn('p2p_drops_total{reason="offline"} 2', text)
+        self.assertIn('p2p_connected_clients 3', text)
+        self.assertIn('p2p_handshake_seconds_bucket{le="+Inf"} 1', text)
+        self.assertIn('p2p_handshake_seconds_count 1', text)
+
+    def test_http_endpoint(self):
+        registry = MetricsRegistry()
+        registry.inc('connections_total')
+        httpd = serve_metrics(registry, port=0)
+        try:
+            url = f"http://127.0.0.1:{httpd.server_address[1]}/metrics"
+            body = urllib.request.urlopen(url, timeout=5).read().decode()
+            self.assertIn('p2p_connections_total 1', body)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+if __name__ == "__main__":
+    unittest.main()
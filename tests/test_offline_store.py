@@ -0,0 +1,154 @@
+"""
+Unit test offline store
+"""
+
+import sys
+import os
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from topology.offline_store import OfflineStore, FsyncPolicy, load_or_create_key
+
+class TestOfflineStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_pending_in_order(self):
+        store = OfflineStore(self.dir, fsync_policy=FsyncPolicy.always())
+        for i in range(5):
+            store.append("client2", f"mesaj {i}".encode())
+        store.append("client3", b"altul")
+
+        pending = store.pending("client2")
+        self.assertEqual([seq for seq, _ in pending], [0, 1, 2, 3, 4])
+        self.assertEqual([frame for _, frame in pending], [f"mesaj {i}".encode() for i in range(5)])
+        self.assertEqual(store.pending("client3"), [(0, b"altul")])
+        self.assertEqual(store.pending("client1"), [])
+        store.close()
+
+    def test_survives_restart(self):
+        store = OfflineStore(self.dir)
+        store.append("client2", b"a")
+        store.append("client2", b"b")
+        store.close()
+
+        store = OfflineStore(self.dir)
+        self.assertEqual(store.pending("client2"), [(0, b"a"), (1, b"b")])
+        store.append("client2", b"c")
+        self.assertEqual(store.pending("client2")[-1], (2, b"c"))
+        store.close()
+
+    def test_ack_removes_delivered(self):
+        store = OfflineStore(self.dir)
+        for i in range(4):
+            store.append("client2", bytes([i]))
+        store.ack("client2", 1)
+        self.assertEqual(store.pending("client2"), [(2, b"\x02"), (3, b"\x03")])
+        self.assertEqual(store.queued_count("client2"), 2)
+
+        # sequence numbers keep growing after compaction
+        self.assertEqual(store.append("client2", b"\x04"), 4)
+        store.close()
+
+    def test_segments_compacted_after_ack(self):
+        store = OfflineStore(self.dir, segment_max_bytes=64)
+        for i in range(20):
+            store.append("client2", b"x" * 20)
+        segment_dir = os.path.join(self.dir, "segments")
+        self.assertGreater(len(os.listdir(segment_dir)), 1)
+
+        store.ack("client2", 19)
+        self.assertEqual(len(os.listdir(segment_dir)), 1)
+        self.assertEqual(store.pending("client2"), [])
+        store.close()
+
+    def test_index_grows(self):
+        store = OfflineStore(self.dir)
+        for i in range(300):
+            store.append("client2", i.to_bytes(2, "big"))
+        pending = store.pending("client2")
+        self.assertEqual(len(pending), 300)
+        self.assertEqual(pending[299], (299, (299).to_bytes(2, "big")))
+        store.close()
+
+    def test_pending_in_batches(self):
+        store = OfflineStore(self.dir)
+        for i in range(150):
+            store.append("client2", i.to_bytes(2, "big"))
+        batches = store.pending_batches("client2", batch_size=64)
+        self.assertEqual([seq for seq, _ in next(batches)], list(range(64)))
+        store.ack("client2", 99) # acks between batches do not shift what is read next
+        self.assertEqual([seq for seq, _ in next(batches)], list(range(100, 150)))
+        self.assertEqual(list(batches), [])
+        self.assertEqual([len(b) for b in store.pending_batches("client2", start=120, batch_size=16)], [16, 14])
+        store.close()
+
+    def test_torn_record_at_tail(self):
+        store = OfflineStore(self.dir)
+        store.append("client2", b"intreg")
+        store.append("client2", b"taiat la scriere")
+        store.close()
+        segment = os.path.join(self.dir, "segments", os.listdir(os.path.join(self.dir, "segments"))[0])
+        with open(segment, "r+b") as f:
+            f.truncate(os.path.getsize(segment) - 5) # header intact, body incomplete
+
+        store = OfflineStore(self.dir)
+        self.assertEqual(store.pending("client2"), [(0, b"intreg")])
+        store.close()
+
+    def test_quotas(self):
+        store = OfflineStore(self.dir, max_recipient_bytes=3 * 14, max_total_bytes=5 * 14)
+        for i in range(3):
+            self.assertEqual(store.append("client2", b"x" * 10), i) # 4 byte header + 10
+        self.assertIsNone(store.append("client2", b"x" * 10))
+        self.assertEqual(store.append("client3", b"y" * 10), 0)
+        self.assertEqual(store.append("client3", b"y" * 10), 1)
+        self.assertIsNone(store.append("client4", b"z" * 10)) # the store is full
+        self.assertEqual(store.queued_bytes(), 5 * 14)
+
+        store.ack("client2", 1)
+        self.assertEqual(store.queued_bytes("client2"), 14)
+        self.assertEqual(store.append("client4", b"z" * 10), 0)
+        store.close()
+
+        store = OfflineStore(self.dir)
+        self.assertEqual(store.queued_bytes("client2"), 14)
+        self.assertEqual(store.queued_bytes(), 4 * 14)
+        store.close()
+
+    def test_idle_indexes_closed(self):
+        store = OfflineStore(self.dir, max_open_indexes=2)
+        for name in ("client1", "client2", "client3"):
+            store.append(name, name.encode())
+        self.assertEqual(list(store.indexes), ["client2", "client3"])
+        self.assertEqual(store.pending("client1"), [(0, b"client1")]) # reopened on demand
+        self.assertEqual(list(store.indexes), ["client3", "client1"])
+        store.close()
+
+        store = OfflineStore(self.dir, max_open_indexes=2)
+        self.assertEqual(len(store.indexes), 0) # opened when used, not at startup
+        self.assertEqual(store.queued_count("client2"), 1)
+        store.close()
+
+    def test_registered_recipients(self):
+        store = OfflineStore(self.dir)
+        self.assertFalse(store.knows("client2"))
+        store.register("client2")
+        self.assertTrue(store.knows("client2"))
+        self.assertEqual(store.pending("client2"), [])
+        store.close()
+        self.assertTrue(OfflineStore(self.dir).knows("client2"))
+
+    def test_store_key_persistent(self):
+        key = load_or_create_key(self.dir)
+        self.assertEqual(len(key), 16)
+        self.assertEqual(load_or_create_key(self.dir), key)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+"""
+Test presence (server roster, client roster cache, deltas with versions)
+"""
+
+import sys
+import os
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from topology.presence import Roster, RosterCache, valid_name, PRESENCE_BATCH
+from topology.server import SecureServer
+from topology.topology import SecureClient
+from topology.identity import ephemeral_identity
+
+class TestRoster(unittest.TestCase):
+    def test_delta_since_version(self):
+        roster = Roster()
+        roster.add("alice")
+        roster.add("bob")
+        roster.remove("alice")
+        roster.add("carol")
+        self.assertEqual(roster.version, 4)
+        self.assertEqual(roster.delta(4), ([], []))
+        self.assertEqual(roster.delta(2), (["carol"], ["alice"]))
+        added, removed = roster.delta(0)
+        self.assertEqual(sorted(added), ["bob", "carol"])
+        self.assertEqual(removed, ["alice"])
+        self.assertFalse(roster.add("bob")) # already online, no new version
+        self.assertEqual(roster.version, 4)
+
+    def test_old_version_gets_full_roster(self):
+        roster = Roster(history=2)
+        for name in ("a", "b", "c", "d"):
+            roster.add(name)
+        self.assertIsNone(roster.delta(1))
+        frames = roster.frames(1)
+        self.assertTrue(frames[0]["reset"])
+        self.assertEqual(frames[0]["added"], ["a", "b", "c", "d"])
+
+    def test_full_roster_in_batches(self):
+        roster = Roster()
+        for i in range(PRESENCE_BATCH * 2 + 5):
+            roster.add(f"user{i}")
+        frames = roster.frames()
+        self.assertEqual(len(frames), 3)
+        self.assertEqual([f["more"] for f in frames], [True, True, False])
+
+        cache = RosterCache()
+        for frame in frames:
+            self.assertTrue(cache.apply(frame))
+        self.assertEqual(len(cache), PRESENCE_BATCH * 2 + 5)
+        self.assertEqual(cache.version, roster.version)
+
+    def test_cache_applies_deltas_and_detects_gaps(self):
+        roster = Roster()
+        roster.add("alice")
+        cache = RosterCache()
+        cache.apply(roster.frames()[0])
+
+        roster.add("bob")
+        delta = roster.frames(1)[0]
+        roster.add("carol")
+        roster.remove("bob")
+        self.assertTrue(cache.apply(delta))
+        self.assertIn("bob", cache)
+        self.assertTrue(cache.apply(roster.frames(1)[0])) # overlaps what we have, still correct
+        self.assertEqual(list(cache), ["alice", "carol"])
+        self.assertFalse(cache.apply({"type": "presence", "version": 9, "base": 7, "added": ["x"], "removed": []}))
+
+    def test_valid_names(self):
+        self.assertTrue(valid_name("client1"))
+        for name in ("", "server", " alice", "a\nb", "x" * 65, None, 7):
+            self.assertFalse(valid_name(name), name)
+
+class TestPresenceUpdates(unittest.TestCase):
+    def setUp(self):
+        self.server = SecureServer('127.0.0.1', 0, identity=ephemeral_identity())
+        threading.Thread(target=self.server.start, daemon=True).start()
+        self.assertTrue(self.server.listening.wait(5))
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.stop()
+
+    def client(self, name, **kwargs):
+        client = SecureClient(name, port=self.server.port, server_key=self.server.identity_fingerprint, **kwargs)
+        self.clients.append(client)
+        return client
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.02)
+        return condition()
+
+    def test_subscriber_sees_joins_and_leaves(self):
+        changes = []
+        alice = self.client("alice", presence=True)
+        alice.on_presence = lambda added, removed: changes.append((added, removed))
+        alice.connect()
+        self.assertTrue(self.wait_for(lambda: "alice" in alice.roster))
+
+        bob = self.client("bob")
+        bob.connect()
+        self.assertTrue(self.wait_for(lambda: "bob" in alice.roster))
+        bob.close()
+        self.assertTrue(self.wait_for(lambda: "bob" not in alice.roster))
+        self.assertEqual(alice.roster.version, self.server.roster.version)
+        self.assertIn((["bob"], []), changes)
+
+    def test_invalid_name_refused(self):
+        with self.assertRaises(ConnectionError):
+            self.client("server").connect(timeout=2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+"""
+Unit test RSASSA-PSS signatures and the server identity (RFC 8017)
+"""
+
+import sys
+import os
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from Cryptodome.PublicKey import RSA
+from Cryptodome.Signature import pss
+from Cryptodome.Hash import SHA256
+from crypto.pss import (rsa_generate_signing_keys, rsa_crt_sign_int, rsa_pss_sign, rsa_pss_verify,
+                        emsa_pss_encode, emsa_pss_verify)
+from crypto.batch_rsa import batch_exponents, batch_rsa_roots, rsa_pss_sign_batch
+from topology.identity import (VerificationCache, load_or_create_identity, public_part, encode_public_key,
+                               fingerprint, sign_offer, BatchSigner)
+
+class TestPSS(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.public_key, cls.private_key = rsa_generate_signing_keys(2048)
+
+    def test_crt_matches_plain_exponentiation(self):
+        n, e, d = self.private_key[:3]
+        self.assertEqual(n.bit_length(), 2048)
+        m = 123456789 ** 20 % n
+        self.assertEqual(rsa_crt_sign_int(m, self.private_key), pow(m, d, n))
+
+    def test_sign_and_verify(self):
+        signature = rsa_pss_sign(b"transcript", self.private_key)
+        self.assertEqual(len(signature), 256)
+        self.assertTrue(rsa_pss_verify(b"transcript", signature, self.public_key))
+        self.assertFalse(rsa_pss_verify(b"transcripT", signature, self.public_key))
+        tampered = bytes([signature[0] ^ 1]) + signature[1:]
+        self.assertFalse(rsa_pss_verify(b"transcript", tampered, self.public_key))
+        other_public, _ = rsa_generate_signing_keys(1024)
+        self.assertFalse(rsa_pss_verify(b"transcript", signature, other_public))
+
+    def test_encoding_with_fixed_salt(self):
+        em = emsa_pss_encode(b"abc", 2047, salt=bytes(32))
+        self.assertEqual(em, emsa_pss_encode(b"abc", 2047, salt=bytes(32)))
+        self.assertTrue(emsa_pss_verify(b"abc", em, 2047))
+        self.assertFalse(emsa_pss_verify(b"abd", em, 2047))
+
+    def test_interoperates_with_pycryptodome(self):
+        # aceeasi schema (SHA-256, MGF1-SHA256, sare de 32 de octeti) in ambele sensuri
+        n, e, d, p, q = self.private_key[:5]
+        key = RSA.construct((n, e, d, p, q))
+        pss.new(key.public_key()).verify(SHA256.new(b"hello"), rsa_pss_sign(b"hello", self.private_key))
+        self.assertTrue(rsa_pss_verify(b"hello", pss.new(key).sign(SHA256.new(b"hello")), self.public_key))
+
+    def test_identity_and_verification_cache(self):
+        with tempfile.TemporaryDirectory() as store:
+            private_key = load_or_create_identity(store, bits=2048)
+            self.assertEqual(load_or_create_identity(store), private_key)
+
+        key_fingerprint = fingerprint(public_part(private_key))
+        key_frame = {"type": "key", "from": "alice", "data": [1, 2], "nonce": "00" * 16}
+        offer = {"type": "shared_aes_offer", "from": "server", "data": [3, 4],
+                 "server_key": encode_public_key(public_part(private_key))}
+        offer["signature"] = sign_offer(private_key, key_fingerprint, "alice", key_frame, offer)
+
+        cache = VerificationCache()
+        self.assertEqual(cache.verify("alice", key_frame, offer, key_fingerprint), key_fingerprint)
+        self.assertEqual(cache.verify("alice", key_frame, offer), key_fingerprint)
+        self.assertEqual((cache.misses, cache.hits), (1, 1))
+
+        with self.assertRaises(ValueError): # another connection (nonce) or another client
+            cache.verify("alice", dict(key_frame, nonce="11" * 16), offer)
+        with self.assertRaises(ValueError):
+            cache.verify("bob", key_frame, offer)
+        with self.assertRaises(ValueError): # offer altered on the way
+            cache.verify("alice", key_frame, dict(offer, data=[3, 5]))
+        with self.assertRaises(ValueError):
+            cache.verify("alice", key_frame, offer, pinned="ab" * 32)
+        with self.assertRaises(ValueError):
+            cache.verify("alice", key_frame, {k: v for k, v in offer.items() if k != "signature"})
+
+class TestBatchRSA(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.public_key, cls.private_key = rsa_generate_signing_keys(2048)
+
+    def test_roots_match_separate_exponentiations(self):
+        n, p, q = self.private_key[0], self.private_key[3], self.private_key[4]
+        for size in (1, 2, 5, 8):
+            exponents = batch_exponents(self.private_key, size)
+            values = [(12345 + i) ** 40 % n for i in range(size)]
+            expected = [pow(v, pow(e, -1, (p - 1) * (q - 1)), n) for v, e in zip(values, exponents)]
+            self.assertEqual(batch_rsa_roots(values, exponents, self.private_key), expected)
+        with self.assertRaises(ValueError):
+            batch_rsa_roots([2, 3], [exponents[0], exponents[0]], self.private_key)
+
+    def test_batch_signatures(self):
+        n = self.public_key[0]
+        messages = [b"transcript %d" % i for i in range(6)]
+        exponents = batch_exponents(self.private_key, len(messages))
+        signatures = rsa_pss_sign_batch(messages, self.private_key, exponents)
+        for message, signature, e in zip(messages, signatures, exponents):
+            self.assertTrue(rsa_pss_verify(message, signature, (n, e)))
+            self.assertFalse(rsa_pss_verify(message, signature, self.public_key))
+        self.assertFalse(rsa_pss_verify(messages[0], signatures[1], (n, exponents[1])))
+
+    def test_batch_signer_offers_verify(self):
+        key_fingerprint = fingerprint(self.public_key)
+        signer = BatchSigner(self.private_key, max_batch=4)
+        offers = {}
+
+        def handshake(name):
+            key_frame = {"type": "key", "from": name, "data": [1, 2], "nonce": "00" * 16}
+            offer = {"type": "shared_aes_offer", "from": "server", "data": [3, 4],
+                     "server_key": encode_public_key(self.public_key)}
+            offer["signature"] = sign_offer(self.private_key, key_fingerprint, name, key_frame, offer, signer)
+            offers[name] = (key_frame, offer)
+
+        threads = [threading.Thread(target=handshake, args=(f"c{i}",)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        cache = VerificationCache()
+        for name, (key_frame, offer) in offers.items():
+            self.assertEqual(cache.verify(name, key_frame, offer, key_fingerprint), key_fingerprint)
+        self.assertTrue(any("signature_e" in offer for _, offer in offers.values()))
+
+        name, (key_frame, offer) = next((n, o) for n, o in offers.items() if "signature_e" in o[1])
+        for exponent in (1, 65539, "3", offer["signature_e"] + 2):
+            with self.assertRaises(ValueError):
+                cache.verify(name, key_frame, dict(offer, signature_e=exponent))
+
+if __name__ == "__main__":
+    unittest.main()
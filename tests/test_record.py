@@ -0,0 +1,170 @@
+"""
+Test the record layer (sequence numbers, MACs, sliding-window replay filter)
+"""
+
+import sys
+import os
+import json
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from topology.record import (Sequencer, ReplayWindow, REPLAY, OUT_OF_WINDOW, BAD_MAC, UNSEQUENCED,
+                             CLIENT_TO_SERVER, SERVER_TO_CLIENT)
+from topology.rekey import KeyRing
+from topology.keyschedule import traffic_key
+from topology.server import SecureServer
+from topology.topology import SecureClient
+from topology.identity import ephemeral_identity
+from aes.aes_encrypt import aes_encryption
+from aes.aes_key import AESKey
+
+KEY = bytes(range(16))
+
+class RecordingConn:
+    def __init__(self):
+        self.sent = []
+
+    def sendall(self, data):
+        self.sent.append(bytes(data))
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+def message(text=b"salut", recipient="bob"):
+    return {"type": "message", "from": "alice", "recipient": recipient,
+            "data": list(aes_encryption(text.ljust(16, b"\0"), traffic_key(KEY, CLIENT_TO_SERVER))), "epoch": 0}
+
+class TestReplayWindow(unittest.TestCase):
+    def test_duplicates_and_reordering(self):
+        window = ReplayWindow(size=64)
+        for seq in (0, 1, 5, 3):
+            self.assertIsNone(window.check(seq))
+            window.accept(seq)
+        self.assertEqual(window.check(3), REPLAY)
+        self.assertEqual(window.check(5), REPLAY)
+        self.assertIsNone(window.check(4)) # late but inside the window, never seen
+        window.accept(100)
+        self.assertEqual(window.check(36), OUT_OF_WINDOW)
+        self.assertIsNone(window.check(37))
+        self.assertEqual(window.check(100), REPLAY)
+
+    def test_large_jump(self):
+        window = ReplayWindow(size=64)
+        window.accept(1)
+        window.accept(2 ** 63)
+        self.assertEqual(window.bitmap, 1)
+        self.assertEqual(window.check(1), OUT_OF_WINDOW)
+
+class TestSealAndOpen(unittest.TestCase):
+    def test_round_trip_and_replay(self):
+        sequencer, window = Sequencer(), ReplayWindow()
+        first = sequencer.seal(message(), KEY, CLIENT_TO_SERVER)
+        second = sequencer.seal(message(), KEY, CLIENT_TO_SERVER)
+        self.assertEqual((first["seq"], second["seq"]), (0, 1))
+        self.assertIsNone(window.open(second, KEY, CLIENT_TO_SERVER))
+        self.assertIsNone(window.open(first, KEY, CLIENT_TO_SERVER))
+        self.assertEqual(window.open(first, KEY, CLIENT_TO_SERVER), REPLAY)
+
+    def test_tampering_detected(self):
+        frame = Sequencer().seal(message(), KEY, CLIENT_TO_SERVER)
+        for field, value in (("recipient", "mallory"), ("epoch", 1), ("data", list(reversed(frame["data"])))):
+            tampered = dict(frame, **{field: value})
+            self.assertEqual(ReplayWindow().open(tampered, KEY, CLIENT_TO_SERVER), BAD_MAC, field)
+        # reflected into the other direction, or checked under another key
+        self.assertEqual(ReplayWindow().open(frame, KEY, SERVER_TO_CLIENT), BAD_MAC)
+        self.assertEqual(ReplayWindow().open(frame, bytes(16), CLIENT_TO_SERVER), BAD_MAC)
+        self.assertEqual(ReplayWindow().open(message(), KEY, CLIENT_TO_SERVER), UNSEQUENCED)
+
+    def test_forged_frame_does_not_move_window(self):
+        window = ReplayWindow(size=64)
+        forged = dict(Sequencer().seal(message(), KEY, CLIENT_TO_SERVER), seq=10 ** 6)
+        self.assertEqual(window.open(forged, KEY, CLIENT_TO_SERVER), BAD_MAC)
+        self.assertIsNone(window.open(Sequencer().seal(message(), KEY, CLIENT_TO_SERVER), KEY, CLIENT_TO_SERVER))
+
+class TestServerReplayFilter(unittest.TestCase):
+    def test_replay_dropped_before_decryption(self):
+        server = SecureServer('127.0.0.1', 0, identity=ephemeral_identity())
+        conns = {"alice": RecordingConn(), "bob": RecordingConn()}
+        with server.client_lock:
+            for name, conn in conns.items():
+                server.register_client(name, conn, (1, 1))
+                server.connected_clients[name].keys = KeyRing(KEY)
+        server._recv_timing.prefix_at = time.perf_counter()
+        sequencer = Sequencer()
+        frames = [json.dumps(sequencer.seal(message(), KEY, CLIENT_TO_SERVER)).encode() for _ in range(3)]
+
+        with mock.patch.object(AESKey, "decrypt", autospec=True, side_effect=AESKey.decrypt) as decrypt:
+            for frame in (frames[0], frames[2], frames[0], frames[1], frames[2]):
+                server.process_frame(conns["alice"], "alice", frame, time.perf_counter())
+        self.assertEqual(decrypt.call_count, 3)
+
+        counters = server.metrics.snapshot()["counters"]
+        self.assertEqual(counters["messages_relayed_total"], 3)
+        self.assertEqual(counters['drops_total{reason="replay"}'], 2)
+
+        # forwarded frames are numbered for bob's direction, in queue order
+        deadline = time.time() + 5
+        while sum(chunk.count(b'"seq"') for chunk in conns["bob"].sent) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        sent = b"".join(conns["bob"].sent)
+        window = ReplayWindow()
+        offset = 0
+        while offset < len(sent):
+            size = int.from_bytes(sent[offset:offset + 4], 'big')
+            frame = json.loads(sent[offset + 4:offset + 4 + size])
+            offset += 4 + size
+            self.assertIsNone(window.open(frame, KEY, SERVER_TO_CLIENT))
+        self.assertEqual(window.highest, 2)
+        server.stop()
+
+class TestClientReplayFilter(unittest.TestCase):
+    def test_replayed_server_frame_dropped(self):
+        client = SecureClient("bob")
+        client.keys = KeyRing(KEY)
+        frame = Sequencer().seal(dict(message(), **{"from": "alice"}), KEY, SERVER_TO_CLIENT)
+        self.assertTrue(client.open_record(frame))
+        self.assertFalse(client.open_record(frame))
+        self.assertEqual(client.metrics.snapshot()["counters"]['drops_total{reason="replay"}'], 1)
+
+    def test_forged_epoch_does_not_move_the_key_ring(self):
+        client = SecureClient("bob")
+        client.keys = KeyRing(KEY)
+        forged = dict(message(), **{"from": "alice", "epoch": 1, "seq": 0, "mac": "00" * 32})
+        self.assertFalse(client.open_record(forged))
+        far = dict(message(), **{"from": "alice", "epoch": 2 ** 40, "seq": 1, "mac": "00" * 32})
+        client.open_record(far) # no key that far ahead: handle_message drops it
+        self.assertIsNone(client.key_for(2 ** 40))
+        self.assertEqual((client.keys.epoch, client.keys.get(0)), (0, KEY))
+
+        # a genuine frame from the next epoch switches over once its MAC checks out
+        next_key = client.keys.peek(1)
+        frame = Sequencer().seal(dict(message(), **{"from": "alice", "epoch": 1}), next_key, SERVER_TO_CLIENT)
+        self.assertTrue(client.open_record(frame))
+        self.assertEqual(client.keys.epoch, 1)
+        self.assertEqual(client.key_for(1), next_key)
+
+    def test_forged_rekey_notice_leaves_the_ring_unchanged(self):
+        client = SecureClient("bob")
+        client.keys = KeyRing(KEY)
+        for forged in ({"type": "rekey", "from": "server", "epoch": 1},
+                       {"type": "rekey", "from": "server", "epoch": 3, "seq": 0, "mac": "00" * 16},
+                       {"type": "rekey", "from": "server", "epoch": "1"}):
+            self.assertFalse(client.open_rekey(forged))
+        self.assertEqual((client.keys.epoch, sorted(client.keys.keys)), (0, [0]))
+
+        # the server's notice is sealed under the key it replaces
+        notice = Sequencer().seal({"type": "rekey", "from": "server", "epoch": 1}, KEY, SERVER_TO_CLIENT)
+        self.assertFalse(client.open_rekey(dict(notice, epoch=2))) # the epoch is covered by the MAC
+        self.assertTrue(client.open_rekey(notice))
+        self.assertEqual(client.keys.epoch, 1)
+        self.assertFalse(client.open_rekey(notice)) # replayed
+        self.assertEqual(client.keys.epoch, 1)
+
+if __name__ == "__main__":
+    unittest.main()
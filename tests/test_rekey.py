@@ -0,0 +1,145 @@
+"""
+Test in-band rekeying (key ring unit tests and rekeying under sustained traffic)
+"""
+
+import sys
+import os
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from topology.rekey import KeyRing, RekeyPolicy, derive_next_key, KEPT_EPOCHS, MAX_EPOCH_JUMP
+from topology.keyschedule import key_schedule
+from topology.record import CLIENT_TO_SERVER, SERVER_TO_CLIENT
+from topology.server import SecureServer
+from topology.topology import SecureClient
+
+class TestKeyRing(unittest.TestCase):
+    def test_both_sides_derive_the_same_keys(self):
+        server, client = KeyRing(b"k" * 16), KeyRing(b"k" * 16)
+        for _ in range(5):
+            server.advance()
+        self.assertTrue(client.advance_to(3))
+        self.assertTrue(client.advance_to(5))
+        self.assertEqual(client.current, server.current)
+        first = KeyRing(b"k" * 16)
+        first.advance()
+        self.assertEqual(first.current, derive_next_key(b"k" * 16, 1))
+        self.assertNotEqual(first.current, b"k" * 16)
+
+    def test_key_schedule_separates_directions_and_uses(self):
+        schedule = key_schedule(b"k" * 16)
+        derived = [schedule.traffic_key(CLIENT_TO_SERVER), schedule.traffic_key(SERVER_TO_CLIENT),
+                   schedule.mac_key(CLIENT_TO_SERVER), schedule.mac_key(SERVER_TO_CLIENT),
+                   schedule.nonce(CLIENT_TO_SERVER), schedule.nonce(SERVER_TO_CLIENT), schedule.next_secret(1)]
+        self.assertEqual(len(set(derived)), len(derived))
+        self.assertNotIn(b"k" * 16, derived) # the epoch secret itself never keys anything
+        self.assertEqual([len(key) for key in derived], [16, 16, 32, 32, 8, 8, 16])
+        self.assertEqual(schedule.next_secret(1), derive_next_key(b"k" * 16, 1))
+        self.assertNotEqual(key_schedule(derive_next_key(b"k" * 16, 1)).traffic_key(CLIENT_TO_SERVER), derived[0])
+
+    def test_old_epochs_are_kept_until_retired(self):
+        keys = KeyRing(b"k" * 16)
+        keys.advance()
+        self.assertIsNotNone(keys.get(0)) # frames in flight from before the switch
+        self.assertTrue(keys.switching)
+        keys.confirm(1)
+        self.assertFalse(keys.switching)
+        self.assertIsNotNone(keys.get(0)) # one switch of grace for frames sent right before the ack
+        keys.advance()
+        keys.confirm(2)
+        self.assertIsNone(keys.get(0))
+        self.assertIsNotNone(keys.get(1))
+        for _ in range(10):
+            keys.advance()
+        self.assertEqual(len(keys.keys), KEPT_EPOCHS)
+
+    def test_newer_epochs_are_derived_without_switching(self):
+        keys = KeyRing(b"k" * 16)
+        ahead = keys.peek(MAX_EPOCH_JUMP)
+        self.assertEqual(ahead, KeyRing(b"k" * 16).peek(MAX_EPOCH_JUMP))
+        self.assertEqual((keys.epoch, keys.get(0)), (0, b"k" * 16)) # nothing committed, nothing retired
+        self.assertIsNone(keys.peek(MAX_EPOCH_JUMP + 1))
+        self.assertFalse(keys.advance_to(2 ** 40)) # refused at once instead of deriving for ever
+        self.assertEqual(keys.epoch, 0)
+        self.assertTrue(keys.advance_to(MAX_EPOCH_JUMP))
+        self.assertEqual(keys.current, ahead)
+
+    def test_policy(self):
+        keys = KeyRing(b"k" * 16)
+        policy = RekeyPolicy(max_bytes=100, max_messages=0, max_seconds=0)
+        keys.count(60)
+        self.assertFalse(policy.due(keys))
+        keys.count(60)
+        self.assertTrue(policy.due(keys))
+        keys.since -= 10
+        self.assertTrue(RekeyPolicy(max_bytes=0, max_messages=0, max_seconds=5).due(keys))
+
+class TestRekeyUnderTraffic(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.server = SecureServer('127.0.0.1', 0, rekey_policy=RekeyPolicy(max_bytes=0, max_messages=10, max_seconds=0))
+        threading.Thread(target=self.server.start, daemon=True).start()
+        self.assertTrue(self.server.listening.wait(5))
+
+    def tearDown(self):
+        self.server.stop()
+        self.tmp.cleanup()
+
+    def test_no_pause_at_rekey_boundaries(self):
+        count = 1000
+        arrivals = []
+        received = []
+        done = threading.Event()
+
+        def on_message(sender, payload, msg):
+            arrivals.append(time.perf_counter())
+            received.append(payload)
+            if len(received) == count:
+                done.set()
+
+        alice = SecureClient("alice", port=self.server.port, server_key=self.server.identity_fingerprint)
+        bob = SecureClient("bob", port=self.server.port, server_key=self.server.identity_fingerprint, on_message=on_message)
+        alice.connect()
+        bob.connect()
+        try:
+            for i in range(count):
+                alice.send("bob", str(i).encode()) # pipelined, crosses many epoch switches in flight
+            self.assertTrue(done.wait(60))
+        finally:
+            alice.close()
+            bob.close()
+
+        self.assertEqual(received, [str(i).encode() for i in range(count)])
+        counters = self.server.metrics.snapshot()["counters"]
+        self.assertGreaterEqual(counters["rekeys_total"], 5)
+        self.assertNotIn('drops_total{reason="stale_epoch"}', counters)
+        gaps = sorted(b - a for a, b in zip(arrivals, arrivals[1:]))
+        # A rekey is a hash and a small frame: no gap comes close to a handshake stall
+        self.assertLess(gaps[-1], 0.25)
+
+    def test_file_transfer_across_rekeys(self):
+        downloads = os.path.join(self.tmp.name, "downloads")
+        alice = SecureClient("alice", port=self.server.port, server_key=self.server.identity_fingerprint)
+        bob = SecureClient("bob", port=self.server.port, server_key=self.server.identity_fingerprint,
+                           download_dir=downloads)
+        alice.connect()
+        bob.connect()
+        path = os.path.join(self.tmp.name, "date.bin")
+        content = os.urandom(1024 * 30)
+        with open(path, 'wb') as f:
+            f.write(content)
+        try:
+            self.assertTrue(alice.send_file("bob", path, chunk_size=1024, window=6))
+        finally:
+            alice.close()
+            bob.close()
+        with open(os.path.join(downloads, "date.bin"), 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertGreater(self.server.metrics.snapshot()["counters"]["rekeys_total"], 3)
+
+if __name__ == "__main__":
+    unittest.main()
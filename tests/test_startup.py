@@ -0,0 +1,33 @@
+"""
+Test startup: entry points run without sys.path tricks and slow imports stay lazy
+"""
+
+import sys
+import os
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+import unittest
+
+# Only needed for key generation, the metrics endpoint or profiling, never just to start
+LAZY_MODULES = ('Cryptodome', 'http.server', 'cProfile', 'pstats', 'BigNumber', 'mpmath')
+
+class TestStartup(unittest.TestCase):
+    def run_python(self, *args):
+        return subprocess.run([sys.executable, *args], cwd=ROOT, capture_output=True, text=True, timeout=60)
+
+    def test_heavy_modules_not_imported(self):
+        for module in ('topology.topology', 'topology.server', 'aes'):
+            proc = self.run_python("-c", f"import sys, {module}; print(' '.join(m for m in {LAZY_MODULES!r} if m in sys.modules))")
+            self.assertEqual(proc.returncode, 0, proc.stderr)
+            self.assertEqual(proc.stdout.strip(), "", module)
+
+    def test_client_entry_point(self):
+        proc = self.run_python("-m", "topology.client")
+        self.assertEqual(proc.returncode, 1)
+        self.assertIn("Usage: python -m topology.client", proc.stdout)
+
+if __name__ == "__main__":
+    unittest.main()
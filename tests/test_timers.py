@@ -0,0 +1,174 @@
+"""
+Test the timer wheel and heartbeat based idle reaping
+"""
+
+import sys
+import os
+import random
+import socket
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from unittest import mock
+from topology.timers import TimerWheel, SLOTS
+from topology.server import SecureServer
+from topology.topology import SecureClient
+from topology.identity import ephemeral_identity
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class StalledConn:
+    """Socket stand-in for a half-open connection: sendall blocks, nothing ever arrives."""
+    def __init__(self):
+        self.release = threading.Event()
+        self.sent = []
+
+    def sendall(self, data):
+        self.sent.append(bytes(data))
+        self.release.wait()
+
+    def shutdown(self, how):
+        self.release.set()
+
+    def close(self):
+        pass
+
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.wheel = TimerWheel(tick=1.0, clock=self.clock)
+        self.fired = []
+
+    def advance_to(self, now):
+        self.clock.now = now
+        self.wheel.advance()
+
+    def test_fires_in_order(self):
+        for delay in (3, 1, 2):
+            self.wheel.schedule(delay, self.fired.append, delay)
+        self.advance_to(1)
+        self.assertEqual(self.fired, [1])
+        self.advance_to(5)
+        self.assertEqual(self.fired, [1, 2, 3])
+        self.assertEqual(self.wheel.pending, 0)
+
+    def test_cancel(self):
+        timer = self.wheel.schedule(2, self.fired.append, "cancelled")
+        self.wheel.schedule(2, self.fired.append, "kept")
+        self.wheel.cancel(timer)
+        self.wheel.cancel(timer) # second cancel is a no-op
+        self.assertEqual(self.wheel.pending, 1)
+        self.advance_to(3)
+        self.assertEqual(self.fired, ["kept"])
+
+    def test_long_delays_cascade_to_exact_tick(self):
+        rng = random.Random(7)
+        delays = [rng.randrange(1, SLOTS ** 3) for _ in range(2000)] + [SLOTS, SLOTS ** 2, SLOTS ** 2 + 1]
+        fired_at = {}
+        for i, delay in enumerate(delays):
+            self.wheel.schedule(delay, lambda i=i: fired_at.__setitem__(i, self.clock.now))
+        # Step one tick at a time around each deadline, jump in between
+        for deadline in sorted(set(delays)):
+            self.advance_to(deadline - 1)
+            self.advance_to(deadline)
+        self.assertEqual(len(fired_at), len(delays))
+        for i, delay in enumerate(delays):
+            self.assertEqual(fired_at[i], delay)
+
+    def test_delay_beyond_top_level(self):
+        with mock.patch("topology.timers.LEVELS", 2): # a short wheel, so the test steps through few ticks
+            self.wheel = TimerWheel(tick=1.0, clock=self.clock)
+            self.wheel.schedule(SLOTS ** 2 * 3 + 10, self.fired.append, "far")
+            self.advance_to(SLOTS ** 2 * 3 + 9)
+            self.assertEqual(self.fired, [])
+            self.advance_to(SLOTS ** 2 * 3 + 10)
+        self.assertEqual(self.fired, ["far"])
+
+    def test_callback_can_reschedule(self):
+        def again():
+            self.fired.append(self.clock.now)
+            if len(self.fired) < 3:
+                self.wheel.schedule(2, again)
+        self.wheel.schedule(2, again)
+        for now in range(1, 8):
+            self.advance_to(now)
+        self.assertEqual(self.fired, [2, 4, 6])
+
+    def test_raising_callback_does_not_stop_other_timers(self):
+        def broken():
+            raise RuntimeError("callback error")
+        self.wheel.schedule(1, self.fired.append, "before")
+        self.wheel.schedule(1, broken)
+        self.wheel.schedule(1, self.fired.append, "same tick")
+        self.wheel.schedule(2, self.fired.append, "later")
+        with self.assertLogs("p2p.timers", "ERROR") as logs:
+            self.advance_to(1)
+        self.assertIn("callback error", logs.output[0])
+        self.assertEqual(sorted(self.fired), ["before", "same tick"])
+        self.advance_to(2)
+        self.assertEqual(self.fired[-1], "later")
+        self.assertEqual(self.wheel.pending, 0)
+
+class TestIdleReaping(unittest.TestCase):
+    def make_server(self, **kwargs):
+        server = SecureServer('127.0.0.1', 0, identity=ephemeral_identity(), heartbeat_interval=0.2,
+                              idle_timeout=0.5, handshake_timeout=0.3, **kwargs)
+        threading.Thread(target=server.start, daemon=True).start()
+        self.assertTrue(server.listening.wait(5))
+        return server
+
+    def wait_until(self, predicate, timeout=5):
+        deadline = time.time() + timeout
+        while not predicate() and time.time() < deadline:
+            time.sleep(0.02)
+        return predicate()
+
+    def test_half_open_session_is_reaped(self):
+        server = self.make_server()
+        conn = StalledConn()
+        with server.client_lock:
+            server.register_client("ghost", conn, (1, 1))
+            outbound = server.connected_clients["ghost"].outbound
+            for _ in range(5):
+                outbound.put(b"queued frame")
+
+        self.assertTrue(self.wait_until(lambda: "ghost" not in server.connected_clients))
+        self.assertIn(b"queued frame", conn.sent[0]) # the writer was stuck on the first frame
+        self.assertEqual(outbound.depth, 0)
+        self.assertGreater(outbound.stats()["dropped"], 0)
+        counters = server.metrics.snapshot()["counters"]
+        self.assertEqual(counters["idle_reaped_total"], 1)
+        self.assertTrue(self.wait_until(lambda: server.timers.pending == 1)) # only the presence flush is left
+        server.stop()
+
+    def test_client_answers_heartbeats(self):
+        server = self.make_server()
+        client = SecureClient("alice", port=server.port, server_key=server.identity_fingerprint)
+        client.connect()
+        time.sleep(1.5) # three idle timeouts without application traffic
+        self.assertIn("alice", server.connected_clients)
+        counters = server.metrics.snapshot()["counters"]
+        self.assertGreaterEqual(counters["heartbeats_sent_total"], 2)
+        self.assertNotIn("idle_reaped_total", counters)
+        client.close()
+        server.stop()
+
+    def test_silent_connection_closed_after_handshake_timeout(self):
+        server = self.make_server()
+        sock = socket.create_connection(('127.0.0.1', server.port))
+        sock.settimeout(5)
+        self.assertEqual(sock.recv(1), b"") # closed by the server, never sent a key frame
+        sock.close()
+        self.assertEqual(server.metrics.snapshot()["counters"]["handshake_timeouts_total"], 1)
+        server.stop()
+
+if __name__ == "__main__":
+    unittest.main()
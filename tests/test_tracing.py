@@ -0,0 +1,76 @@
+"""
+Unit test tracing / profiling hooks
+"""
+
+import sys
+import os
+import json
+import pstats
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from topology.tracing import Tracer, ProfileWindow
+
+class TestTracing(unittest.TestCase):
+    def test_disabled_tracer_returns_none(self):
+        tracer = Tracer(0.0)
+        self.assertIsNone(tracer.begin("server.relay"))
+        self.assertIsNone(tracer.begin("server.relay", trace_id="abc"))
+        tracer.finish(None)
+        self.assertEqual(len(tracer.traces), 0)
+
+    def test_propagated_trace_id(self):
+        tracer = Tracer(0.0001)
+        trace = tracer.begin("server.relay", trace_id="abc")
+        self.assertEqual(trace.trace_id, "abc")
+
+    def test_chrome_export(self):
+        tracer = Tracer(1.0, process_name="server")
+        trace = tracer.begin("server.relay")
+        start = time.perf_counter()
+        trace.add("aes_decryption", start, start + 0.002)
+        trace.add("sendall", start + 0.002, start + 0.003)
+        tracer.finish(trace)
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "trace.json")
+            self.assertEqual(tracer.export_chrome(path), 3)
+            with open(path) as f:
+                events = json.load(f)["traceEvents"]
+
+        spans = [e for e in events if e["ph"] == "X"]
+        self.assertEqual([e["name"] for e in spans], ["aes_decryption", "sendall"])
+        self.assertAlmostEqual(spans[0]["dur"], 2000, delta=1)
+        self.assertEqual(spans[0]["args"]["trace_id"], trace.trace_id)
+
+    def test_profile_window_dumps_after_n_messages(self):
+        window = ProfileWindow()
+        with window.section():
+            pass  # closed window -> nothing recorded
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "profile.pstats")
+            window.open(4, path)
+
+            def handle():
+                for _ in range(2):
+                    with window.section():
+                        sum(range(1000))
+
+            threads = [threading.Thread(target=handle) for _ in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            self.assertFalse(window.active)
+            self.assertTrue(os.path.exists(path))
+            stats = pstats.Stats(path)
+            self.assertGreater(stats.total_calls, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+"""
+Test file transfer between two clients through a local SecureServer
+"""
+
+import sys
+import os
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from topology.server import SecureServer
+from topology.topology import SecureClient
+from topology.transfer import FileSender
+
+CHUNK = 2048
+
+class TestFileTransfer(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.server = SecureServer('127.0.0.1', 0)
+        threading.Thread(target=self.server.start, daemon=True).start()
+        self.assertTrue(self.server.listening.wait(5))
+
+        self.received = []
+        self.downloads = os.path.join(self.tmp.name, "downloads")
+        self.alice = SecureClient("alice", port=self.server.port, server_key=self.server.identity_fingerprint)
+        self.bob = SecureClient("bob", port=self.server.port, server_key=self.server.identity_fingerprint,
+                                download_dir=self.downloads, on_file=lambda sender, path, ok: self.received.append((sender, path, ok)))
+        self.alice.connect()
+        self.bob.connect()
+
+        self.path = os.path.join(self.tmp.name, "poza.bin")
+        self.content = os.urandom(CHUNK * 6 + 100) # binary, and the last chunk is partial
+        with open(self.path, 'wb') as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        self.alice.close()
+        self.bob.close()
+        self.server.stop()
+        self.tmp.cleanup()
+
+    def read_download(self):
+        with open(os.path.join(self.downloads, "poza.bin"), 'rb') as f:
+            return f.read()
+
+    def test_transfer(self):
+        self.assertTrue(self.alice.send_file("bob", self.path, chunk_size=CHUNK, window=3))
+        self.assertEqual(self.read_download(), self.content)
+        self.assertEqual(self.received, [("alice", os.path.join(self.downloads, "poza.bin"), True)])
+        self.assertFalse(os.path.exists(os.path.join(self.downloads, "poza.bin.part.json")))
+        counters = self.server.metrics.snapshot()["counters"]
+        self.assertEqual(counters["file_chunks_relayed_total"], 7)
+
+    def test_resume_from_last_acknowledged_chunk(self):
+        # What an interrupted run leaves behind: three chunks on disk and their ack recorded
+        transfer_id = FileSender(self.alice, "bob", self.path, chunk_size=CHUNK).transfer_id
+        os.makedirs(self.downloads, exist_ok=True)
+        part = os.path.join(self.downloads, "poza.bin.part")
+        with open(part, 'wb') as f:
+            f.write(self.content[:CHUNK * 3] + b"garbage past the last ack")
+        with open(part + '.json', 'w') as f:
+            f.write('{"transfer_id": "%s", "next": 3}' % transfer_id)
+
+        self.assertTrue(self.alice.send_file("bob", self.path, chunk_size=CHUNK))
+        self.assertEqual(self.read_download(), self.content)
+        counters = self.server.metrics.snapshot()["counters"]
+        self.assertEqual(counters["file_chunks_relayed_total"], 4)
+
+    def test_text_file_is_compressed_before_encryption(self):
+        text = ("Mulțumesc, ne vedem mâine la ora 10. " * 400).encode()
+        with open(self.path, 'wb') as f:
+            f.write(text)
+        self.assertTrue(self.alice.send_file("bob", self.path, chunk_size=CHUNK))
+        self.assertEqual(self.read_download(), text)
+        self.assertGreater(self.alice.metrics.snapshot()["counters"]["compression_bytes_saved_total"], len(text) // 2)
+        self.assertGreater(self.server.metrics.snapshot()["counters"]["compression_bytes_saved_total"], 0)
+
+    def test_compressed_chunks_for_a_client_without_compression(self):
+        carol = SecureClient("carol", port=self.server.port, server_key=self.server.identity_fingerprint,
+                             download_dir=os.path.join(self.tmp.name, "carol"),
+                             compression=False)
+        carol.connect()
+        try:
+            text = b"aaaa bbbb cccc " * 1000
+            with open(self.path, 'wb') as f:
+                f.write(text)
+            self.assertTrue(self.alice.send_file("carol", self.path, chunk_size=CHUNK))
+            with open(os.path.join(self.tmp.name, "carol", "poza.bin"), 'rb') as f:
+                self.assertEqual(f.read(), text)
+            self.assertIsNone(carol.compressor)
+            self.assertEqual(self.server.metrics.snapshot()["histograms"]["decompress_seconds"]["count"], 8)
+        finally:
+            carol.close()
+
+    def test_existing_file_is_not_overwritten(self):
+        os.makedirs(self.downloads, exist_ok=True)
+        with open(os.path.join(self.downloads, "poza.bin"), 'wb') as f:
+            f.write(b"fisierul lui bob")
+        self.assertTrue(self.alice.send_file("bob", self.path, chunk_size=CHUNK))
+        self.assertEqual(self.read_download(), b"fisierul lui bob")
+        renamed = os.path.join(self.downloads, "poza (1).bin")
+        with open(renamed, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertEqual(self.received, [("alice", renamed, True)])
+
+    def test_accept_hook_refuses_offer(self):
+        offers = []
+        self.bob.file_receiver.accept = lambda sender, name, size: offers.append((sender, name, size)) and False
+        self.assertFalse(self.alice.send_file("bob", self.path, chunk_size=CHUNK))
+        self.assertEqual(offers, [("alice", "poza.bin", len(self.content))])
+        self.assertEqual(os.listdir(self.downloads), [])
+
+    def test_malformed_offer_does_not_stop_the_receiver(self):
+        for offer in ({"transfer_id": "x"},
+                      {"transfer_id": "y", "name": "a.bin", "size": 10, "chunk_size": 0, "sha256": "00" * 32},
+                      {"transfer_id": "z", "name": "a.bin", "size": "mult", "chunk_size": CHUNK, "sha256": "00" * 32}):
+            self.alice.send_data_to_server(dict(offer, type="file_offer", **{"from": "alice"}, recipient="bob"))
+        self.alice.send("bob", b"inca aici")
+        self.assertEqual(next(self.bob.messages(timeout=10)), ("alice", b"inca aici"))
+        self.assertEqual(self.bob.file_receiver.transfers, {})
+        self.assertTrue(self.alice.send_file("bob", self.path, chunk_size=CHUNK))
+        self.assertEqual(self.read_download(), self.content)
+
+    def test_recipient_offline(self):
+        self.bob.close()
+        self.assertFalse(self.alice.send_file("carol", self.path, chunk_size=CHUNK))
+
+if __name__ == "__main__":
+    unittest.main()
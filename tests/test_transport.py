@@ -0,0 +1,127 @@
+"""
+Test the transports (tcp://, unix://, mem://) and the server and client on each of them
+"""
+
+import sys
+import os
+import socket
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import unittest
+from topology import transport
+from topology.server import SecureServer
+from topology.topology import SecureClient
+from topology.identity import ephemeral_identity
+
+class TestUrls(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(transport.parse_url("tcp://127.0.0.1:9000"), ("tcp", ("127.0.0.1", 9000)))
+        self.assertEqual(transport.parse_url("tcp://[::1]:0"), ("tcp", ("::1", 0)))
+        self.assertEqual(transport.parse_url("unix:///tmp/p2p.sock"), ("unix", "/tmp/p2p.sock"))
+        self.assertEqual(transport.parse_url("mem://relay"), ("mem", "relay"))
+        for bad in ("127.0.0.1:9000", "udp://host:1", "tcp://host", "unix://"):
+            with self.assertRaises(ValueError):
+                transport.parse_url(bad)
+
+    def test_bad_url_refused_by_constructors(self):
+        with self.assertRaises(ValueError):
+            SecureClient("alice", url="http://example.com:80")
+        with self.assertRaises(ValueError):
+            SecureServer('127.0.0.1', 0, identity=ephemeral_identity(), url="udp://127.0.0.1:0")
+
+class TestMemoryTransport(unittest.TestCase):
+    def setUp(self):
+        self.listener = transport.listen("mem://")
+        self.addCleanup(self.listener.close)
+
+    def pair(self):
+        client = transport.connect(self.listener.url)
+        server, _ = self.listener.accept()
+        return client, server
+
+    def test_bytes_both_ways_and_close(self):
+        client, server = self.pair()
+        client.sendall(b"hello")
+        self.assertEqual(server.recv(3), b"hel")
+        self.assertEqual(server.recv(10), b"lo")
+        server.sendall(b"back")
+        buffer = bytearray(8)
+        self.assertEqual(client.recv_into(buffer, 3), 3)
+        self.assertEqual(client.recv(10), b"k")
+        self.assertEqual(bytes(buffer[:3]), b"bac")
+        client.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(server.recv(10), b"") # peer closed
+        with self.assertRaises(BrokenPipeError):
+            server.sendall(b"late")
+
+    def test_recv_timeout(self):
+        client, _ = self.pair()
+        client.settimeout(0.05)
+        with self.assertRaises(socket.timeout):
+            client.recv(1)
+
+    def test_sendall_blocks_while_peer_buffer_is_full(self):
+        client, server = self.pair()
+        data = os.urandom(transport.MEMORY_BUFFER * 3)
+        done = threading.Event()
+        threading.Thread(target=lambda: (client.sendall(data), done.set()), daemon=True).start()
+        self.assertFalse(done.wait(0.1))
+        received = b""
+        while len(received) < len(data):
+            received += server.recv(65536)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(received, data)
+
+    def test_connect_refused(self):
+        with self.assertRaises(ConnectionRefusedError):
+            transport.connect("mem://nobody-listens")
+        with self.assertRaises(OSError):
+            transport.listen(self.listener.url) # name taken
+
+class TestServerOnEachTransport(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def exchange(self, url):
+        server = SecureServer('127.0.0.1', 0, identity=ephemeral_identity(), url=url)
+        threading.Thread(target=server.start, daemon=True).start()
+        self.assertTrue(server.listening.wait(5))
+        received = []
+        got = threading.Event()
+        alice = SecureClient("alice", url=server.url, server_key=server.identity_fingerprint)
+        bob = SecureClient("bob", url=server.url, server_key=server.identity_fingerprint,
+                           on_message=lambda sender, payload, msg: (received.append((sender, payload)), got.set()))
+        alice.connect()
+        bob.connect()
+        alice.send("bob", b"hi there")
+        self.assertTrue(got.wait(5))
+        self.assertEqual(received, [("alice", b"hi there")])
+        alice.close()
+        bob.close()
+        server.stop()
+        return server
+
+    def test_tcp(self):
+        server = self.exchange("tcp://127.0.0.1:0")
+        self.assertNotEqual(server.port, 0)
+        self.assertEqual(server.url, f"tcp://127.0.0.1:{server.port}")
+
+    def test_unix(self):
+        path = os.path.join(self.tmp.name, "p2p.sock")
+        self.exchange(f"unix://{path}")
+        deadline = time.time() + 5
+        while os.path.exists(path) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(os.path.exists(path)) # removed when the server stops
+
+    def test_memory(self):
+        server = self.exchange("mem://")
+        self.assertTrue(server.url.startswith("mem://anon-"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,3 @@
-from BigNumber.BigNumber import BigNumber
-
 # my_pow - implements the pow algorithm for big numbers
 def my_pow(m: int, e: int, n: int) -> int:
     first_extra_factor = None
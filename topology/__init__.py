@@ -0,0 +1,7 @@
+"""
+Relay server and clients. Entry points:
+
+    python -m topology.server
+    python -m topology.client <name>
+    python -m topology.loadgen --help
+"""
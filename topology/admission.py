@@ -0,0 +1,80 @@
+"""
+Handshake admission control: keeps a burst of new connections from starving established ones.
+
+A handshake is CPU work (a DH key pair and shared secret, the transcript signature) and in one
+Python process that work holds the GIL: a reconnect storm of a few hundred clients used to
+delay every relayed message by the sum of the handshakes running next to it. Three limits
+keep that bounded:
+
+- HandshakeAdmission counts the handshakes between accept() and the offer. Past
+  HANDSHAKE_QUEUE the server answers {"type": "busy", "retry_after": seconds} and closes the
+  connection; clients wait that long (jittered, so the retries don't come back as one wave)
+  and try again. A burst the accept loop has not taken in yet waits in the kernel's listen
+  backlog (topology.transport.LISTEN_BACKLOG) instead of being refused.
+- Only HANDSHAKE_WORKERS handshakes do their key agreement at the same time; the others wait
+  for a slot without touching the interpreter. Signatures are made one batch at a time by the
+  server's BatchSigner.
+- With handshake processes both run in a pool of HANDSHAKE_WORKERS processes with a lower
+  scheduling priority (HANDSHAKE_NICE), so neither the GIL nor the CPU is taken from the
+  relay. Workers are started from a fork server, not forked from the threaded server.
+"""
+
+import concurrent.futures
+import contextlib
+import multiprocessing
+import os
+import random
+import threading
+
+HANDSHAKE_QUEUE = 256 # handshakes in progress before new connections are turned away
+HANDSHAKE_WORKERS = 2 # key agreements running at the same time, and worker processes in the pool
+HANDSHAKE_NICE = 10 # added to the niceness of the worker processes
+BUSY_RETRY_AFTER = 1.0 # mean seconds a turned away client waits before it connects again
+
+
+class HandshakeAdmission:
+    """Bounded admission of handshakes and the slots for their CPU work."""
+
+    def __init__(self, limit=HANDSHAKE_QUEUE, workers=HANDSHAKE_WORKERS, retry_after=BUSY_RETRY_AFTER):
+        self.limit = limit
+        self.retry_after = retry_after
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(workers)
+
+    def admit(self):
+        """Takes a place for a new connection's handshake. False if the server is at its limit."""
+        with self.lock:
+            if self.pending >= self.limit:
+                return False
+            self.pending += 1
+            return True
+
+    def done(self):
+        """Gives back the place of a handshake that finished (either way)."""
+        with self.lock:
+            self.pending -= 1
+
+    @contextlib.contextmanager
+    def working(self):
+        """Holds one of the CPU slots for the block."""
+        with self.slots:
+            yield
+
+    def busy_frame(self):
+        """The rejection sent to a connection that was not admitted."""
+        return {"type": "busy", "from": "server",
+                "retry_after": round(self.retry_after * random.uniform(0.5, 1.5), 3)}
+
+
+def _lower_priority():
+    if hasattr(os, 'nice'):
+        os.nice(HANDSHAKE_NICE)
+
+
+def handshake_pool(processes):
+    """Process pool for handshake crypto; workers start on first use."""
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    return concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=context,
+                                                  initializer=_lower_priority)
@@ -0,0 +1,68 @@
+"""
+Shared pool of byte buffers for the receive and send paths.
+
+Reading a frame into a fresh bytes object (and growing it with += while the body trickles in)
+and joining every writer batch into a new bytes object allocates, per frame, memory of the
+frame's size that is garbage a moment later. With tens of thousands of sessions that churn
+fragments the heap, and a mostly idle session should hold no buffer at all between frames.
+
+Buffers are bytearrays in power-of-two size classes from MIN_BUFFER to MAX_BUFFER. acquire()
+hands out a free one of the right class (or allocates it), release() puts it back unless its
+class already keeps MAX_FREE buffers, so the pool never holds more than a bounded amount.
+Larger requests are allocated and dropped as before.
+"""
+
+import threading
+
+MIN_BUFFER = 4 * 1024
+MAX_BUFFER = 1024 * 1024
+MAX_FREE = 64 # free buffers kept per size class
+
+
+class BufferPool:
+    def __init__(self, min_size=MIN_BUFFER, max_size=MAX_BUFFER, max_free=MAX_FREE):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_free = max_free
+        self.free = {} # size class -> list of free bytearrays
+        self.lock = threading.Lock()
+        self.allocated = 0 # buffers created because none of the class was free
+        self.reused = 0
+
+    def size_class(self, size):
+        if size > self.max_size:
+            return None
+        return max(self.min_size, 1 << (size - 1).bit_length())
+
+    def acquire(self, size):
+        """A bytearray of at least size bytes (its contents are whatever the last user left)."""
+        cls = self.size_class(size)
+        if cls is None:
+            return bytearray(size)
+        with self.lock:
+            free = self.free.get(cls)
+            if free:
+                self.reused += 1
+                return free.pop()
+            self.allocated += 1
+        return bytearray(cls)
+
+    def release(self, buffer):
+        cls = len(buffer)
+        if cls != self.size_class(cls):
+            return # not one of ours (too large, or resized by the caller)
+        with self.lock:
+            free = self.free.setdefault(cls, [])
+            if len(free) < self.max_free:
+                free.append(buffer)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "allocated": self.allocated,
+                "reused": self.reused,
+                "free_bytes": sum(cls * len(free) for cls, free in self.free.items()),
+            }
+
+
+POOL = BufferPool() # shared by every connection of the process
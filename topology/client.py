@@ -0,0 +1,31 @@
+"""
+Interactive client: python -m topology.client <name> [url]
+
+url is the server's tcp://, unix:// or mem:// address (default tcp://127.0.0.1:9000).
+"""
+
+import logging
+import os
+import sys
+
+from topology.topology import SecureClient, DOWNLOAD_DIR, SERVER_URL
+from topology.log import configure_logging
+from topology.presence import valid_name
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) not in (1, 2):
+        print("Usage: python -m topology.client <name> [url]")
+        sys.exit(1)
+    client_name_arg = argv[0]
+    if not valid_name(client_name_arg):
+        print(f"Invalid client name: {client_name_arg!r}")
+        sys.exit(1)
+    configure_logging(logging.WARNING) # The CLI prints what the user needs; only problems are logged
+    url = argv[1] if len(argv) > 1 else SERVER_URL
+    SecureClient(client_name_arg, download_dir=os.path.join(DOWNLOAD_DIR, client_name_arg), url=url).start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Optional zlib compression of payloads before they are encrypted, negotiated per session.
+
+The client lists what it supports in its "key" frame and the server answers with what it
+accepted in the "shared_aes_offer":
+
+    "compression": {"codec": "zlib", "dictionary": "<DICTIONARY_ID>"}
+
+Every frame is compressed on its own against a preset dictionary (zdict) rather than through
+a streaming context, so frames may be decompressed in any order and the server can forward a
+compressed payload to another session that uses the same dictionary without touching it.
+
+Small payloads are never compressed, and larger ones are first probed: a fast level 1 pass
+over the first PROBE_SIZE bytes that does not shrink them by PROBE_RATIO means the data is
+already compressed or random (images, archives, encrypted files) and is sent as it is.
+"""
+
+import hashlib
+import time
+import zlib
+
+CODEC = 'zlib'
+LEVEL = 6
+MIN_SIZE = 256 # payloads below this are sent uncompressed
+PROBE_SIZE = 4096 # bytes compressed by the ratio probe
+PROBE_RATIO = 0.9 # the probe must reach this compressed/original ratio to go ahead
+MAX_DECOMPRESSED = 1024 * 1024 # refuse frames that would inflate beyond this
+
+# Preset dictionary: fragments that show up in chat text and in the text files people send.
+# Later bytes are cheaper to reference, so the most common fragments come last.
+DICTIONARY = (
+    '<html><head><meta charset="utf-8"><title></title></head><body><div class="'
+    '{"type": "message", "from": "", "recipient": "", "data": [], "id": null, "name": "'
+    'def class import return self None True False print(" if __name__ == "__main__":'
+    'https://www. .com/ .ro/ http:// mailto: @gmail.com Subject: Re: Fwd: '
+    'Mulțumesc, bună ziua, salut! ce faci? mâine, astăzi, acum, după, pentru că '
+    'the of and to in is that for it with as was on be at by this have from or had '
+    'Thanks, hello! how are you? see you tomorrow, today, now, after, because '
+    'I think we should, can you please, let me know, sounds good, ok, yes, no. '
+).encode('utf-8')
+DICTIONARY_ID = hashlib.sha256(DICTIONARY).hexdigest()[:16]
+
+
+def supported():
+    """What a peer advertises in the handshake."""
+    return {"codec": CODEC, "dictionary": DICTIONARY_ID}
+
+
+def negotiate(offer):
+    """Server side: the accepted parameters for a client's offer, or None if compression stays off."""
+    if not isinstance(offer, dict) or offer.get("codec") != CODEC:
+        return None
+    if offer.get("dictionary") == DICTIONARY_ID:
+        return {"codec": CODEC, "dictionary": DICTIONARY_ID}
+    return {"codec": CODEC, "dictionary": None} # plain zlib, the peer has another dictionary
+
+
+class Compressor:
+    """Compression for one negotiated session. Metrics (optional) get the savings and CPU cost."""
+
+    def __init__(self, params, metrics=None):
+        self.params = dict(params)
+        self.zdict = DICTIONARY if params.get("dictionary") == DICTIONARY_ID else None
+        self.metrics = metrics
+
+    def compatible(self, other):
+        """True if a payload compressed by other can be decompressed by this session as it is."""
+        return other is not None and self.params == other.params
+
+    def compress(self, payload):
+        """Returns (data, compressed). Small and incompressible payloads come back unchanged."""
+        metrics = self.metrics
+        if len(payload) < MIN_SIZE:
+            if metrics:
+                metrics.inc('compression_skipped_total{reason="small"}')
+            return payload, False
+
+        start = time.perf_counter()
+        if len(payload) > PROBE_SIZE:
+            probe = self._compressobj(1)
+            sample = payload[:PROBE_SIZE]
+            probed = len(probe.compress(sample) + probe.flush())
+            if probed > len(sample) * PROBE_RATIO:
+                if metrics:
+                    metrics.observe('compress_seconds', time.perf_counter() - start)
+                    metrics.inc('compression_skipped_total{reason="incompressible"}')
+                return payload, False
+
+        compressor = self._compressobj(LEVEL)
+        data = compressor.compress(payload) + compressor.flush()
+        if metrics:
+            metrics.observe('compress_seconds', time.perf_counter() - start)
+        if len(data) >= len(payload):
+            if metrics:
+                metrics.inc('compression_skipped_total{reason="incompressible"}')
+            return payload, False
+        if metrics:
+            metrics.inc('compression_bytes_in_total', len(payload))
+            metrics.inc('compression_bytes_saved_total', len(payload) - len(data))
+        return data, True
+
+    def decompress(self, data, limit=MAX_DECOMPRESSED):
+        """Inverse of compress(). Raises ValueError on corrupt data or output over limit."""
+        start = time.perf_counter()
+        decompressor = zlib.decompressobj(zdict=self.zdict) if self.zdict else zlib.decompressobj()
+        try:
+            payload = decompressor.decompress(data, limit)
+        except zlib.error as e:
+            raise ValueError(f"Corrupt compressed payload: {e}")
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError("Compressed payload is truncated or inflates beyond the limit")
+        if self.metrics:
+            self.metrics.observe('decompress_seconds', time.perf_counter() - start)
+        return payload
+
+    def _compressobj(self, level):
+        if self.zdict:
+            return zlib.compressobj(level, zdict=self.zdict)
+        return zlib.compressobj(level)
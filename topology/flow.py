@@ -0,0 +1,372 @@
+"""
+Flow control for the relay: per-sender token buckets and per-connection outbound queues.
+
+Frames for a client are never written while client_lock is held. They are appended to the
+client's OutboundQueue and a writer thread drains it, so a recipient that stops reading only
+fills its own queue. The queue is bounded by a high watermark (in bytes); once it is hit the
+queue refuses frames until the writer brings it back under the low watermark, and the server
+applies its slow-consumer policy (disconnect the client or park it).
+
+The queue has two classes. CONTROL frames (key offers, rekeys, heartbeats, presence, acks) go
+out before anything else and are not refused over the watermark. DATA frames wait in one
+sub-queue per flow (sender and frame type), served by deficit round robin (Shreedhar and
+Varghese), so one sender's file transfer can't starve another sender's messages. A writer
+batch holds at most DATA_BATCH_BYTES of data, and data frames larger than FRAGMENT_SIZE go
+out in fragments, so a control frame never waits for more than one batch.
+
+Fragments reuse the 4-byte length prefix: its top bit marks a fragment, the next bit the last
+fragment of the frame, the rest is the fragment's length. Only one fragmented frame is in
+progress per connection; complete control frames may come between its fragments, and
+FrameAssembler puts it back together on the receiving side.
+"""
+
+import collections
+import threading
+import time
+
+from topology.buffers import POOL
+
+POLICY_DISCONNECT = 'disconnect'
+POLICY_PARK = 'park'
+
+CONTROL = 0
+DATA = 1
+FRAGMENT = 0x80000000 # length prefix flag: part of a larger frame
+LAST_FRAGMENT = 0x40000000 # with FRAGMENT: the frame's last part
+LENGTH_MASK = 0x3FFFFFFF
+FRAGMENT_SIZE = 16 * 1024 # data frames with a larger body are sent in pieces of this size
+DATA_BATCH_BYTES = 16 * 1024 # data bytes per sendall; bounds how long a control frame waits
+QUANTUM = 16 * 1024 # bytes a flow of weight 1 may send per round robin turn
+WRITER_LINGER = 5.0 # seconds an idle writer thread waits for frames before it exits
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, at most `burst` saved up.
+
+    Used from a single handler thread, so it needs no lock.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def consume(self, amount=1):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+
+class RateLimiter:
+    """Messages/sec and bytes/sec limits for one sender. A rate of 0 disables that limit."""
+
+    __slots__ = ('messages', 'bytes')
+
+    def __init__(self, msgs_per_sec, bytes_per_sec, burst_seconds=1.0):
+        self.messages = TokenBucket(msgs_per_sec, max(1, msgs_per_sec * burst_seconds)) if msgs_per_sec else None
+        self.bytes = TokenBucket(bytes_per_sec, max(1, bytes_per_sec * burst_seconds)) if bytes_per_sec else None
+
+    def allow(self, size):
+        if self.messages and not self.messages.consume(1):
+            return False
+        if self.bytes and not self.bytes.consume(size):
+            return False
+        return True
+
+
+class FrameAssembler:
+    """Receiving side of fragmentation: whole frames out of (length prefix, body) pairs."""
+
+    def __init__(self):
+        self.partial = None
+
+    def feed(self, prefix, body):
+        """The complete frame, or None while a fragmented one is still missing pieces."""
+        if not prefix & FRAGMENT:
+            return body
+        if self.partial is None:
+            self.partial = bytearray()
+        self.partial += body
+        if not prefix & LAST_FRAGMENT:
+            return None
+        frame = bytes(self.partial)
+        self.partial = None
+        return frame
+
+
+class OutboundQueue:
+    """Bounded two-class queue of encoded frames for one connection, drained by its own writer thread.
+
+    The writer is started by the first put() and exits once the queue has been empty for
+    `linger` seconds, so an idle connection holds no thread; the next put() starts a new one.
+    With prioritize=False every frame goes through one FIFO and nothing is fragmented, which
+    is how the queue behaved before the classes existed (kept for comparison benchmarks).
+    """
+
+    MAX_BATCH_BYTES = 64 * 1024 # frames are coalesced into one sendall up to this size
+
+    def __init__(self, conn, high_watermark=1024 * 1024, low_watermark=256 * 1024,
+                 metrics=None, on_error=None, on_drained=None, name=None, prioritize=True, linger=WRITER_LINGER):
+        self.conn = conn
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.metrics = metrics
+        self.on_error = on_error # called once, from the writer thread, if the socket fails
+        self.on_drained = on_drained # called from the writer thread when a full queue drops under the low watermark
+        self.name = name
+        self.prioritize = prioritize
+        self.linger = linger
+
+        # The containers are created by put() and dropped again when the writer goes idle:
+        # an empty deque costs most of a kilobyte, times every idle connection
+        self.control = None # deque of (frame bytes, enqueue time, None)
+        self.flows = {} # flow -> deque of (frame bytes, enqueue time, seal), for the flows with frames queued
+        self.weights = {} # flow -> weight, for the flows with frames queued
+        self.deficits = {} # flow -> bytes the flow may still send in its turn
+        self.active = None # deque of the flows with frames queued, in round robin order
+        self.in_turn = False # the flow at the head of active already got its quantum
+        self.fragmenting = None # [body memoryview, offset] of the data frame being sent in fragments
+        self.frame_count = 0
+        self.queued_bytes = 0
+        self.over_watermark = False
+        self.dropped = 0
+        self.sent = 0
+        self.data_put = 0 # data frames accepted so far
+        self.data_taken = 0 # data frames the writer has started sending
+        self.closed = False
+        self.cond = threading.Condition()
+        self.writer = None # running writer thread, None while the queue is idle
+
+    def put(self, frame, priority=DATA, flow=None, weight=1, seal=None):
+        """Queues an encoded frame. Returns False if the queue is full (or closed) and the frame was refused.
+
+        Control frames are only refused once the queue is closed. seal(frame), if given, is called
+        by the writer when it takes the frame and returns the bytes to send: frames of
+        different flows leave in another order than they came, and record sequence numbers
+        have to follow the wire.
+        """
+        with self.cond:
+            if self.closed:
+                return False
+            control = priority == CONTROL and self.prioritize
+            if not control and (self.over_watermark or self.queued_bytes + len(frame) > self.high_watermark):
+                self.over_watermark = True
+                self.dropped += 1
+                return False
+            entry = (frame, time.perf_counter(), seal)
+            if control:
+                if self.control is None:
+                    self.control = collections.deque()
+                self.control.append(entry)
+            else:
+                if not self.prioritize:
+                    flow = None
+                queue = self.flows.get(flow)
+                if queue is None:
+                    queue = self.flows[flow] = collections.deque()
+                    if self.active is None:
+                        self.active = collections.deque()
+                    self.active.append(flow)
+                    self.deficits[flow] = 0
+                self.weights[flow] = weight
+                queue.append(entry)
+                self.data_put += 1
+            self.frame_count += 1
+            self.queued_bytes += len(frame)
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write_loop, daemon=True)
+                self.writer.start()
+            else:
+                self.cond.notify()
+            return True
+
+    @property
+    def depth(self):
+        return self.frame_count
+
+    def stats(self):
+        with self.cond:
+            return {
+                "depth": self.frame_count,
+                "bytes": self.queued_bytes,
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "over_watermark": self.over_watermark,
+                "control": len(self.control or ()),
+                "flows": len(self.flows),
+            }
+
+    def close(self):
+        """Stops the writer after the frames already queued have been written."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def discard(self):
+        """Closes the queue and drops the frames not written yet, for a peer that is gone. Returns how many."""
+        with self.cond:
+            dropped = self.frame_count
+            self._clear()
+            self.dropped += dropped
+            self.closed = True
+            self.cond.notify()
+        return dropped
+
+    def _clear(self):
+        self.control = None
+        self.flows = {}
+        self.weights = {}
+        self.deficits = {}
+        self.active = None
+        self.in_turn = False
+        self.fragmenting = None
+        self.frame_count = 0
+        self.queued_bytes = 0
+
+    def _next_fragment(self, batch):
+        """Appends the next fragment of the frame in progress. Returns (wire bytes, frames finished)."""
+        body, offset = self.fragmenting
+        piece = body[offset:offset + FRAGMENT_SIZE]
+        offset += len(piece)
+        last = offset >= len(body)
+        batch.append((FRAGMENT | (LAST_FRAGMENT if last else 0) | len(piece)).to_bytes(4, 'big'))
+        batch.append(piece)
+        if last:
+            self.fragmenting = None
+        else:
+            self.fragmenting[1] = offset
+        return 4 + len(piece), int(last)
+
+    def _take_data_frame(self):
+        """Deficit round robin: the next data frame entry, None if no flow has one."""
+        while self.active:
+            flow = self.active[0]
+            if not self.in_turn:
+                # The flow at the head starts its turn with one more quantum
+                self.in_turn = True
+                self.deficits[flow] += QUANTUM * self.weights[flow]
+            queue = self.flows[flow]
+            size = len(queue[0][0])
+            if self.deficits[flow] < size:
+                self.active.rotate(-1)
+                self.in_turn = False
+                continue
+            self.deficits[flow] -= size
+            entry = queue.popleft()
+            if not queue:
+                self.active.popleft()
+                self.in_turn = False
+                del self.flows[flow]
+                del self.deficits[flow]
+                del self.weights[flow]
+            self.data_taken += 1
+            return entry
+        return None
+
+    def _next_batch(self):
+        """Frames for one sendall, chosen with cond held: (pieces, wire bytes, queued bytes, frames)."""
+        batch = []
+        wire_bytes = 0
+        queued = 0
+        finished = 0
+        # Strict priority: every control frame first
+        while self.control and (not batch or wire_bytes + len(self.control[0][0]) <= self.MAX_BATCH_BYTES):
+            frame, enqueued_at, seal = self.control.popleft()
+            queued += len(frame)
+            if seal:
+                frame = seal(frame)
+            batch.append(frame)
+            wire_bytes += len(frame)
+            finished += 1
+            self._observe_wait(enqueued_at)
+
+        data_bytes = 0
+        limit = DATA_BATCH_BYTES if self.prioritize else self.MAX_BATCH_BYTES
+        while data_bytes < limit and wire_bytes < self.MAX_BATCH_BYTES:
+            if self.fragmenting:
+                size, done = self._next_fragment(batch)
+                wire_bytes += size
+                data_bytes += size
+                finished += done
+                continue
+            if not self.active:
+                break
+            if data_bytes and data_bytes + len(self.flows[self.active[0]][0][0]) > limit:
+                break
+            frame, enqueued_at, seal = self._take_data_frame()
+            self._observe_wait(enqueued_at)
+            queued += len(frame)
+            if seal:
+                frame = seal(frame)
+            if self.prioritize and len(frame) - 4 > FRAGMENT_SIZE:
+                self.fragmenting = [memoryview(frame)[4:], 0]
+                continue
+            batch.append(frame)
+            wire_bytes += len(frame)
+            data_bytes += len(frame)
+            finished += 1
+        return batch, wire_bytes, queued, finished
+
+    def _send(self, batch, batch_bytes):
+        if len(batch) == 1:
+            self.conn.sendall(batch[0])
+            return
+        # Coalesced into a pooled buffer instead of a new bytes object per batch
+        buffer = POOL.acquire(batch_bytes)
+        offset = 0
+        for piece in batch:
+            end = offset + len(piece)
+            buffer[offset:end] = piece
+            offset = end
+        with memoryview(buffer) as view:
+            self.conn.sendall(view[:batch_bytes])
+        POOL.release(buffer)
+
+    def _observe_wait(self, enqueued_at):
+        if self.metrics:
+            self.metrics.observe('queue_wait_seconds', time.perf_counter() - enqueued_at)
+
+    def _write_loop(self):
+        while True:
+            with self.cond:
+                while not self.frame_count and not self.closed:
+                    if not self.cond.wait(self.linger) and not self.frame_count:
+                        self.writer = None # idle: the next put() starts a new writer
+                        self._clear()
+                        return
+                if not self.frame_count:
+                    return
+                batch, batch_bytes, queued, finished = self._next_batch()
+                self.frame_count -= finished
+
+            try:
+                send_start = time.perf_counter()
+                self._send(batch, batch_bytes)
+                if self.metrics:
+                    self.metrics.observe('send_seconds', time.perf_counter() - send_start)
+                    self.metrics.inc('bytes_out_total', batch_bytes)
+            except Exception as e:
+                with self.cond:
+                    self.closed = True
+                    self._clear()
+                if self.on_error:
+                    self.on_error(self, e)
+                return
+
+            drained = False
+            with self.cond:
+                self.sent += finished
+                # A fragmented frame's bytes are released with its first fragment
+                self.queued_bytes = max(0, self.queued_bytes - queued)
+                if self.over_watermark and self.queued_bytes <= self.low_watermark:
+                    self.over_watermark = False
+                    drained = True
+            if drained and self.on_drained:
+                self.on_drained(self)
@@ -0,0 +1,300 @@
+"""
+Server identity: a long-term RSA key that signs every handshake.
+
+The client sends a fresh nonce in its "key" frame. The server answers with its public key and
+an RSASSA-PSS signature over the handshake transcript in the "shared_aes_offer":
+
+    "server_key": {"n": "<hex>", "e": 65537}, "signature": "<hex>"
+
+The transcript is SHA-256 over a fixed label, the server key fingerprint, the client name, the
+client's key frame (nonce included, so an old offer can't be replayed) and the offer itself
+without the signature. Clients check the fingerprint against the pinned one before they use the session key. A
+client not given a fingerprint looks the server URL up in its known hosts file, and pins the
+first key it sees there (trust on first use that survives restarts, like ssh's known_hosts).
+
+The part of the transcript that only depends on the server key and the client name is the
+same on every reconnect. VerificationCache keeps the parsed and checked key together with the
+hash state of that prefix, so a reconnect only hashes the frames and does one modexp.
+
+Signing is the one private-key operation of a handshake. When many clients connect at once
+(every client of a restarted server reconnects together) a BatchSigner signs the transcripts
+in batches with batch RSA: same modulus, a different small public exponent per signature. The
+offer then names the exponent, "signature_e": 7, next to the signature and like it outside the
+transcript; clients accept only the key's own exponent or one of crypto.batch_rsa.BATCH_PRIMES.
+"""
+
+import collections
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+
+from crypto.pss import rsa_generate_signing_keys, rsa_crt_private_key, rsa_pss_sign, rsa_pss_verify, PUBLIC_EXPONENT
+from crypto.batch_rsa import BATCH_PRIMES, batch_exponents, rsa_pss_sign_batch
+
+SERVER_KEY_BITS = 2048
+MIN_SERVER_KEY_BITS = 2048 # clients refuse weaker server keys
+KEY_FILE = 'server_key.json'
+TRANSCRIPT_LABEL = b"p2p handshake v1"
+CACHE_SIZE = 64 # (server key, client name) prefixes kept by a VerificationCache
+SIGN_BATCH = 8 # most handshakes a BatchSigner signs with one batch RSA operation
+SIGN_WINDOW = 0.005 # seconds a batch waits to fill up while handshakes keep arriving
+UNSIGNED_FIELDS = ("signature", "signature_e") # offer fields left out of the transcript
+
+
+def load_or_create_identity(directory, bits=SERVER_KEY_BITS):
+    """The server's private key from directory, generated and saved (mode 0600) on first use."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, KEY_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            saved = json.load(f)
+        return rsa_crt_private_key(int(saved["p"], 16), int(saved["q"], 16), int(saved["e"]))
+    _, private_key = rsa_generate_signing_keys(bits)
+    e, p, q = private_key[1], private_key[3], private_key[4]
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({"e": e, "p": format(p, 'x'), "q": format(q, 'x')}, f)
+    return private_key
+
+
+@functools.lru_cache(maxsize=None)
+def ephemeral_identity(bits=SERVER_KEY_BITS):
+    """Key for servers without a store directory: generated once per process, never saved."""
+    return rsa_generate_signing_keys(bits)[1]
+
+
+def public_part(private_key):
+    return private_key[0], private_key[1]
+
+
+def encode_public_key(public_key):
+    n, e = public_key
+    return {"n": format(n, 'x'), "e": e}
+
+
+def decode_public_key(fields):
+    return int(fields["n"], 16), int(fields["e"])
+
+
+def fingerprint(public_key):
+    """Hex SHA-256 of the public key; what clients pin."""
+    n, e = public_key
+    return hashlib.sha256(n.to_bytes((n.bit_length() + 7) // 8, 'big') + e.to_bytes(4, 'big')).hexdigest()
+
+
+class KnownHosts:
+    """Server key fingerprints pinned per server URL, one "<url> <fingerprint>" line each.
+
+    Lines are only ever appended, and the first one for a URL wins, so clients in several
+    processes sharing the file agree on the pin even if they raced to add it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def lookup(self, url):
+        """Pinned fingerprint of the server at url, None if it was never seen."""
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2 and fields[0] == url:
+                        return fields[1]
+        except FileNotFoundError:
+            pass
+        return None
+
+    def pin(self, url, key_fingerprint):
+        """Pins key_fingerprint for url unless a key is pinned already. Returns the pinned one."""
+        with self.lock:
+            pinned = self.lookup(url)
+            if pinned:
+                return pinned
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(f"{url} {key_fingerprint}\n")
+            return self.lookup(url)
+
+
+def canonical(frame):
+    return json.dumps(frame, sort_keys=True, separators=(',', ':')).encode()
+
+
+def transcript_prefix(key_fingerprint, client_name):
+    prefix = hashlib.sha256(TRANSCRIPT_LABEL)
+    prefix.update(bytes.fromhex(key_fingerprint))
+    prefix.update(canonical(client_name))
+    return prefix
+
+
+def transcript_digest(prefix, key_frame, offer):
+    """Digest of the handshake: key frame and offer (its signature left out) on top of the prefix."""
+    digest = prefix.copy()
+    digest.update(canonical(key_frame))
+    digest.update(canonical({k: v for k, v in offer.items() if k not in UNSIGNED_FIELDS}))
+    return digest.digest()
+
+
+def sign_offer(private_key, key_fingerprint, client_name, key_frame, offer, signer=None):
+    """Server side: hex signature of the transcript of this handshake.
+
+    With a signer (BatchSigner) the signature may come out of a batch under a small exponent,
+    which is then stored in offer["signature_e"].
+    """
+    digest = transcript_digest(transcript_prefix(key_fingerprint, client_name), key_frame, offer)
+    if signer is None:
+        return rsa_pss_sign(digest, private_key).hex()
+    signature, exponent = signer.sign(digest)
+    if exponent != private_key[1]:
+        offer["signature_e"] = exponent
+    return signature.hex()
+
+
+def sign_digests(digests, private_key, exponents):
+    """[(signature, exponent)] for the digests of one batch; a batch of one uses the key's own exponent."""
+    if len(digests) == 1:
+        return [(rsa_pss_sign(digests[0], private_key), private_key[1])]
+    return list(zip(rsa_pss_sign_batch(digests, private_key, exponents), exponents))
+
+
+class BatchSigner:
+    """Signs transcript digests for the handshake threads, several at a time.
+
+    Requests queue up and one signing thread takes up to max_batch of them. A batch of one is
+    signed as usual; a larger one with rsa_pss_sign_batch, the i-th request under the i-th of
+    the key's batch exponents. A request that finds the signer idle is signed right away. The
+    thread only holds a batch open for up to window seconds when the previous batch had
+    company, i.e. while a reconnect storm is going on, so a lone handshake pays no extra
+    latency and a storm pays at most window plus one batch.
+    """
+
+    def __init__(self, private_key, max_batch=SIGN_BATCH, window=SIGN_WINDOW, metrics=None, executor=None):
+        self.private_key = private_key
+        self.exponents = batch_exponents(private_key, max_batch)
+        self.max_batch = max_batch
+        self.window = window
+        self.metrics = metrics
+        self.executor = executor # a process pool to sign in, None signs in the signer thread
+        self.pending = collections.deque() # [digest, (signature, exponent), error, done Event]
+        self.cond = threading.Condition()
+        self.storm = False # the last batch had more than one request
+        self.worker = None
+
+    def sign(self, digest):
+        """(signature, public exponent it verifies with) for digest. Blocks until the batch is signed."""
+        request = [digest, None, None, threading.Event()]
+        with self.cond:
+            self.pending.append(request)
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._run, daemon=True)
+                self.worker.start()
+            else:
+                self.cond.notify()
+        request[3].wait()
+        if request[2] is not None:
+            raise request[2]
+        return request[1]
+
+    def _next_batch(self):
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+            if self.storm:
+                deadline = time.monotonic() + self.window
+                while len(self.pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+            batch = [self.pending.popleft() for _ in range(min(len(self.pending), self.max_batch))]
+            self.storm = len(batch) > 1
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            digests = [request[0] for request in batch]
+            exponents = self.exponents[:len(batch)]
+            try:
+                if self.executor:
+                    results = self.executor.submit(sign_digests, digests, self.private_key, exponents).result()
+                else:
+                    results = sign_digests(digests, self.private_key, exponents)
+            except Exception as e: # handed to every waiting handshake, the thread keeps going
+                for request in batch:
+                    request[2] = e
+                    request[3].set()
+                continue
+            for request, result in zip(batch, results):
+                request[1] = result
+                request[3].set()
+            if self.metrics:
+                self.metrics.inc('sign_batches_total')
+                self.metrics.inc('sign_batched_total', len(batch))
+
+
+class VerificationCache:
+    """Checked server keys and their transcript prefixes, by (server key, client name).
+
+    Shared by every client of a process (see VERIFICATION_CACHE), so reconnects reuse it.
+    """
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.entries = collections.OrderedDict() # (n, e, client name) -> (fingerprint, public key, prefix)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def prepare(self, key_fields, client_name):
+        """(fingerprint, public key, prefix) for the key an offer carries. Raises ValueError if unusable."""
+        cache_key = (key_fields.get("n"), key_fields.get("e"), client_name)
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry:
+                self.entries.move_to_end(cache_key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        public_key = decode_public_key(key_fields)
+        n, e = public_key
+        if n.bit_length() < MIN_SERVER_KEY_BITS or e != PUBLIC_EXPONENT or n % 2 == 0:
+            raise ValueError(f"Unacceptable server key ({n.bit_length()} bits, e={e})")
+        key_fingerprint = fingerprint(public_key)
+        entry = (key_fingerprint, public_key, transcript_prefix(key_fingerprint, client_name))
+        with self.lock:
+            self.entries[cache_key] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry
+
+    def verify(self, client_name, key_frame, offer, pinned=None):
+        """Checks the server's signature on an offer. Returns the server key fingerprint.
+
+        Raises ValueError if the offer is unsigned, the key is not the pinned one or the
+        signature does not match the transcript.
+        """
+        if "server_key" not in offer or "signature" not in offer:
+            raise ValueError("Offer is not signed by the server")
+        key_fingerprint, public_key, prefix = self.prepare(offer["server_key"], client_name)
+        if pinned and key_fingerprint != pinned:
+            raise ValueError(f"Server key {key_fingerprint[:16]} does not match the pinned key {pinned[:16]}")
+        n, e = public_key
+        exponent = offer.get("signature_e", e)
+        if exponent != e and (not isinstance(exponent, int) or exponent not in BATCH_PRIMES):
+            raise ValueError(f"Unacceptable signature exponent {exponent!r}")
+        digest = transcript_digest(prefix, key_frame, offer)
+        if not rsa_pss_verify(digest, bytes.fromhex(offer["signature"]), (n, exponent)):
+            raise ValueError("Bad server signature")
+        return key_fingerprint
+
+
+VERIFICATION_CACHE = VerificationCache()
@@ -0,0 +1,77 @@
+"""
+Session key schedule: every key a session uses, derived from one secret with HKDF (RFC 5869).
+
+The handshake still yields a single 16-byte key per session (sent under RSA, or derived from
+the DH shared secret). That key is the secret of epoch 0; rekeying derives the secret of each
+next epoch from the previous one. Nothing uses an epoch secret directly:
+
+    PRK                       = HKDF-Extract(SCHEDULE_SALT, epoch secret)
+    traffic key, direction    = HKDF-Expand(PRK, "p2p traffic key" + direction, 16)
+    MAC key, direction        = HKDF-Expand(PRK, "p2p record mac" + direction, 32)
+    CTR nonce, direction      = HKDF-Expand(PRK, "p2p ctr nonce" + direction, 8)
+    secret of epoch n + 1     = HKDF-Expand(PRK, "p2p rekey" + n + 1, 16)
+
+so the two directions encrypt under different AES keys (a message can't be reflected or
+decrypted with the other direction's keystream), MACs and encryption never share a key, and
+rekeying needs no exchange. Directions are the labels of topology.record (b"c2s", b"s2c").
+
+Code keeps passing the epoch secret around as "the key" of an epoch, as before; the derived
+keys are looked up with key_schedule(secret) where they are used. Those lookups are on the
+relay path, so schedules are cached, and each one keeps its PRK as an HMAC state with the
+inner and outer pads already hashed: a derivation is two SHA-256 compressions.
+"""
+
+import functools
+
+from crypto.hkdf import HmacSha256, hkdf_extract, hkdf_expand
+
+SCHEDULE_SALT = b"p2p key schedule v1"
+TRAFFIC_LABEL = b"p2p traffic key "
+MAC_LABEL = b"p2p record mac "
+NONCE_LABEL = b"p2p ctr nonce "
+REKEY_LABEL = b"p2p rekey "
+MAC_KEY_SIZE = 32
+NONCE_SIZE = 8 # the nonce half of an AES-CTR counter block (aes.aes_ctr)
+
+
+class KeySchedule:
+    """The keys derived from one epoch secret. Derivations are memoized per direction."""
+
+    __slots__ = ('secret', 'prk', '_derived')
+
+    def __init__(self, secret):
+        self.secret = secret
+        self.prk = HmacSha256(hkdf_extract(SCHEDULE_SALT, secret))
+        self._derived = {}
+
+    def derive(self, label, length):
+        okm = self._derived.get(label)
+        if okm is None:
+            okm = self._derived[label] = hkdf_expand(self.prk, label, length)
+        return okm
+
+    def traffic_key(self, direction):
+        """AES key of the frames sent in direction."""
+        return self.derive(TRAFFIC_LABEL + direction, len(self.secret))
+
+    def mac_key(self, direction):
+        """HMAC key of the record layer in direction."""
+        return self.derive(MAC_LABEL + direction, MAC_KEY_SIZE)
+
+    def nonce(self, direction):
+        """CTR nonce of the message keystream in direction (topology.keystream)."""
+        return self.derive(NONCE_LABEL + direction, NONCE_SIZE)
+
+    def next_secret(self, epoch):
+        """Secret of epoch, the one after this schedule's. Knowing it does not reveal this one."""
+        return hkdf_expand(self.prk, REKEY_LABEL + epoch.to_bytes(4, 'big'), len(self.secret))
+
+
+@functools.lru_cache(maxsize=4096)
+def key_schedule(secret):
+    """KeySchedule of an epoch secret, cached: senders and the relay ask for it on every frame."""
+    return KeySchedule(secret)
+
+
+def traffic_key(secret, direction):
+    return key_schedule(secret).traffic_key(direction)
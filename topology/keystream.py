@@ -0,0 +1,184 @@
+"""
+Precomputed AES-CTR keystream for messages.
+
+A message is one 16-byte block. In the old mode it is encrypted with the AES block function
+itself, so every send pays a full AES encryption (and the server one more per relay) at the
+moment the message is written. With the "ctr" message mode, negotiated in the handshake, the
+sender XORs the padded block with a block of CTR keystream instead:
+
+    "data": [...], "nonce": "<16 hex digits>", "ctr": 42
+
+The keystream does not depend on the message, so each sending direction keeps a Keystream:
+a small ring of blocks computed ahead of time by one background thread (KeystreamRefiller)
+and refilled whenever it runs low. A send takes the next block and XORs, which is a couple
+of microseconds; only a burst longer than the buffer computes blocks inline. The receiver
+computes the one block it needs from the nonce and counter in the frame.
+
+Counter blocks are nonce (8 bytes) || counter (8 bytes), as for file chunks (aes.aes_ctr).
+The key and the nonce of a stream are the traffic key and CTR nonce of its epoch and direction
+in the session's key schedule (topology.keyschedule). No counter block is encrypted twice:
+
+- a Keystream hands out every counter exactly once, in increasing order; a refill continues
+  from the last counter computed, and blocks computed for counters already handed out are
+  dropped rather than used;
+- each side keeps one stream per (epoch, direction) and only ever replaces it with the stream
+  of a newer epoch, whose key is different; the other direction has its own key as well.
+
+The nonce and counter are in the MAC'd header of the record layer.
+"""
+
+import collections
+import os
+import threading
+import time
+
+from aes.aes_ctr import NONCE_SIZE
+
+CTR_MODE = "ctr" # value of "message_mode" in the key frame and the offer
+KEYSTREAM_BLOCKS = 32 # blocks buffered per stream (16 bytes each)
+REFILL_BELOW = 8 # the refiller is woken once fewer blocks than this are left
+MAX_COUNTER = 2 ** 64 - 1
+
+
+def counter_block(nonce, counter):
+    return nonce + counter.to_bytes(8, 'big')
+
+
+def xor_block(data, block):
+    """data XOR the first len(data) bytes of block."""
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(block[:len(data)], 'big')).to_bytes(len(data), 'big')
+
+
+def ctr_fields(frame):
+    """(nonce, counter) of a CTR message frame. ValueError if they are malformed."""
+    nonce = bytes.fromhex(frame["nonce"])
+    counter = frame["ctr"]
+    if len(nonce) != NONCE_SIZE or not isinstance(counter, int) or not 0 <= counter <= MAX_COUNTER:
+        raise ValueError("Malformed CTR nonce or counter")
+    return nonce, counter
+
+
+def decrypt_ctr(cipher, frame):
+    """Plaintext of a CTR message frame, cipher being the AESKey of its epoch."""
+    nonce, counter = ctr_fields(frame)
+    data = bytes(frame["data"])
+    if len(data) > 16:
+        raise ValueError("A CTR message is at most one block")
+    return xor_block(data, cipher.encrypt(counter_block(nonce, counter)))
+
+
+class Keystream:
+    """Keystream of one sending direction under one key. take() is safe from any thread."""
+
+    __slots__ = ('cipher', 'nonce', 'epoch', 'capacity', 'ring', 'next', 'generated', 'lock', 'refilling',
+                 'refiller', 'metrics')
+
+    def __init__(self, cipher, nonce, epoch=0, capacity=KEYSTREAM_BLOCKS, refiller=None, metrics=None):
+        if len(nonce) != NONCE_SIZE:
+            raise ValueError(f"A CTR nonce is {NONCE_SIZE} bytes")
+        self.cipher = cipher # AESKey of the traffic key
+        self.nonce = nonce
+        self.epoch = epoch # key epoch of the stream
+        self.capacity = capacity
+        self.ring = bytearray(capacity * 16) # the block of counter c is at (c % capacity) * 16
+        self.next = 0 # counter handed out by the next take()
+        self.generated = 0 # blocks next .. generated - 1 are in the ring
+        self.lock = threading.Lock()
+        self.refilling = False # queued on the refiller or being refilled
+        self.refiller = refiller if refiller is not None else REFILLER
+        self.metrics = metrics
+        self.schedule_refill() # ahead of the first send
+
+    @property
+    def available(self):
+        return self.generated - self.next
+
+    def take(self):
+        """(counter, 16-byte keystream block) for one message; every counter is handed out once."""
+        with self.lock:
+            counter = self.next
+            if counter > MAX_COUNTER:
+                raise OverflowError("CTR counters exhausted, the session has to rekey")
+            self.next = counter + 1
+            if self.generated > counter:
+                offset = (counter % self.capacity) * 16
+                block = bytes(self.ring[offset:offset + 16])
+            else:
+                block = None
+                self.generated = counter + 1
+            low = self.generated - self.next < REFILL_BELOW and not self.refilling
+            if low:
+                self.refilling = True
+        if block is None:
+            # The buffer ran dry (a burst, or the refiller is behind): compute this one inline
+            block = self.cipher.encrypt(counter_block(self.nonce, counter))
+            if self.metrics:
+                self.metrics.inc('keystream_misses_total')
+        if low:
+            self.refiller.schedule(self)
+        return counter, block
+
+    def encrypt(self, data):
+        """(counter, ciphertext) of data, at most one block."""
+        counter, block = self.take()
+        return counter, xor_block(data, block)
+
+    def refill_one(self):
+        """Computes the next missing block. False once the ring is full (and refilling is over)."""
+        with self.lock:
+            counter = self.generated
+            if counter - self.next >= self.capacity:
+                self.refilling = False
+                return False
+        block = self.cipher.encrypt(counter_block(self.nonce, counter))
+        with self.lock:
+            # take() may have handed this counter out in the meantime (computed inline): drop it
+            if self.generated == counter:
+                offset = (counter % self.capacity) * 16
+                self.ring[offset:offset + 16] = block
+                self.generated = counter + 1
+        return True
+
+    def schedule_refill(self):
+        with self.lock:
+            if self.refilling:
+                return
+            self.refilling = True
+        self.refiller.schedule(self)
+
+
+class KeystreamRefiller:
+    """One background thread that tops up the keystreams that ran low.
+
+    It computes one block at a time and yields the interpreter between blocks, so a send or a
+    relay waiting for the GIL gets it after one AES block rather than after a whole refill.
+    """
+
+    def __init__(self):
+        self.pending = collections.deque()
+        self.condition = threading.Condition(threading.Lock())
+        self.thread = None
+
+    def schedule(self, stream):
+        with self.condition:
+            self.pending.append(stream)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="keystream-refill", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                stream = self.pending.popleft()
+            while stream.refill_one():
+                time.sleep(0)
+
+
+REFILLER = KeystreamRefiller() # shared by every Keystream of the process
+
+if hasattr(os, 'register_at_fork'):
+    # A forked child (benchmarks, worker processes) has no refill thread; it starts its own
+    os.register_at_fork(after_in_child=REFILLER.__init__)
@@ -0,0 +1,377 @@
+"""
+Load generator for SecureServer.
+
+Simulates many clients from a few processes. Every process runs one asyncio loop, and every
+simulated client is a coroutine with its own connection (no thread per client). Clients
+perform the real handshake (RSA keypair, "key" frame, decrypting the "shared_aes_offer") and
+then send AES encrypted messages to other clients of the same process, so send and receive
+timestamps come from the same clock.
+
+    python -m topology.loadgen --clients 2000 --processes 4 --rate 2 --duration 30 \\
+        --ramp linear:20 --size uniform:4:16 --output summary.json
+
+The summary (JSON) reports throughput, latency percentiles, handshake rate and error counts.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import time
+
+from crypto.rsa import rsa_generate_keys, rsa_decrypt
+from crypto.dh import dh_generate_keys, dh_shared_secret, dh_derive_key
+from aes.aes_encrypt import aes_encryption
+from aes.aes_decrypt import aes_decryption
+from topology.rekey import KeyRing
+from topology.keyschedule import traffic_key
+from topology.transport import parse_url, TCP, UNIX
+from topology.record import Sequencer, ReplayWindow, CLIENT_TO_SERVER, SERVER_TO_CLIENT
+from topology.flow import FrameAssembler, LENGTH_MASK
+
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 9000
+BLOCK_SIZE = 16
+ID_LENGTH = 7 # base-36 message id at the start of every payload, the rest is filler
+
+
+def parse_size(spec):
+    """'fixed:16', 'uniform:8:16' or 'choice:8,12,16' -> function returning a payload size."""
+    kind, _, args = spec.partition(':')
+    if kind == 'fixed':
+        size = int(args)
+        sizer = lambda: size
+    elif kind == 'uniform':
+        low, high = (int(x) for x in args.split(':'))
+        sizer = lambda: random.randint(low, high)
+    elif kind == 'choice':
+        sizes = [int(x) for x in args.split(',')]
+        sizer = lambda: random.choice(sizes)
+    else:
+        raise ValueError(f"Unknown size distribution: {spec}")
+    return lambda: max(ID_LENGTH, min(BLOCK_SIZE, sizer()))
+
+
+def start_offsets(count, ramp):
+    """Start delay of each client for a ramp profile: 'none', 'linear:SECONDS' or 'step:STEPS:SECONDS'."""
+    kind, _, args = ramp.partition(':')
+    if kind == 'none' or count == 0:
+        return [0.0] * count
+    if kind == 'linear':
+        seconds = float(args)
+        return [seconds * i / count for i in range(count)]
+    if kind == 'step':
+        steps, seconds = args.split(':')
+        steps, seconds = int(steps), float(seconds)
+        return [seconds * (i * steps // count) / steps for i in range(count)]
+    raise ValueError(f"Unknown ramp profile: {ramp}")
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def encode_frame(data):
+    message_bytes = json.dumps(data).encode('utf-8')
+    return len(message_bytes).to_bytes(4, 'big') + message_bytes
+
+
+async def read_frame(reader, assembler):
+    """Next frame from the server; large frames arrive in fragments and are put back together."""
+    while True:
+        prefix = int.from_bytes(await reader.readexactly(4), 'big')
+        frame = assembler.feed(prefix, await reader.readexactly(prefix & LENGTH_MASK))
+        if frame is not None:
+            return json.loads(frame.decode())
+
+
+class WorkerStats:
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.bytes_sent = 0
+        self.latencies = []
+        self.handshake_times = []
+        self.handshake_done = [] # wall clock completion times, comparable across processes
+        self.errors = {}
+        self.sent_at = {}
+        self.next_id = 0
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+def open_connection(config):
+    """asyncio streams to the server: --url (tcp:// or unix://) if given, else --host/--port."""
+    if not config.url:
+        return asyncio.open_connection(config.host, config.port)
+    scheme, address = parse_url(config.url)
+    if scheme == UNIX:
+        return asyncio.open_unix_connection(address)
+    return asyncio.open_connection(*address)
+
+
+class SimulatedClient:
+    def __init__(self, name, config, stats, ready):
+        self.name = name
+        self.config = config
+        self.stats = stats
+        self.ready = ready # names of the clients in this process that finished their handshake
+        self.keys = None # KeyRing, follows the server's in-band rekeys
+        self.sequencer = Sequencer() # record layer, like SecureClient
+        self.replay = ReplayWindow()
+        self.writer = None
+
+    async def run(self, start_delay, stop_at, size):
+        await asyncio.sleep(start_delay)
+        config = self.config
+
+        handshake_start = time.perf_counter()
+        if config.kex == 'rsa':
+            public_key, private_key = rsa_generate_keys(128)
+            key_frame = {"type": "key", "from": self.name, "data": list(public_key)}
+        else:
+            public_key, private_key = dh_generate_keys(config.kex)
+            key_frame = {"type": "key", "from": self.name, "kex": config.kex, "data": format(public_key, 'x')}
+        try:
+            reader, self.writer = await asyncio.wait_for(
+                open_connection(config), config.timeout)
+        except (OSError, asyncio.TimeoutError):
+            self.stats.error('connect')
+            return
+        assembler = FrameAssembler()
+        try:
+            self.writer.write(encode_frame(key_frame))
+            offer = await asyncio.wait_for(read_frame(reader, assembler), config.timeout)
+            if offer.get("type") == "busy": # turned away by the server's handshake admission
+                self.stats.error('busy')
+                self.writer.close()
+                return
+            if config.kex == 'rsa':
+                aes_key = bytes(rsa_decrypt(c, private_key) for c in offer["data"])
+            else:
+                server_public = int(offer["data"], 16)
+                aes_key = dh_derive_key(config.kex, dh_shared_secret(config.kex, server_public, private_key),
+                                        public_key, server_public)
+            self.keys = KeyRing(aes_key)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, KeyError):
+            self.stats.error('handshake')
+            self.writer.close()
+            return
+        self.stats.handshake_times.append(time.perf_counter() - handshake_start)
+        self.stats.handshake_done.append(time.time())
+        self.ready.append(self.name)
+
+        receiver = asyncio.ensure_future(self.receive(reader, assembler))
+        try:
+            await self.send_loop(stop_at, size)
+            # let in-flight messages arrive before hanging up
+            await asyncio.sleep(max(0.0, stop_at + config.drain - time.monotonic()))
+        finally:
+            receiver.cancel()
+            self.writer.close()
+
+    async def send_loop(self, stop_at, size):
+        config = self.config
+        while time.monotonic() < stop_at:
+            if config.arrival == 'poisson':
+                await asyncio.sleep(random.expovariate(config.rate))
+            else:
+                await asyncio.sleep(1.0 / config.rate)
+            if len(self.ready) < 2 or self.writer.is_closing():
+                continue
+            target = random.choice(self.ready)
+            if target == self.name:
+                continue
+
+            msg_id = self.stats.next_id
+            self.stats.next_id += 1
+            payload = self.encode_id(msg_id).encode().ljust(size(), b'x')
+            ciphertext = aes_encryption(payload.ljust(BLOCK_SIZE, b'\0'), traffic_key(self.keys.current, CLIENT_TO_SERVER))
+            message = {"type": "message", "from": self.name, "recipient": target,
+                       "data": list(ciphertext), "epoch": self.keys.epoch}
+            frame = encode_frame(self.sequencer.seal(message, self.keys.current, CLIENT_TO_SERVER))
+            self.stats.sent_at[msg_id] = time.perf_counter()
+            try:
+                self.writer.write(frame)
+                await self.writer.drain()
+            except (OSError, ConnectionError):
+                self.stats.error('send')
+                return
+            self.stats.sent += 1
+            self.stats.bytes_sent += len(frame)
+
+    async def receive(self, reader, assembler):
+        try:
+            while True:
+                msg = await read_frame(reader, assembler)
+                epoch = msg.get("epoch", 0)
+                if msg.get("type") == "rekey":
+                    # sealed under the key it replaces; only an authentic notice moves the ring
+                    key = self.keys.peek(epoch - 1)
+                    if key and not self.replay.open(msg, key, SERVER_TO_CLIENT) and self.keys.advance_to(epoch):
+                        self.writer.write(encode_frame({"type": "rekey_ack", "from": self.name, "epoch": epoch}))
+                    else:
+                        self.stats.error('record')
+                if msg.get("type") == "ping":
+                    self.writer.write(encode_frame({"type": "pong", "from": self.name}))
+                if msg.get("type") != "message":
+                    continue
+                # the epoch is only trusted, and the ring moved on, once the MAC checks out
+                key = self.keys.peek(epoch)
+                if not key or self.replay.open(msg, key, SERVER_TO_CLIENT):
+                    self.stats.error('record')
+                    continue
+                self.keys.advance_to(epoch)
+                payload = aes_decryption(bytes(msg["data"]), traffic_key(key, SERVER_TO_CLIENT)).rstrip(b'\0')
+                sent_at = self.stats.sent_at.pop(int(payload[:ID_LENGTH], 36), None)
+                if sent_at is not None:
+                    self.stats.latencies.append(time.perf_counter() - sent_at)
+                self.stats.received += 1
+        except asyncio.CancelledError:
+            raise
+        except asyncio.IncompleteReadError:
+            self.stats.error('disconnected')
+        except (OSError, ValueError, KeyError):
+            self.stats.error('receive')
+
+    @staticmethod
+    def encode_id(msg_id):
+        digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+        text = ''
+        for _ in range(ID_LENGTH):
+            msg_id, digit = divmod(msg_id, 36)
+            text = digits[digit] + text
+        return text
+
+
+async def run_worker(worker_id, client_count, offsets, config):
+    stats = WorkerStats()
+    ready = []
+    size = parse_size(config.size)
+    stop_at = time.monotonic() + config.duration
+    clients = [SimulatedClient(f"load-{worker_id}-{i}", config, stats, ready) for i in range(client_count)]
+    await asyncio.gather(*(client.run(offset, stop_at, size) for client, offset in zip(clients, offsets)))
+    return stats
+
+
+def worker_main(worker_id, client_count, offsets, config, results):
+    stats = asyncio.run(run_worker(worker_id, client_count, offsets, config))
+    results.put({
+        "sent": stats.sent,
+        "received": stats.received,
+        "bytes_sent": stats.bytes_sent,
+        "latencies": stats.latencies,
+        "handshake_times": stats.handshake_times,
+        "handshake_done": stats.handshake_done,
+        "errors": stats.errors,
+        "unanswered": len(stats.sent_at),
+    })
+
+
+def summarize(worker_results, config, elapsed):
+    latencies = sorted(l for r in worker_results for l in r["latencies"])
+    handshakes = sorted(h for r in worker_results for h in r["handshake_times"])
+    errors = {}
+    for r in worker_results:
+        for kind, count in r["errors"].items():
+            errors[kind] = errors.get(kind, 0) + count
+    unanswered = sum(r["unanswered"] for r in worker_results)
+    if unanswered:
+        errors["lost"] = unanswered
+
+    received = sum(r["received"] for r in worker_results)
+    done = sorted(t for r in worker_results for t in r["handshake_done"])
+    handshake_window = done[-1] - done[0] if len(done) > 1 else elapsed
+    return {
+        "config": {
+            "clients": config.clients,
+            "processes": config.processes,
+            "duration_s": config.duration,
+            "rate_per_client": config.rate,
+            "arrival": config.arrival,
+            "size": config.size,
+            "ramp": config.ramp,
+            "kex": config.kex,
+        },
+        "elapsed_s": elapsed,
+        "sent": sum(r["sent"] for r in worker_results),
+        "received": received,
+        "msgs_per_sec": received / config.duration if config.duration else 0.0,
+        "bytes_sent": sum(r["bytes_sent"] for r in worker_results),
+        "latency_ms": {
+            "p50": percentile(latencies, 50) * 1e3,
+            "p90": percentile(latencies, 90) * 1e3,
+            "p99": percentile(latencies, 99) * 1e3,
+            "max": (latencies[-1] if latencies else 0.0) * 1e3,
+        },
+        "handshakes": len(handshakes),
+        "handshakes_per_sec": len(handshakes) / handshake_window if handshake_window else 0.0,
+        "handshake_ms": {
+            "p50": percentile(handshakes, 50) * 1e3,
+            "p99": percentile(handshakes, 99) * 1e3,
+        },
+        "errors": errors,
+    }
+
+
+def run(config):
+    """Runs the load test described by config (an argparse namespace) and returns the summary."""
+    offsets = start_offsets(config.clients, config.ramp)
+    processes = max(1, min(config.processes, config.clients))
+    # client i goes to process i % processes, so every process ramps up at the same pace
+    shares = [offsets[p::processes] for p in range(processes)]
+
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=worker_main, args=(p, len(shares[p]), shares[p], config, results))
+               for p in range(processes)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    worker_results = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    return summarize(worker_results, config, time.perf_counter() - start)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator for SecureServer")
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--url', help="tcp://host:port or unix:///path, instead of --host/--port")
+    parser.add_argument('--clients', type=int, default=100, help="simulated clients in total")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--duration', type=float, default=30.0, help="seconds of traffic, counted from start")
+    parser.add_argument('--rate', type=float, default=1.0, help="messages per second per client")
+    parser.add_argument('--arrival', choices=['constant', 'poisson'], default='poisson')
+    parser.add_argument('--size', default='uniform:8:16', help="fixed:N | uniform:A:B | choice:A,B,... (bytes, max 16)")
+    parser.add_argument('--ramp', default='linear:10', help="none | linear:SECONDS | step:STEPS:SECONDS")
+    parser.add_argument('--kex', choices=['rsa', 'ffdhe2048', 'ffdhe3072', 'ffdhe4096'], default='rsa',
+                        help="handshake: RSA key transport or ephemeral DH in an RFC 7919 group")
+    parser.add_argument('--timeout', type=float, default=10.0, help="connect/handshake timeout")
+    parser.add_argument('--drain', type=float, default=2.0, help="seconds to wait for in-flight messages")
+    parser.add_argument('--output', help="write the JSON summary to this file as well")
+    args = parser.parse_args(argv)
+    if args.url:
+        try:
+            scheme, _ = parse_url(args.url)
+        except ValueError as e:
+            parser.error(str(e))
+        if scheme not in (TCP, UNIX):
+            parser.error("mem:// only connects within one process; use tcp:// or unix:// for the load generator")
+    return args
+
+
+if __name__ == "__main__":
+    config = parse_args()
+    summary = run(config)
+    text = json.dumps(summary, indent=2)
+    if config.output:
+        with open(config.output, 'w') as f:
+            f.write(text + "\n")
+    print(text)
@@ -0,0 +1,135 @@
+"""
+Structured logging for the relay.
+
+Log calls only enqueue the LogRecord (QueueHandler); a QueueListener thread formats and
+writes them, so no stdout write happens while client_lock is held. Records are rendered
+as key=value pairs, extra fields included:
+
+    ts=2024-05-01T10:00:00.123 level=INFO logger=p2p.server msg="Client connected" client=client1
+
+Anything passed as extra={"payload": ...} is redacted unless redaction is turned off,
+and repeated warnings with the same template are rate limited.
+"""
+
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+ROOT_LOGGER = 'p2p'
+
+# attributes every LogRecord has; anything else came in through extra=
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def get_logger(name):
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+class StructuredFormatter(logging.Formatter):
+    def format(self, record):
+        ts = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created))
+        parts = [f"ts={ts}.{int(record.msecs):03d}", f"level={record.levelname}",
+                 f"logger={record.name}", f"msg={_quote(record.getMessage())}"]
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRS:
+                parts.append(f"{key}={_quote(value)}")
+        line = " ".join(parts)
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+def _quote(value):
+    text = str(value)
+    if not text or any(c in text for c in ' "=\n'):
+        return '"' + text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+    return text
+
+
+class RedactionFilter(logging.Filter):
+    """Replaces message payloads with their length, so plaintext never reaches the logs."""
+
+    FIELDS = ('payload',)
+
+    def filter(self, record):
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                setattr(record, field, f"<redacted {len(value)} chars>")
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most `burst` records per template every `interval` seconds (WARNING and up).
+
+    The first record after a suppressed stretch carries suppressed=<count>.
+    """
+
+    def __init__(self, interval=10.0, burst=5, min_level=logging.WARNING):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.min_level = min_level
+        self.windows = {}  # (logger, template) -> [window start, emitted, suppressed]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < self.min_level:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self.windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+class _InProcessQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that skips formatting in the caller; the listener formats instead.
+
+    The stock prepare() renders the message eagerly (it expects a pickling queue); our
+    queue never leaves the process, so handing over the record itself is enough.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def configure_logging(level=logging.INFO, stream=None, redact=True, rate_limit=True):
+    """Installs the background writer on the 'p2p' logger and returns the running QueueListener."""
+    logger = logging.getLogger(ROOT_LOGGER)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        if isinstance(handler, logging.handlers.QueueHandler) and hasattr(handler, 'listener'):
+            handler.listener.stop()
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(StructuredFormatter())
+
+    log_queue = queue.SimpleQueue()
+    handler = _InProcessQueueHandler(log_queue)
+    if rate_limit:
+        handler.addFilter(RateLimitFilter())
+    if redact:
+        handler.addFilter(RedactionFilter())
+
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+    handler.listener = listener
+    listener.start()
+
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    return listener
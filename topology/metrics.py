@@ -0,0 +1,175 @@
+"""
+Lock-cheap metrics for the relay: counters, gauges and log-bucketed latency histograms.
+
+Every thread records into its own shard (a plain dict reached through threading.local),
+so the hot path never takes a lock. Shards are merged when somebody scrapes the registry,
+either through the Prometheus text endpoint or the "stats" admin message.
+"""
+
+import threading
+import time
+
+# Histogram bucket k holds observations below 2**k microseconds (1us .. ~33s), plus +Inf
+HISTOGRAM_BUCKETS = 26
+
+
+class _Shard:
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}  # name -> [bucket counts..., +Inf count, sum in seconds]
+
+
+class MetricsRegistry:
+    def __init__(self, prefix='p2p_'):
+        self.prefix = prefix
+        self.gauges = {}
+        self._local = threading.local()
+        self._shards = []            # (thread, shard) for every thread that recorded something
+        self._retired = _Shard()     # shards of finished threads, folded in on scrape
+        self._lock = threading.Lock()  # taken on shard registration and on scrape only
+        self._collectors = []        # callables returning {gauge name: value}, run on scrape
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def inc(self, name, amount=1):
+        """Adds amount to a counter. Labels may be part of the name: 'drops_total{reason="offline"}'."""
+        counters = self._shard().counters
+        counters[name] = counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def add_collector(self, collector):
+        """Registers a function returning gauges computed at scrape time (queue depths and the like)."""
+        self._collectors.append(collector)
+
+    def observe(self, name, seconds):
+        """Records a duration in the histogram called name."""
+        histograms = self._shard().histograms
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = [0] * (HISTOGRAM_BUCKETS + 2)
+        bucket = int(seconds * 1e6).bit_length()
+        histogram[bucket if bucket < HISTOGRAM_BUCKETS else HISTOGRAM_BUCKETS] += 1
+        histogram[-1] += seconds
+
+    def time(self, name):
+        """Context manager observing the duration of its block."""
+        return _Timer(self, name)
+
+    @staticmethod
+    def _merge_into(target, shard):
+        for name, value in list(shard.counters.items()):
+            target.counters[name] = target.counters.get(name, 0) + value
+        for name, histogram in list(shard.histograms.items()):
+            merged = target.histograms.get(name)
+            if merged is None:
+                merged = target.histograms[name] = [0] * (HISTOGRAM_BUCKETS + 2)
+            for i, value in enumerate(list(histogram)):
+                merged[i] += value
+
+    def snapshot(self):
+        """Merges every shard and returns a JSON friendly view of all metrics."""
+        merged = _Shard()
+        with self._lock:
+            alive = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    self._merge_into(self._retired, shard)
+            self._shards = alive
+            self._merge_into(merged, self._retired)
+            for _, shard in alive:
+                self._merge_into(merged, shard)
+
+        histograms = {}
+        for name, histogram in merged.histograms.items():
+            histograms[name] = {
+                "buckets": histogram[:HISTOGRAM_BUCKETS + 1],
+                "count": sum(histogram[:HISTOGRAM_BUCKETS + 1]),
+                "sum": histogram[-1],
+            }
+        # Collectors run outside the registry lock, they may take locks of their own
+        gauges = dict(self.gauges)
+        for collector in self._collectors:
+            gauges.update(collector())
+        return {"counters": merged.counters, "gauges": gauges, "histograms": histograms}
+
+    def render_prometheus(self):
+        """Prometheus text exposition format (version 0.0.4)."""
+        snapshot = self.snapshot()
+        lines = []
+        declared = set()
+
+        def declare(name, kind):
+            base = name.split('{', 1)[0]
+            if base not in declared:
+                declared.add(base)
+                lines.append(f"# TYPE {self.prefix}{base} {kind}")
+
+        for name, value in sorted(snapshot["counters"].items()):
+            declare(name, "counter")
+            lines.append(f"{self.prefix}{name} {value}")
+        for name, value in sorted(snapshot["gauges"].items()):
+            declare(name, "gauge")
+            lines.append(f"{self.prefix}{name} {value}")
+        for name, histogram in sorted(snapshot["histograms"].items()):
+            declare(name, "histogram")
+            cumulative = 0
+            for k, count in enumerate(histogram["buckets"]):
+                cumulative += count
+                le = "+Inf" if k == HISTOGRAM_BUCKETS else f"{2 ** k / 1e6:g}"
+                lines.append(f'{self.prefix}{name}_bucket{{le="{le}"}} {cumulative}')
+            lines.append(f"{self.prefix}{name}_sum {histogram['sum']}")
+            lines.append(f"{self.prefix}{name}_count {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+class _Timer:
+    __slots__ = ('registry', 'name', 'start')
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def serve_metrics(registry, host='127.0.0.1', port=9100):
+    """Starts a background HTTP server exposing registry at /metrics. Returns the server object."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer # only the server needs it, and it is slow to import
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # scrapes are not worth a line on stdout
+
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
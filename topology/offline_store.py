@@ -0,0 +1,429 @@
+"""
+Store-and-forward queue for messages whose recipient is not connected.
+
+Frames are appended to segmented append-only log files. Every recipient has a
+memory-mapped index file holding the (segment, offset) of each queued frame,
+plus a cursor of what has already been acknowledged. Once every frame in a
+segment has been acknowledged the segment file is deleted.
+
+Only the most recently used indexes are kept open, and the bytes queued for
+one recipient and for the whole store are capped.
+
+Layout of the store directory:
+    segments/00000001.log   -> [4 bytes length][frame] records
+    index/<hex(name)>.idx   -> header (base, count, acked) + (segment, offset) entries
+"""
+
+import collections
+import mmap
+import os
+import secrets
+import struct
+import threading
+import time
+
+RECORD_HEADER = struct.Struct('>I')
+INDEX_HEADER = struct.Struct('<QQQQ')  # base seq, entry count, acked entries, bytes queued
+INDEX_ENTRY = struct.Struct('<QQ')     # segment number, offset inside segment
+
+PENDING_BATCH = 64 # frames read per store lock acquisition when a backlog is delivered
+MAX_OPEN_INDEXES = 128 # recipient indexes kept open (file + mmap); the least recently used one is closed
+MAX_RECIPIENT_BYTES = 16 * 1024 * 1024 # unacknowledged bytes queued for one recipient
+MAX_TOTAL_BYTES = 1024 * 1024 * 1024 # unacknowledged bytes queued for all recipients together
+
+SEGMENT_SUFFIX = '.log'
+INDEX_SUFFIX = '.idx'
+STORE_KEY_FILE = 'store.key'
+
+
+class FsyncPolicy:
+    """Decides when appended frames are forced to disk.
+
+    every_n:  fsync after this many appends (1 = every append, 0 = disabled)
+    interval: fsync at most this many seconds after the first unsynced append (0 = disabled)
+    """
+
+    def __init__(self, every_n=64, interval=0.05):
+        self.every_n = every_n
+        self.interval = interval
+
+    @classmethod
+    def always(cls):
+        return cls(every_n=1, interval=0)
+
+    @classmethod
+    def never(cls):
+        return cls(every_n=0, interval=0)
+
+
+class _RecipientIndex:
+    """Memory-mapped list of (segment, offset) entries for a single recipient."""
+
+    INITIAL_CAPACITY = 64
+
+    def __init__(self, path):
+        self.path = path
+        new_file = not os.path.exists(path)
+        self.file = open(path, 'a+b')
+        if new_file or os.path.getsize(path) < INDEX_HEADER.size:
+            self.file.truncate(INDEX_HEADER.size + self.INITIAL_CAPACITY * INDEX_ENTRY.size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        if new_file:
+            INDEX_HEADER.pack_into(self.map, 0, 0, 0, 0, 0)
+
+    @property
+    def capacity(self):
+        return (len(self.map) - INDEX_HEADER.size) // INDEX_ENTRY.size
+
+    def header(self):
+        base, count, acked, _ = INDEX_HEADER.unpack_from(self.map, 0)
+        return base, count, acked
+
+    def set_header(self, base, count, acked):
+        INDEX_HEADER.pack_into(self.map, 0, base, count, acked, self.queued_bytes)
+
+    @property
+    def queued_bytes(self):
+        """Size on disk (record headers included) of the unacknowledged frames."""
+        return INDEX_HEADER.unpack_from(self.map, 0)[3]
+
+    @queued_bytes.setter
+    def queued_bytes(self, value):
+        base, count, acked = self.header()
+        INDEX_HEADER.pack_into(self.map, 0, base, count, acked, value)
+
+    def entry(self, position):
+        return INDEX_ENTRY.unpack_from(self.map, INDEX_HEADER.size + position * INDEX_ENTRY.size)
+
+    def append(self, segment, offset):
+        """Adds an entry and returns its absolute sequence number."""
+        base, count, acked = self.header()
+        if count == self.capacity:
+            self._grow(self.capacity * 2)
+        INDEX_ENTRY.pack_into(self.map, INDEX_HEADER.size + count * INDEX_ENTRY.size, segment, offset)
+        self.set_header(base, count + 1, acked)
+        return base + count
+
+    def compact(self):
+        """Drops acknowledged entries from the front of the index."""
+        base, count, acked = self.header()
+        if acked == 0:
+            return
+        start = INDEX_HEADER.size + acked * INDEX_ENTRY.size
+        end = INDEX_HEADER.size + count * INDEX_ENTRY.size
+        self.map[INDEX_HEADER.size:INDEX_HEADER.size + (end - start)] = self.map[start:end]
+        self.set_header(base + acked, count - acked, 0)
+
+    def _grow(self, capacity):
+        self.map.flush()
+        self.map.close()
+        self.file.truncate(INDEX_HEADER.size + capacity * INDEX_ENTRY.size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+class OfflineStore:
+    """Durable per-recipient FIFO of opaque frames."""
+
+    SEGMENT_MAX_BYTES = 4 * 1024 * 1024
+
+    def __init__(self, directory, segment_max_bytes=SEGMENT_MAX_BYTES, fsync_policy=None,
+                 max_open_indexes=MAX_OPEN_INDEXES, max_recipient_bytes=MAX_RECIPIENT_BYTES,
+                 max_total_bytes=MAX_TOTAL_BYTES):
+        self.directory = directory
+        self.segment_dir = os.path.join(directory, 'segments')
+        self.index_dir = os.path.join(directory, 'index')
+        os.makedirs(self.segment_dir, exist_ok=True)
+        os.makedirs(self.index_dir, exist_ok=True)
+
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync_policy = fsync_policy or FsyncPolicy()
+        self.max_open_indexes = max(1, max_open_indexes)
+        self.max_recipient_bytes = max_recipient_bytes
+        self.max_total_bytes = max_total_bytes
+        self.lock = threading.Lock()
+
+        self.indexes = collections.OrderedDict() # recipient -> open _RecipientIndex, least recently used first
+        self.queued = {}      # recipient -> bytes queued, for every recipient with an index file
+        self.queued_total = 0
+        self.live = {}        # segment number -> number of unacknowledged entries
+        self.unsynced = 0
+        self.first_unsynced_at = None
+        self.closed = False
+
+        self._load_indexes()
+        segments = self._segment_numbers()
+        self.active_number = segments[-1] if segments else 1
+        self.active = open(self._segment_path(self.active_number), 'ab')
+        self._drop_dead_segments()
+
+        self._flusher = None
+        if self.fsync_policy.interval:
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+
+    def _segment_path(self, number):
+        return os.path.join(self.segment_dir, f"{number:08d}{SEGMENT_SUFFIX}")
+
+    def _segment_numbers(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.segment_dir)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def _index_path(self, recipient):
+        return os.path.join(self.index_dir, recipient.encode('utf-8').hex() + INDEX_SUFFIX)
+
+    def _index_for(self, recipient, create):
+        """The open index of recipient, opened (and created if create) on demand.
+
+        Opening one past max_open_indexes closes the least recently used index; a closed
+        index is flushed, so nothing but its file descriptor and mapping is given up.
+        """
+        index = self.indexes.get(recipient)
+        if index is not None:
+            self.indexes.move_to_end(recipient)
+            return index
+        if recipient not in self.queued:
+            if not create:
+                return None
+            self.queued[recipient] = 0
+        index = self.indexes[recipient] = _RecipientIndex(self._index_path(recipient))
+        while len(self.indexes) > self.max_open_indexes:
+            _, idle = self.indexes.popitem(last=False)
+            idle.close()
+        return index
+
+    def _load_indexes(self):
+        """Counts the live entries of every index. The indexes are only opened again when used."""
+        for name in os.listdir(self.index_dir):
+            if not name.endswith(INDEX_SUFFIX):
+                continue
+            recipient = bytes.fromhex(name[:-len(INDEX_SUFFIX)]).decode('utf-8')
+            index = _RecipientIndex(os.path.join(self.index_dir, name))
+            try:
+                _, count, acked = index.header()
+                entries = [index.entry(position) for position in range(acked, count)]
+                for segment, _ in entries:
+                    self.live[segment] = self.live.get(segment, 0) + 1
+                if entries and not index.queued_bytes: # written before the byte count was kept
+                    index.queued_bytes = self._record_sizes(entries)
+                self.queued[recipient] = index.queued_bytes
+                self.queued_total += index.queued_bytes
+            finally:
+                index.close()
+
+    def _record_sizes(self, entries):
+        """Total size on disk of the records at entries [(segment, offset)]; torn records count as their header."""
+        total = 0
+        handles = {}
+        try:
+            for segment, offset in entries:
+                handle = handles.get(segment)
+                if handle is None:
+                    handle = handles[segment] = open(self._segment_path(segment), 'rb')
+                handle.seek(offset)
+                raw_len = handle.read(RECORD_HEADER.size)
+                total += RECORD_HEADER.size
+                if len(raw_len) == RECORD_HEADER.size:
+                    total += RECORD_HEADER.unpack(raw_len)[0]
+        finally:
+            for handle in handles.values():
+                handle.close()
+        return total
+
+    def knows(self, recipient):
+        """True if recipient was registered or ever had a frame queued."""
+        with self.lock:
+            return recipient in self.queued
+
+    def register(self, recipient):
+        """Creates the (empty) queue of recipient, so frames can be queued for it once it goes offline."""
+        with self.lock:
+            if recipient not in self.queued:
+                self._index_for(recipient, create=True)
+
+    def queued_bytes(self, recipient=None):
+        """Bytes waiting for recipient, or for every recipient together."""
+        with self.lock:
+            return self.queued_total if recipient is None else self.queued.get(recipient, 0)
+
+    def _drop_dead_segments(self):
+        for number in self._segment_numbers():
+            if number != self.active_number and not self.live.get(number):
+                os.remove(self._segment_path(number))
+                self.live.pop(number, None)
+
+    def append(self, recipient, frame: bytes):
+        """Queues a frame for recipient and returns its sequence number.
+
+        Returns None instead, without storing anything, if the frame would take the recipient
+        over max_recipient_bytes or the store over max_total_bytes.
+        """
+        size = RECORD_HEADER.size + len(frame)
+        with self.lock:
+            if self.queued.get(recipient, 0) + size > self.max_recipient_bytes or \
+                    self.queued_total + size > self.max_total_bytes:
+                return None
+            if self.active.tell() + RECORD_HEADER.size + len(frame) > self.segment_max_bytes and self.active.tell() > 0:
+                self._roll_segment()
+
+            offset = self.active.tell()
+            self.active.write(RECORD_HEADER.pack(len(frame)) + frame)
+            index = self._index_for(recipient, create=True)
+            seq = index.append(self.active_number, offset)
+            index.queued_bytes += size
+            self.queued[recipient] += size
+            self.queued_total += size
+            self.live[self.active_number] = self.live.get(self.active_number, 0) + 1
+
+            self.unsynced += 1
+            if self.first_unsynced_at is None:
+                self.first_unsynced_at = time.monotonic()
+            if self.fsync_policy.every_n and self.unsynced >= self.fsync_policy.every_n:
+                self._sync()
+            else:
+                self.active.flush()
+            return seq
+
+    def _roll_segment(self):
+        self._sync()
+        self.active.close()
+        if not self.live.get(self.active_number):
+            os.remove(self._segment_path(self.active_number))
+            self.live.pop(self.active_number, None)
+        self.active_number += 1
+        self.active = open(self._segment_path(self.active_number), 'ab')
+
+    def pending(self, recipient):
+        """Returns the unacknowledged frames of recipient as a list of (seq, frame), oldest first."""
+        return [entry for batch in self.pending_batches(recipient) for entry in batch]
+
+    def pending_batches(self, recipient, start=0, batch_size=PENDING_BATCH):
+        """Yields the unacknowledged frames of recipient from seq start on, batch_size (seq, frame) at a time.
+
+        The store lock is only held while one batch is read, so appends and acks from other
+        threads go on while a long backlog is being delivered.
+        """
+        while True:
+            batch = self.read_pending(recipient, start, batch_size)
+            if not batch:
+                return
+            yield batch
+            start = batch[-1][0] + 1
+
+    def read_pending(self, recipient, start, limit):
+        """Up to limit unacknowledged (seq, frame) of recipient with seq >= start, oldest first."""
+        with self.lock:
+            index = self._index_for(recipient, create=False)
+            if index is None:
+                return []
+            self.active.flush()
+            base, count, acked = index.header()
+            frames = []
+            handles = {}
+            try:
+                first = max(acked, start - base)
+                for position in range(first, min(count, first + limit)):
+                    segment, offset = index.entry(position)
+                    handle = handles.get(segment)
+                    if handle is None:
+                        handle = handles[segment] = open(self._segment_path(segment), 'rb')
+                    handle.seek(offset)
+                    raw_len = handle.read(RECORD_HEADER.size)
+                    if len(raw_len) < RECORD_HEADER.size:
+                        break  # torn write at the tail of the log
+                    length = RECORD_HEADER.unpack(raw_len)[0]
+                    frame = handle.read(length)
+                    if len(frame) < length:
+                        break  # header written, body torn
+                    frames.append((base + position, frame))
+            finally:
+                for handle in handles.values():
+                    handle.close()
+            return frames
+
+    def ack(self, recipient, seq):
+        """Marks every frame of recipient up to and including seq as delivered."""
+        with self.lock:
+            index = self._index_for(recipient, create=False)
+            if index is None:
+                return
+            base, count, acked = index.header()
+            new_acked = min(seq - base + 1, count)
+            if new_acked <= acked:
+                return
+            self.active.flush()
+            entries = [index.entry(position) for position in range(acked, new_acked)]
+            for segment, _ in entries:
+                self.live[segment] -= 1
+            freed = min(self._record_sizes(entries), index.queued_bytes)
+            index.queued_bytes -= freed
+            self.queued[recipient] -= freed
+            self.queued_total -= freed
+            index.set_header(base, count, new_acked)
+            if new_acked == count or new_acked * 2 >= index.capacity:
+                index.compact()
+            self._drop_dead_segments()
+
+    def queued_count(self, recipient):
+        with self.lock:
+            index = self._index_for(recipient, create=False)
+            if index is None:
+                return 0
+            _, count, acked = index.header()
+            return count - acked
+
+    def _sync(self):
+        self.active.flush()
+        os.fsync(self.active.fileno())
+        for index in self.indexes.values():
+            index.flush()
+        self.unsynced = 0
+        self.first_unsynced_at = None
+
+    def flush(self):
+        """Forces every appended frame to disk."""
+        with self.lock:
+            if not self.closed:
+                self._sync()
+
+    def _flush_loop(self):
+        interval = self.fsync_policy.interval
+        while not self.closed:
+            time.sleep(interval)
+            with self.lock:
+                if self.closed:
+                    break
+                if self.first_unsynced_at is not None and time.monotonic() - self.first_unsynced_at >= interval:
+                    self._sync()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self._sync()
+            self.closed = True
+            self.active.close()
+            for index in self.indexes.values():
+                index.close()
+            self.indexes.clear()
+
+
+def load_or_create_key(directory, key_size=16):
+    """Returns the AES key used to encrypt queued frames at rest, creating it on first use."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, STORE_KEY_FILE)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read()
+    key = secrets.token_bytes(key_size)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return key
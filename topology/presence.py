@@ -0,0 +1,132 @@
+"""
+Presence: who is online, as a versioned roster.
+
+The server keeps every client that completed a handshake in a Roster (a set, so lookups and
+changes are O(1) with tens of thousands of names) and numbers every change. A client that
+sends {"type": "presence_subscribe", "since": v} gets what changed after version v:
+
+    {"type": "presence", "version": 42, "base": 40, "added": [...], "removed": [...]}
+
+"base" is the version the delta applies to. A subscriber with nothing yet (no "since") or
+with a version older than the change history first gets the whole roster with "reset": true,
+split into frames of at most PRESENCE_BATCH names ("more": true on all but the last).
+
+Changes are not pushed one by one. The server flushes them every PRESENCE_INTERVAL seconds as
+one delta that is encoded once and queued to every subscriber, so a connect storm costs each
+subscriber one frame per interval instead of one frame per connect.
+"""
+
+import collections
+
+PRESENCE_INTERVAL = 0.2 # seconds between delta flushes
+PRESENCE_HISTORY = 65536 # changes kept for subscribers that come back with an older version
+PRESENCE_BATCH = 1000 # names per frame of a full roster
+MAX_NAME_LENGTH = 64
+RESERVED_NAMES = ("server",)
+
+
+def valid_name(name):
+    """Client names: non-empty printable strings, not taken by the server itself."""
+    return (isinstance(name, str) and 0 < len(name) <= MAX_NAME_LENGTH and name.isprintable()
+            and name.strip() == name and name not in RESERVED_NAMES)
+
+
+class Roster:
+    """Server side: the online clients and the numbered history of changes. Not thread safe."""
+
+    def __init__(self, history=PRESENCE_HISTORY):
+        self.members = set()
+        self.version = 0
+        self.changes = collections.deque(maxlen=history) # (version, name, online)
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def __len__(self):
+        return len(self.members)
+
+    def add(self, name):
+        if name in self.members:
+            return False
+        self.members.add(name)
+        self._record(name, True)
+        return True
+
+    def remove(self, name):
+        if name not in self.members:
+            return False
+        self.members.discard(name)
+        self._record(name, False)
+        return True
+
+    def _record(self, name, online):
+        self.version += 1
+        self.changes.append((self.version, name, online))
+
+    def delta(self, since):
+        """(added, removed) between version since and now, or None if the history no longer reaches back."""
+        if since > self.version or (since < self.version and self.changes[0][0] > since + 1):
+            return None
+        final = {}
+        for version, name, online in reversed(self.changes):
+            if version <= since:
+                break
+            final.setdefault(name, online) # the newest change of a name wins
+        added = [name for name, online in final.items() if online]
+        removed = [name for name, online in final.items() if not online]
+        return added, removed
+
+    def frames(self, since=None):
+        """Frames that bring a subscriber at version since (None: nothing yet) to the current version."""
+        delta = self.delta(since) if since is not None else None
+        if delta is not None:
+            added, removed = delta
+            return [{"type": "presence", "version": self.version, "base": since, "added": added, "removed": removed}]
+        names = sorted(self.members)
+        frames = []
+        for start in range(0, max(len(names), 1), PRESENCE_BATCH):
+            frames.append({"type": "presence", "version": self.version, "reset": start == 0,
+                           "added": names[start:start + PRESENCE_BATCH], "removed": [],
+                           "more": start + PRESENCE_BATCH < len(names)})
+        return frames
+
+
+class RosterCache:
+    """Client side copy of the roster, kept current by the server's presence frames."""
+
+    def __init__(self):
+        self.names = set()
+        self.version = None # None until the first full roster arrived
+        self.loading = False # between the first and the last frame of a full roster
+        self.changes = ([], []) # (added, removed) by the last frame applied, names we already knew left out
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(sorted(self.names))
+
+    def apply(self, frame):
+        """Applies a presence frame. Returns False if a delta was missed and a new subscribe is needed."""
+        version = int(frame["version"])
+        if frame.get("reset"):
+            self.names = set()
+            self.loading = True
+        elif not self.loading:
+            if self.version is None or int(frame["base"]) > self.version:
+                return False # gap: changes between our version and the delta's base are missing
+            if version <= self.version:
+                self.changes = ([], [])
+                return True # already contained in what we have
+        added = [name for name in frame.get("added", ()) if name not in self.names]
+        removed = [name for name in frame.get("removed", ()) if name in self.names]
+        self.names.update(added)
+        self.names.difference_update(removed)
+        self.changes = (added, removed)
+        if not frame.get("more"):
+            self.loading = False
+            self.version = version
+        return True
@@ -0,0 +1,128 @@
+"""
+Record layer: a sequence number and a MAC on every encrypted frame, per hop.
+
+Each direction of a session (client -> server, server -> client) numbers its "message" and
+"file_chunk" frames 0, 1, 2, ... (64 bits) and adds
+
+    "seq": 17, "mac": "<hex>"
+
+The MAC is HMAC-SHA256, truncated to MAC_SIZE bytes, over the direction, the sequence number,
+the header fields of the frame (type, names, epoch, transfer fields, CTR nonce and counter) and
+the ciphertext. Its key is the MAC key of the frame's epoch and direction in the session's key
+schedule (topology.keyschedule), so a frame can't be reflected back to its sender, and
+rekeying replaces the MAC keys as well. The server's "rekey" notices are sealed the same way,
+under the key of the epoch they replace, so an injected notice can't move the client's key ring.
+
+The receiver keeps an IPsec-style sliding window (RFC 4303, 3.4.3): the highest sequence number
+accepted and a bitmap of the REPLAY_WINDOW numbers below it. A duplicate or a frame older than
+the window is dropped after one integer test, before the MAC or any AES work. The window only
+moves once the MAC checked out, so forged frames can't push it forward.
+"""
+
+import functools
+import hmac
+import json
+
+from crypto.hkdf import HmacSha256
+from topology.keyschedule import key_schedule
+
+RECORD_TYPES = ("message", "file_chunk")
+CLIENT_TO_SERVER = b"c2s"
+SERVER_TO_CLIENT = b"s2c"
+REPLAY_WINDOW = 1024 # sequence numbers below the highest one that are still accepted once
+MAX_SEQ = 2 ** 64 - 1
+MAC_SIZE = 16 # bytes of HMAC-SHA256 kept, as HMAC-SHA-256-128 in IPsec (RFC 4868)
+HEADER_FIELDS = ("type", "from", "recipient", "epoch", "transfer_id", "index", "nonce", "compressed", "size", "ctr")
+
+# Why a frame was dropped, used as the reason label of drops_total
+REPLAY = "replay"
+OUT_OF_WINDOW = "out_of_window"
+BAD_MAC = "bad_mac"
+UNSEQUENCED = "unsequenced"
+
+
+@functools.lru_cache(maxsize=1024)
+def mac_state(key, direction):
+    """HMAC state keyed for one (epoch key, direction), pads hashed once; copied for every frame."""
+    return HmacSha256(key_schedule(key).mac_key(direction))
+
+
+def record_mac(frame, seq, key, direction):
+    header = json.dumps([frame.get(field) for field in HEADER_FIELDS], separators=(',', ':')).encode()
+    data = frame.get("data", "") # rekey notices carry no data
+    mac = mac_state(key, direction).copy()
+    mac.update(seq.to_bytes(8, 'big') + len(header).to_bytes(4, 'big') + header)
+    mac.update(bytes(data) if isinstance(data, list) else data.encode('ascii'))
+    return mac.digest()[:MAC_SIZE]
+
+
+class Sequencer:
+    """Sending side: the next sequence number of one direction. Callers serialize take()."""
+
+    __slots__ = ('next',)
+
+    def __init__(self):
+        self.next = 0
+
+    def take(self):
+        if self.next > MAX_SEQ:
+            raise OverflowError("Record sequence numbers exhausted, the session has to reconnect")
+        seq = self.next
+        self.next += 1
+        return seq
+
+    def seal(self, frame, key, direction):
+        """Numbers frame and adds its MAC, in place."""
+        seq = self.take()
+        frame["seq"] = seq
+        frame["mac"] = record_mac(frame, seq, key, direction).hex()
+        return frame
+
+
+class ReplayWindow:
+    """Receiving side of one direction. Used by a single receiver thread, so it needs no lock."""
+
+    __slots__ = ('size', 'mask', 'highest', 'bitmap')
+
+    def __init__(self, size=REPLAY_WINDOW):
+        self.size = size
+        self.mask = (1 << size) - 1
+        self.highest = -1
+        self.bitmap = 0 # bit i set: highest - i was accepted
+
+    def check(self, seq):
+        """None if seq may be accepted, otherwise why not (REPLAY or OUT_OF_WINDOW)."""
+        if seq > self.highest:
+            return None
+        offset = self.highest - seq
+        if offset >= self.size:
+            return OUT_OF_WINDOW
+        return REPLAY if self.bitmap >> offset & 1 else None
+
+    def accept(self, seq):
+        """Marks seq as received; only call it for a frame whose MAC verified."""
+        if seq > self.highest:
+            shift = seq - self.highest
+            self.bitmap = ((self.bitmap << shift) | 1) & self.mask if shift < self.size else 1
+            self.highest = seq
+        else:
+            self.bitmap |= 1 << (self.highest - seq)
+
+    def open(self, frame, key, direction):
+        """Checks a received frame: None if it is fresh and authentic (and marks it), else the drop reason."""
+        seq = frame.get("seq")
+        mac = frame.get("mac")
+        if not isinstance(seq, int) or not 0 <= seq <= MAX_SEQ or not isinstance(mac, str):
+            return UNSEQUENCED
+        reason = self.check(seq)
+        if reason:
+            return reason
+        try:
+            expected = record_mac(frame, seq, key, direction)
+            authentic = hmac.compare_digest(bytes.fromhex(mac), expected)
+        except (KeyError, TypeError, ValueError):
+            authentic = False
+        if not authentic:
+            return BAD_MAC
+        self.accept(seq)
+        return None
@@ -0,0 +1,120 @@
+"""
+In-band rekeying of the client/server AES key.
+
+The RSA handshake only happens once per connection. After that the server decides when a
+session key has been used enough (bytes, frames or age) and sends {"type": "rekey", "epoch": n}.
+Both sides derive key n from key n-1 with HKDF (topology.keyschedule), so nothing secret goes
+over the wire and nobody waits for an exchange. Every encrypted frame carries the epoch of the key it
+was encrypted with; each side keeps the previous key around until the switch is over, so
+frames already in flight when the epoch changes still decrypt. The client confirms with
+{"type": "rekey_ack", "epoch": n}, and the server only starts the next switch after that,
+so a client that is slow to notice never sends under a key the server already forgot.
+"""
+
+import time
+
+from topology.keyschedule import key_schedule
+
+REKEY_BYTES = 256 * 1024 * 1024 # traffic (both directions) under one key
+REKEY_MESSAGES = 1000000 # frames under one key
+REKEY_SECONDS = 3600.0 # age of a key, checked whenever the session has traffic
+KEPT_EPOCHS = 3 # older keys are dropped even if the peer never confirmed the switch
+MAX_EPOCH_JUMP = KEPT_EPOCHS # epochs a frame may be ahead of the receiver's current one
+
+
+def derive_next_key(key, epoch):
+    """Key of `epoch` from the key of epoch - 1. Knowing it does not reveal the older keys."""
+    return key_schedule(key).next_secret(epoch)
+
+
+class RekeyPolicy:
+    """When to rekey a session. A limit of 0 disables that trigger."""
+
+    def __init__(self, max_bytes=REKEY_BYTES, max_messages=REKEY_MESSAGES, max_seconds=REKEY_SECONDS):
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.max_seconds = max_seconds
+
+    def due(self, usage):
+        return bool((self.max_bytes and usage.bytes >= self.max_bytes)
+                    or (self.max_messages and usage.messages >= self.max_messages)
+                    or (self.max_seconds and time.monotonic() - usage.since >= self.max_seconds))
+
+
+class KeyRing:
+    """The keys of one session by epoch: the current one and, during a switch, the previous one."""
+
+    __slots__ = ('epoch', 'confirmed', 'keys', 'bytes', 'messages', 'since')
+
+    def __init__(self, key):
+        self.epoch = 0
+        self.confirmed = 0 # newest epoch the peer said it switched to
+        self.keys = {0: key}
+        self.reset_usage()
+
+    def reset_usage(self):
+        self.bytes = 0
+        self.messages = 0
+        self.since = time.monotonic()
+
+    @property
+    def current(self):
+        return self.keys[self.epoch]
+
+    def get(self, epoch):
+        """Key for the epoch a frame was encrypted with, None if it is unknown or already retired."""
+        return self.keys.get(epoch)
+
+    @property
+    def switching(self):
+        """True while the peer has not confirmed the current epoch yet."""
+        return self.confirmed < self.epoch
+
+    def count(self, size):
+        self.bytes += size
+        self.messages += 1
+
+    def advance(self):
+        """Derives the next key and makes it current. The previous ones stay until retire()."""
+        self.epoch += 1
+        self.keys[self.epoch] = derive_next_key(self.keys[self.epoch - 1], self.epoch)
+        self.retire(self.epoch - KEPT_EPOCHS + 1)
+        self.reset_usage()
+        return self.epoch
+
+    def peek(self, epoch):
+        """Key of epoch without changing the ring: a kept one, or derived forward from the current
+        key if epoch is at most MAX_EPOCH_JUMP ahead. None otherwise.
+
+        The epoch of a received frame is not authenticated until its MAC is checked with this
+        key, so only advance_to() after that moves the ring on.
+        """
+        key = self.keys.get(epoch)
+        if key is not None or not self.epoch < epoch <= self.epoch + MAX_EPOCH_JUMP:
+            return key
+        key = self.current
+        for next_epoch in range(self.epoch + 1, epoch + 1):
+            key = derive_next_key(key, next_epoch)
+        return key
+
+    def advance_to(self, epoch):
+        """Receiving side of a rekey: derives forward up to epoch.
+
+        Returns False, leaving the ring as it is, if epoch is more than MAX_EPOCH_JUMP ahead.
+        """
+        if epoch - self.epoch > MAX_EPOCH_JUMP:
+            return False
+        while self.epoch < epoch:
+            self.advance()
+        return True
+
+    def confirm(self, epoch):
+        """The peer switched to epoch. The key just before it is kept one switch longer: the
+        peer may have picked it up for a frame right before it noticed the rekey."""
+        self.confirmed = max(self.confirmed, min(epoch, self.epoch))
+        self.retire(self.confirmed - 1)
+
+    def retire(self, epoch):
+        """Forgets the keys older than epoch once the peer confirmed the switch."""
+        for old in [e for e in self.keys if e < epoch]:
+            del self.keys[old]
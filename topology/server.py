@@ -2,201 +2,1043 @@ import socket
 import threading
 import json
 import secrets
-import sys
+import logging
 import os
+import sys
+import time
 
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from crypto.rsa import rsa_encrypt
-from aes.aes_encrypt import aes_encryption
-from aes.aes_decrypt import aes_decryption
+from crypto.dh import GROUPS as DH_GROUPS, dh_generate_keys, dh_shared_secret, dh_derive_key
+from aes.aes_key import AESKey
+from topology.offline_store import OfflineStore, load_or_create_key
+from topology.metrics import MetricsRegistry, serve_metrics
+from topology.tracing import Tracer, ProfileWindow
+from topology.log import get_logger, configure_logging
+from topology.transfer import encrypt_chunk, decrypt_chunk, peer_int
+from topology.compression import Compressor, negotiate as negotiate_compression
+from topology.rekey import KeyRing, RekeyPolicy
+from topology.flow import OutboundQueue, RateLimiter, POLICY_DISCONNECT, POLICY_PARK, CONTROL, DATA
+from topology.presence import Roster, valid_name, PRESENCE_INTERVAL
+from topology.timers import TimerWheel
+from topology import transport
+from topology.record import RECORD_TYPES, CLIENT_TO_SERVER, SERVER_TO_CLIENT, MAX_SEQ
+from topology.session import ClientSession
+from topology.keystream import CTR_MODE, decrypt_ctr
+from topology.keyschedule import traffic_key
+from topology.buffers import POOL
+from topology.identity import (load_or_create_identity, ephemeral_identity, public_part, encode_public_key,
+                               fingerprint, sign_offer, BatchSigner, SIGN_BATCH)
+from topology.admission import HandshakeAdmission, handshake_pool, HANDSHAKE_QUEUE, HANDSHAKE_WORKERS
 
 SERVER_HOST = '127.0.0.1'
 SERVER_PORT = 9000 # Dedicated port for the server
+SERVER_URL = None # e.g. 'unix:///tmp/p2p.sock' for clients on the same host; None is tcp://SERVER_HOST:SERVER_PORT
+SERVER_STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'offline_store')
+METRICS_PORT = 9100 # Local Prometheus endpoint (http://127.0.0.1:9100/metrics)
+TRACE_SAMPLE_RATE = 0.0 # Fraction of messages traced; 0 disables tracing
+TRACE_FILE = 'server_trace.json' # Chrome trace-event output ("trace_dump" admin message)
+PROFILE_FILE = 'server_profile.pstats' # cProfile output ("profile" admin message)
+LOG_LEVEL = logging.INFO # DEBUG logs every relayed message (payloads stay redacted)
+SLOW_CONSUMER_POLICY = POLICY_DISCONNECT # or POLICY_PARK: queue to the offline store until the client catches up
+OUTBOUND_HIGH_WATERMARK = 1024 * 1024 # bytes queued for one client before it counts as a slow consumer
+OUTBOUND_LOW_WATERMARK = 256 * 1024 # a parked client resumes once its queue drains below this
+RATE_LIMIT_MSGS = 1000 # frames per second per sender, 0 disables
+RATE_LIMIT_BYTES = 4 * 1024 * 1024 # bytes per second per sender, 0 disables
+HEARTBEAT_INTERVAL = 15.0 # seconds of silence from a client before the server pings it
+IDLE_TIMEOUT = 45.0 # seconds of silence (ping unanswered) before the session is reaped
+HANDSHAKE_TIMEOUT = 10.0 # seconds a new connection gets to send its key frame
+HANDSHAKE_PROCESSES = True # python -m topology.server runs handshake crypto in worker processes
+ADMIN_CLIENTS = () # client names allowed to send admin frames (stats, profile, trace_dump); empty disables them
+MAX_FRAME = 1024 * 1024 # longest frame a client may send (a default file chunk is about 45 KB)
+REJECT_LINGER = 1.0 # seconds a turned away connection stays open so the client reads the busy frame
+# Stack of the handler and writer threads. The 8 MiB default reserves 800 GB of address space for
+# 100k connections; 256 KiB is enough for the deepest JSON the decoder accepts, this leaves margin
+THREAD_STACK_SIZE = 512 * 1024
+
+FILE_CONTROL_FRAMES = ("file_offer", "file_accept", "file_ack", "file_error") # relayed unchanged
+ADMIN_FRAMES = ("stats", "profile", "trace_dump") # served only to the sessions named in admin_clients
+
+log = get_logger('server')
+
+def dh_agreement(group, client_public):
+    """Server half of an ephemeral DH exchange: (AES key, server public value). Runs in a handshake worker."""
+    server_public, server_secret = dh_generate_keys(group)
+    shared = dh_shared_secret(group, client_public, server_secret)
+    return dh_derive_key(group, shared, client_public, server_public), server_public
 
 class SecureServer:
-    def __init__(self, host, port):
+    def __init__(self, host, port, store_dir=None, metrics_port=None, trace_sample_rate=TRACE_SAMPLE_RATE,
+                 compression=True, rekey_policy=None, ctr_messages=True,
+                 slow_consumer_policy=SLOW_CONSUMER_POLICY, high_watermark=OUTBOUND_HIGH_WATERMARK,
+                 low_watermark=OUTBOUND_LOW_WATERMARK, rate_limit_msgs=RATE_LIMIT_MSGS, rate_limit_bytes=RATE_LIMIT_BYTES,
+                 identity=None, heartbeat_interval=HEARTBEAT_INTERVAL, idle_timeout=IDLE_TIMEOUT,
+                 handshake_timeout=HANDSHAKE_TIMEOUT, url=None, sign_batch=SIGN_BATCH,
+                 handshake_queue=HANDSHAKE_QUEUE, handshake_workers=HANDSHAKE_WORKERS, handshake_processes=False,
+                 listen_backlog=transport.LISTEN_BACKLOG, admin_clients=ADMIN_CLIENTS):
         self.host = host
         self.port = port
-        # Store connected clients: {'client_name': {'conn': socket_obj, 'pub_key': (e, n), 'aes_key': bytes}}
-        self.connected_clients = {}
+        self.url = url or transport.tcp_url(host, port) # tcp://, unix:// or mem://, see topology.transport
+        transport.parse_url(self.url)
+        self.connected_clients = {} # client name -> ClientSession
         self.client_lock = threading.Lock() # Protects access to self.connected_clients
+        self.listening = threading.Event() # Set once the listening socket is bound (port 0 picks a free port)
+        self.listener = None
+        self.stopping = False
+
+        # Messages for offline recipients are queued on disk, encrypted with a server-side store key
+        self.offline_store = None
+        self.store_cipher = None
+        if store_dir:
+            self.offline_store = OfflineStore(store_dir)
+            self.store_cipher = AESKey(load_or_create_key(store_dir))
+
+        # Long-term signing key: given, kept next to the offline store, or one per process
+        if identity is None:
+            identity = load_or_create_identity(store_dir) if store_dir else ephemeral_identity()
+        self.identity = identity
+        self.identity_public = encode_public_key(public_part(identity))
+        self.identity_fingerprint = fingerprint(public_part(identity))
+
+        self.metrics = MetricsRegistry()
+        # Handshake signatures are made by one signer thread, batched while many clients connect at once
+        self.signer = BatchSigner(identity, max(1, sign_batch), metrics=self.metrics)
+        self.metrics_port = metrics_port
+        self.tracer = Tracer(trace_sample_rate, process_name='server')
+        self.profile_window = ProfileWindow()
+        self.admin_clients = frozenset(admin_clients) # the only sessions whose admin frames are served
+        self._recv_timing = threading.local() # When the length prefix of the current frame arrived
+
+        if slow_consumer_policy not in (POLICY_DISCONNECT, POLICY_PARK):
+            raise ValueError(f"Unknown slow consumer policy: {slow_consumer_policy}")
+        self.slow_consumer_policy = slow_consumer_policy
+        self.compression = compression # accept the compression clients offer in their handshake
+        self.ctr_messages = ctr_messages # accept the "ctr" message mode (precomputed keystream, topology.keystream)
+        self.rekey_policy = rekey_policy or RekeyPolicy() # when session keys are replaced in-band
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.rate_limit_msgs = rate_limit_msgs
+        self.rate_limit_bytes = rate_limit_bytes
+        self.metrics.add_collector(self.collect_queue_gauges)
+
+        # Heartbeats and idle reaping: one timer per connection on a wheel driven by a single thread
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.handshake_timeout = handshake_timeout
+        self.timers = TimerWheel()
 
-        print(f"[Server] Initializing on {self.host}:{self.port}")
+        # Handshakes are admitted up to a limit and their crypto runs on a fixed number of workers
+        self.admission = HandshakeAdmission(handshake_queue, handshake_workers)
+        self.handshake_workers = handshake_workers
+        self.handshake_processes = handshake_processes # the workers are processes, started in start()
+        self.handshake_pool = None
+        self.listen_backlog = listen_backlog
+
+        # Who is online, for clients that subscribed to presence (guarded by client_lock)
+        self.roster = Roster()
+        self.presence_subscribers = set() # names of the sessions that get roster deltas
+        self.presence_flushed = 0 # roster version the subscribers have been sent
+
+        log.info("Initializing", extra={"host": self.host, "port": self.port})
 
     def start(self):
         """Starts the server, listening for incoming client connections."""
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind((self.host, self.port))
-            s.listen()
-            print(f"[Server] Listening on {self.host}:{self.port}")
-            while True:
-                conn, addr = s.accept()
+        listener = transport.listen(self.url, self.listen_backlog)
+        threading.stack_size(THREAD_STACK_SIZE) # process-wide, for every thread started from now on
+        try:
+            self.listener = listener
+            self.url = listener.url # the port a tcp://host:0 URL picked, a mem:// name
+            self.port = listener.port
+            if self.handshake_processes:
+                self.handshake_pool = handshake_pool(self.handshake_workers)
+                self.signer.executor = self.handshake_pool
+            self.listening.set()
+            log.info("Listening", extra={"url": self.url, "fingerprint": self.identity_fingerprint})
+            threading.Thread(target=self.timers.run, args=(lambda: self.stopping,), daemon=True).start()
+            self.timers.schedule(PRESENCE_INTERVAL, self.presence_tick)
+            if self.metrics_port is not None:
+                serve_metrics(self.metrics, '127.0.0.1', self.metrics_port)
+                log.info("Metrics endpoint started", extra={"url": f"http://127.0.0.1:{self.metrics_port}/metrics"})
+            while not self.stopping:
+                try:
+                    conn, addr = listener.accept()
+                except OSError:
+                    if self.stopping:
+                        break
+                    raise
+                self.metrics.inc('connections_total')
+                if not self.admission.admit():
+                    self.reject_busy(conn, addr)
+                    continue
                 threading.Thread(target=self.handle_client_connection, args=(conn, addr), daemon=True).start()
+        finally:
+            listener.close()
+
+    def stop(self):
+        """Stops accepting connections and closes every client connection."""
+        self.stopping = True
+        if self.listener:
+            self.listener.close()
+        with self.client_lock:
+            for client_info in self.connected_clients.values():
+                client_info.outbound.close()
+                try:
+                    client_info.conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                client_info.conn.close()
+            self.connected_clients.clear()
+        if self.handshake_pool:
+            # waits for the workers to exit: left behind they would block on the call queue forever
+            self.handshake_pool.shutdown(wait=True, cancel_futures=True)
+        if self.offline_store:
+            self.offline_store.close()
 
     def recv_full(self, conn):
-        """Helper to receive a full message given its length prefix."""
+        """Receives one length prefixed frame into a buffer from the shared pool.
+
+        Returns a memoryview of the frame, None if the connection closed or failed. The caller
+        gives the buffer back with release_frame() once nothing refers to the frame any more.
+        """
+        buffer = None
         try:
-            raw_len = conn.recv(4)
-            if not raw_len: return None
-            msg_len = int.from_bytes(raw_len, 'big')
-            data = b''
-            conn.settimeout(10.0) # Increased timeout for server
-            while len(data) < msg_len:
-                packet = conn.recv(msg_len - len(data))
-                if not packet:
-                    conn.settimeout(None)
+            raw_len = b''
+            while len(raw_len) < 4: # the prefix itself can arrive in pieces
+                chunk = conn.recv(4 - len(raw_len))
+                if not chunk:
                     return None
-                data += packet
-            conn.settimeout(None)
-            return data
-        except socket.timeout:
-            return None
+                raw_len += chunk
+            self._recv_timing.prefix_at = time.perf_counter()
+            msg_len = int.from_bytes(raw_len, 'big')
+            if msg_len > MAX_FRAME:
+                # Checked before a buffer is taken: a prefix alone must not make us allocate 4 GiB
+                log.warning("Frame too large, closing connection", extra={"size": msg_len})
+                self.metrics.inc('drops_total{reason="frame_too_large"}')
+                return None
+            buffer = POOL.acquire(msg_len)
+            view = memoryview(buffer)[:msg_len]
+            received = 0
+            # No socket timeout: a peer that stalls mid-frame stops refreshing last_seen and is reaped
+            while received < msg_len:
+                count = conn.recv_into(view[received:], msg_len - received)
+                if not count:
+                    break
+                received += count
+            if received < msg_len:
+                view.release()
+                POOL.release(buffer)
+                return None
+            self.metrics.inc('bytes_in_total', msg_len + 4)
+            return view
         except Exception as e:
-            print(f"[Server] Error in recv_full: {e}")
+            log.warning("Error in recv_full", extra={"error": e})
+            if buffer is not None:
+                POOL.release(buffer)
             return None
 
-    def send_data_direct(self, conn_socket, data):
-        """Sends data over an already established socket connection."""
+    @staticmethod
+    def release_frame(frame):
+        """Returns the buffer of a frame from recv_full to the pool."""
+        buffer = frame.obj
+        frame.release()
+        POOL.release(buffer)
+
+    @staticmethod
+    def encode_frame(data):
+        """Length prefixed JSON, the wire format of every frame."""
+        message_bytes = json.dumps(data).encode('utf-8')
+        return len(message_bytes).to_bytes(4, 'big') + message_bytes
+
+    def register_client(self, client_name, conn, pub_key):
+        """Creates the session of a client that sent its public key. Must be called with client_lock held."""
+        previous = self.connected_clients.get(client_name)
+        if previous:
+            previous.outbound.close()
+            self.timers.cancel(previous.timer)
+        outbound = OutboundQueue(conn, self.high_watermark, self.low_watermark, metrics=self.metrics,
+                                 on_error=self.on_outbound_error, on_drained=self.on_outbound_drained, name=client_name)
+        session = ClientSession(client_name, conn, pub_key, outbound,
+                                RateLimiter(self.rate_limit_msgs, self.rate_limit_bytes))
+        session.timer = self.timers.schedule(self.heartbeat_interval, self.check_idle, client_name, conn)
+        self.connected_clients[client_name] = session
+        self.metrics.set_gauge('connected_clients', len(self.connected_clients))
+
+    def unregister_client(self, client_name, conn):
+        """Drops the session of client_name if it still belongs to conn. Must be called with client_lock held."""
+        client_info = self.connected_clients.get(client_name)
+        if client_info and client_info.conn == conn:
+            client_info.outbound.close()
+            self.timers.cancel(client_info.timer)
+            del self.connected_clients[client_name]
+            self.presence_subscribers.discard(client_name)
+            self.roster.remove(client_name)
+        self.metrics.set_gauge('connected_clients', len(self.connected_clients))
+
+    def send_to_client(self, client_name, client_info, data, trace=None):
+        """Queues a frame for a client; the socket is written by the client's writer thread.
+
+        Messages and file chunks are data, queued per sender; everything else is control and
+        overtakes them. Never blocks, so it is safe under client_lock. Returns False if the
+        client's queue is over its high watermark, in which case the slow consumer policy has
+        been applied.
+        """
+        enqueue_start = time.perf_counter()
+        if data.get("type") in RECORD_TYPES:
+            # Numbered when the writer takes it: flows are interleaved, the wire order is only known then
+            data.pop("seq", None)
+            data.pop("mac", None)
+            frame = self.encode_frame(data)
+            queued = client_info.outbound.put(frame, DATA, flow=(data.get("from"), data["type"]),
+                                                 seal=self.record_sealer(client_info, data))
+        else:
+            frame = self.encode_frame(data)
+            queued = client_info.outbound.put(frame, CONTROL)
+        if trace:
+            trace.add("enqueue", enqueue_start, time.perf_counter())
+        if not queued:
+            self.handle_slow_consumer(client_name, client_info)
+        else:
+            self.count_traffic(client_name, client_info, len(frame))
+        return queued
+
+    @staticmethod
+    def record_sealer(client_info, data, key=None):
+        """seal() for the outbound queue: numbers and MACs a record frame already encoded without them.
+
+        Runs on the writer thread, in wire order. The fields are spliced in before the closing
+        brace instead of encoding the (possibly large) frame again. The MAC key is the one of the
+        frame's epoch unless key is given.
+        """
+        key = key or client_info.keys.get(data["epoch"])
+        sequencer = client_info.sequencer
+
+        def seal(frame):
+            sequencer.seal(data, key, SERVER_TO_CLIENT)
+            tail = f', "seq": {data["seq"]}, "mac": "{data["mac"]}"}}'.encode()
+            return (len(frame) - 5 + len(tail)).to_bytes(4, 'big') + frame[4:-1] + tail
+        return seal
+
+    def count_traffic(self, client_name, client_info, size):
+        """Accounts a frame to the session key and rekeys once the policy says so. Called with client_lock held.
+
+        The rekey notice is a control frame and overtakes queued data, so the next switch also
+        waits until the data queued before the last notice has been sent: the client keeps
+        KEPT_EPOCHS keys and those frames must not fall out of its ring.
+        """
+        keys = client_info.keys
+        if not keys:
+            return
+        keys.count(size)
+        if not keys.switching and self.rekey_policy.due(keys) and \
+                client_info.outbound.data_taken >= client_info.rekey_mark:
+            self.rekey(client_name, client_info)
+
+    def rekey(self, client_name, client_info):
+        """Moves the session to the next key epoch. Called with client_lock held.
+
+        Both sides derive the new key, so this is one hash and one small frame: traffic keeps
+        flowing. Frames queued before the notice use the old epoch, the ones after it the new
+        one, and the client still holds the old key for the frames in between. The notice is
+        sealed by the record layer under the current key: the client only moves on authentic ones.
+        """
+        keys = client_info.keys
+        outbound = client_info.outbound
+        data = {"type": "rekey", "from": "server", "epoch": keys.epoch + 1}
+        notice = self.encode_frame(data)
+        if not outbound.put(notice, CONTROL, seal=self.record_sealer(client_info, data, keys.current)):
+            return # queue closed, try again on a later frame
+        client_info.rekey_mark = outbound.data_put
+        epoch = keys.advance()
+        if client_info.keystream:
+            client_info.keystream_for(keys, self.metrics) # starts filling the new epoch's stream
+        self.metrics.inc('rekeys_total')
+        log.info("Session rekeyed", extra={"client": client_name, "epoch": epoch})
+
+    def presence_tick(self):
+        """Timer callback: flushes roster changes to the presence subscribers every PRESENCE_INTERVAL seconds."""
+        if self.stopping:
+            return
+        with self.client_lock:
+            self.flush_presence()
+        self.timers.schedule(PRESENCE_INTERVAL, self.presence_tick)
+
+    def check_idle(self, client_name, conn):
+        """Timer callback: pings a client that went quiet and reaps it once it stays silent.
+
+        Frames only refresh last_seen; the timer is moved here, at most twice per heartbeat
+        interval, instead of on every frame. A session that hears nothing for
+        heartbeat_interval gets a ping, one that still hears nothing by idle_timeout (a crashed
+        peer, a half-open TCP connection) is reaped.
+        """
+        with self.client_lock:
+            client_info = self.connected_clients.get(client_name)
+            if self.stopping or not client_info or client_info.conn != conn:
+                return
+            idle = time.monotonic() - client_info.last_seen
+            if idle >= self.idle_timeout:
+                self.reap_client(client_name, client_info, idle)
+                return
+            if idle >= self.heartbeat_interval and not client_info.pinged:
+                client_info.pinged = True
+                client_info.outbound.put(self.encode_frame({"type": "ping", "from": "server"}), CONTROL)
+                self.metrics.inc('heartbeats_sent_total')
+            wait = (self.idle_timeout if client_info.pinged else self.heartbeat_interval) - idle
+            client_info.timer = self.timers.schedule(wait, self.check_idle, client_name, conn)
+
+    def reap_client(self, client_name, client_info, idle):
+        """Drops a silent session: registry entry, queued frames and socket. Called with client_lock held.
+
+        Offline messages in the dropped frames are still unacknowledged in the store and are
+        delivered again on the next connect.
+        """
+        dropped = client_info.outbound.discard()
+        log.info("Idle client reaped", extra={"client": client_name, "idle_seconds": round(idle, 1), "dropped_frames": dropped})
+        self.metrics.inc('idle_reaped_total')
+        self.unregister_client(client_name, client_info.conn)
         try:
-            message_bytes = json.dumps(data).encode('utf-8')
-            msg_len_bytes = len(message_bytes).to_bytes(4, 'big')
-            conn_socket.sendall(msg_len_bytes + message_bytes)
-        except Exception as e:
-            print(f"[Server] Error sending data directly to client: {e}")
-            raise # Re-raise to let calling function know connection might be bad
+            # Ends the handler thread's recv; on a half-open connection nothing else would
+            client_info.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
-    def handle_client_connection(self, conn, addr):
-        """Handles initial handshake and then continuously receives messages from a connected client."""
-        client_name = None
+    def reject_busy(self, conn, addr):
+        """Turns a connection away while the handshake limit is reached: busy frame, then close.
+
+        Only our side is shut down now. Closing with the client's key frame unread would reset
+        the connection and could drop the busy frame before the client reads it; the socket is
+        closed a little later from the timer wheel.
+        """
+        self.metrics.inc('handshakes_rejected_total')
+        log.warning("Handshake limit reached, connection turned away", extra={"addr": addr})
         try:
-            # Step 1: Receive public key from client to identify them
-            initial_data = self.recv_full(conn)
-            if not initial_data:
-                conn.close()
-                return
+            conn.sendall(self.encode_frame(self.admission.busy_frame()))
+            conn.shutdown(socket.SHUT_WR)
+        except OSError:
+            conn.close()
+            return
+        self.timers.schedule(REJECT_LINGER, conn.close)
+
+    def handshake_expired(self, conn, addr):
+        """Timer callback: a connection that has not sent its key frame in time is closed."""
+        log.info("Handshake timed out", extra={"addr": addr})
+        self.metrics.inc('handshake_timeouts_total')
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
-            msg = json.loads(initial_data.decode())
-            if msg.get("type") == "key" and "from" in msg and "data" in msg:
-                client_name = msg["from"]
-                client_pubkey = tuple(msg["data"])
+    def flush_presence(self):
+        """Sends the roster changes since the last flush to every subscriber. Called with client_lock held.
 
-                with self.client_lock:
-                    self.connected_clients[client_name] = {
-                        'conn': conn,
-                        'pub_key': client_pubkey,
-                        'aes_key': None # AES key will be generated and shared later
-                    }
-                print(f"[Server] Client {client_name} connected. Public key received.")
-
-                # Step 2: Generate and send shared AES key to this client
-                # The server generates AES key for each client independently
-                shared_aes_key = secrets.token_bytes(16)
-                with self.client_lock:
-                    self.connected_clients[client_name]['aes_key'] = shared_aes_key
+        The delta is encoded once and the same bytes are queued for everyone; subscribers
+        that joined after the last flush already have part of it and skip what they know.
+        """
+        roster = self.roster
+        if roster.version == self.presence_flushed:
+            return
+        frames = roster.frames(self.presence_flushed)
+        self.presence_flushed = roster.version
+        encoded = [self.encode_frame(frame) for frame in frames]
+        for name in list(self.presence_subscribers):
+            client_info = self.connected_clients.get(name)
+            if not client_info:
+                self.presence_subscribers.discard(name)
+                continue
+            for frame in encoded:
+                if not client_info.outbound.put(frame, CONTROL):
+                    self.handle_slow_consumer(name, client_info)
+                    break
+        self.metrics.inc('presence_deltas_total')
+        self.metrics.set_gauge('presence_subscribers', len(self.presence_subscribers))
 
-                encrypted_shared_aes = [rsa_encrypt(b, client_pubkey) for b in shared_aes_key]
-                self.send_data_direct(conn, {
-                    "type": "shared_aes_offer",
-                    "from": "server", # The server is the sender
-                    "data": encrypted_shared_aes
-                })
-                print(f"[Server] Sent shared AES key to {client_name}.")
+    def handle_slow_consumer(self, client_name, client_info):
+        """Applies the slow consumer policy to a client whose outbound queue is full. Called with client_lock held."""
+        if self.slow_consumer_policy == POLICY_PARK:
+            if not client_info.parked:
+                client_info.parked = True
+                self.metrics.inc('slow_consumer_parked_total')
+                log.warning("Slow consumer parked", extra={"client": client_name, "queued_bytes": client_info.outbound.queued_bytes})
+            return
 
-            else:
-                print(f"[Server] Invalid initial handshake from {addr}: {msg}")
-                conn.close()
+        log.warning("Slow consumer disconnected", extra={"client": client_name, "queued_bytes": client_info.outbound.queued_bytes})
+        self.metrics.inc('slow_consumer_disconnects_total')
+        self.unregister_client(client_name, client_info.conn)
+        try:
+            # Unblocks the writer stuck in sendall and ends the handler thread's recv
+            client_info.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def on_outbound_error(self, queue, error):
+        """Writer thread callback: the client's socket failed, forget the session."""
+        log.info("Client connection lost while sending", extra={"client": queue.name, "error": error})
+        with self.client_lock:
+            self.unregister_client(queue.name, queue.conn)
+        try:
+            queue.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def on_outbound_drained(self, queue):
+        """Writer thread callback: a full queue caught up, resume a parked client from the offline store."""
+        with self.client_lock:
+            client_info = self.connected_clients.get(queue.name)
+            if not client_info or client_info.outbound is not queue or not client_info.parked:
+                return
+            client_info.parked = False
+            log.info("Slow consumer resumed", extra={"client": queue.name})
+        self.deliver_offline_messages(queue.name)
+
+    def collect_queue_gauges(self):
+        """Outbound queue gauges, computed when the metrics are scraped."""
+        sessions = list(self.connected_clients.values())
+        queues = [session.outbound.stats() for session in sessions]
+        return {
+            'outbound_queued_bytes': sum(q['bytes'] for q in queues),
+            'outbound_queue_depth_max': max((q['depth'] for q in queues), default=0),
+            'outbound_dropped_frames': sum(q['dropped'] for q in queues),
+            'parked_clients': sum(1 for session in sessions if session.parked),
+            'timers_pending': self.timers.pending,
+        }
+
+    def handle_client_connection(self, conn, addr):
+        """Handles initial handshake and then continuously receives messages from a connected client."""
+        client_name = None
+        try:
+            try:
+                client_name = self.handshake(conn, addr)
+            finally:
+                self.admission.done() # the place is taken from accept() to the offer
+            if not client_name:
                 return
 
             # Step 3: Continuously receive and process messages from this client
             while True:
                 data = self.recv_full(conn)
+                received_at = time.perf_counter()
                 if not data: # Connection closed by client
-                    print(f"[Server] Client {client_name} disconnected.")
+                    log.info("Client disconnected", extra={"client": client_name})
                     with self.client_lock:
-                        if client_name in self.connected_clients and self.connected_clients[client_name]['conn'] == conn:
-                            del self.connected_clients[client_name]
+                        self.unregister_client(client_name, conn)
                     break
 
                 try:
-                    msg = json.loads(data.decode())
-                except json.JSONDecodeError:
-                    print(f"[Server] Malformed JSON from {client_name}.")
-                    continue
+                    with self.profile_window.section():
+                        self.process_frame(conn, client_name, data, received_at)
+                finally:
+                    self.release_frame(data)
 
-                if msg.get("type") == "message" and "from" in msg and "recipient" in msg and "data" in msg:
-                    sender = msg["from"]
-                    recipient = msg["recipient"]
-                    ciphertext = bytes(msg["data"])
+        except json.JSONDecodeError:
+            log.warning("Initial message was not valid JSON", extra={"client": client_name or addr})
+        except ConnectionResetError:
+            log.info("Client unexpectedly disconnected", extra={"client": client_name or addr})
+            with self.client_lock:
+                self.unregister_client(client_name, conn)
+        except Exception as e:
+            log.warning("Error handling client", extra={"client": client_name or addr, "error": e})
+        finally:
+            with self.client_lock:
+                client_info = self.connected_clients.get(client_name)
+                if client_info and client_info.conn == conn:
+                    # recv failed without a clean close (timeout, reset inside recv_full)
+                    self.unregister_client(client_name, conn)
+            conn.close()
 
-                    if sender != client_name: # Sanity check
-                        print(f"[Server] Warning: Message 'from' field '{sender}' does not match connected client '{client_name}'. Discarding.")
-                        continue
+    def handshake(self, conn, addr):
+        """Key frame, key agreement and signed offer. Returns the client's name, None if the handshake failed.
 
-                    with self.client_lock:
-                        sender_info = self.connected_clients.get(sender)
-                        recipient_info = self.connected_clients.get(recipient)
-
-                        if not sender_info or not sender_info['aes_key']:
-                            print(f"[Server] No AES key for sender {sender}. Cannot decrypt.")
-                            continue
-
-                        if not recipient_info or not recipient_info['aes_key']:
-                            print(f"[Server] Recipient {recipient} not found or no AES key. Cannot forward.")
-                            continue
-
-                        # Decrypt message from sender using their AES key
-                        try:
-                            plaintext_padded = aes_decryption(ciphertext, sender_info['aes_key'])
-                            plaintext_str = plaintext_padded.decode('utf-8', errors='replace').rstrip('\x00')
-                            print(f"[Server] Decrypted message from {sender} for {recipient}: '{plaintext_str}'")
-                        except Exception as e:
-                            print(f"[Server] Error decrypting message from {sender}: {e}")
-                            continue
-
-                        # Re-encrypt message for recipient using recipient's AES key
-                        try:
-                            msg_bytes = plaintext_str.encode("utf-8")
-                            block_size = 16
-                            msg_bytes_padded = msg_bytes.ljust(block_size, b'\0')
-                            re_encrypted_ciphertext = aes_encryption(msg_bytes_padded, recipient_info['aes_key'])
-                        except Exception as e:
-                            print(f"[Server] Error re-encrypting message for {recipient}: {e}")
-                            continue
-
-                        # Forward the re-encrypted message
-                        try:
-                            self.send_data_direct(recipient_info['conn'], {
-                                "type": "message",
-                                "from": sender,
-                                "recipient": recipient, # Keep recipient for client's display
-                                "data": list(re_encrypted_ciphertext)
-                            })
-                            print(f"[Server] Forwarded message from {sender} to {recipient}.")
-                        except Exception as e:
-                            print(f"[Server] Failed to forward message to {recipient}: {e}")
-                            if recipient in self.connected_clients:
-                                recipient_info['conn'].close()
-                                del self.connected_clients[recipient]
+        A method of its own so the key frame, the offer and its signature are freed when it
+        returns instead of living on the handler's stack for as long as the connection does.
+        """
+        # Step 1: Receive public key from client to identify them
+        handshake_timer = self.timers.schedule(self.handshake_timeout, self.handshake_expired, conn, addr)
+        initial_data = self.recv_full(conn)
+        self.timers.cancel(handshake_timer)
+        if not initial_data:
+            return None
 
+        handshake_start = time.perf_counter()
+        msg = json.loads(str(initial_data, 'utf-8'))
+        self.release_frame(initial_data)
+        if msg.get("type") != "key" or not valid_name(msg.get("from")) or "data" not in msg:
+            log.warning("Invalid initial handshake", extra={"addr": addr, "type": msg.get("type")})
+            self.metrics.inc('handshake_failures_total')
+            return None
+        client_name = msg["from"]
 
-                else:
-                    print(f"[Server] Unknown message type from {client_name}: {msg.get('type')}")
+        # Step 2: Agree on the AES key for this client (RSA transport or ephemeral DH)
+        try:
+            client_pubkey, shared_aes_key, offer_fields = self.key_agreement(msg)
+        except (ValueError, TypeError) as e:
+            log.warning("Key agreement failed", extra={"client": client_name, "error": e})
+            self.metrics.inc('handshake_failures_total')
+            return None
 
-        except json.JSONDecodeError:
-            print(f"[Server] Initial message from {client_name or addr} was not valid JSON.")
-        except ConnectionResetError:
-            print(f"[Server] Client {client_name or addr} unexpectedly disconnected.")
+        if self.offline_store:
+            # From now on messages for this name are queued while it is offline, never for a name never seen
+            self.offline_store.register(client_name)
+        with self.client_lock:
+            self.register_client(client_name, conn, client_pubkey)
+        log.info("Client connected, public key received", extra={"client": client_name, "kex": msg.get("kex", "rsa")})
+
+        try:
+            # The offer is built and signed before taking the lock, signing is the slow part
+            offer = {
+                "type": "shared_aes_offer",
+                "from": "server", # The server is the sender
+                **offer_fields
+            }
+            compression = negotiate_compression(msg.get("compression")) if self.compression else None
+            if compression:
+                offer["compression"] = compression
+            ctr = self.ctr_messages and msg.get("message_mode") == CTR_MODE
+            if ctr:
+                offer["message_mode"] = CTR_MODE
+            offer["server_key"] = self.identity_public
+            with self.metrics.time('sign_seconds'):
+                offer["signature"] = sign_offer(self.identity, self.identity_fingerprint, client_name, msg, offer, self.signer)
+
+            # The key is published, offered and followed by any queued messages under one lock,
+            # so no relayed message can reach the client before its key or overtake the queue
             with self.client_lock:
-                if client_name in self.connected_clients:
-                    self.connected_clients[client_name]['conn'].close()
-                    del self.connected_clients[client_name]
+                client_info = self.connected_clients.get(client_name)
+                if not client_info or client_info.conn != conn:
+                    return None # replaced by a newer connection under the same name
+                client_info.keys = KeyRing(shared_aes_key)
+                self.roster.add(client_name)
+                if compression:
+                    client_info.compressor = Compressor(compression, self.metrics)
+                client_info.ctr = ctr
+                self.send_to_client(client_name, client_info, offer)
+                self.metrics.observe('handshake_seconds', time.perf_counter() - handshake_start)
+                self.metrics.inc('handshakes_total')
+                log.info("Sent shared AES key", extra={"client": client_name})
+            self.deliver_offline_messages(client_name)
+        except Exception:
+            with self.client_lock:
+                self.unregister_client(client_name, conn)
+            raise
+        return client_name
+
+    def key_agreement(self, msg):
+        """Session key for a "key" frame: (client RSA public key or None, AES key, offer fields).
+
+        Without "kex" the client sent an RSA public key and the server picks the AES key and
+        encrypts it for the client. With "kex": "ffdhe2048" (3072, 4096) the client sent a DH
+        public value; the server answers with its own, from a fresh secret, and both derive
+        the key from the shared secret. Raises ValueError for unknown groups or bad values.
+        """
+        group = msg.get("kex")
+        if group is None:
+            client_pubkey = tuple(msg["data"])
+            # The server generates AES key for each client independently
+            shared_aes_key = secrets.token_bytes(16)
+            return client_pubkey, shared_aes_key, {"data": [rsa_encrypt(b, client_pubkey) for b in shared_aes_key]}
+
+        if group not in DH_GROUPS:
+            raise ValueError(f"Unsupported key exchange: {group}")
+        client_public = int(msg["data"], 16)
+        # A DH handshake is the expensive kind: it waits for a worker slot (a process, if there is a pool)
+        with self.admission.working(), self.metrics.time('dh_seconds'):
+            if self.handshake_pool:
+                shared_aes_key, server_public = self.handshake_pool.submit(dh_agreement, group, client_public).result()
+            else:
+                shared_aes_key, server_public = dh_agreement(group, client_public)
+        return None, shared_aes_key, {"kex": group, "data": format(server_public, 'x')}
+
+    def process_frame(self, conn, client_name, data, received_at):
+        """Parses one frame received from client_name and dispatches it by type."""
+        client_info = self.connected_clients.get(client_name)
+        if not client_info:
+            return
+        client_info.last_seen = time.monotonic() # any frame proves the peer alive, even a dropped one
+        client_info.pinged = False
+        # Rate limits are checked before any parsing or decryption work is spent on the frame
+        if not client_info.limiter.allow(len(data)):
+            log.warning("Sender over its rate limit, frame dropped", extra={"client": client_name})
+            self.metrics.inc('drops_total{reason="rate_limited"}')
+            return
+        try:
+            msg = json.loads(str(data, 'utf-8'))
+        except json.JSONDecodeError:
+            log.warning("Malformed JSON", extra={"client": client_name})
+            self.metrics.inc('drops_total{reason="malformed"}')
+            return
+        if not isinstance(msg, dict):
+            log.warning("Frame is not a JSON object", extra={"client": client_name})
+            self.metrics.inc('drops_total{reason="bad_frame"}')
+            return
+        parsed_at = time.perf_counter()
+
+        trace = self.tracer.begin("server.relay", msg.get("trace_id"))
+        if trace:
+            trace.add("recv_full", self._recv_timing.prefix_at, received_at)
+            trace.add("json.loads", received_at, parsed_at)
+
+        # Fields the peer sent are checked where they are used: a bad one costs the frame, not the connection
+        try:
+            if msg.get("type") in RECORD_TYPES and not self.open_record(client_name, client_info, msg):
+                self.tracer.finish(trace)
+                return
+
+            if msg.get("type") in ADMIN_FRAMES and client_name not in self.admin_clients:
+                log.warning("Admin frame from a client that is not an admin, dropped", extra={"client": client_name, "type": msg.get("type")})
+                self.metrics.inc('drops_total{reason="not_admin"}')
+                self.tracer.finish(trace)
+                return
+
+            if msg.get("type") == "message" and "from" in msg and "recipient" in msg and "data" in msg:
+                self.relay_message(client_name, msg, received_at, trace)
+
+            elif msg.get("type") == "file_chunk" and "recipient" in msg and "nonce" in msg and "data" in msg:
+                self.relay_file_chunk(client_name, msg, trace)
+
+            elif msg.get("type") in FILE_CONTROL_FRAMES and "recipient" in msg and "transfer_id" in msg:
+                self.relay_file_control(client_name, msg)
+
+            elif msg.get("type") == "rekey_ack" and "epoch" in msg:
+                with self.client_lock:
+                    if client_info.keys:
+                        client_info.keys.confirm(peer_int(msg, "epoch", 0, MAX_SEQ))
+
+            elif msg.get("type") == "ping":
+                with self.client_lock:
+                    self.send_to_client(client_name, client_info, {"type": "pong", "from": "server"})
+
+            elif msg.get("type") == "pong":
+                pass # answer to our heartbeat; last_seen is already updated
+
+            elif msg.get("type") == "presence_subscribe":
+                since = peer_int(msg, "since", 0, MAX_SEQ) if msg.get("since") is not None else None
+                with self.client_lock:
+                    self.presence_subscribers.add(client_name)
+                    for frame in self.roster.frames(since):
+                        if not self.send_to_client(client_name, client_info, frame):
+                            break
+
+            elif msg.get("type") == "offline_ack" and "seq" in msg:
+                if self.offline_store:
+                    self.offline_store.ack(client_name, peer_int(msg, "seq", 0, MAX_SEQ))
+
+            elif msg.get("type") == "stats":
+                # Admin view of the metrics registry, same data as the Prometheus endpoint
+                with self.client_lock:
+                    queues = {name: info.outbound.stats() for name, info in self.connected_clients.items()}
+                    self.send_to_client(client_name, client_info, {
+                        "type": "stats",
+                        "from": "server",
+                        "data": self.metrics.snapshot(),
+                        "queues": queues
+                    })
+
+            elif msg.get("type") == "profile":
+                # Admin switch: profile the next N frames and dump pstats next to the server
+                messages = peer_int(msg, "messages", 1, MAX_SEQ) if "messages" in msg else 1000
+                self.profile_window.open(messages, PROFILE_FILE)
+                log.info("Profiling window opened", extra={"frames": messages, "path": PROFILE_FILE})
+
+            elif msg.get("type") == "trace_dump":
+                events = self.tracer.export_chrome(TRACE_FILE)
+                log.info("Trace events written", extra={"events": events, "path": TRACE_FILE})
+
+            else:
+                log.warning("Unknown message type", extra={"client": client_name, "type": msg.get("type")})
+        except (ValueError, TypeError) as e:
+            log.warning("Bad frame dropped", extra={"client": client_name, "type": msg.get("type"), "error": e})
+            self.metrics.inc('drops_total{reason="bad_frame"}')
+
+        self.tracer.finish(trace)
+
+    def open_record(self, client_name, client_info, msg):
+        """Replay window and MAC of a message or file chunk, checked before any AES work.
+
+        Returns False if the frame is a replay, too old for the window, unsequenced or forged.
+        Only the client's handler thread calls this, so the window needs no lock.
+        """
+        keys = client_info.keys
+        key = keys.get(msg.get("epoch", 0)) if keys else None
+        if not key:
+            return True # no key for that epoch: the relay drops the frame and says why
+        reason = client_info.replay.open(msg, key, CLIENT_TO_SERVER)
+        if reason:
+            log.warning("Record rejected", extra={"client": client_name, "reason": reason, "seq": msg.get("seq")})
+            self.metrics.inc(f'drops_total{{reason="{reason}"}}')
+            return False
+        return True
+
+    def relay_message(self, client_name, msg, received_at, trace=None):
+        """Decrypts a message with the sender's key and forwards it re-encrypted for the recipient."""
+        sender = msg["from"]
+        recipient = msg["recipient"]
+        ciphertext = bytes(msg["data"])
+        debug = log.isEnabledFor(logging.DEBUG) # checked once, so disabled per-message logs cost nothing
+
+        if sender != client_name: # Sanity check
+            log.warning("Message 'from' field does not match connected client, discarding", extra={"sender": sender, "client": client_name})
+            self.metrics.inc('drops_total{reason="spoofed_sender"}')
+            return
+
+        with self.client_lock:
+            lock_acquired = time.perf_counter()
+            self.metrics.observe('lock_wait_seconds', lock_acquired - received_at)
+            if trace:
+                trace.add("client_lock", received_at, lock_acquired)
+            sender_info = self.connected_clients.get(sender)
+            recipient_info = self.connected_clients.get(recipient)
+
+            if not sender_info or not sender_info.keys:
+                log.warning("No AES key for sender, cannot decrypt", extra={"sender": sender})
+                self.metrics.inc('drops_total{reason="no_sender_key"}')
+                return
+            sender_key = sender_info.keys.get(msg.get("epoch", 0))
+            if not sender_key:
+                log.warning("Message for a retired key epoch, discarding", extra={"sender": sender, "epoch": msg.get("epoch")})
+                self.metrics.inc('drops_total{reason="stale_epoch"}')
+                return
+            self.count_traffic(sender, sender_info, len(ciphertext))
+
+            if (not recipient_info or not recipient_info.keys) and not self.offline_store:
+                log.warning("Recipient not found or no AES key, cannot forward", extra={"recipient": recipient})
+                self.metrics.inc('drops_total{reason="no_recipient"}')
+                return
+
+            # Decrypt message from sender using their AES key
+            try:
+                decrypt_start = time.perf_counter()
+                if "ctr" in msg:
+                    plaintext_padded = decrypt_ctr(sender_info.recv_cipher(sender_key), msg)
+                else:
+                    plaintext_padded = sender_info.recv_cipher(sender_key).decrypt(ciphertext)
+                decrypt_end = time.perf_counter()
+                self.metrics.observe('aes_decrypt_seconds', decrypt_end - decrypt_start)
+                if trace:
+                    trace.add("aes_decryption", decrypt_start, decrypt_end)
+                plaintext_str = plaintext_padded.decode('utf-8', errors='replace').rstrip('\x00')
+                if debug:
+                    log.debug("Decrypted message", extra={"sender": sender, "recipient": recipient, "payload": plaintext_str})
+            except Exception as e:
+                log.warning("Error decrypting message", extra={"sender": sender, "error": e})
+                self.metrics.inc('drops_total{reason="decrypt_error"}')
+                return
+
+            queue_offline = not recipient_info or not recipient_info.keys or recipient_info.parked
+            if not queue_offline:
+                # Re-encrypt message for recipient using recipient's AES key
+                try:
+                    msg_bytes = plaintext_str.encode("utf-8")
+                    block_size = 16
+                    msg_bytes_padded = msg_bytes.ljust(block_size, b'\0')
+                    encrypt_start = time.perf_counter()
+                    encrypted = self.encrypt_message(recipient_info, msg_bytes_padded)
+                    encrypt_end = time.perf_counter()
+                    self.metrics.observe('aes_encrypt_seconds', encrypt_end - encrypt_start)
+                    if trace:
+                        trace.add("aes_encryption", encrypt_start, encrypt_end)
+                except Exception as e:
+                    log.warning("Error re-encrypting message", extra={"recipient": recipient, "error": e})
+                    self.metrics.inc('drops_total{reason="encrypt_error"}')
+                    return
+
+                # Forward the re-encrypted message
+                forwarded = {
+                    "type": "message",
+                    "from": sender,
+                    "recipient": recipient, # Keep recipient for client's display
+                    **encrypted
+                }
+                if trace:
+                    forwarded["trace_id"] = trace.trace_id
+                if self.send_to_client(recipient, recipient_info, forwarded, trace):
+                    self.metrics.inc('messages_relayed_total')
+                    if debug:
+                        log.debug("Forwarded message", extra={"sender": sender, "recipient": recipient})
+                elif self.offline_store:
+                    # Recipient is a slow consumer, it gets the message from the store once it catches up
+                    queue_offline = True
+                else:
+                    self.metrics.inc('drops_total{reason="queue_full"}')
+
+        if queue_offline:
+            # Stored once client_lock is released: appending to the store can fsync
+            self.store_offline_message(sender, recipient, plaintext_str)
+
+    def encrypt_message(self, client_info, plaintext_padded):
+        """The "data" and "epoch" fields (plus "nonce" and "ctr" in the CTR mode) of a message to a client.
+
+        In the CTR mode this is an XOR with the next block of the session's precomputed keystream.
+        """
+        keys = client_info.keys
+        if client_info.ctr:
+            stream = client_info.keystream_for(keys, self.metrics)
+            counter, ciphertext = stream.encrypt(plaintext_padded)
+            return {"data": list(ciphertext), "epoch": keys.epoch, "nonce": stream.nonce.hex(), "ctr": counter}
+        return {"data": list(client_info.send_cipher(keys.current).encrypt(plaintext_padded)), "epoch": keys.epoch}
+
+    def relay_file_chunk(self, client_name, msg, trace=None):
+        """Re-encrypts one file chunk (AES-CTR) from the sender's key to the recipient's.
+
+        Chunks are much larger than messages, so the AES work happens outside client_lock;
+        the lock is only held to look up the keys and to queue the frame.
+        """
+        recipient = msg["recipient"]
+        with self.client_lock:
+            sender_info = self.connected_clients.get(client_name)
+            recipient_info = self.connected_clients.get(recipient)
+            sender_keys = sender_info.keys if sender_info else None
+            recipient_keys = recipient_info.keys if recipient_info else None
+            sender_key = sender_keys.get(msg.get("epoch", 0)) if sender_keys else None
+            if recipient_keys:
+                recipient_epoch, recipient_key = recipient_keys.epoch, recipient_keys.current
+            else:
+                recipient_epoch, recipient_key = None, None
+            if sender_key:
+                self.count_traffic(client_name, sender_info, len(msg["data"]))
+            sender_compressor = sender_info.compressor if sender_info else None
+            recipient_compressor = recipient_info.compressor if recipient_info else None
+        if not sender_key:
+            self.metrics.inc('drops_total{reason="no_sender_key"}')
+            return
+        if not recipient_key:
+            self.metrics.inc('drops_total{reason="no_recipient"}')
+            self.reply_file_error(client_name, msg, "recipient offline")
+            return
+
+        forwarded = dict(msg)
+        try:
+            with self.metrics.time('file_chunk_reencrypt_seconds'):
+                plaintext = decrypt_chunk(msg, traffic_key(sender_key, CLIENT_TO_SERVER))
+                if msg.get("compressed"):
+                    if not sender_compressor:
+                        raise ValueError("compressed chunk without negotiated compression")
+                    if recipient_compressor and recipient_compressor.compatible(sender_compressor):
+                        # Same codec and dictionary on both sessions: forwarded still compressed
+                        self.metrics.inc('compression_bytes_saved_total', max(0, int(msg.get("size", 0)) - len(plaintext)))
+                    else:
+                        plaintext = sender_compressor.decompress(plaintext)
+                        forwarded.pop("compressed")
+                        forwarded.pop("size", None)
+                forwarded["nonce"], forwarded["data"] = encrypt_chunk(plaintext, traffic_key(recipient_key, SERVER_TO_CLIENT))
+                forwarded["epoch"] = recipient_epoch
         except Exception as e:
-            print(f"[Server] Error handling client {client_name or addr}: {e}")
-        finally:
-            if conn and client_name not in self.connected_clients:
-                conn.close()
+            log.warning("Error re-encrypting file chunk", extra={"sender": client_name, "error": e})
+            self.metrics.inc('drops_total{reason="decrypt_error"}')
+            return
+
+        forwarded["from"] = client_name
+        with self.client_lock:
+            recipient_info = self.connected_clients.get(recipient)
+            # The recipient may have reconnected with a new key in the meantime; the sender's ack timeout resends the chunk
+            if recipient_info and recipient_info.keys is recipient_keys and \
+                    self.send_to_client(recipient, recipient_info, forwarded, trace):
+                self.metrics.inc('file_chunks_relayed_total')
+                self.metrics.inc('file_bytes_relayed_total', len(plaintext))
+            else:
+                self.metrics.inc('drops_total{reason="file_chunk"}')
+
+    def relay_file_control(self, client_name, msg):
+        """Forwards offers, accepts, acks and errors of a file transfer as they are."""
+        forwarded = dict(msg)
+        forwarded["from"] = client_name
+        with self.client_lock:
+            recipient_info = self.connected_clients.get(msg["recipient"])
+            if recipient_info and recipient_info.keys:
+                self.send_to_client(msg["recipient"], recipient_info, forwarded)
+                return
+        self.metrics.inc('drops_total{reason="no_recipient"}')
+        if msg["type"] != "file_error": # never answer an error with an error
+            self.reply_file_error(client_name, msg, "recipient offline")
+
+    def reply_file_error(self, client_name, msg, reason):
+        with self.client_lock:
+            client_info = self.connected_clients.get(client_name)
+            if client_info:
+                self.send_to_client(client_name, client_info, {
+                    "type": "file_error",
+                    "from": "server",
+                    "recipient": client_name,
+                    "transfer_id": msg.get("transfer_id"),
+                    "reason": reason
+                })
+
+    def store_offline_message(self, sender, recipient, plaintext_str):
+        """Queues a message for a recipient that is not connected, encrypted with the store key.
+
+        Called without client_lock: the append may fsync. A recipient that came online (or was
+        resumed) while the message was being stored gets it delivered right away. Only names that
+        completed a handshake at least once are queued for, up to the store's byte quotas.
+        """
+        if not self.offline_store:
+            return
+        if not self.offline_store.knows(recipient):
+            log.warning("Message for a client never seen, not queued", extra={"sender": sender, "recipient": recipient})
+            self.metrics.inc('drops_total{reason="no_recipient"}')
+            return
+        try:
+            msg_bytes_padded = plaintext_str.encode("utf-8").ljust(16, b'\0')
+            frame = json.dumps({
+                "from": sender,
+                "recipient": recipient,
+                "data": list(self.store_cipher.encrypt(msg_bytes_padded))
+            }).encode('utf-8')
+            seq = self.offline_store.append(recipient, frame)
+            if seq is None:
+                log.warning("Offline queue full, message dropped", extra={"sender": sender, "recipient": recipient})
+                self.metrics.inc('drops_total{reason="store_full"}')
+                return
+            self.metrics.inc('messages_queued_offline_total')
+            log.debug("Recipient offline, message queued", extra={"sender": sender, "recipient": recipient, "seq": seq})
+        except Exception as e:
+            log.warning("Error queueing message", extra={"recipient": recipient, "error": e})
+            self.metrics.inc('drops_total{reason="store_error"}')
+            return
+        with self.client_lock:
+            recipient_info = self.connected_clients.get(recipient)
+            online = recipient_info is not None and recipient_info.keys is not None and not recipient_info.parked
+        if online:
+            self.deliver_offline_messages(recipient)
+
+    def deliver_offline_messages(self, client_name):
+        """Queues stored messages to a client that just completed its handshake (or caught up after
+        being parked), oldest first. Stops early if the client's outbound queue fills up again.
+
+        Must be called without client_lock: the backlog is read from the store in batches with
+        the lock released, and each batch is queued under the lock.
+        """
+        if not self.offline_store:
+            return
+        with self.client_lock:
+            client_info = self.connected_clients.get(client_name)
+            if not client_info or not client_info.keys:
+                return
+            start = client_info.offline_sent + 1 # seqs below were already queued to this session
+        for batch in self.offline_store.pending_batches(client_name, start):
+            stored_batch = []
+            for seq, frame in batch:
+                stored = json.loads(frame.decode('utf-8'))
+                stored_batch.append((seq, stored, self.store_cipher.decrypt(bytes(stored["data"]))))
+            with self.client_lock:
+                if self.connected_clients.get(client_name) is not client_info or client_info.parked:
+                    return # disconnected, replaced or parked again meanwhile
+                for seq, stored, plaintext_padded in stored_batch:
+                    if seq <= client_info.offline_sent:
+                        continue # queued by a concurrent delivery, waiting for its ack
+                    if not self.send_to_client(client_name, client_info, {
+                        "type": "message",
+                        "from": stored["from"],
+                        "recipient": stored["recipient"],
+                        **self.encrypt_message(client_info, plaintext_padded),
+                        "offline_seq": seq
+                    }):
+                        return
+                    client_info.offline_sent = seq
+                    log.debug("Delivered queued message", extra={"sender": stored["from"], "client": client_name, "seq": seq})
+
+def main(argv=None):
+    """python -m topology.server [url]"""
+    argv = sys.argv[1:] if argv is None else argv
+    configure_logging(LOG_LEVEL)
+    server = SecureServer(SERVER_HOST, SERVER_PORT, store_dir=SERVER_STORE_DIR, metrics_port=METRICS_PORT,
+                          url=argv[0] if argv else SERVER_URL, handshake_processes=HANDSHAKE_PROCESSES)
+    server.start()
 
 if __name__ == "__main__":
-    server = SecureServer(SERVER_HOST, SERVER_PORT)
-    server.start()
\ No newline at end of file
+    main()
\ No newline at end of file
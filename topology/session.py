@@ -0,0 +1,78 @@
+"""
+Server-side state of one connected client.
+
+Sessions used to be plain dicts. A dict with fifteen keys costs about a kilobyte before any of
+its values, and the per-session helpers (rate limiter, sequencer, replay window) each carried
+their own __dict__ on top. ClientSession and those helpers use __slots__, so an idle session is
+a few fixed-size objects; at 100k sessions that is the difference between fitting in a memory
+budget or not. See benchmarks/bench_sessions.py for the measured cost per idle connection.
+"""
+
+import time
+
+from aes.aes_key import AESKey
+from topology.keyschedule import key_schedule
+from topology.keystream import Keystream
+from topology.record import Sequencer, ReplayWindow, CLIENT_TO_SERVER, SERVER_TO_CLIENT
+
+
+class ClientSession:
+    __slots__ = ('name', 'conn', 'pub_key', 'keys', 'outbound', 'limiter', 'parked', 'compressor',
+                 'offline_sent', 'last_seen', 'pinged', 'timer', 'sequencer', 'replay', 'rekey_mark',
+                 '_recv_cipher', '_send_cipher', 'ctr', 'keystream')
+
+    def __init__(self, name, conn, pub_key, outbound, limiter, timer=None):
+        self.name = name
+        self.conn = conn
+        self.pub_key = pub_key # (e, n), None after a DH handshake
+        self.keys = None # KeyRing of the AES session keys, created once the key is shared
+        self.outbound = outbound # OutboundQueue, written by its own writer thread
+        self.limiter = limiter # RateLimiter for the frames the client sends
+        self.parked = False # slow consumer under POLICY_PARK, new messages go to the offline store
+        self.compressor = None # Compressor if compression was negotiated in the handshake
+        self.offline_sent = -1 # highest offline seq already queued to this session
+        self.last_seen = time.monotonic() # when the last complete frame arrived, refreshed without touching the timer
+        self.pinged = False # a heartbeat was sent and nothing has arrived since
+        self.timer = timer # heartbeat / idle Timer on the server's wheel
+        self.sequencer = Sequencer() # record numbers of the frames we send (server -> client), taken by the writer
+        self.replay = ReplayWindow() # record numbers seen from the client, for the replay check
+        self.rekey_mark = 0 # outbound data frames queued before the last rekey notice
+        self._recv_cipher = None # (epoch key, AESKey of its client -> server traffic key) used last
+        self._send_cipher = None # the same for server -> client
+        self.ctr = False # messages to the client use the "ctr" mode, negotiated in the handshake
+        self.keystream = None # Keystream of the messages we send, created on the first one
+
+    def recv_cipher(self, key):
+        """Expanded AES key for what the client sends under key, one of this session's epoch keys.
+
+        Only the last one per direction is kept: a session uses one epoch at a time except
+        around a rekey.
+        """
+        cached = self._recv_cipher
+        if cached is None or cached[0] != key:
+            cached = self._recv_cipher = (key, AESKey(key_schedule(key).traffic_key(CLIENT_TO_SERVER)))
+        return cached[1]
+
+    def send_cipher(self, key):
+        """Expanded AES key for what the server sends to the client under key."""
+        cached = self._send_cipher
+        if cached is None or cached[0] != key:
+            cached = self._send_cipher = (key, AESKey(key_schedule(key).traffic_key(SERVER_TO_CLIENT)))
+        return cached[1]
+
+    def keystream_for(self, keys, metrics=None):
+        """Keystream for messages sent under the current epoch of keys (the session's KeyRing).
+
+        A new epoch gets a new stream; the old one is dropped with its buffer, the server
+        never sends under an older epoch again.
+        """
+        stream = self.keystream
+        if stream is None or stream.epoch != keys.epoch:
+            key = keys.current
+            stream = self.keystream = Keystream(self.send_cipher(key), key_schedule(key).nonce(SERVER_TO_CLIENT),
+                                                keys.epoch, metrics=metrics)
+        return stream
+
+    def __repr__(self):
+        return f"ClientSession({self.name!r}, epoch={self.keys.epoch if self.keys else None})"
+
@@ -0,0 +1,119 @@
+"""
+Hierarchical timer wheel for per-connection timeouts.
+
+Time is counted in ticks of `tick` seconds. Level 0 has SLOTS slots of one tick each, level 1
+SLOTS slots of SLOTS ticks, and so on. A timer goes into the slot of the lowest level that can
+hold its deadline; when the lower level wraps around, the matching slot one level up is
+emptied and its timers move down. Scheduling and cancelling are O(1) (a dict insert or
+delete), firing is O(1) per timer plus at most LEVELS - 1 moves, and nothing is allocated per
+connection except the Timer itself, so 100k connections cost one thread and 100k small objects
+instead of 100k threads or sockets with timeouts.
+
+Deadlines are rounded up to the next tick. Callbacks run on the thread that calls advance()
+(the wheel's own thread with run()), outside the wheel's lock, so they may schedule again. A
+callback that raises is logged and skipped: the other timers of the tick still fire, and the
+wheel's thread keeps running.
+"""
+
+import math
+import threading
+import time
+
+from topology.log import get_logger
+
+TICK = 0.1 # seconds
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+LEVELS = 4 # 64^4 ticks of 0.1s: about 19 days before a timer has to be cascaded again from the top
+
+log = get_logger('timers')
+
+
+class Timer:
+    __slots__ = ('deadline', 'callback', 'args', 'slot')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline # tick at which the timer fires
+        self.callback = callback
+        self.args = args
+        self.slot = None # dict the timer currently sits in, None once fired or cancelled
+
+
+class TimerWheel:
+    def __init__(self, tick=TICK, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self.start = clock()
+        self.current = 0 # last tick processed
+        self.wheels = [[{} for _ in range(SLOTS)] for _ in range(LEVELS)]
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def schedule(self, delay, callback, *args):
+        """Calls callback(*args) after delay seconds. Returns the Timer, for cancel()."""
+        deadline = math.ceil((self.clock() - self.start + delay) / self.tick - 1e-9) # 0.2 / 0.1 is 2.0000000000000004
+        timer = Timer(deadline, callback, args)
+        with self.lock:
+            timer.deadline = max(deadline, self.current + 1) # the current tick has been processed already
+            self._insert(timer)
+            self.pending += 1
+        return timer
+
+    def cancel(self, timer):
+        """Cancels a timer that has not fired yet; harmless for fired or cancelled ones."""
+        with self.lock:
+            if timer.slot is not None:
+                del timer.slot[timer]
+                timer.slot = None
+                self.pending -= 1
+
+    def _insert(self, timer):
+        # During a cascade the current tick is not processed yet, so a timer due now goes into its slot
+        deadline = max(timer.deadline, self.current)
+        delta = deadline - self.current
+        level = 0
+        while level < LEVELS - 1 and delta >= SLOTS << (SLOT_BITS * level):
+            level += 1
+        if delta >= SLOTS << (SLOT_BITS * level):
+            deadline = self.current + (SLOTS << (SLOT_BITS * level)) - 1 # beyond the top level: parked, moved again later
+        slot = self.wheels[level][(deadline >> (SLOT_BITS * level)) & (SLOTS - 1)]
+        slot[timer] = None
+        timer.slot = slot
+
+    def advance(self, now=None):
+        """Processes every tick up to now and runs the callbacks of the timers that expired."""
+        target = int(((self.clock() if now is None else now) - self.start) / self.tick)
+        expired = []
+        with self.lock:
+            while self.current < target:
+                self.current += 1
+                tick = self.current
+                # Cascade: when a level wraps, the next slot of the level above moves down
+                for level in range(1, LEVELS):
+                    if tick & ((1 << (SLOT_BITS * level)) - 1):
+                        break
+                    slot = self.wheels[level][(tick >> (SLOT_BITS * level)) & (SLOTS - 1)]
+                    timers = list(slot)
+                    slot.clear()
+                    for timer in timers:
+                        self._insert(timer)
+                slot = self.wheels[0][tick & (SLOTS - 1)]
+                for timer in list(slot):
+                    if timer.deadline <= tick:
+                        del slot[timer]
+                        timer.slot = None
+                        self.pending -= 1
+                        expired.append(timer)
+        for timer in expired:
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                log.error("Timer callback failed", extra={"callback": getattr(timer.callback, '__qualname__', timer.callback),
+                                                          "error": e}, exc_info=True)
+        return len(expired)
+
+    def run(self, stopped):
+        """Advances the wheel every tick until stopped() is true. Meant for a dedicated thread."""
+        while not stopped():
+            time.sleep(self.tick)
+            self.advance()
@@ -1,121 +1,387 @@
 import socket
 import threading
+import queue
 import sys
 import time
 import json
 import os
+import secrets
 
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from crypto.rsa import rsa_generate_keys, rsa_decrypt
+from crypto.dh import GROUPS as DH_GROUPS, dh_generate_keys, dh_shared_secret, dh_derive_key
 from aes.aes_encrypt import aes_encryption
 from aes.aes_decrypt import aes_decryption
+from aes.aes_key import AESKey
+from topology.tracing import Tracer
+from topology.log import get_logger
+from topology.transfer import FileSender, FileReceiver
+from topology.compression import Compressor, supported as compression_supported
+from topology.metrics import MetricsRegistry
+from topology.rekey import KeyRing
+from topology.identity import VERIFICATION_CACHE, KnownHosts
+from topology.presence import RosterCache
+from topology import transport
+from topology.record import Sequencer, ReplayWindow, CLIENT_TO_SERVER, SERVER_TO_CLIENT
+from topology.flow import FrameAssembler, LENGTH_MASK
+from topology.keystream import Keystream, CTR_MODE, decrypt_ctr
+from topology.keyschedule import key_schedule, traffic_key
 
 SERVER_HOST = '127.0.0.1'
 SERVER_PORT = 9000 # Server's dedicated port
+SERVER_URL = None # tcp://, unix:// or mem:// URL of the server (topology.transport); None is tcp://SERVER_HOST:SERVER_PORT
 
-CLIENT_NAMES = ['client1', 'client2', 'client3']
+TRACE_SAMPLE_RATE = 0.0 # Fraction of sent messages traced; 0 disables tracing
+BLOCK_SIZE = 16 # A message is a single AES block, zero padded
+DOWNLOAD_DIR = 'downloads' # Where the CLI client stores received files
+KEY_EXCHANGE = 'rsa' # or an RFC 7919 group ('ffdhe2048', 'ffdhe3072', 'ffdhe4096') for ephemeral DH
+SERVER_KEY_FINGERPRINT = None # pinned server key (hex SHA-256, logged by the server); None looks it up in KNOWN_HOSTS
+KNOWN_HOSTS = os.path.join(os.path.expanduser('~'), '.p2p', 'known_hosts') # server keys pinned on first use, per URL
+MESSAGE_MODE = CTR_MODE # offered in the handshake: XOR with precomputed keystream; 'block' always encrypts the block itself
+
+log = get_logger('client')
 
 class SecureClient:
+    """Library-level client: connect(), send(target, payload), on_message / messages(), close().
+
+    The handshake and the crypto are the same as before; cli_loop is a thin wrapper on top.
+    """
     MAX_CONN_RETRIES = 5
     CONN_RETRY_DELAY = 2  # seconds
+    KEY_TIMEOUT = 30 # seconds to wait for the shared AES key after connecting
 
-    def __init__(self, name):
+    def __init__(self, name, host=SERVER_HOST, port=SERVER_PORT, on_message=None,
+                 trace_sample_rate=TRACE_SAMPLE_RATE, download_dir=None, on_file=None, compression=True,
+                 key_exchange=KEY_EXCHANGE, server_key=SERVER_KEY_FINGERPRINT, presence=False, url=SERVER_URL,
+                 message_mode=MESSAGE_MODE, accept_file=None, known_hosts=KNOWN_HOSTS, insecure_tofu=False):
         self.name = name
-        self.public_key, self.private_key = rsa_generate_keys(128)
+        self.host = host
+        self.port = port
+        self.url = url or transport.tcp_url(host, port)
+        transport.parse_url(self.url) # ValueError now rather than on connect
+        if key_exchange != 'rsa' and key_exchange not in DH_GROUPS:
+            raise ValueError(f"Unknown key exchange: {key_exchange}")
+        self.key_exchange = key_exchange
+        if message_mode not in (CTR_MODE, 'block'):
+            raise ValueError(f"Unknown message mode: {message_mode}")
+        self.message_mode = message_mode
+        self.ctr = False # the server accepted the CTR mode for this connection
+        self.keystream = None # Keystream of our messages under the current key (CTR mode)
+        # RSA: one keypair for the client's lifetime. DH: a fresh secret per connection, see connect_to_server
+        self.public_key, self.private_key = rsa_generate_keys(128) if key_exchange == 'rsa' else (None, None)
         self.server_connection = None # The persistent connection to the server
-        self.server_aes_key = None    # AES key shared with the server
-        self.lock = threading.Lock() # Protects shared resources like server_aes_key
+        self.server_key = server_key # fingerprint the server's signing key must have; set on first use if None
+        self.known_hosts = KnownHosts(known_hosts) if known_hosts else None # where first-use pins are kept
+        self.insecure_tofu = insecure_tofu # without server_key or known_hosts, trust the first key for this object only
+        self.key_frame = None # our last "key" frame, part of the transcript the server signs
+        self.handshake_error = None # why the last handshake was refused, if it was
+        self.retry_after = None # seconds the server asked us to wait when it turned the connection away
+        self.keys = None # KeyRing of the AES keys shared with the server, by epoch
+        self.sequencer = Sequencer() # record numbers of our messages and chunks, new per connection
+        self.replay = ReplayWindow() # record numbers seen from the server, new per connection
+        self.assembler = FrameAssembler() # large frames from the server arrive in fragments
+        self.lock = threading.Lock() # Protects shared resources like keys
+        self.send_lock = threading.Lock() # Keeps frames from concurrent senders from interleaving
+        self.key_ready = threading.Event() # Set once the shared AES key is stored
+        self.tracer = Tracer(trace_sample_rate, process_name=name)
+        self.metrics = MetricsRegistry() # client side counters (compression savings and cost)
+        self.compression = compression # offered in the handshake
+        self.compressor = None # set if the server accepted compression for this session
+        self.recv_prefix_at = None # When the length prefix of the last received frame arrived
+
+        # Received messages go to on_message(sender, payload, msg) if set, otherwise to the inbox
+        self.on_message = on_message
+        self.on_event = None # Called with every other frame from the server (stats, ...)
+
+        # Who is online: with presence=True the client subscribes after every handshake
+        self.presence = presence
+        self.roster = RosterCache()
+        self.on_presence = None # on_presence(added, removed) after every roster change
+        self.inbox = queue.Queue()
+
+        # File transfers: offers are accepted only if there is somewhere to put the files (and accept_file agrees)
+        self.file_receiver = FileReceiver(self, download_dir, on_file, accept_file) if download_dir else None
+        self.file_senders = {} # transfer_id -> FileSender of our outgoing transfers
+
+        log.info("Initializing", extra={"client": self.name})
+
+    def connect(self, timeout=KEY_TIMEOUT):
+        """Connects, performs the key handshake and starts the receiver thread.
+
+        Raises ConnectionError if the server can't be reached or the AES key doesn't arrive in time.
+        A server at its handshake limit answers "busy"; we wait the time it asks for and try again.
+        """
+        for attempt in range(self.MAX_CONN_RETRIES):
+            self.retry_after = None
+            self.key_ready.clear()
+            if not self.connect_to_server():
+                raise ConnectionError(f"Could not connect to server at {self.url}")
+
+            # Start a separate thread to continuously receive messages from the server
+            threading.Thread(target=self.receive_messages_from_server, daemon=True).start()
+
+            if not self.wait_for_server_aes_key(timeout):
+                self.close()
+                raise ConnectionError("Timed out waiting for the shared AES key from the server")
+            if self.retry_after is None:
+                break
+            self.close()
+            log.info("Server busy, retrying", extra={"client": self.name, "attempt": attempt + 1, "retry_after": self.retry_after})
+            time.sleep(self.retry_after)
+        else:
+            raise ConnectionError("Server busy, gave up connecting")
+        if self.handshake_error:
+            self.close()
+            raise ConnectionError(f"Server authentication failed: {self.handshake_error}")
+        if self.presence:
+            self.subscribe_presence()
+
+    def subscribe_presence(self):
+        """Asks for the roster changes since the version we have (the whole roster the first time)."""
+        return self.send_data_to_server({"type": "presence_subscribe", "from": self.name, "since": self.roster.version})
+
+    def send(self, target, payload: bytes, trace=None):
+        """Encrypts payload for target and writes it to the server without waiting for any reply.
+
+        Any number of sends may be in flight; returns False if the connection is gone.
+        """
+        if len(payload) > BLOCK_SIZE:
+            raise ValueError(f"Payload is {len(payload)} bytes, at most {BLOCK_SIZE} fit in a message")
+
+        epoch, aes_key = self.current_key()
+        if not aes_key:
+            log.warning("No shared AES key with server, cannot send", extra={"client": self.name})
+            return False
 
-        print(f"[{self.name}] Initializing...")
+        stream = self.keystream_for(epoch, aes_key)
+        encrypt_start = time.perf_counter()
+        if stream:
+            counter, ciphertext = stream.encrypt(payload.ljust(BLOCK_SIZE, b'\0'))
+        else:
+            ciphertext = aes_encryption(payload.ljust(BLOCK_SIZE, b'\0'), traffic_key(aes_key, CLIENT_TO_SERVER))
+        if trace:
+            trace.add("aes_encryption", encrypt_start, time.perf_counter())
+
+        message_payload = {
+            "type": "message",
+            "from": self.name,
+            "recipient": target, # Indicate final recipient to the server
+            "data": list(ciphertext),
+            "epoch": epoch
+        }
+        if stream:
+            message_payload["nonce"] = stream.nonce.hex()
+            message_payload["ctr"] = counter
+        if trace:
+            message_payload["trace_id"] = trace.trace_id
+        return self.send_data_to_server(message_payload, trace, record_key=aes_key)
+
+    def send_file(self, target, path, **kwargs):
+        """Streams the file at path to target, blocking until it is confirmed.
+
+        Returns True once the receiver has the whole file with a matching SHA-256. If the
+        transfer is interrupted, calling send_file again with the same file resumes it.
+        """
+        sender = FileSender(self, target, path, **kwargs)
+        self.file_senders[sender.transfer_id] = sender
+        try:
+            return sender.run()
+        finally:
+            self.file_senders.pop(sender.transfer_id, None)
+
+    def current_key(self):
+        """(epoch, key) to encrypt with, (None, None) before the handshake or after close()."""
+        with self.lock:
+            if not self.keys:
+                return None, None
+            return self.keys.epoch, self.keys.current
+
+    def keystream_for(self, epoch, key):
+        """Keystream for sending under (epoch, key) in the CTR mode, None to use the block mode.
+
+        There is one stream per epoch: the rekey notice (or the next send) replaces it with the
+        new epoch's. A send that picked its key just before a rekey gets None rather than a
+        second stream for the old epoch, which would repeat that stream's counters.
+        """
+        with self.lock:
+            if not self.ctr or not key:
+                return None
+            schedule = key_schedule(key)
+            cipher_key = schedule.traffic_key(CLIENT_TO_SERVER)
+            stream = self.keystream
+            if stream is None or stream.epoch < epoch:
+                stream = self.keystream = Keystream(AESKey(cipher_key), schedule.nonce(CLIENT_TO_SERVER), epoch)
+            elif stream.epoch > epoch or stream.cipher.key != cipher_key:
+                return None
+            return stream
+
+    def key_for(self, epoch):
+        """Key to decrypt a frame from the server encrypted under epoch.
+
+        A frame from a newer epoch than ours means the server rekeyed and its notice got
+        lost or is still behind, so we derive forward (at most MAX_EPOCH_JUMP epochs). The
+        key is not kept: open_record switches to that epoch once the frame's MAC checks out.
+        """
+        with self.lock:
+            return self.keys.peek(epoch) if self.keys else None
+
+    def advance_key(self, epoch):
+        """Switches to a newer key epoch of the server. False if it is too far ahead to be real."""
+        with self.lock:
+            return bool(self.keys) and self.keys.advance_to(epoch)
+
+    def messages(self, timeout=None):
+        """Yields (sender, payload) for received messages until the connection closes.
+
+        Only used when no on_message callback is set. With a timeout, stops after that many
+        idle seconds.
+        """
+        while True:
+            try:
+                item = self.inbox.get(timeout=timeout)
+            except queue.Empty:
+                return
+            if item is None:
+                return
+            yield item
+
+    def close(self):
+        """Closes the connection to the server; the receiver thread and messages() stop."""
+        with self.lock:
+            conn = self.server_connection
+            self.server_connection = None
+            self.keys = None
+            self.keystream = None
+        if conn:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
 
     def start(self):
-        """Starts the client: connects to server, exchanges keys, and starts CLI."""
-        self.connect_to_server()
-        if not self.server_connection:
-            print(f"[{self.name}] Failed to connect to server. Exiting.")
+        """Starts the interactive client: connects to server, exchanges keys, and starts CLI."""
+        self.on_message = self.print_message
+        self.on_event = self.print_event
+        self.presence = True
+        if self.file_receiver:
+            self.file_receiver.on_file = self.print_file
+        try:
+            self.connect()
+        except ConnectionError as e:
+            print(f"[{self.name}] {e}. Exiting.")
             sys.exit(1)
-
-        # Start a separate thread to continuously receive messages from the server
-        threading.Thread(target=self.receive_messages_from_server, daemon=True).start()
-
-        # Wait for the AES key from the server
-        self.wait_for_server_aes_key()
-
+        print(f"[{self.name}] Shared AES key with server established!")
         self.cli_loop()
 
     def connect_to_server(self):
         """Establishes and maintains the connection to the SecureServer."""
-        print(f"[{self.name}] Connecting to server at {SERVER_HOST}:{SERVER_PORT}...")
+        log.info("Connecting to server", extra={"client": self.name, "url": self.url})
         for attempt in range(self.MAX_CONN_RETRIES):
+            sock = None
             try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(5.0) # Set a timeout for connection
-                sock.connect((SERVER_HOST, SERVER_PORT))
-                sock.settimeout(None) # Remove timeout after connection
+                sock = transport.connect(self.url, timeout=5.0) # the timeout covers the connect only
+                self.sequencer = Sequencer()
+                self.replay = ReplayWindow()
+                self.assembler = FrameAssembler()
+                self.ctr = False
 
                 self.server_connection = sock
-                print(f"[{self.name}] Successfully connected to server on attempt {attempt + 1}.")
-
-                # Send public key to server immediately
-                self.send_data_to_server({
-                    "type": "key",
-                    "from": self.name,
-                    "data": list(self.public_key)
-                })
-                print(f"[{self.name}] Sent public key to server.")
+                log.info("Connected to server", extra={"client": self.name, "attempt": attempt + 1})
+
+                # Send public key to server immediately, with the compression we can do
+                if self.key_exchange == 'rsa':
+                    key_frame = {
+                        "type": "key",
+                        "from": self.name,
+                        "data": list(self.public_key)
+                    }
+                else:
+                    self.public_key, self.private_key = dh_generate_keys(self.key_exchange)
+                    key_frame = {
+                        "type": "key",
+                        "from": self.name,
+                        "kex": self.key_exchange,
+                        "data": format(self.public_key, 'x')
+                    }
+                if self.compression:
+                    key_frame["compression"] = compression_supported()
+                if self.message_mode == CTR_MODE:
+                    key_frame["message_mode"] = CTR_MODE
+                key_frame["nonce"] = secrets.token_hex(16) # makes the signed transcript unique to this connection
+                self.key_frame = key_frame
+                self.handshake_error = None
+                self.send_data_to_server(key_frame)
+                log.info("Sent public key to server", extra={"client": self.name})
                 return True
             except (ConnectionRefusedError, socket.timeout, OSError) as e:
-                print(f"[{self.name}] Connection to server failed on attempt {attempt + 1}/{self.MAX_CONN_RETRIES}: {e}")
-                sock.close()
+                log.warning("Connection to server failed", extra={"client": self.name, "attempt": attempt + 1, "error": e})
+                if sock:
+                    sock.close()
                 if attempt < self.MAX_CONN_RETRIES - 1:
-                    print(f"[{self.name}] Retrying in {self.CONN_RETRY_DELAY} seconds...")
                     time.sleep(self.CONN_RETRY_DELAY)
                 else:
-                    print(f"[{self.name}] Failed to connect to server after {self.MAX_CONN_RETRIES} attempts.")
+                    log.error("Giving up connecting to server", extra={"client": self.name, "attempts": self.MAX_CONN_RETRIES})
                     return False
             except Exception as e:
-                print(f"[{self.name}] Unexpected error connecting to server: {e}")
-                sock.close()
+                log.error("Unexpected error connecting to server", extra={"client": self.name, "error": e})
+                if sock:
+                    sock.close()
                 return False
 
+    @staticmethod
+    def recv_exact(conn, size):
+        data = b''
+        while len(data) < size:
+            packet = conn.recv(size - len(data))
+            if not packet:
+                return None
+            data += packet
+        return data
+
     def recv_full(self, conn):
-        """Helper to receive a full message given its length prefix."""
+        """Helper to receive a full message given its length prefix, reassembling fragmented frames."""
         try:
-            raw_len = conn.recv(4)
-            if not raw_len: return None
-            msg_len = int.from_bytes(raw_len, 'big')
-            data = b''
-            conn.settimeout(10.0) # Longer timeout for server
-            while len(data) < msg_len:
-                packet = conn.recv(msg_len - len(data))
-                if not packet:
-                    conn.settimeout(None)
+            while True:
+                raw_len = self.recv_exact(conn, 4)
+                if not raw_len: return None
+                self.recv_prefix_at = time.perf_counter()
+                prefix = int.from_bytes(raw_len, 'big')
+                data = self.recv_exact(conn, prefix & LENGTH_MASK)
+                if data is None:
                     return None
-                data += packet
-            conn.settimeout(None)
-            return data
-        except socket.timeout:
-            return None
+                frame = self.assembler.feed(prefix, data)
+                if frame is not None:
+                    return frame
         except Exception as e:
-            print(f"[{self.name}] Error in recv_full from server: {e}")
+            if self.server_connection:
+                log.warning("Error in recv_full from server", extra={"client": self.name, "error": e})
             return None
 
-    def send_data_to_server(self, data):
-        """Sends JSON data to the server over the persistent connection."""
-        if not self.server_connection:
-            print(f"[{self.name}] No active connection to server. Cannot send data.")
+    def send_data_to_server(self, data, trace=None, record_key=None):
+        """Sends JSON data to the server over the persistent connection.
+
+        With record_key (the AES key data was encrypted with) the frame is numbered and MACed
+        by the record layer first.
+        """
+        conn = self.server_connection
+        if not conn:
+            log.warning("No active connection to server, cannot send data", extra={"client": self.name})
             return False
         try:
+            if record_key:
+                with self.lock:
+                    self.sequencer.seal(data, record_key, CLIENT_TO_SERVER)
             message_bytes = json.dumps(data).encode('utf-8')
             msg_len_bytes = len(message_bytes).to_bytes(4, 'big')
-            self.server_connection.sendall(msg_len_bytes + message_bytes)
+            send_start = time.perf_counter()
+            with self.send_lock:
+                conn.sendall(msg_len_bytes + message_bytes)
+            if trace:
+                trace.add("sendall", send_start, time.perf_counter())
             return True
         except Exception as e:
-            print(f"[{self.name}] Error sending data to server: {e}")
-            self.server_connection.close()
-            self.server_connection = None
-            self.server_aes_key = None # Invalidate key on connection loss
-            print(f"[{self.name}] Server connection lost. Please restart client.")
+            log.error("Error sending data to server, connection lost", extra={"client": self.name, "error": e})
+            self.close() # Invalidates the key as well
             return False
 
     def receive_messages_from_server(self):
@@ -123,85 +389,277 @@ class SecureClient:
         while self.server_connection:
             try:
                 data = self.recv_full(self.server_connection)
+                received_at = time.perf_counter()
                 if not data:
-                    print(f"[{self.name}] Server disconnected.")
-                    with self.lock:
-                        if self.server_connection:
-                            self.server_connection.close()
-                            self.server_connection = None
-                            self.server_aes_key = None
-                    print(f"[{self.name}] Server connection lost. Please restart client.")
+                    if self.server_connection:
+                        log.warning("Server disconnected", extra={"client": self.name})
+                    self.close()
                     break # Exit thread
 
                 try:
                     msg = json.loads(data.decode())
                 except json.JSONDecodeError:
-                    print(f"[{self.name}] Received malformed JSON from server.")
+                    log.warning("Received malformed JSON from server", extra={"client": self.name})
                     continue
 
                 msg_type = msg.get("type")
+                trace = self.tracer.begin("client.receive", msg.get("trace_id"))
+                if trace:
+                    trace.add("recv_full", self.recv_prefix_at, received_at)
+                    trace.add("json.loads", received_at, time.perf_counter())
 
                 if msg_type == "shared_aes_offer":
                     sender_name = msg.get("from")
                     encrypted_shared_aes = msg["data"]
                     if sender_name == "server": # Expecting AES key from server
+                        if not self.authenticate_server(msg):
+                            self.key_ready.set() # connect() reports handshake_error
+                            break
                         try:
-                            decrypted_shared_aes_bytes = bytes(
-                                [rsa_decrypt(c, self.private_key) for c in encrypted_shared_aes])
+                            if self.key_exchange == 'rsa':
+                                decrypted_shared_aes_bytes = bytes(
+                                    [rsa_decrypt(c, self.private_key) for c in encrypted_shared_aes])
+                            else:
+                                decrypted_shared_aes_bytes = self.derive_dh_key(msg)
                             with self.lock:
-                                self.server_aes_key = decrypted_shared_aes_bytes
-                            print(f"[{self.name}] Received and stored shared AES key from server.")
+                                self.keys = KeyRing(decrypted_shared_aes_bytes)
+                                if self.compression and msg.get("compression"):
+                                    self.compressor = Compressor(msg["compression"], self.metrics)
+                                self.ctr = self.message_mode == CTR_MODE and msg.get("message_mode") == CTR_MODE
+                            self.keystream_for(0, decrypted_shared_aes_bytes) # filled before the first send
+                            self.key_ready.set()
+                            log.info("Received and stored shared AES key from server", extra={"client": self.name})
                         except Exception as e:
-                            print(f"[{self.name}] Failed to decrypt/store shared AES key from server: {e}")
+                            log.error("Failed to decrypt/store shared AES key from server", extra={"client": self.name, "error": e})
                     else:
-                        print(f"[{self.name}] Unexpected AES offer from {sender_name}. Discarding.")
+                        log.warning("Unexpected AES offer, discarding", extra={"client": self.name, "sender": sender_name})
+
+                elif msg_type == "busy":
+                    # Handshake admission turned us away; connect() waits and tries again. No
+                    # end-of-inbox marker: this connection never got to deliver anything
+                    self.retry_after = min(float(msg.get("retry_after", self.CONN_RETRY_DELAY)), self.CONN_RETRY_DELAY * 5)
+                    self.key_ready.set()
+                    return
 
                 elif msg_type == "message":
-                    sender = msg.get("from")
-                    recipient = msg.get("recipient")
-                    ciphertext = bytes(msg["data"])
-
-                    with self.lock:
-                        if not self.server_aes_key:
-                            print(f"[{self.name}] No SHARED AES key with server yet. Cannot decrypt message from {sender}")
-                            continue
-                        try:
-                            plaintext_padded = aes_decryption(ciphertext, self.server_aes_key)
-                            plaintext_str = plaintext_padded.decode('utf-8', errors='replace').rstrip('\x00')
-                            print(f"\n[{self.name}] Encrypted message from {sender} (for {recipient or self.name}): '{plaintext_str}'\n> ", end='')
-                        except Exception as e:
-                            print(f"\n[{self.name}] Error decrypting/decoding message from {sender}: {e}\n> ", end='')
+                    if self.open_record(msg):
+                        self.handle_message(msg, trace)
+
+                elif msg_type == "rekey":
+                    # Next key derived locally; frames still in flight keep using the older epochs
+                    if self.open_rekey(msg):
+                        self.keystream_for(*self.current_key()) # the new epoch's stream fills before it is needed
+                        self.send_data_to_server({"type": "rekey_ack", "from": self.name, "epoch": msg["epoch"]})
+
+                elif msg_type == "ping":
+                    # Server heartbeat: we have been quiet, show that we are still here
+                    self.send_data_to_server({"type": "pong", "from": self.name})
+
+                elif msg_type == "pong":
+                    pass
+
+                elif msg_type == "presence":
+                    if not self.roster.apply(msg):
+                        log.info("Missed a presence delta, subscribing again", extra={"client": self.name})
+                        self.subscribe_presence()
+                    elif self.on_presence and any(self.roster.changes):
+                        self.on_presence(*self.roster.changes)
+
+                elif msg_type in ("file_offer", "file_chunk"):
+                    if msg_type == "file_chunk" and not self.open_record(msg):
+                        pass
+                    elif self.file_receiver:
+                        self.file_receiver.on_frame(msg)
+                    else:
+                        self.send_data_to_server({"type": "file_error", "from": self.name, "recipient": msg.get("from"),
+                                                  "transfer_id": msg.get("transfer_id"), "reason": "not accepting files"})
+
+                elif msg_type in ("file_accept", "file_ack", "file_error"):
+                    sender = self.file_senders.get(msg.get("transfer_id"))
+                    if sender:
+                        sender.on_frame(msg)
+
+                elif self.on_event:
+                    self.on_event(msg)
 
                 else:
-                    print(f"[{self.name}] Unknown message type from server: {msg_type}")
+                    log.warning("Unknown message type from server", extra={"client": self.name, "type": msg_type})
+
+                self.tracer.finish(trace)
 
             except Exception as e:
-                print(f"[{self.name}] Error in receive_messages_from_server: {e}")
-                break # Break loop if error occurs
+                # recv_full turns connection errors into None above; anything here is one bad frame
+                log.error("Error handling frame from server, frame skipped", extra={"client": self.name, "error": e},
+                          exc_info=True)
+                continue
 
+        self.inbox.put(None) # Ends messages() iterators
 
-    def wait_for_server_aes_key(self):
-        """Pauses execution until the AES key with the server is established."""
-        print(f"[{self.name}] Waiting for AES key from server...")
-        while True:
-            with self.lock:
-                if self.server_aes_key:
-                    break
-            print(f"[{self.name}] Still waiting for AES key from server...")
-            time.sleep(1)
-        print(f"[{self.name}] Shared AES key with server established!")
+    def authenticate_server(self, offer):
+        """Checks the server's signature over this handshake and its key against the pinned one.
+
+        Without a pinned key the server's URL is looked up in known_hosts; a server seen for the
+        first time gets its key pinned there. With neither, the key is only trusted if the client
+        was created with insecure_tofu=True.
+        """
+        pinned = self.server_key or (self.known_hosts.lookup(self.url) if self.known_hosts else None)
+        try:
+            with self.metrics.time('verify_seconds'):
+                server_key = VERIFICATION_CACHE.verify(self.name, self.key_frame, offer, pinned)
+            if not pinned:
+                if self.known_hosts:
+                    if self.known_hosts.pin(self.url, server_key) != server_key:
+                        raise ValueError("Another key was pinned for this server meanwhile")
+                    log.warning("New server, key pinned", extra={"client": self.name, "fingerprint": server_key,
+                                                                 "path": self.known_hosts.path})
+                elif self.insecure_tofu:
+                    log.warning("Server key not pinned, trusting it from now on", extra={"client": self.name, "fingerprint": server_key})
+                else:
+                    raise ValueError("Server key not pinned: pass server_key, known_hosts or insecure_tofu=True")
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            log.error("Server authentication failed", extra={"client": self.name, "error": e})
+            self.handshake_error = str(e)
+            return False
+        self.server_key = server_key
+        return True
+
+    def derive_dh_key(self, offer):
+        """Session key from the server's DH value; the secret is dropped right after (forward secrecy)."""
+        if offer.get("kex") != self.key_exchange:
+            raise ValueError(f"Server answered with key exchange {offer.get('kex')}, expected {self.key_exchange}")
+        server_public = int(offer["data"], 16)
+        shared = dh_shared_secret(self.key_exchange, server_public, self.private_key)
+        key = dh_derive_key(self.key_exchange, shared, self.public_key, server_public)
+        self.private_key = None
+        return key
+
+    def open_record(self, msg):
+        """Replay window and MAC of a message or file chunk from the server, before any AES work.
+
+        A frame from a newer epoch moves the key ring on only once its MAC is verified.
+        """
+        epoch = msg.get("epoch", 0)
+        key = self.key_for(epoch)
+        if not key:
+            return True # handle_message / the file receiver report the missing key
+        reason = self.replay.open(msg, key, SERVER_TO_CLIENT)
+        if reason:
+            log.warning("Record rejected", extra={"client": self.name, "reason": reason, "seq": msg.get("seq")})
+            self.metrics.inc(f'drops_total{{reason="{reason}"}}')
+            return False
+        self.advance_key(epoch)
+        return True
+
+    def open_rekey(self, msg):
+        """Checks a rekey notice and switches to the epoch it announces. False if it was dropped.
+
+        The server seals notices under the key of the epoch before the announced one, so only
+        a notice whose MAC checks out moves the key ring.
+        """
+        epoch = msg.get("epoch")
+        key = self.key_for(epoch - 1) if isinstance(epoch, int) and not isinstance(epoch, bool) and epoch > 0 else None
+        reason = self.replay.open(msg, key, SERVER_TO_CLIENT) if key else "stale_epoch"
+        if not reason and not self.advance_key(epoch):
+            reason = "stale_epoch"
+        if reason:
+            log.warning("Rekey notice rejected", extra={"client": self.name, "reason": reason, "epoch": epoch})
+            self.metrics.inc(f'drops_total{{reason="{reason}"}}')
+            return False
+        return True
 
+    def handle_message(self, msg, trace=None):
+        """Decrypts a relayed message and hands it to on_message or the inbox."""
+        sender = msg.get("from")
+        ciphertext = bytes(msg["data"])
+
+        aes_key = self.key_for(msg.get("epoch", 0))
+        if not aes_key:
+            log.warning("No AES key for this message, cannot decrypt", extra={"client": self.name, "sender": sender, "epoch": msg.get("epoch")})
+            return
+        try:
+            decrypt_start = time.perf_counter()
+            if "ctr" in msg:
+                payload = decrypt_ctr(AESKey(traffic_key(aes_key, SERVER_TO_CLIENT)), msg).rstrip(b'\0')
+            else:
+                payload = aes_decryption(ciphertext, traffic_key(aes_key, SERVER_TO_CLIENT)).rstrip(b'\0')
+            if trace:
+                trace.add("aes_decryption", decrypt_start, time.perf_counter())
+        except Exception as e:
+            log.warning("Error decrypting message", extra={"client": self.name, "sender": sender, "error": e})
+            return
+
+        if self.on_message:
+            self.on_message(sender, payload, msg)
+        else:
+            self.inbox.put((sender, payload))
+
+        # Messages queued while we were offline must be acknowledged so the server can drop them
+        if "offline_seq" in msg:
+            self.send_data_to_server({
+                "type": "offline_ack",
+                "from": self.name,
+                "seq": msg["offline_seq"]
+            })
+
+    def wait_for_server_aes_key(self, timeout=None):
+        """Pauses execution until the AES key with the server is established. Returns False on timeout."""
+        log.info("Waiting for AES key from server", extra={"client": self.name})
+        return self.key_ready.wait(timeout)
+
+    def print_message(self, sender, payload, msg):
+        plaintext_str = payload.decode('utf-8', errors='replace')
+        print(f"\n[{self.name}] Encrypted message from {sender} (for {msg.get('recipient') or self.name}): '{plaintext_str}'\n> ", end='')
+
+    def print_file(self, sender, path, ok):
+        status = "saved to" if ok else "failed checksum, discarded"
+        print(f"\n[{self.name}] File from {sender} {status} {path}\n> ", end='')
+
+    def send_file_in_background(self, target, path):
+        def transfer():
+            ok = self.send_file(target, path)
+            print(f"\n[{self.name}] File transfer of {path} to {target} {'finished' if ok else 'failed'}.\n> ", end='')
+        threading.Thread(target=transfer, daemon=True).start()
+
+    def print_event(self, msg):
+        if msg.get("type") == "stats":
+            print(f"\n[{self.name}] Server stats: {json.dumps(msg.get('data'), indent=2)}\n> ", end='')
+        else:
+            print(f"\n[{self.name}] Unknown message type from server: {msg.get('type')}\n> ", end='')
 
     def cli_loop(self):
-        print(f"[{self.name}] Ready. Known peers (via server): {CLIENT_NAMES}")
+        print(f"[{self.name}] Ready. Type /who for the clients online.")
         while True:
             try:
                 command = input("> ").strip()
                 if command.lower() in ['quit', 'exit']:
                     print(f"[{self.name}] Exiting...")
-                    if self.server_connection:
-                        self.server_connection.close() # Close connection cleanly
+                    self.close() # Close connection cleanly
                     break
+                if command.lower() == '/who':
+                    print(f"[{self.name}] Online ({len(self.roster)}): {', '.join(self.roster)}")
+                    continue
+                if command.lower() == '/stats':
+                    self.send_data_to_server({"type": "stats", "from": self.name})
+                    continue
+                if command.lower() == '/trace':
+                    trace_file = f"{self.name}_trace.json"
+                    events = self.tracer.export_chrome(trace_file)
+                    print(f"[{self.name}] Wrote {events} trace events to {trace_file}.")
+                    self.send_data_to_server({"type": "trace_dump", "from": self.name})
+                    continue
+                if command.lower().startswith('/profile'):
+                    profile_args = command.split()
+                    messages = int(profile_args[1]) if len(profile_args) > 1 else 1000
+                    self.send_data_to_server({"type": "profile", "from": self.name, "messages": messages})
+                    continue
+                if command.lower().startswith('/sendfile'):
+                    file_args = command.split(" ", 2)
+                    if len(file_args) != 3 or not os.path.isfile(file_args[2]):
+                        print("Usage: /sendfile <target_client> <path to an existing file>")
+                        continue
+                    self.send_file_in_background(file_args[1], file_args[2])
+                    print(f"[{self.name}] Sending {file_args[2]} to {file_args[1]}...")
+                    continue
                 parts = command.split(" ", 1)
                 if len(parts) != 2:
                     print("Usage: <target_client> <message>")
@@ -209,47 +667,26 @@ class SecureClient:
 
                 target, msg_text = parts
                 if target == self.name: print("Can't send to self."); continue
-                if target not in CLIENT_NAMES: print(f"Unknown target: {target}. Known: {CLIENT_NAMES}"); continue
-
-                with self.lock:
-                    if not self.server_aes_key:
-                        print(f"[{self.name}] No SHARED AES key with server. Cannot send.")
-                        continue
+                if target not in self.roster:
+                    # Offline (or mistyped): the server keeps messages for names it does not see online
+                    print(f"[{self.name}] {target} is not online; sending anyway, the server queues it if it keeps an offline store.")
 
                 msg_bytes = msg_text.encode("utf-8")
-                block_size = 16
-                msg_bytes_padded = msg_bytes.ljust(block_size, b'\0')
-
-                with self.lock:
-                    ciphertext = aes_encryption(msg_bytes_padded, self.server_aes_key)
-
-                message_payload = {
-                    "type": "message",
-                    "from": self.name,
-                    "recipient": target, # Indicate final recipient to the server
-                    "data": list(ciphertext)
-                }
+                if len(msg_bytes) > BLOCK_SIZE:
+                    print(f"Message too long: at most {BLOCK_SIZE} bytes.")
+                    continue
 
-                if self.send_data_to_server(message_payload):
+                trace = self.tracer.begin("client.send")
+                sent = self.send(target, msg_bytes, trace)
+                self.tracer.finish(trace)
+                if sent:
                     print(f"[{self.name}] Sent AES-encrypted message to server for {target}")
                 else:
                     print(f"[{self.name}] Failed to send message to server.")
 
             except KeyboardInterrupt:
                 print(f"\n[{self.name}] Exiting...")
-                if self.server_connection:
-                    self.server_connection.close()
+                self.close()
                 break
             except Exception as e:
                 print(f"[{self.name}] Error in CLI loop: {e}")
-
-
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python client.py <client1|client2|client3>")
-        sys.exit(1)
-    client_name_arg = sys.argv[1]
-    if client_name_arg not in CLIENT_NAMES:
-        print(f"Unknown client: {client_name_arg}. Choose from: {CLIENT_NAMES}")
-        sys.exit(1)
-    SecureClient(client_name_arg).start()
\ No newline at end of file
@@ -0,0 +1,173 @@
+"""
+Opt-in per-message tracing and profiling windows.
+
+A Tracer samples messages at a configurable rate. A sampled message gets a Trace with a
+trace id (propagated in the frame as "trace_id") and one timestamped span per stage
+(recv_full, json.loads, lock wait, aes_decryption, sendall...). Traces are exported in the
+Chrome trace-event format, which chrome://tracing and Perfetto can open.
+
+When tracing is disabled, begin() returns None and call sites only pay an `if trace:` check.
+"""
+
+import collections
+import json
+import os
+import random
+import secrets
+import threading
+import time
+
+
+class Trace:
+    __slots__ = ('trace_id', 'name', 'spans')
+
+    def __init__(self, trace_id, name):
+        self.trace_id = trace_id
+        self.name = name
+        self.spans = []  # (stage, start, end, thread id) with perf_counter timestamps
+
+    def add(self, stage, start, end):
+        self.spans.append((stage, start, end, threading.get_ident()))
+
+
+class Tracer:
+    def __init__(self, sample_rate=0.0, process_name='p2p', max_traces=10000):
+        self.sample_rate = sample_rate
+        self.process_name = process_name
+        self.traces = collections.deque(maxlen=max_traces)
+        # perf_counter is only meaningful inside a process; anchor it to the wall clock so
+        # server and client traces can be loaded side by side
+        self._epoch_offset = time.time() - time.perf_counter()
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+
+    def begin(self, name, trace_id=None):
+        """Starts a trace for one message, or returns None when it is not sampled.
+
+        A trace_id coming from the peer is always honoured so both ends record the same message.
+        """
+        if trace_id is None:
+            if self.sample_rate <= 0 or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+                return None
+            trace_id = secrets.token_hex(8)
+        elif self.sample_rate <= 0:
+            return None
+        return Trace(trace_id, name)
+
+    def finish(self, trace):
+        if trace is not None and trace.spans:
+            self.traces.append(trace)
+
+    def chrome_events(self):
+        pid = os.getpid()
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": self.process_name}}]
+        for trace in list(self.traces):
+            for stage, start, end, tid in trace.spans:
+                events.append({
+                    "name": stage,
+                    "cat": trace.name,
+                    "ph": "X",
+                    "ts": (start + self._epoch_offset) * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"trace_id": trace.trace_id},
+                })
+        return events
+
+    def export_chrome(self, path):
+        """Writes every collected trace to path as Chrome trace-event JSON and returns the event count."""
+        events = self.chrome_events()
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return len(events)
+
+
+class ProfileWindow:
+    """Wraps the handling of the next N messages in cProfile and dumps the merged stats.
+
+    cProfile only sees the thread that enabled it, so every handler thread profiles its own
+    message inside section() and the per-thread results are merged when the window closes.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.lock = threading.Lock()
+        self.remaining = 0
+        self.output_path = None
+        self.profiles = []
+        self._local = threading.local()
+
+    def open(self, messages, output_path):
+        with self.lock:
+            self.remaining = messages
+            self.output_path = output_path
+            self.profiles = []
+            self.active = messages > 0
+
+    def section(self):
+        """Context manager around the processing of one message; a no-op when no window is open."""
+        if not self.active:
+            return _NULL_SECTION
+        return _ProfiledSection(self)
+
+    def _thread_profile(self):
+        profile = getattr(self._local, 'profile', None)
+        if profile is None or getattr(self._local, 'generation', None) is not self.profiles:
+            import cProfile # imported when a window is opened, not by every process that imports tracing
+            profile = self._local.profile = cProfile.Profile()
+            self._local.generation = self.profiles
+            with self.lock:
+                self.profiles.append(profile)
+        return profile
+
+    def _message_done(self):
+        with self.lock:
+            if not self.active:
+                return
+            self.remaining -= 1
+            if self.remaining > 0:
+                return
+            self.active = False
+            profiles, path = self.profiles, self.output_path
+        import pstats
+        stats = None
+        for profile in profiles:
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        if stats is not None:
+            stats.dump_stats(path)
+
+
+class _NullSection:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SECTION = _NullSection()
+
+
+class _ProfiledSection:
+    __slots__ = ('window', 'profile')
+
+    def __init__(self, window):
+        self.window = window
+        self.profile = window._thread_profile()
+
+    def __enter__(self):
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.disable()
+        self.window._message_done()
+        return False
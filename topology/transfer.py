@@ -0,0 +1,416 @@
+"""
+Chunked, resumable file transfer between clients, relayed by the server.
+
+The sender streams the file from disk in CHUNK_SIZE pieces. Every chunk is encrypted with
+AES-CTR under the traffic key of its hop and direction (topology.keyschedule) and a fresh
+random nonce; the server decrypts it and re-encrypts it for the recipient, like it does for
+messages. At most `window` chunks are unacknowledged at a time. Acks are cumulative ("next
+chunk I need"), and a window that makes no progress for `retransmit_timeout` seconds is sent
+again from the oldest unacked chunk.
+
+The receiver writes chunks in order straight into "<name>.part"; every SYNC_EVERY chunks it
+fsyncs the part file and records the next chunk index in "<name>.part.json". A finished file
+never replaces an existing one: it is saved as "<stem> (1)<ext>", "<stem> (2)<ext>"... instead. The transfer id is derived from the
+file contents, so offering the same file again after an interruption resumes from the last
+acknowledged chunk instead of starting over.
+
+Frames (all with "from", "recipient" and "transfer_id"):
+    file_offer   sender -> recipient   name, size, chunk_size, sha256
+    file_accept  recipient -> sender   resume_from
+    file_chunk   sender -> recipient   index, nonce (hex), data (base64 AES-CTR ciphertext),
+                                       compressed + size when the chunk was compressed first
+    file_ack     recipient -> sender   next (first chunk not yet written), done, ok
+    file_error   server or peer        reason
+
+Chunks also carry the "seq" and "mac" of the record layer (topology.record), set per hop.
+"""
+
+import base64
+import hashlib
+import itertools
+import json
+import os
+import secrets
+import threading
+
+from aes.aes_ctr import aes_ctr, NONCE_SIZE
+from topology.log import get_logger
+from topology.keyschedule import traffic_key
+from topology.record import CLIENT_TO_SERVER, SERVER_TO_CLIENT
+
+CHUNK_SIZE = 32 * 1024 # bytes of file data per chunk frame
+WINDOW = 8 # chunks in flight; keep window * chunk frame size under the server's outbound watermark
+RETRANSMIT_TIMEOUT = 10.0 # seconds without an ack before the window is sent again
+MAX_RETRANSMITS = 5 # consecutive timeouts before the transfer is abandoned
+DUPLICATE_ACKS = 3 # repeated acks for the same chunk that trigger a retransmit without waiting for the timeout
+HASH_BLOCK = 1024 * 1024 # read size when hashing a file
+SYNC_EVERY = 16 # chunks written between two fsyncs of a part file (and of its resume state)
+MAX_CHUNK_SIZE = 512 * 1024 # largest chunk_size accepted in an offer; a chunk frame must stay under the server's MAX_FRAME
+MAX_CHUNKS = 1 << 32 # most chunks an offered file may have, so size is bounded by size <= chunk_size * MAX_CHUNKS
+
+log = get_logger('transfer')
+
+
+def file_sha256(path):
+    """Hex SHA-256 of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def encrypt_chunk(data, key):
+    """Returns (nonce hex, base64 ciphertext) for one chunk, with a fresh nonce."""
+    nonce = secrets.token_bytes(NONCE_SIZE)
+    return nonce.hex(), base64.b64encode(aes_ctr(data, key, nonce)).decode('ascii')
+
+
+def decrypt_chunk(msg, key, limit=None):
+    """Plaintext of a file_chunk frame. ValueError/KeyError/TypeError for a malformed one; limit bounds the ciphertext."""
+    nonce = bytes.fromhex(msg["nonce"])
+    if len(nonce) != NONCE_SIZE:
+        raise ValueError("Bad nonce in file_chunk frame")
+    data = base64.b64decode(msg["data"], validate=True)
+    if limit is not None and len(data) > limit:
+        raise ValueError("file_chunk larger than its chunk_size")
+    return aes_ctr(data, key, nonce)
+
+
+def chunk_count(size, chunk_size):
+    return (size + chunk_size - 1) // chunk_size
+
+
+def peer_int(msg, field, low, high):
+    """Integer field of a frame from a peer, checked to be in [low, high]. ValueError otherwise."""
+    value = msg.get(field)
+    if not isinstance(value, int) or isinstance(value, bool) or not low <= value <= high:
+        raise ValueError(f"Bad {field!r} in {msg.get('type')} frame: {value!r}")
+    return value
+
+
+def peer_str(msg, field):
+    value = msg.get(field)
+    if not isinstance(value, str) or not value:
+        raise ValueError(f"Bad {field!r} in {msg.get('type')} frame")
+    return value
+
+
+class FileSender:
+    """Sends one file to `target` through `client` (a connected SecureClient)."""
+
+    def __init__(self, client, target, path, chunk_size=CHUNK_SIZE, window=WINDOW,
+                 retransmit_timeout=RETRANSMIT_TIMEOUT):
+        self.client = client
+        self.target = target
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = os.path.getsize(path)
+        self.chunk_size = chunk_size
+        self.window = window
+        self.retransmit_timeout = retransmit_timeout
+        self.total = chunk_count(self.size, chunk_size)
+        self.sha256 = file_sha256(path)
+        # Same file, same name, same recipient -> same id, which is what makes resuming work
+        self.transfer_id = hashlib.sha256(
+            f"{self.sha256}:{self.name}:{client.name}:{target}:{chunk_size}".encode()).hexdigest()[:32]
+
+        self.cond = threading.Condition()
+        self.acked = None # next chunk the receiver needs; None until the offer is accepted
+        self.ok = None # receiver's verdict once the last chunk is written
+        self.error = None
+        self.retransmits = 0
+        self.duplicate_acks = 0
+        self.fast_retransmit = False # set by on_frame, the run loop goes back to acked
+
+    def frame(self, frame_type, **fields):
+        return {"type": frame_type, "from": self.client.name, "recipient": self.target,
+                "transfer_id": self.transfer_id, **fields}
+
+    def run(self):
+        """Blocks until the receiver confirmed the whole file. Returns True if its SHA-256 matched."""
+        self.client.send_data_to_server(self.frame(
+            "file_offer", name=self.name, size=self.size, chunk_size=self.chunk_size, sha256=self.sha256))
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.acked is not None or self.error, self.retransmit_timeout):
+                self.error = "offer not answered"
+            if self.error:
+                log.warning("File transfer failed", extra={"transfer": self.transfer_id, "error": self.error})
+                return False
+            resumed_from = self.acked
+        if resumed_from:
+            log.info("Resuming file transfer", extra={"transfer": self.transfer_id, "chunk": resumed_from})
+
+        next_to_send = resumed_from
+        with open(self.path, 'rb') as f:
+            while True:
+                with self.cond:
+                    if self.error or self.ok is not None:
+                        break
+                    acked = self.acked
+                    if self.fast_retransmit:
+                        # A chunk was lost (or could not be decrypted) and the ones after it keep being
+                        # answered with the same ack: send from the gap instead of waiting for the timeout
+                        self.fast_retransmit = False
+                        log.info("Fast retransmit", extra={"transfer": self.transfer_id, "chunk": acked})
+                        next_to_send = acked
+                while next_to_send < self.total and next_to_send < acked + self.window:
+                    if not self.send_chunk(f, next_to_send):
+                        with self.cond:
+                            self.error = "connection lost"
+                        break
+                    next_to_send += 1
+
+                with self.cond:
+                    progressed = self.cond.wait_for(
+                        lambda: self.acked != acked or self.fast_retransmit or self.error or self.ok is not None,
+                        self.retransmit_timeout)
+                    if progressed:
+                        self.retransmits = 0
+                        continue
+                    self.retransmits += 1
+                    if self.retransmits > MAX_RETRANSMITS:
+                        self.error = "receiver stopped acknowledging"
+                        continue
+                    # Go back N: everything after the last cumulative ack is sent again
+                    log.info("Retransmitting window", extra={"transfer": self.transfer_id, "chunk": self.acked})
+                    next_to_send = self.acked
+
+        if self.error:
+            log.warning("File transfer failed", extra={"transfer": self.transfer_id, "error": self.error})
+            return False
+        return self.ok
+
+    def send_chunk(self, f, index):
+        epoch, key = self.client.current_key()
+        if not key:
+            return False
+        f.seek(index * self.chunk_size)
+        chunk = f.read(self.chunk_size)
+        fields = {}
+        compressor = self.client.compressor
+        if compressor:
+            payload, compressed = compressor.compress(chunk)
+            if compressed:
+                fields = {"compressed": True, "size": len(chunk)}
+                chunk = payload
+        nonce, data = encrypt_chunk(chunk, traffic_key(key, CLIENT_TO_SERVER))
+        return self.client.send_data_to_server(self.frame("file_chunk", index=index, nonce=nonce, data=data,
+                                                          epoch=epoch, **fields), record_key=key)
+
+    def on_frame(self, msg):
+        """Receiver thread: file_accept, file_ack or file_error for this transfer."""
+        try:
+            if msg["type"] == "file_accept":
+                resume_from = peer_int(msg, "resume_from", 0, self.total)
+            elif msg["type"] == "file_ack":
+                acked = peer_int(msg, "next", 0, self.total)
+        except ValueError as e:
+            log.warning("Ignoring malformed file frame", extra={"transfer": self.transfer_id, "error": e})
+            return
+        with self.cond:
+            if msg["type"] == "file_accept":
+                self.acked = resume_from
+            elif msg["type"] == "file_ack":
+                if acked == self.acked:
+                    self.duplicate_acks += 1
+                    if self.duplicate_acks == DUPLICATE_ACKS:
+                        self.fast_retransmit = True
+                elif acked > (self.acked or 0):
+                    self.duplicate_acks = 0
+                self.acked = max(self.acked or 0, acked)
+                if msg.get("done"):
+                    self.ok = bool(msg.get("ok"))
+            else:
+                self.error = msg.get("reason", "refused")
+            self.cond.notify_all()
+
+
+class FileReceiver:
+    """Writes incoming transfers for `client` into `directory`."""
+
+    def __init__(self, client, directory, on_file=None, accept=None):
+        self.client = client
+        self.directory = directory
+        self.on_file = on_file # on_file(sender, path, ok) once a transfer completes
+        self.accept = accept # accept(sender, name, size) -> bool for every offer; None accepts them all
+        self.transfers = {} # transfer_id -> state dict of the transfers in progress
+        os.makedirs(directory, exist_ok=True)
+
+    def reply(self, state, frame_type, **fields):
+        self.client.send_data_to_server({"type": frame_type, "from": self.client.name, "recipient": state["sender"],
+                                         "transfer_id": state["transfer_id"], **fields})
+
+    def on_frame(self, msg):
+        if msg["type"] == "file_offer":
+            self.on_offer(msg)
+        elif msg["type"] == "file_chunk":
+            self.on_chunk(msg)
+
+    def refuse(self, msg, reason):
+        self.client.send_data_to_server({"type": "file_error", "from": self.client.name, "recipient": msg.get("from"),
+                                         "transfer_id": msg.get("transfer_id"), "reason": reason})
+
+    @staticmethod
+    def parse_offer(msg):
+        """(transfer_id, sender, name, size, chunk_size, sha256) of an offer. ValueError if any field is bad."""
+        transfer_id, sender = peer_str(msg, "transfer_id"), peer_str(msg, "from")
+        name = os.path.basename(peer_str(msg, "name").replace('\\', '/')) # no directory part, whatever the sender's OS
+        if not name or name in ('.', '..'):
+            raise ValueError("invalid file name")
+        chunk_size = peer_int(msg, "chunk_size", 1, MAX_CHUNK_SIZE)
+        size = peer_int(msg, "size", 0, chunk_size * MAX_CHUNKS)
+        sha256 = peer_str(msg, "sha256")
+        if len(sha256) != 64 or any(c not in '0123456789abcdef' for c in sha256):
+            raise ValueError("Bad 'sha256' in file_offer frame")
+        return transfer_id, sender, name, size, chunk_size, sha256
+
+    def on_offer(self, msg):
+        try:
+            transfer_id, sender, name, size, chunk_size, sha256 = self.parse_offer(msg)
+        except ValueError as e:
+            log.warning("Malformed file offer", extra={"client": self.client.name, "sender": msg.get("from"), "error": e})
+            self.refuse(msg, "invalid file name" if str(e) == "invalid file name" else "malformed offer")
+            return
+        if self.accept and not self.accept(sender, name, size):
+            log.info("File offer refused", extra={"client": self.client.name, "sender": sender, "file": name})
+            self.refuse(msg, "refused")
+            return
+        path = self.free_path(name, transfer_id)
+        state = {
+            "transfer_id": transfer_id,
+            "sender": sender,
+            "path": path,
+            "size": size,
+            "chunk_size": chunk_size,
+            "sha256": sha256,
+            "next": 0,
+        }
+        state["total"] = chunk_count(size, chunk_size)
+
+        # A previous, interrupted run of the same transfer resumes from its last written chunk
+        try:
+            with open(path + '.part.json') as f:
+                saved = json.load(f)
+            if saved.get("transfer_id") == state["transfer_id"] and os.path.exists(path + '.part'):
+                state["next"] = peer_int(saved, "next", 0, state["total"])
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+        previous = self.transfers.pop(state["transfer_id"], None)
+        if previous:
+            previous["file"].close()
+        part = open(path + '.part', 'r+b' if state["next"] else 'w+b')
+        part.truncate(state["next"] * state["chunk_size"]) # drop anything written after the last ack
+        state["file"] = part
+        self.transfers[state["transfer_id"]] = state
+        self.save(state)
+
+        log.info("Receiving file", extra={"client": self.client.name, "sender": state["sender"],
+                                          "file": name, "size": state["size"], "chunk": state["next"]})
+        self.reply(state, "file_accept", resume_from=state["next"])
+        if state["next"] >= state["total"]:
+            self.finish(state)
+
+    def on_chunk(self, msg):
+        state = self.transfers.get(msg.get("transfer_id"))
+        if not state:
+            return
+        try:
+            index = peer_int(msg, "index", 0, state["total"] - 1)
+            if index == state["next"]:
+                key = self.client.key_for(msg.get("epoch", 0))
+                if not key:
+                    return
+                data = decrypt_chunk(msg, traffic_key(key, SERVER_TO_CLIENT), limit=state["chunk_size"])
+        except (ValueError, KeyError, TypeError) as e: # binascii.Error is a ValueError
+            log.warning("Malformed file chunk, transfer abandoned", extra={"client": self.client.name, "error": e})
+            self.abandon(state, "malformed chunk")
+            return
+        if index == state["next"]:
+            if msg.get("compressed"):
+                if not self.client.compressor:
+                    self.reply(state, "file_error", reason="compression was not negotiated")
+                    return
+                try:
+                    data = self.client.compressor.decompress(data, limit=state["chunk_size"])
+                except ValueError as e:
+                    log.warning("Dropping corrupt file chunk", extra={"client": self.client.name, "error": e})
+                    return
+            f = state["file"]
+            f.seek(index * state["chunk_size"])
+            f.write(data)
+            state["next"] += 1
+            if state["next"] >= state["total"]:
+                self.finish(state)
+                return
+            if state["next"] % SYNC_EVERY == 0:
+                self.sync(state)
+        # Duplicates and chunks past a gap are answered with the current cumulative ack
+        self.reply(state, "file_ack", next=state["next"])
+
+    def abandon(self, state, reason):
+        """Stops a transfer the sender broke. What is synced so far stays for a later offer to resume."""
+        state["file"].close()
+        del self.transfers[state["transfer_id"]]
+        self.reply(state, "file_error", reason=reason)
+
+    def free_path(self, name, transfer_id):
+        """Path a new transfer of name is written to: the first of name, "<stem> (1)<ext>", ...
+        that is neither an existing file nor the target of another transfer in progress.
+        """
+        stem, ext = os.path.splitext(name)
+        taken = {state["path"] for other, state in self.transfers.items() if other != transfer_id}
+        for n in itertools.count():
+            path = os.path.join(self.directory, name if n == 0 else f"{stem} ({n}){ext}")
+            if path not in taken and not os.path.exists(path):
+                return path
+
+    @staticmethod
+    def publish(part, path):
+        """Moves a finished part file to path, or to the next free "<stem> (n)<ext>" if a file
+        appeared there meanwhile. Returns where it went; never replaces an existing file.
+        """
+        stem, ext = os.path.splitext(path)
+        for n in itertools.count():
+            target = path if n == 0 else f"{stem} ({n}){ext}"
+            try:
+                os.link(part, target) # unlike os.replace, fails if target exists
+            except FileExistsError:
+                continue
+            os.remove(part)
+            return target
+
+    def sync(self, state):
+        """Forces the chunks written so far to disk, then records them as the point to resume from."""
+        f = state["file"]
+        f.flush()
+        os.fsync(f.fileno())
+        self.save(state)
+
+    def save(self, state):
+        """Records progress; only called once the chunks up to state['next'] are on disk."""
+        tmp = state["path"] + '.part.json.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({"transfer_id": state["transfer_id"], "next": state["next"]}, f)
+        os.replace(tmp, state["path"] + '.part.json')
+
+    def finish(self, state):
+        state["file"].flush()
+        os.fsync(state["file"].fileno())
+        state["file"].close()
+        del self.transfers[state["transfer_id"]]
+        ok = file_sha256(state["path"] + '.part') == state["sha256"]
+        if ok:
+            part = state["path"] + '.part'
+            state["path"] = self.publish(part, state["path"])
+            os.remove(part + '.json')
+            log.info("File received", extra={"client": self.client.name, "file": state["path"]})
+        else:
+            # Nothing worth resuming from, the next offer starts over
+            os.remove(state["path"] + '.part')
+            os.remove(state["path"] + '.part.json')
+            log.warning("File checksum mismatch", extra={"client": self.client.name, "file": state["path"]})
+        if self.on_file:
+            self.on_file(state["sender"], state["path"], ok)
+        self.reply(state, "file_ack", next=state["next"], done=True, ok=ok)
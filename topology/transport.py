@@ -0,0 +1,248 @@
+"""
+Transports: how client connections reach the server, selected by URL.
+
+    tcp://127.0.0.1:9000      TCP; port 0 picks a free port
+    unix:///tmp/p2p.sock      Unix domain socket: same host only, no TCP/IP stack on the path
+    mem://name                in-process pipe for tests and benchmarks: no sockets, no ports;
+                              mem:// with no name picks a fresh one
+
+listen(url) returns a listener with accept() -> (conn, addr), close() and the resolved url.
+connect(url) returns a connection. Every connection offers the part of the blocking socket API
+the server and client use: recv, recv_into, sendall, settimeout, shutdown and close. Frames,
+encryption and the handshake are the same on every transport.
+"""
+
+import collections
+import itertools
+import os
+import socket
+import stat
+import threading
+
+TCP = 'tcp'
+UNIX = 'unix'
+MEMORY = 'mem'
+SCHEMES = (TCP, UNIX, MEMORY)
+LISTEN_BACKLOG = 1024 # a reconnect storm waits here rather than being refused; capped by net.core.somaxconn
+MEMORY_BUFFER = 256 * 1024 # bytes buffered per direction of a memory pipe, like a socket's send buffer
+
+
+def parse_url(url):
+    """(scheme, address): (host, port) for tcp, a path for unix, a name for mem. Raises ValueError."""
+    scheme, sep, rest = url.partition('://')
+    if not sep or scheme not in SCHEMES:
+        raise ValueError(f"Unsupported transport URL: {url!r} (expected one of {', '.join(s + '://' for s in SCHEMES)})")
+    if scheme == TCP:
+        host, sep, port = rest.rpartition(':')
+        if not sep or not host or not port.isdigit():
+            raise ValueError(f"Expected tcp://host:port, got {url!r}")
+        return scheme, (host.strip('[]'), int(port))
+    if scheme == UNIX and not rest:
+        raise ValueError(f"Expected unix:///path, got {url!r}")
+    return scheme, rest
+
+
+def tcp_url(host, port):
+    return f"tcp://{host}:{port}"
+
+
+def listen(url, backlog=LISTEN_BACKLOG):
+    scheme, address = parse_url(url)
+    if scheme == MEMORY:
+        return MemoryListener(address)
+    if scheme == UNIX:
+        _remove_stale_socket(address)
+    sock = _stream_socket(scheme, address)
+    if scheme == TCP:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.bind(address)
+        sock.listen(backlog)
+    except OSError:
+        sock.close()
+        raise
+    return SocketListener(sock, scheme, address)
+
+
+def connect(url, timeout=None):
+    """Connects to a listener. timeout bounds the connect only; the connection is blocking afterwards."""
+    scheme, address = parse_url(url)
+    if scheme == MEMORY:
+        return MemoryListener.connect(address)
+    sock = _stream_socket(scheme, address)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(address)
+        sock.settimeout(None)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _stream_socket(scheme, address):
+    if scheme == UNIX:
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    return socket.socket(socket.AF_INET6 if ':' in address[0] else socket.AF_INET, socket.SOCK_STREAM)
+
+
+def _remove_stale_socket(path):
+    """A Unix socket file left by a server that did not shut down cleanly would make bind fail."""
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class SocketListener:
+    """Listening TCP or Unix domain socket."""
+
+    def __init__(self, sock, scheme, address):
+        self.sock = sock
+        self.scheme = scheme
+        if scheme == TCP:
+            self.port = sock.getsockname()[1]
+            self.url = tcp_url(address[0], self.port)
+        else:
+            self.port = None
+            self.url = f"unix://{address}"
+        self.path = address if scheme == UNIX else None
+
+    def accept(self):
+        return self.sock.accept()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR) # wakes up a thread blocked in accept
+        except OSError:
+            pass
+        self.sock.close()
+        if self.path:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+class MemoryPipe:
+    """One direction of a memory connection: a bounded byte buffer."""
+
+    def __init__(self, capacity=MEMORY_BUFFER):
+        self.buffer = bytearray()
+        self.capacity = capacity
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class MemoryConnection:
+    """Socket stand-in over two MemoryPipes. sendall blocks while the peer's buffer is full."""
+
+    def __init__(self, inbound, outbound, name):
+        self.inbound = inbound
+        self.outbound = outbound
+        self.name = name
+        self.timeout = None
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def recv(self, size):
+        pipe = self.inbound
+        with pipe.cond:
+            if not pipe.cond.wait_for(lambda: pipe.buffer or pipe.closed, self.timeout):
+                raise socket.timeout("timed out")
+            data = bytes(pipe.buffer[:size])
+            del pipe.buffer[:size]
+            pipe.cond.notify_all() # room for a blocked sender
+            return data
+
+    def recv_into(self, buffer, size=0):
+        data = self.recv(size or len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def sendall(self, data):
+        pipe = self.outbound
+        view = memoryview(data)
+        with pipe.cond:
+            while view:
+                if not pipe.cond.wait_for(lambda: pipe.closed or len(pipe.buffer) < pipe.capacity, self.timeout):
+                    raise socket.timeout("timed out")
+                if pipe.closed:
+                    raise BrokenPipeError(f"memory connection {self.name} closed")
+                room = pipe.capacity - len(pipe.buffer)
+                pipe.buffer += view[:room]
+                view = view[room:]
+                pipe.cond.notify_all()
+
+    def shutdown(self, how):
+        if how in (socket.SHUT_RD, socket.SHUT_RDWR):
+            self.inbound.close()
+        if how in (socket.SHUT_WR, socket.SHUT_RDWR):
+            self.outbound.close()
+
+    def close(self):
+        self.shutdown(socket.SHUT_RDWR)
+
+
+class MemoryListener:
+    """Named in-process listener; connect() hands the server side of a new pipe pair to accept()."""
+
+    registry = {}
+    registry_lock = threading.Lock()
+    anonymous = itertools.count(1)
+
+    def __init__(self, name):
+        with self.registry_lock:
+            if not name:
+                name = f"anon-{os.getpid()}-{next(self.anonymous)}"
+            if name in self.registry:
+                raise OSError(f"mem://{name} is already listening")
+            self.registry[name] = self
+        self.name = name
+        self.url = f"mem://{name}"
+        self.port = None
+        self.pending = collections.deque()
+        self.closed = False
+        self.cond = threading.Condition()
+        self.connections = itertools.count(1)
+
+    @classmethod
+    def connect(cls, name):
+        with cls.registry_lock:
+            listener = cls.registry.get(name)
+        if listener is None:
+            raise ConnectionRefusedError(f"nothing listens on mem://{name}")
+        to_server, to_client = MemoryPipe(), MemoryPipe()
+        with listener.cond:
+            if listener.closed:
+                raise ConnectionRefusedError(f"mem://{name} is closed")
+            peer = f"{name}#{next(listener.connections)}"
+            listener.pending.append(MemoryConnection(to_server, to_client, peer))
+            listener.cond.notify()
+        return MemoryConnection(to_client, to_server, peer)
+
+    def accept(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.pending or self.closed)
+            if self.closed:
+                raise OSError(f"{self.url} is closed")
+            conn = self.pending.popleft()
+            return conn, conn.name
+
+    def close(self):
+        with self.registry_lock:
+            if self.registry.get(self.name) is self:
+                del self.registry[self.name]
+        with self.cond:
+            self.closed = True
+            for conn in self.pending:
+                conn.close()
+            self.pending.clear()
+            self.cond.notify_all()